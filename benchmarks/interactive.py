@@ -0,0 +1,273 @@
+"""
+    this module is for measuring the latency of an interactive connection
+    next to saturating bulk ones through LsServer, with and without
+    the scheduler, run it from the repository root:
+
+        python -m benchmarks.interactive --bulk 8 --duration 5
+
+    The measured process runs LsServer only. This process runs the sinks
+    and the clients, which speak the lightsocks protocol to LsServer
+    directly, so no LsLocal shares the work.
+    The bulk sink sends as fast as it can to every bulk client,
+    the echo client sends a small message every interval
+    and waits for the echo, that round trip time is reported.
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import random
+import socket
+import sys
+import typing
+
+from lightsocks.core.cipher import Cipher
+from lightsocks.core.password import randomPassword
+from lightsocks.core.scheduler import Scheduler
+from lightsocks.server import LsServer
+from lightsocks.utils import net, socks
+
+BULK_CHUNK = 64 * 1024
+
+
+def percentile(values: typing.List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct))]
+
+
+def runServer(pipe, password: bytearray, schedule: bool):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    server = LsServer(
+        loop=loop,
+        password=password,
+        listenAddr=net.Address('127.0.0.1', 0),
+        scheduler=Scheduler(loop) if schedule else None)
+    server.bind()
+    pipe.send(server.listener.getsockname())
+
+    async def run():
+        asyncio.ensure_future(server.listen())
+        await loop.run_in_executor(None, pipe.recv)
+        server.stopAccepting()
+        await server.drain(1)
+
+    try:
+        loop.run_until_complete(run())
+    finally:
+        loop.close()
+
+
+class Driver:
+    """
+    Driver runs the sinks and the clients of one measurement.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop,
+                 serverAddr: net.Address, password: bytearray) -> None:
+        self.loop = loop
+        self.serverAddr = serverAddr
+        self.cipher = Cipher.NewCipher(password)
+        self.received = 0
+        self.rtts = []
+        self.starved = False
+        self.tasks = set()
+        self.sinks = []
+        self.conns = []
+
+    def spawn(self, coro):
+        task = asyncio.ensure_future(coro, loop=self.loop)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    def listen(self, handle: typing.Callable) -> net.Address:
+        sink = socket.socket()
+        sink.bind(('127.0.0.1', 0))
+        sink.listen(socket.SOMAXCONN)
+        sink.setblocking(False)
+        self.sinks.append(sink)
+
+        async def serve():
+            while True:
+                conn, _ = await self.loop.sock_accept(sink)
+                self.conns.append(conn)
+                self.spawn(handle(conn))
+
+        self.spawn(serve())
+        return net.Address(*sink.getsockname())
+
+    async def sendBulk(self, conn: socket.socket):
+        data = random.randbytes(BULK_CHUNK)
+        try:
+            while True:
+                await self.loop.sock_sendall(conn, data)
+                # sock_sendall does not yield while the socket is writable
+                await asyncio.sleep(0)
+        except OSError:
+            pass
+
+    async def echo(self, conn: socket.socket):
+        try:
+            while True:
+                data = await self.loop.sock_recv(conn, 1024)
+                if not data:
+                    break
+                await self.loop.sock_sendall(conn, data)
+        except OSError:
+            pass
+
+    async def open(self, dstAddr: net.Address) -> socket.socket:
+        """
+        Open a connection to the dstAddr through LsServer.
+        """
+        conn = socket.socket()
+        conn.setblocking(False)
+        self.conns.append(conn)
+        await self.loop.sock_connect(conn, self.serverAddr)
+        for msg, size in ((socks.GREETING, 2),
+                          (socks.packRequest(*dstAddr),
+                           len(socks.packReply()))):
+            msg = bytearray(msg)
+            self.cipher.encode(msg)
+            await self.loop.sock_sendall(conn, msg)
+            await self.recvExactly(conn, size)
+        return conn
+
+    async def recvExactly(self, conn: socket.socket, size: int) -> bytes:
+        buf = b''
+        while len(buf) < size:
+            data = await self.loop.sock_recv(conn, size - len(buf))
+            if not data:
+                raise ConnectionError('closed by LsServer')
+            buf += data
+        return buf
+
+    async def drainBulk(self, conn: socket.socket):
+        try:
+            while True:
+                data = await self.loop.sock_recv(conn, BULK_CHUNK)
+                if not data:
+                    break
+                self.received += len(data)
+                await asyncio.sleep(0)
+        except OSError:
+            pass
+
+    async def ping(self, conn: socket.socket, args: argparse.Namespace,
+                   until: float, warmup: float):
+        """
+        Ping until the time is up, or an echo does not come back
+        within the timeout, then the echo flow is starved.
+        """
+        msg = bytearray(random.randbytes(args.size))
+        self.cipher.encode(msg)
+        while self.loop.time() < until:
+            start = self.loop.time()
+            await self.loop.sock_sendall(conn, msg)
+            try:
+                await asyncio.wait_for(
+                    self.recvExactly(conn, args.size), args.timeout)
+            except asyncio.TimeoutError:
+                self.starved = True
+                self.rtts.append(args.timeout)
+                return
+            if start >= warmup:
+                self.rtts.append(self.loop.time() - start)
+            await asyncio.sleep(args.interval)
+
+    async def measure(self, args: argparse.Namespace) -> dict:
+        bulkAddr = self.listen(self.sendBulk)
+        echoAddr = self.listen(self.echo)
+        for _ in range(args.bulk):
+            self.spawn(self.drainBulk(await self.open(bulkAddr)))
+        echoConn = await self.open(echoAddr)
+
+        start = self.loop.time()
+        warmup = start + args.warmup
+        until = warmup + args.duration
+        await self.ping(echoConn, args, until, warmup)
+        received = self.received
+        elapsed = self.loop.time() - start
+
+        for task in list(self.tasks):
+            task.cancel()
+        await asyncio.sleep(0)
+        for conn in self.sinks + self.conns:
+            conn.close()
+        rtts = [rtt * 1000 for rtt in self.rtts]
+        return {
+            'pings': len(rtts),
+            'starved': self.starved,
+            'rttP50Ms': round(percentile(rtts, 0.5), 3),
+            'rttP99Ms': round(percentile(rtts, 0.99), 3),
+            'rttMaxMs': round(max(rtts, default=0.0), 3),
+            'bulkMBps': round(received / 1024 / 1024 / elapsed, 3),
+        }
+
+
+def measure(args: argparse.Namespace, password: bytearray,
+            schedule: bool) -> dict:
+    context = multiprocessing.get_context('spawn')
+    pipe, serverPipe = context.Pipe()
+    server = context.Process(
+        target=runServer, args=(serverPipe, password, schedule))
+    server.start()
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        serverAddr = net.Address(*pipe.recv())
+        driver = Driver(loop, serverAddr, password)
+        return loop.run_until_complete(driver.measure(args))
+    finally:
+        pipe.send('stop')
+        server.join(10)
+        if server.is_alive():
+            server.terminate()
+        loop.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Measure the interactive latency next to bulk flows')
+    parser.add_argument(
+        '--bulk', type=int, default=8,
+        help='bulk connections, default: 8')
+    parser.add_argument(
+        '--duration', metavar='SECONDS', type=float, default=5.0,
+        help='seconds to measure, default: 5')
+    parser.add_argument(
+        '--warmup', metavar='SECONDS', type=float, default=1.0,
+        help='seconds before measuring, default: 1')
+    parser.add_argument(
+        '--interval', metavar='SECONDS', type=float, default=0.01,
+        help='seconds between the pings, default: 0.01')
+    parser.add_argument(
+        '--size', metavar='BYTES', type=int, default=64,
+        help='bytes of every ping, default: 64')
+    parser.add_argument(
+        '--timeout', metavar='SECONDS', type=float, default=2.0,
+        help='seconds to wait for an echo, default: 2')
+    parser.add_argument(
+        '--seed', type=int, default=0, help='random seed, default: 0')
+    parser.add_argument(
+        '--json', metavar='FILE', help='path to dump the report')
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    password = randomPassword()
+    result = {'python': sys.version.split()[0], 'bulk': args.bulk}
+    for name, schedule in (('fifo', False), ('scheduled', True)):
+        result[name] = measure(args, password, schedule)
+        print('%-9s rtt p50 %.3fms p99 %.3fms max %.3fms, bulk %.1f MB/s%s' %
+              (name, result[name]['rttP50Ms'], result[name]['rttP99Ms'],
+               result[name]['rttMaxMs'], result[name]['bulkMBps'],
+               ', starved' if result[name]['starved'] else ''))
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
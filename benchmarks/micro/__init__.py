@@ -0,0 +1,18 @@
+"""
+    this package is for timing the hot paths of one connection
+    in the process, run it from the repository root:
+
+        python -m benchmarks.micro run --save
+        python -m benchmarks.micro run --json new.json
+        python -m benchmarks.micro compare new.json
+
+    Every case is timed with timeit and perf_counter_ns,
+    its loops are calibrated to take at least minTime,
+    and repeated, the median of the nanoseconds per call is compared.
+    The baselines are kept per Python version in baselines/,
+    compare flags the cases that are slower than the baseline
+    by more than the threshold, and exits with 1 if there are any.
+    A baseline is only as good as the machine it was saved on,
+    save it where the spread of every case is within NOISE,
+    compare exits with 2 when there is no baseline.
+"""
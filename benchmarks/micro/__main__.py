@@ -0,0 +1,179 @@
+"""
+    this module is for running the micro benchmarks and comparing
+    them with the baseline, see benchmarks.micro.
+"""
+import argparse
+import fnmatch
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+import timeit
+import typing
+
+from benchmarks.micro.cases import allCases
+
+BASELINES = os.path.join(os.path.dirname(__file__), 'baselines')
+REPEAT = 7
+MIN_TIME = 0.1
+THRESHOLD = 0.1
+# the spread of a case relative to its median, a baseline with more
+# hides the regressions below it
+NOISE = 0.05
+
+
+def baselinePath() -> str:
+    return os.path.join(BASELINES,
+                        'py%d.%d.json' % sys.version_info[:2])
+
+
+def measure(func: typing.Callable, repeat: int, minTime: float) -> dict:
+    """
+    Time the func in repeat rounds of at least minTime each,
+    return the statistics of the nanoseconds per call.
+    """
+    number = 1
+    while timeit.Timer(func).timeit(number) < minTime:
+        number *= 2
+    rounds = timeit.Timer(
+        func, timer=time.perf_counter_ns).repeat(repeat, number)
+    perCall = [total / number for total in rounds]
+    quartiles = statistics.quantiles(perCall, n=4) if len(perCall) > 1 \
+        else perCall * 3
+    return {
+        'loops': number,
+        'minNs': round(min(perCall), 1),
+        'medianNs': round(statistics.median(perCall), 1),
+        'meanNs': round(statistics.mean(perCall), 1),
+        'stdevNs': round(statistics.stdev(perCall), 1)
+        if len(perCall) > 1 else 0.0,
+        'iqrNs': round(quartiles[2] - quartiles[0], 1),
+    }
+
+
+def run(args: argparse.Namespace) -> dict:
+    results = {}
+    for name, setup in allCases():
+        if args.filter and not any(
+                fnmatch.fnmatch(name, pattern) for pattern in args.filter):
+            continue
+        results[name] = measure(setup(), args.repeat, args.min_time)
+        print('%-32s %14.1f ns  +- %.1f%%' %
+              (name, results[name]['medianNs'], 100 * results[name]['iqrNs'] /
+               max(results[name]['medianNs'], 1e-9)))
+    report = {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'machine': platform.machine(),
+        'processor': platform.processor(),
+        'time': int(time.time()),
+        'cases': results,
+    }
+    path = args.json or (baselinePath() if args.save else None)
+    if path:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+        print('saved to %s' % path)
+    noisy = [
+        name for name, result in sorted(results.items())
+        if result['iqrNs'] > NOISE * result['medianNs']
+    ]
+    if args.save and noisy:
+        print('the spread of %s is over %d%% of the median, '
+              'save the baseline on a quiet machine' %
+              (', '.join(noisy), 100 * NOISE))
+    return report
+
+
+def compare(baseline: dict, current: dict, threshold: float) -> int:
+    """
+    Print the ratio of the medians of every case,
+    return the number of the cases that are slower beyond the threshold
+    and beyond their noise.
+    """
+    regressions = 0
+    for name, new in sorted(current['cases'].items()):
+        old = baseline['cases'].get(name)
+        if old is None:
+            print('%-32s %14.1f ns  new' % (name, new['medianNs']))
+            continue
+        ratio = new['medianNs'] / max(old['medianNs'], 1e-9)
+        # the spread of both runs, relative to the baseline
+        noise = (old['iqrNs'] + new['iqrNs']) / max(old['medianNs'], 1e-9)
+        mark = ''
+        if ratio > 1 + max(threshold, noise):
+            mark = 'REGRESSION'
+            regressions += 1
+        elif ratio < 1 - max(threshold, noise):
+            mark = 'faster'
+        print('%-32s %14.1f -> %14.1f ns  x%.3f %s' %
+              (name, old['medianNs'], new['medianNs'], ratio, mark))
+    if baseline.get('python') != current.get('python'):
+        print('the baseline is of Python %s, this is %s' %
+              (baseline.get('python'), current.get('python')))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Time the hot paths of one connection')
+    commands = parser.add_subparsers(dest='command', required=True)
+    runParser = commands.add_parser('run', help='run the cases')
+    runParser.add_argument(
+        '--save', action='store_true',
+        help='save the results as the baseline of this Python version')
+    runParser.add_argument(
+        '--json', metavar='FILE', help='path to dump the results')
+    compareParser = commands.add_parser(
+        'compare', help='compare the results with the baseline')
+    compareParser.add_argument(
+        'current', nargs='?',
+        help='results of run --json, default: run the cases now')
+    compareParser.add_argument(
+        '--baseline', metavar='FILE',
+        help='default: the baseline of this Python version')
+    compareParser.add_argument(
+        '--threshold', type=float, default=THRESHOLD,
+        help='slowdown to flag when it is beyond the noise too, '
+        'default: %s' % THRESHOLD)
+    for sub in (runParser, compareParser):
+        sub.add_argument(
+            '--filter', metavar='PATTERN', action='append',
+            help='run the cases that match the glob pattern only')
+        sub.add_argument(
+            '--repeat', type=int, default=REPEAT,
+            help='rounds of every case, default: %d' % REPEAT)
+        sub.add_argument(
+            '--min-time', metavar='SECONDS', type=float, default=MIN_TIME,
+            help='seconds of every round at least, default: %s' % MIN_TIME)
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        run(args)
+        return
+
+    path = args.baseline or baselinePath()
+    if not os.path.exists(path):
+        print('no baseline at %s, save one with run --save '
+              'on a quiet machine' % path)
+        sys.exit(2)
+    with open(path, encoding='utf-8') as f:
+        baseline = json.load(f)
+    if args.current:
+        with open(args.current, encoding='utf-8') as f:
+            current = json.load(f)
+    else:
+        args.json = None
+        args.save = False
+        current = run(args)
+    regressions = compare(baseline, current, args.threshold)
+    if regressions:
+        print('%d regressions' % regressions)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+"""
+    this module is for the cases of the micro benchmarks,
+    every case is a name and a function that makes the callable to time.
+"""
+import asyncio
+import os
+import typing
+
+from lightsocks.core import session, transport
+from lightsocks.core.cipher import Cipher
+from lightsocks.core.password import (dumpsPassword, loadsPassword,
+                                      randomPassword, validatePassword)
+from lightsocks.server import LsServer
+from lightsocks.utils import net, socks, tracing
+
+CHUNK_SIZES = (64, 512, 4 * 1024, 64 * 1024, 1024 * 1024)
+
+Case = typing.Tuple[str, typing.Callable[[], typing.Callable]]
+
+
+def cipherCases() -> typing.List[Case]:
+    cases = []
+    for size in CHUNK_SIZES:
+        for name in ('encode', 'decode'):
+
+            def setup(name=name, size=size):
+                cipher = Cipher.NewCipher(randomPassword())
+                data = bytearray(size)
+                method = getattr(cipher, name)
+                return lambda: method(data)
+
+            cases.append(('cipher.%s.%d' % (name, size), setup))
+
+    def newCipher():
+        password = randomPassword()
+        return lambda: Cipher.NewCipher(password)
+
+    cases.append(('cipher.NewCipher', newCipher))
+    return cases
+
+
+def passwordCases() -> typing.List[Case]:
+    password = randomPassword()
+    text = dumpsPassword(password)
+    return [
+        ('password.loads', lambda: lambda: loadsPassword(text)),
+        ('password.dumps', lambda: lambda: dumpsPassword(password)),
+        ('password.validate', lambda: lambda: validatePassword(password)),
+    ]
+
+
+def parseCases() -> typing.List[Case]:
+    """
+    The parsing of the first data of a tunnel in LsServer.handleConn:
+    the trace id, the session header and the SOCKS request.
+    """
+    cases = []
+    for name, host in (('ipv4', '93.184.216.34'), ('domain', 'example.com'),
+                       ('ipv6', '2606:2800:220:1:248:1893:25c8:1946')):
+        buf = bytes(socks.packRequest(host, 443))
+        cases.append(('socks.parseRequest.%s' % name,
+                      lambda buf=buf: lambda: socks.parseRequest(buf)))
+
+    first = (tracing.packTraceId(os.urandom(tracing.ID_SIZE).hex()) +
+             session.packNew(session.newSessionId()) + socks.GREETING)
+
+    def prelude():
+        _, buf = tracing.unpackTraceId(first)
+        return session.unpackHeader(buf)
+
+    cases.append(('server.prelude', lambda: prelude))
+    return cases
+
+
+def handshake() -> typing.Callable:
+    """
+    One connection through LsServer.handleConn on a MemoryLoop,
+    from the method selection to the reply, then closed.
+    """
+    loop = transport.MemoryLoop()
+    password = randomPassword()
+    cipher = Cipher.NewCipher(password)
+    server = LsServer(
+        loop=loop, password=password, listenAddr=net.Address('10.0.0.1', 0))
+    front = transport.createSocket(loop)
+    front.bind(('10.0.0.1', 1080))
+    front.listen()
+    listener = transport.createSocket(loop)
+    listener.bind(('10.0.0.2', 80))
+    listener.listen()
+
+    def encoded(data: bytes) -> bytearray:
+        data = bytearray(data)
+        cipher.encode(data)
+        return data
+
+    greeting = encoded(socks.GREETING)
+    request = encoded(socks.packRequest('10.0.0.2', 80))
+    replySize = len(socks.packReply())
+
+    async def connect():
+        conn = transport.createSocket(loop)
+        await loop.sock_connect(conn, front.getsockname())
+        accepted, _ = await loop.sock_accept(front)
+        handling = asyncio.ensure_future(server.handleConn(accepted))
+        await loop.sock_sendall(conn, greeting)
+        await loop.sock_recv(conn, 2)
+        await loop.sock_sendall(conn, request)
+        await loop.sock_recv(conn, replySize)
+        dst, _ = await loop.sock_accept(listener)
+        dst.close()
+        conn.close()
+        await handling
+
+    return lambda: loop.run_until_complete(connect())
+
+
+def allCases() -> typing.List[Case]:
+    return cipherCases() + passwordCases() + parseCases() + [
+        ('server.handshake', handshake)
+    ]
@@ -0,0 +1,290 @@
+"""
+    this module is for replaying the traffic recorded by
+    `lsserver --record FILE` against a local sink, run it from
+    the repository root:
+
+        python -m benchmarks.replay traffic.lsrc --speed 10
+
+    Every recorded connection is opened at its recorded start time
+    through LsLocal and LsServer to the sink. The client sends the
+    recorded upstream chunks, and the sink sends the downstream ones,
+    both at their recorded offsets divided by the speed.
+    The payload is replayed if it has been recorded, or filled in.
+
+    By default LsLocal and LsServer run in this process,
+    --local sends the connections to a running lslocal instead,
+    its lsserver must reach the sink on 127.0.0.1:--sink-port.
+"""
+import argparse
+import asyncio
+import json
+import random
+import socket
+import struct
+import sys
+import time
+import typing
+
+from lightsocks.core.password import randomPassword
+from lightsocks.local import LsLocal
+from lightsocks.server import LsServer
+from lightsocks.utils import net, socks
+from lightsocks.utils.recorder import DOWN, UP, Conn, loadLog
+
+INDEX = struct.Struct('<I')
+FILLER_SIZE = 64 * 1024
+
+
+def percentile(values: typing.List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct))]
+
+
+class Replayer:
+    """
+    Replayer plays the connections of a log,
+    the sink finds the connection by the index the client sends first.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop,
+                 conns: typing.List[Conn], localAddr: net.Address,
+                 sink: socket.socket, speed: float, seed: int) -> None:
+        self.loop = loop
+        self.conns = conns
+        self.localAddr = localAddr
+        self.sink = sink
+        self.speed = speed
+        rand = random.Random(seed)
+        self.filler = bytes(rand.getrandbits(8) for _ in range(FILLER_SIZE))
+        self.results = []
+        self.failed = 0
+        self.tasks = set()
+
+    def spawn(self, coro):
+        task = asyncio.ensure_future(coro, loop=self.loop)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def sleepUntil(self, start: float, offset: int):
+        if self.speed <= 0:
+            return
+        delay = start + offset / 1e6 / self.speed - self.loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def send(self, conn: socket.socket, event):
+        if event.payload is not None:
+            await self.loop.sock_sendall(conn, event.payload)
+            return
+        size = event.size
+        while size > 0:
+            n = min(size, FILLER_SIZE)
+            await self.loop.sock_sendall(conn, self.filler[:n])
+            size -= n
+
+    async def drain(self, conn: socket.socket) -> int:
+        received = 0
+        while True:
+            data = await self.loop.sock_recv(conn, FILLER_SIZE)
+            if not data:
+                return received
+            received += len(data)
+
+    async def serveSink(self):
+        while True:
+            conn, _ = await self.loop.sock_accept(self.sink)
+            self.spawn(self.playDown(conn))
+
+    async def playDown(self, conn: socket.socket):
+        start = self.loop.time()
+        with conn:
+            buf = b''
+            while len(buf) < INDEX.size:
+                data = await self.loop.sock_recv(conn, INDEX.size - len(buf))
+                if not data:
+                    return
+                buf += data
+            record = self.conns[INDEX.unpack(buf)[0]]
+            draining = asyncio.ensure_future(self.drain(conn), loop=self.loop)
+            try:
+                for event in record.events:
+                    if event.direction == DOWN:
+                        await self.sleepUntil(start,
+                                              event.offset - record.connect)
+                        await self.send(conn, event)
+                conn.shutdown(socket.SHUT_WR)
+                await draining
+            except OSError:
+                draining.cancel()
+
+    async def playUp(self, index: int, record: Conn):
+        client = socket.socket()
+        client.setblocking(False)
+        begin = self.loop.time()
+        try:
+            await self.loop.sock_connect(client, self.localAddr)
+            await self.loop.sock_sendall(client, socks.GREETING)
+            await self.loop.sock_recv(client, 1024)
+            await self.loop.sock_sendall(
+                client, socks.packRequest(*self.sink.getsockname()))
+            reply = await self.loop.sock_recv(client, 1024)
+            if reply != socks.packReply():
+                raise ConnectionError('replay %d refused' % index)
+            setup = self.loop.time() - begin
+            await self.loop.sock_sendall(client, INDEX.pack(index))
+
+            draining = asyncio.ensure_future(
+                self.drain(client), loop=self.loop)
+            start = self.loop.time()
+            for event in record.events:
+                if event.direction == UP:
+                    await self.sleepUntil(start,
+                                          event.offset - record.connect)
+                    await self.send(client, event)
+            client.shutdown(socket.SHUT_WR)
+            received = await draining
+        except OSError:
+            self.failed += 1
+            return
+        finally:
+            client.close()
+
+        duration = self.loop.time() - begin
+        self.results.append({
+            'setup': setup,
+            'duration': duration,
+            'recorded': record.duration / 1e6,
+            'received': received,
+        })
+
+    async def run(self) -> float:
+        self.spawn(self.serveSink())
+        starts = [record.start for record in self.conns]
+        first = min(starts, default=0.0)
+        begin = self.loop.time()
+        playing = []
+        for index, record in sorted(
+                enumerate(self.conns), key=lambda item: item[1].start):
+            if self.speed > 0:
+                delay = begin + (record.start - first) / self.speed - \
+                    self.loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            playing.append(
+                asyncio.ensure_future(
+                    self.playUp(index, record), loop=self.loop))
+        await asyncio.gather(*playing)
+        elapsed = self.loop.time() - begin
+        for task in list(self.tasks):
+            task.cancel()
+        return elapsed
+
+
+def report(replayer: Replayer, elapsed: float, speed: float) -> dict:
+    results = replayer.results
+    setups = [result['setup'] * 1000 for result in results]
+    # how much longer a connection took than recorded, at the same speed
+    stretches = [
+        result['duration'] * max(speed, 1e-9) / result['recorded']
+        for result in results if result['recorded'] > 0 and speed > 0
+    ]
+    received = sum(result['received'] for result in results)
+    return {
+        'python': sys.version.split()[0],
+        'connections': len(results),
+        'failed': replayer.failed,
+        'seconds': round(elapsed, 3),
+        'downBytes': received,
+        'downMBps': round(received / 1024 / 1024 / max(elapsed, 1e-9), 3),
+        'setupP50Ms': round(percentile(setups, 0.5), 3),
+        'setupP99Ms': round(percentile(setups, 0.99), 3),
+        'stretchP50': round(percentile(stretches, 0.5), 3),
+        'stretchP99': round(percentile(stretches, 0.99), 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Replay the traffic recorded by lsserver --record')
+    parser.add_argument('log', help='path to the recorded log')
+    parser.add_argument(
+        '--speed', type=float, default=1.0,
+        help='how many times faster to replay, 0 for no waiting, '
+        'default: 1')
+    parser.add_argument(
+        '--limit', type=int, help='replay the first N connections only')
+    parser.add_argument(
+        '--local', metavar='HOST:PORT',
+        help='replay through a running lslocal')
+    parser.add_argument(
+        '--sink-port', type=int, default=0,
+        help='port of the sink, default: a random one')
+    parser.add_argument(
+        '--seed', type=int, default=0, help='random seed, default: 0')
+    parser.add_argument(
+        '--json', metavar='FILE', help='path to dump the report')
+    args = parser.parse_args()
+
+    conns = loadLog(args.log)
+    if args.limit is not None:
+        conns = conns[:args.limit]
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    sink = socket.socket()
+    sink.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sink.bind(('127.0.0.1', args.sink_port))
+    sink.listen(socket.SOMAXCONN)
+    sink.setblocking(False)
+
+    services = []
+    if args.local:
+        host, _, port = args.local.rpartition(':')
+        localAddr = net.Address(host, int(port))
+    else:
+        random.seed(args.seed)
+        password = randomPassword()
+        server = LsServer(
+            loop=loop,
+            password=password,
+            listenAddr=net.Address('127.0.0.1', 0))
+        server.bind()
+        local = LsLocal(
+            loop=loop,
+            password=password,
+            listenAddr=net.Address('127.0.0.1', 0),
+            remoteAddr=net.Address(*server.listener.getsockname()))
+        local.bind()
+        services = [server, local]
+        for service in services:
+            asyncio.ensure_future(service.listen(), loop=loop)
+        localAddr = net.Address(*local.listener.getsockname())
+
+    replayer = Replayer(loop, conns, localAddr, sink, args.speed, args.seed)
+    start = time.perf_counter()
+    try:
+        elapsed = loop.run_until_complete(replayer.run())
+        for service in services:
+            service.stopAccepting()
+            loop.run_until_complete(service.drain(1))
+    finally:
+        sink.close()
+        loop.close()
+
+    result = report(replayer, elapsed, args.speed)
+    print('replayed %d connections (%d failed) in %.3fs, wall %.3fs' %
+          (result['connections'], result['failed'], result['seconds'],
+           time.perf_counter() - start))
+    print('setup p50 %.3fms p99 %.3fms, stretch p50 %.3f p99 %.3f, '
+          '%.3f MB/s down' %
+          (result['setupP50Ms'], result['setupP99Ms'], result['stretchP50'],
+           result['stretchP99'], result['downMBps']))
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,437 @@
+"""
+    this module is for measuring how many connections one LsServer
+    process can hold, run it from the repository root:
+
+        python -m benchmarks.soak --connections 20000 --step 2000
+
+    The measured process runs LsServer only.
+    A driver process runs the sink, LsLocal and the SOCKS5 clients,
+    so the numbers are not mixed with the cost of the clients.
+    The driver needs 4 fds for every connection, the server 2.
+    Everything is on loopback, and the same seed gives the same run.
+
+    The connections ramp up in steps, after every step the server holds
+    them for a while, then RSS, the tracemalloc total, the tasks, the fds
+    and the event-loop lag are recorded.
+    It stops at the first step that fails to open connections,
+    or whose loop lag goes over the budget.
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import resource
+import socket
+import sys
+import time
+import tracemalloc
+import typing
+
+from lightsocks.core.password import randomPassword
+from lightsocks.local import LsLocal
+from lightsocks.server import LsServer
+from lightsocks.utils import net, socks
+
+OPEN_CONCURRENCY = 256
+LAG_INTERVAL = 0.01
+
+
+def raiseFileLimit() -> int:
+    """
+    Raise the soft limit of the fds to the hard limit.
+    """
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY:
+        hard = 1 << 20
+    if soft != resource.RLIM_INFINITY and soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+            soft = hard
+        except (ValueError, OSError):
+            pass
+    return soft
+
+
+def rssBytes() -> int:
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        # the peak instead of the current RSS, ru_maxrss is in KB on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def fdCount() -> typing.Optional[int]:
+    try:
+        return len(os.listdir('/proc/self/fd'))
+    except OSError:
+        return None
+
+
+def percentile(values: typing.List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct))]
+
+
+async def measureLag(loop: asyncio.AbstractEventLoop,
+                     duration: float) -> typing.List[float]:
+    """
+    Sleep LAG_INTERVAL again and again, the oversleep is the loop lag.
+    """
+    lags = []
+    deadline = loop.time() + duration
+    while loop.time() < deadline:
+        start = loop.time()
+        await asyncio.sleep(LAG_INTERVAL)
+        lags.append(max(0.0, loop.time() - start - LAG_INTERVAL))
+    return lags
+
+
+class Driver:
+    """
+    Driver opens the SOCKS5 sessions through LsLocal to the sink,
+    a seeded part of them keeps sending the payload, the rest are idle.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop,
+                 serverAddr: net.Address, password: bytearray,
+                 payload: int, active: float, interval: float,
+                 seed: int) -> None:
+        self.loop = loop
+        self.random = random.Random(seed)
+        self.payload = bytes(self.random.getrandbits(8)
+                             for _ in range(payload))
+        self.active = active
+        self.interval = interval
+        self.clients = []
+        self.tasks = set()
+        self.chats = set()
+
+        self.sink = socket.socket()
+        self.sink.bind(('127.0.0.1', 0))
+        self.sink.listen(socket.SOMAXCONN)
+        self.sink.setblocking(False)
+        self.local = LsLocal(
+            loop=loop,
+            password=password,
+            listenAddr=net.Address('127.0.0.1', 0),
+            remoteAddr=serverAddr)
+        self.local.bind()
+
+    def spawn(self, coro, tasks: set=None):
+        if tasks is None:
+            tasks = self.tasks
+        task = asyncio.ensure_future(coro, loop=self.loop)
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+    async def serveSink(self):
+        while True:
+            try:
+                conn, _ = await self.loop.sock_accept(self.sink)
+            except OSError:
+                # out of fds, the driver is the limit now
+                await asyncio.sleep(LAG_INTERVAL)
+                continue
+            self.spawn(self.echo(conn))
+
+    async def echo(self, conn: socket.socket):
+        with conn:
+            while True:
+                data = await self.loop.sock_recv(conn, 65536)
+                if not data:
+                    break
+                await self.loop.sock_sendall(conn, data)
+
+    async def openOne(self) -> typing.Optional[socket.socket]:
+        client = socket.socket()
+        client.setblocking(False)
+        try:
+            await self.loop.sock_connect(client,
+                                         self.local.listener.getsockname())
+            await self.loop.sock_sendall(client, socks.GREETING)
+            await self.loop.sock_recv(client, 1024)
+            await self.loop.sock_sendall(
+                client,
+                socks.packRequest(*self.sink.getsockname()))
+            reply = await self.loop.sock_recv(client, 1024)
+        except OSError:
+            client.close()
+            return None
+        if reply != socks.packReply():
+            client.close()
+            return None
+        return client
+
+    async def chat(self, client: socket.socket, delay: float):
+        await asyncio.sleep(delay)
+        while True:
+            await self.loop.sock_sendall(client, self.payload)
+            received = 0
+            while received < len(self.payload):
+                data = await self.loop.sock_recv(client, 65536)
+                if not data:
+                    return
+                received += len(data)
+            await asyncio.sleep(self.interval)
+
+    async def ramp(self, target: int) -> dict:
+        semaphore = asyncio.Semaphore(OPEN_CONCURRENCY)
+
+        async def openLimited():
+            async with semaphore:
+                return await self.openOne()
+
+        start = time.perf_counter()
+        count = max(0, target - len(self.clients))
+        results = await asyncio.gather(
+            *(openLimited() for _ in range(count)))
+        failed = 0
+        for client in results:
+            if client is None:
+                failed += 1
+                continue
+            self.clients.append(client)
+            if self.random.random() < self.active:
+                self.spawn(
+                    self.chat(client, self.random.random() * self.interval),
+                    self.chats)
+        return {
+            'opened': len(self.clients),
+            'failed': failed,
+            'seconds': time.perf_counter() - start,
+        }
+
+    async def close(self):
+        for task in list(self.chats):
+            task.cancel()
+        await asyncio.sleep(0)
+        for client in self.clients:
+            client.close()
+        self.local.stopAccepting()
+        await self.local.drain(10)
+        for task in list(self.tasks):
+            task.cancel()
+        self.sink.close()
+
+
+def runDriver(pipe, serverAddr: net.Address, password: bytearray,
+              payload: int, active: float, interval: float, seed: int):
+    raiseFileLimit()
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    driver = Driver(loop, serverAddr, password, payload, active, interval,
+                    seed)
+
+    async def run():
+        driver.spawn(driver.serveSink())
+        driver.spawn(driver.local.listen())
+        while True:
+            command = await loop.run_in_executor(None, pipe.recv)
+            if command[0] == 'stop':
+                await driver.close()
+                pipe.send({'closed': len(driver.clients)})
+                break
+            pipe.send(await driver.ramp(command[1]))
+
+    try:
+        loop.run_until_complete(run())
+    finally:
+        loop.close()
+
+
+def sample(loop: asyncio.AbstractEventLoop, server: LsServer,
+           lags: typing.List[float]) -> dict:
+    heap = None
+    if tracemalloc.is_tracing():
+        heap = tracemalloc.get_traced_memory()[0]
+    return {
+        'connections': len(server.connections),
+        'rss': rssBytes(),
+        'heap': heap,
+        'tasks': len(asyncio.all_tasks(loop)),
+        'fds': fdCount(),
+        'lagP99Ms': round(percentile(lags, 0.99) * 1000, 3),
+        'lagMaxMs': round(max(lags, default=0.0) * 1000, 3),
+    }
+
+
+def perConn(step: dict, baseline: dict, key: str) -> typing.Optional[int]:
+    connections = step['connections'] - baseline['connections']
+    if step[key] is None or connections <= 0:
+        return None
+    return (step[key] - baseline[key]) // connections
+
+
+async def soak(loop: asyncio.AbstractEventLoop, server: LsServer, pipe,
+               args: argparse.Namespace) -> dict:
+    async def call(*command):
+        pipe.send(command)
+        return await loop.run_in_executor(None, pipe.recv)
+
+    asyncio.ensure_future(server.listen(), loop=loop)
+    baseline = sample(loop, server, await measureLag(loop, args.hold))
+    steps = []
+    stopped = None
+    target = 0
+    while target < args.connections:
+        target = min(args.connections, target + args.step)
+        ramp = await call('ramp', target)
+        # wait for the server side of the new connections
+        deadline = loop.time() + args.hold
+        while (len(server.connections) < ramp['opened'] and
+               loop.time() < deadline):
+            await asyncio.sleep(LAG_INTERVAL)
+
+        step = sample(loop, server, await measureLag(loop, args.hold))
+        step.update(
+            target=target,
+            failed=ramp['failed'],
+            rampSeconds=round(ramp['seconds'], 3),
+            rssPerConn=perConn(step, baseline, 'rss'),
+            heapPerConn=perConn(step, baseline, 'heap'))
+        steps.append(step)
+        printStep(step)
+
+        if ramp['failed']:
+            stopped = 'failed to open %d connections' % ramp['failed']
+            break
+        if step['lagP99Ms'] > args.lag_budget:
+            stopped = 'loop lag p99 %.1fms over the budget' % step['lagP99Ms']
+            break
+
+    await call('stop')
+    server.stopAccepting()
+    await server.drain(10)
+    return report(args, baseline, steps, stopped)
+
+
+def report(args: argparse.Namespace, baseline: dict,
+           steps: typing.List[dict], stopped: typing.Optional[str]) -> dict:
+    stable = [step for step in steps
+              if not step['failed'] and step['lagP99Ms'] <= args.lag_budget]
+    capacity = {
+        'connections': stable[-1]['connections'] if stable else 0,
+        'stoppedBy': stopped,
+        'rssPerConn': stable[-1]['rssPerConn'] if stable else None,
+        'heapPerConn': stable[-1]['heapPerConn'] if stable else None,
+        'projected': None,
+    }
+    if capacity['rssPerConn'] and args.memory:
+        budget = args.memory * 1024 * 1024 - baseline['rss']
+        capacity['projected'] = max(0, budget // capacity['rssPerConn'])
+    return {
+        'python': sys.version.split()[0],
+        'params': {
+            'connections': args.connections,
+            'step': args.step,
+            'hold': args.hold,
+            'active': args.active,
+            'payload': args.payload,
+            'interval': args.interval,
+            'seed': args.seed,
+            'tracemalloc': args.tracemalloc,
+        },
+        'fileLimit': raiseFileLimit(),
+        'baseline': baseline,
+        'steps': steps,
+        'capacity': capacity,
+    }
+
+
+def printStep(step: dict):
+    print('%8d conns %9.1f MB rss %8s B/conn %6d tasks %8s fds '
+          '%8.2f ms lag p99' %
+          (step['connections'], step['rss'] / 1024 / 1024,
+           step['rssPerConn'], step['tasks'], step['fds'],
+           step['lagP99Ms']))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Soak LsServer with many concurrent connections')
+    parser.add_argument(
+        '--connections', type=int, default=10000,
+        help='connections to open at most, default: 10000')
+    parser.add_argument(
+        '--step', type=int, default=1000,
+        help='connections to open in every step, default: 1000')
+    parser.add_argument(
+        '--hold', metavar='SECONDS', type=float, default=2.0,
+        help='seconds to hold the connections after every step, '
+        'default: 2')
+    parser.add_argument(
+        '--active', metavar='FRACTION', type=float, default=0.1,
+        help='the fraction of the connections that keep sending, '
+        'default: 0.1')
+    parser.add_argument(
+        '--payload', metavar='BYTES', type=int, default=1024,
+        help='bytes the active connections send each time, default: 1024')
+    parser.add_argument(
+        '--interval', metavar='SECONDS', type=float, default=1.0,
+        help='seconds between the sends of an active connection, '
+        'default: 1')
+    parser.add_argument(
+        '--lag-budget', metavar='MS', type=float, default=100.0,
+        help='stop when the loop lag p99 is over it, default: 100')
+    parser.add_argument(
+        '--memory', metavar='MB', type=int,
+        help='project the connections that fit in the memory')
+    parser.add_argument(
+        '--tracemalloc', action='store_true', default=False,
+        help='record the python heap, it slows the server down')
+    parser.add_argument(
+        '--seed', type=int, default=0, help='random seed, default: 0')
+    parser.add_argument(
+        '--json', metavar='FILE', help='path to dump the report')
+    args = parser.parse_args()
+
+    print('fd limit %d' % raiseFileLimit())
+    random.seed(args.seed)
+    password = randomPassword()
+    if args.tracemalloc:
+        tracemalloc.start()
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    server = LsServer(
+        loop=loop, password=password, listenAddr=net.Address('127.0.0.1', 0))
+    server.bind()
+
+    context = multiprocessing.get_context('spawn')
+    pipe, driverPipe = context.Pipe()
+    driver = context.Process(
+        target=runDriver,
+        args=(driverPipe, net.Address(*server.listener.getsockname()),
+              password, args.payload, args.active, args.interval,
+              args.seed))
+    driver.start()
+    try:
+        result = loop.run_until_complete(soak(loop, server, pipe, args))
+    finally:
+        driver.join(10)
+        if driver.is_alive():
+            driver.terminate()
+        loop.close()
+
+    capacity = result['capacity']
+    print('\ncapacity: %d connections, %s B rss/conn' %
+          (capacity['connections'], capacity['rssPerConn']))
+    if capacity['heapPerConn'] is not None:
+        print('python heap: %d B/conn' % capacity['heapPerConn'])
+    if capacity['stoppedBy']:
+        print('stopped by: %s' % capacity['stoppedBy'])
+    if capacity['projected'] is not None:
+        print('projected: %d connections in %d MB' %
+              (capacity['projected'], args.memory))
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
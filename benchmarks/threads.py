@@ -0,0 +1,222 @@
+"""
+    this module is for measuring how the throughput of one LsServer
+    process scales with the threads of lsserver --threads,
+    run it from the repository root, on a GIL and a free-threaded build:
+
+        python -m benchmarks.threads --threads 1 2 4
+        python3.13t -m benchmarks.threads --threads 1 2 4
+
+    The measured process runs LsServer only, the main loop accepts
+    and the workers relay. The driver processes speak the protocol
+    of lightsocks directly, every connection streams the payload
+    encoded once ahead to a sink in the driver for the duration,
+    so the cost of the clients stays out of the measured process.
+    The bytes the sinks received per second are reported.
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import socket
+import sys
+import sysconfig
+import time
+
+from lightsocks.core.cipher import Cipher
+from lightsocks.core.password import randomPassword
+from lightsocks.server import LsServer
+from lightsocks.utils import net, socks, workers
+
+PAYLOAD = 64 * 1024
+
+
+def gilEnabled() -> bool:
+    isEnabled = getattr(sys, '_is_gil_enabled', None)
+    return True if isEnabled is None else isEnabled()
+
+
+class Driver:
+    """
+    Driver streams the encoded payload through LsServer
+    on connections in parallel, and counts what its sink receives.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop,
+                 serverAddr: net.Address, password: bytearray,
+                 payload: int) -> None:
+        self.loop = loop
+        self.serverAddr = serverAddr
+        self.cipher = Cipher.NewCipher(password)
+        self.payload = self.encoded(bytes(payload))
+        self.received = 0
+        self.drops = set()
+        self.sink = socket.socket()
+        self.sink.bind(('127.0.0.1', 0))
+        self.sink.listen(socket.SOMAXCONN)
+        self.sink.setblocking(False)
+
+    def encoded(self, data: bytes) -> bytearray:
+        data = bytearray(data)
+        self.cipher.encode(data)
+        return data
+
+    async def serveSink(self):
+        while True:
+            conn, _ = await self.loop.sock_accept(self.sink)
+            task = asyncio.ensure_future(self.drop(conn), loop=self.loop)
+            self.drops.add(task)
+            task.add_done_callback(self.drops.discard)
+
+    async def drop(self, conn: socket.socket):
+        with conn:
+            while True:
+                data = await self.loop.sock_recv(conn, 256 * 1024)
+                if not data:
+                    break
+                self.received += len(data)
+
+    async def stream(self, deadline: float):
+        client = socket.socket()
+        client.setblocking(False)
+        with client:
+            await self.loop.sock_connect(client, self.serverAddr)
+            await self.loop.sock_sendall(client, self.encoded(socks.GREETING))
+            await self.loop.sock_recv(client, 2)
+            await self.loop.sock_sendall(
+                client,
+                self.encoded(socks.packRequest(*self.sink.getsockname())))
+            await self.loop.sock_recv(client, len(socks.packReply()))
+            while self.loop.time() < deadline:
+                await self.loop.sock_sendall(client, self.payload)
+
+    async def run(self, connections: int, duration: float) -> int:
+        sinking = asyncio.ensure_future(self.serveSink(), loop=self.loop)
+        deadline = self.loop.time() + duration
+        await asyncio.gather(
+            *(self.stream(deadline) for _ in range(connections)))
+        # let the sinks take the bytes in flight, they are not counted
+        received = self.received
+        await asyncio.sleep(0.1)
+        for task in [sinking] + list(self.drops):
+            task.cancel()
+        await asyncio.sleep(0)
+        self.sink.close()
+        return received
+
+
+def runDriver(queue, serverAddr: net.Address, password: bytearray,
+              connections: int, duration: float, payload: int):
+    loop = asyncio.new_event_loop()
+    try:
+        driver = Driver(loop, serverAddr, password, payload)
+        queue.put(loop.run_until_complete(driver.run(connections, duration)))
+    finally:
+        loop.close()
+
+
+def measure(threads: int, args: argparse.Namespace) -> dict:
+    password = randomPassword()
+    loop = asyncio.new_event_loop()
+    pool = workers.WorkerPool(threads) if threads > 1 else None
+
+    def newServer(loop: asyncio.AbstractEventLoop) -> LsServer:
+        return LsServer(
+            loop=loop,
+            password=password,
+            listenAddr=net.Address('127.0.0.1', 0))
+
+    server = newServer(loop)
+    server.bind()
+    if pool is not None:
+        server.shards = [newServer(workerLoop) for workerLoop in pool.loops]
+        pool.start()
+    listening = asyncio.ensure_future(server.listen(), loop=loop)
+
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    drivers = [
+        context.Process(
+            target=runDriver,
+            args=(queue, net.Address(*server.listener.getsockname()),
+                  password, args.connections, args.duration, args.payload))
+        for _ in range(args.drivers)
+    ]
+    start = time.perf_counter()
+    for driver in drivers:
+        driver.start()
+
+    async def collect():
+        return [
+            await loop.run_in_executor(None, queue.get) for _ in drivers
+        ]
+
+    try:
+        received = sum(loop.run_until_complete(collect()))
+        seconds = time.perf_counter() - start
+        server.stopAccepting()
+        loop.run_until_complete(server.drain(10))
+        listening.cancel()
+    finally:
+        for driver in drivers:
+            driver.join(10)
+        if pool is not None:
+            pool.stop()
+        loop.close()
+    return {
+        'threads': threads,
+        'bytes': received,
+        'mbps': round(received * 8 / args.duration / 1e6, 1),
+        'seconds': round(seconds, 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Measure the throughput of LsServer per thread count')
+    parser.add_argument(
+        '--threads', metavar='N', type=int, nargs='+', default=[1, 2, 4],
+        help='thread counts to measure, default: 1 2 4')
+    parser.add_argument(
+        '--drivers', type=int, default=multiprocessing.cpu_count() // 2 or 1,
+        help='driver processes, default: half of the CPUs')
+    parser.add_argument(
+        '--connections', type=int, default=8,
+        help='connections of every driver, default: 8')
+    parser.add_argument(
+        '--duration', metavar='SECONDS', type=float, default=5.0,
+        help='seconds to stream, default: 5')
+    parser.add_argument(
+        '--payload', metavar='BYTES', type=int, default=PAYLOAD,
+        help='bytes of every send, default: %d' % PAYLOAD)
+    parser.add_argument(
+        '--json', metavar='FILE', help='path to dump the results')
+    args = parser.parse_args()
+
+    results = []
+    for threads in args.threads:
+        result = measure(threads, args)
+        results.append(result)
+        print('%4d threads %10.1f Mbps  x%.2f' %
+              (threads, result['mbps'],
+               result['mbps'] / max(results[0]['mbps'], 1e-9)))
+    report = {
+        'python': sys.version.split()[0],
+        'gil': gilEnabled(),
+        'freeThreadedBuild': bool(sysconfig.get_config_var('Py_GIL_DISABLED')),
+        'params': {
+            'drivers': args.drivers,
+            'connections': args.connections,
+            'duration': args.duration,
+            'payload': args.payload,
+        },
+        'results': results,
+    }
+    print('python %s, GIL %s' %
+          (report['python'], 'enabled' if report['gil'] else 'disabled'))
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
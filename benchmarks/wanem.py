@@ -0,0 +1,524 @@
+"""
+    this module is for emulating a slow and lossy link between
+    LsLocal and LsServer, without root or netem, run it from
+    the repository root:
+
+        python -m benchmarks.wanem --sweep lan cross-border lossy
+        python -m benchmarks.wanem --listen 127.0.0.1:8389 \\
+            --upstream 127.0.0.1:8388 --profile cross-border
+
+    WanEmulator is a TCP relay, every chunk it reads is sent on
+    after the one way delay and a random jitter, at most at the
+    bandwidth of the link, which is shared by the connections.
+    TCP keeps the order of the bytes, so a lost or reordered packet
+    shows up as a chunk that comes late and holds back the ones behind it:
+    reorder holds a chunk for one more round trip, like a fast
+    retransmit, stall holds it for stallTime, like a retransmit timeout.
+    loss resets both sides of the connection, like a broken path.
+
+    The sweep runs LsServer, the emulator in front of it, LsLocal
+    and a sink in this process, and measures the setup time
+    of the connections, the round trip time of small echoes
+    and the throughput of a download, for every profile.
+"""
+import argparse
+import asyncio
+import json
+import random
+import socket
+import sys
+import time
+import typing
+from collections import namedtuple
+
+from lightsocks.core.password import randomPassword
+from lightsocks.core.relay import LINGER_RESET
+from lightsocks.local import LsLocal
+from lightsocks.server import LsServer
+from lightsocks.utils import net, socks
+
+CHUNK_SIZE = 16 * 1024
+# the chunks in flight of one direction, like the window of TCP
+WINDOW_CHUNKS = 64
+BULK_CHUNK = 64 * 1024
+ECHO = b'E'
+BULK = b'B'
+
+# delay and jitter are one way, in seconds, bandwidth in bytes per second,
+# loss, reorder and stall are probabilities per chunk
+Profile = namedtuple(
+    'Profile',
+    'name delay jitter bandwidth loss reorder stall stallTime')
+
+MBIT = 1000 * 1000 // 8
+
+PROFILES = {
+    profile.name: profile
+    for profile in (
+        Profile('loopback', 0.0, 0.0, 0, 0.0, 0.0, 0.0, 0.0),
+        Profile('lan', 0.0005, 0.0001, 1000 * MBIT, 0.0, 0.0, 0.0, 0.0),
+        Profile('broadband', 0.01, 0.002, 50 * MBIT, 0.0, 0.001, 0.0, 0.0),
+        Profile('cross-border', 0.075, 0.015, 10 * MBIT, 0.0, 0.01, 0.002,
+                1.0),
+        Profile('lossy', 0.075, 0.04, 2 * MBIT, 0.002, 0.05, 0.01, 1.0),
+        Profile('mobile', 0.04, 0.03, 5 * MBIT, 0.001, 0.02, 0.005, 0.5),
+    )
+}
+
+
+def percentile(values: typing.List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct))]
+
+
+def parseProfile(text: str) -> Profile:
+    """
+    A name of PROFILES, or delay,jitter,bandwidth,loss,reorder,stall
+    with the times in ms and the bandwidth in Mbit/s.
+    """
+    if text in PROFILES:
+        return PROFILES[text]
+    try:
+        delay, jitter, bandwidth, loss, reorder, stall = map(
+            float, text.split(','))
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            'unknown profile %r, choose from %s or give '
+            'delay,jitter,bandwidth,loss,reorder,stall' %
+            (text, ', '.join(PROFILES)))
+    return Profile(text, delay / 1000, jitter / 1000, int(bandwidth * MBIT),
+                   loss, reorder, stall, 1.0)
+
+
+class Link:
+    """
+    Link is one direction of the emulated link.
+    The chunks of all the connections queue for its bandwidth,
+    schedule returns when a chunk arrives at the other end.
+    """
+    __slots__ = ('loop', 'profile', 'rand', 'free')
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, profile: Profile,
+                 rand: random.Random) -> None:
+        self.loop = loop
+        self.profile = profile
+        self.rand = rand
+        self.free = 0.0
+
+    def schedule(self, size: int) -> float:
+        profile = self.profile
+        sent = self.loop.time()
+        if profile.bandwidth > 0:
+            sent = max(sent, self.free) + size / profile.bandwidth
+            self.free = sent
+        due = sent + profile.delay
+        if profile.jitter > 0:
+            due += self.rand.uniform(0, profile.jitter)
+        if self.rand.random() < profile.reorder:
+            due += 2 * profile.delay
+        if self.rand.random() < profile.stall:
+            due += profile.stallTime
+        return due
+
+    def lost(self) -> bool:
+        return self.rand.random() < self.profile.loss
+
+
+class WanEmulator:
+    """
+    WanEmulator accepts the connections on the listener,
+    and relays every one to the upstream through the two Links.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop,
+                 listener: socket.socket, upstream: net.Address,
+                 profile: Profile, seed: int=0) -> None:
+        self.loop = loop
+        self.listener = listener
+        self.upstream = upstream
+        self.profile = profile
+        rand = random.Random(seed)
+        self.up = Link(loop, profile, rand)
+        self.down = Link(loop, profile, rand)
+        self.resets = 0
+        self.tasks = set()
+
+    def spawn(self, coro) -> asyncio.Future:
+        task = asyncio.ensure_future(coro, loop=self.loop)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    async def serve(self):
+        while True:
+            conn, _ = await self.loop.sock_accept(self.listener)
+            self.spawn(self.relay(conn))
+
+    async def relay(self, client: socket.socket):
+        try:
+            upstream = await net.connect(self.loop, *self.upstream)
+        except OSError:
+            client.close()
+            return
+        # the connect takes one round trip of the link
+        await asyncio.sleep(2 * self.profile.delay)
+        broken = self.loop.create_future()
+        pumps = [
+            self.spawn(self.pump(client, upstream, self.up, broken)),
+            self.spawn(self.pump(upstream, client, self.down, broken)),
+        ]
+        try:
+            pending = set(pumps)
+            while pending and not broken.done():
+                _, pending = await asyncio.wait(
+                    pending | {broken}, return_when=asyncio.FIRST_COMPLETED)
+                pending.discard(broken)
+            if broken.done():
+                self.resets += 1
+                for conn in (client, upstream):
+                    try:
+                        conn.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
+                                        LINGER_RESET)
+                    except OSError:
+                        pass
+        finally:
+            for task in pumps:
+                task.cancel()
+            if not broken.done():
+                broken.cancel()
+            client.close()
+            upstream.close()
+
+    async def pump(self, src: socket.socket, dst: socket.socket, link: Link,
+                   broken: asyncio.Future):
+        """
+        Read the chunks as they come, and deliver them when they are due.
+        """
+        queue = asyncio.Queue(WINDOW_CHUNKS)
+        delivering = asyncio.ensure_future(
+            self.deliver(dst, queue, broken), loop=self.loop)
+        last = 0.0
+        try:
+            while True:
+                try:
+                    data = await self.loop.sock_recv(src, CHUNK_SIZE)
+                except OSError:
+                    data = b''
+                if data and link.lost():
+                    if not broken.done():
+                        broken.set_result(None)
+                    return
+                # the bytes of a connection arrive in order
+                last = max(last, link.schedule(len(data)))
+                await queue.put((last, data))
+                if not data:
+                    break
+            await delivering
+        finally:
+            delivering.cancel()
+
+    async def deliver(self, dst: socket.socket, queue: asyncio.Queue,
+                      broken: asyncio.Future):
+        while True:
+            due, data = await queue.get()
+            delay = due - self.loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            try:
+                if not data:
+                    dst.shutdown(socket.SHUT_WR)
+                    return
+                await self.loop.sock_sendall(dst, data)
+            except OSError:
+                if not broken.done():
+                    broken.set_result(None)
+                return
+
+
+class Sink:
+    """
+    Sink echoes the connections that start with ECHO,
+    and sends the size that follows BULK to the others.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop) -> None:
+        self.loop = loop
+        self.listener = socket.socket()
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(socket.SOMAXCONN)
+        self.listener.setblocking(False)
+        self.data = random.randbytes(BULK_CHUNK)
+        self.tasks = set()
+
+    @property
+    def address(self) -> net.Address:
+        return net.Address(*self.listener.getsockname())
+
+    async def serve(self):
+        while True:
+            conn, _ = await self.loop.sock_accept(self.listener)
+            task = asyncio.ensure_future(self.handle(conn), loop=self.loop)
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def handle(self, conn: socket.socket):
+        with conn:
+            try:
+                kind = await recvExactly(self.loop, conn, 1)
+                if kind == ECHO:
+                    while True:
+                        data = await self.loop.sock_recv(conn, 1024)
+                        if not data:
+                            break
+                        await self.loop.sock_sendall(conn, data)
+                    return
+                size = int.from_bytes(
+                    await recvExactly(self.loop, conn, 8), 'big')
+                while size > 0:
+                    n = min(size, BULK_CHUNK)
+                    await self.loop.sock_sendall(conn, self.data[:n])
+                    size -= n
+                    # sock_sendall does not yield while the socket is writable
+                    await asyncio.sleep(0)
+                conn.shutdown(socket.SHUT_WR)
+            except OSError:
+                pass
+
+    def close(self):
+        for task in list(self.tasks):
+            task.cancel()
+        self.listener.close()
+
+
+async def recvExactly(loop: asyncio.AbstractEventLoop, conn: socket.socket,
+                      size: int) -> bytes:
+    buf = b''
+    while len(buf) < size:
+        data = await loop.sock_recv(conn, size - len(buf))
+        if not data:
+            raise ConnectionError('closed before %d bytes' % size)
+        buf += data
+    return buf
+
+
+class Driver:
+    """
+    Driver measures one profile through LsLocal.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop,
+                 localAddr: net.Address, sinkAddr: net.Address) -> None:
+        self.loop = loop
+        self.localAddr = localAddr
+        self.sinkAddr = sinkAddr
+
+    async def open(self, kind: bytes) -> typing.Tuple[socket.socket, float]:
+        """
+        Open a connection to the sink, return it and its setup time.
+        """
+        start = self.loop.time()
+        conn = await net.connect(self.loop, *self.localAddr)
+        try:
+            await self.loop.sock_sendall(conn, socks.GREETING)
+            await recvExactly(self.loop, conn, 2)
+            await self.loop.sock_sendall(conn,
+                                         socks.packRequest(*self.sinkAddr))
+            reply = await recvExactly(self.loop, conn, len(socks.packReply()))
+            if reply[1] != socks.REP_SUCCEEDED:
+                raise ConnectionError('refused by LsServer')
+            await self.loop.sock_sendall(conn, kind)
+        except BaseException:
+            conn.close()
+            raise
+        return conn, self.loop.time() - start
+
+    async def measure(self, args: argparse.Namespace) -> dict:
+        setups = []
+        rtts = []
+        failed = 0
+        for _ in range(args.connections):
+            try:
+                conn, setup = await asyncio.wait_for(
+                    self.open(ECHO), args.timeout)
+            except (OSError, asyncio.TimeoutError):
+                failed += 1
+                continue
+            setups.append(setup)
+            with conn:
+                try:
+                    for _ in range(args.pings):
+                        start = self.loop.time()
+                        await self.loop.sock_sendall(conn, b'x' * args.size)
+                        await asyncio.wait_for(
+                            recvExactly(self.loop, conn, args.size),
+                            args.timeout)
+                        rtts.append(self.loop.time() - start)
+                except (OSError, asyncio.TimeoutError):
+                    failed += 1
+
+        received = 0
+        start = self.loop.time()
+        try:
+            conn, _ = await asyncio.wait_for(self.open(BULK), args.timeout)
+            with conn:
+                await self.loop.sock_sendall(conn,
+                                             args.bulk.to_bytes(8, 'big'))
+                while True:
+                    data = await asyncio.wait_for(
+                        self.loop.sock_recv(conn, BULK_CHUNK), args.timeout)
+                    if not data:
+                        break
+                    received += len(data)
+        except (OSError, asyncio.TimeoutError):
+            failed += 1
+        elapsed = self.loop.time() - start
+
+        setups = [setup * 1000 for setup in setups]
+        rtts = [rtt * 1000 for rtt in rtts]
+        return {
+            'failed': failed,
+            'setupP50Ms': round(percentile(setups, 0.5), 3),
+            'setupP99Ms': round(percentile(setups, 0.99), 3),
+            'rttP50Ms': round(percentile(rtts, 0.5), 3),
+            'rttP99Ms': round(percentile(rtts, 0.99), 3),
+            'downBytes': received,
+            'downMBps': round(received / 1024 / 1024 / max(elapsed, 1e-9),
+                              3),
+        }
+
+
+def measureProfile(profile: Profile, args: argparse.Namespace) -> dict:
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    password = randomPassword()
+    server = LsServer(
+        loop=loop, password=password, listenAddr=net.Address('127.0.0.1', 0))
+    server.bind()
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(socket.SOMAXCONN)
+    listener.setblocking(False)
+    emulator = WanEmulator(loop, listener,
+                           net.Address(*server.listener.getsockname()),
+                           profile, args.seed)
+    local = LsLocal(
+        loop=loop,
+        password=password,
+        listenAddr=net.Address('127.0.0.1', 0),
+        remoteAddr=net.Address(*listener.getsockname()))
+    local.bind()
+    sink = Sink(loop)
+    services = [server, local]
+    tasks = [
+        asyncio.ensure_future(coro, loop=loop)
+        for coro in (server.listen(), local.listen(), emulator.serve(),
+                     sink.serve())
+    ]
+    driver = Driver(loop, net.Address(*local.listener.getsockname()),
+                    sink.address)
+    try:
+        result = loop.run_until_complete(driver.measure(args))
+        result['resets'] = emulator.resets
+        for service in services:
+            service.stopAccepting()
+            loop.run_until_complete(service.drain(1))
+    finally:
+        for task in tasks + list(emulator.tasks):
+            task.cancel()
+        sink.close()
+        listener.close()
+        loop.run_until_complete(asyncio.sleep(0))
+        loop.close()
+    return result
+
+
+def sweep(args: argparse.Namespace):
+    result = {'python': sys.version.split()[0], 'profiles': {}}
+    for profile in args.sweep:
+        start = time.perf_counter()
+        measured = measureProfile(profile, args)
+        result['profiles'][profile.name] = dict(
+            measured, profile=profile._asdict())
+        print('%-13s setup p50 %8.1fms rtt p50 %8.1fms p99 %8.1fms, '
+              '%7.3f MB/s down, %d failed, %d resets, %.1fs' %
+              (profile.name, measured['setupP50Ms'], measured['rttP50Ms'],
+               measured['rttP99Ms'], measured['downMBps'],
+               measured['failed'], measured['resets'],
+               time.perf_counter() - start))
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(result, f, indent=2)
+
+
+def serve(args: argparse.Namespace):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    listenAddr = net.parseAddress(args.listen)
+    listener = socket.socket()
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(listenAddr)
+    listener.listen(socket.SOMAXCONN)
+    listener.setblocking(False)
+    emulator = WanEmulator(loop, listener, net.parseAddress(args.upstream),
+                           args.profile, args.seed)
+    print('Emulate %s on %s:%d to %s' % (args.profile.name, *listenAddr,
+                                         args.upstream))
+    try:
+        loop.run_until_complete(emulator.serve())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        listener.close()
+        loop.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Emulate a WAN link between LsLocal and LsServer')
+    parser.add_argument(
+        '--sweep', metavar='PROFILE', type=parseProfile, nargs='+',
+        help='measure these profiles, the names are %s' % ', '.join(PROFILES))
+    parser.add_argument(
+        '--listen', metavar='HOST:PORT', help='serve the emulator here')
+    parser.add_argument(
+        '--upstream', metavar='HOST:PORT', help='the lsserver to relay to')
+    parser.add_argument(
+        '--profile', type=parseProfile, default=PROFILES['cross-border'],
+        help='a profile name, or delay,jitter,bandwidth,loss,reorder,stall '
+        'in ms and Mbit/s, default: cross-border')
+    parser.add_argument(
+        '--connections', type=int, default=10,
+        help='echo connections per profile, default: 10')
+    parser.add_argument(
+        '--pings', type=int, default=10,
+        help='echoes per connection, default: 10')
+    parser.add_argument(
+        '--size', metavar='BYTES', type=int, default=64,
+        help='bytes of every echo, default: 64')
+    parser.add_argument(
+        '--bulk', metavar='BYTES', type=int, default=4 * 1024 * 1024,
+        help='bytes to download per profile, default: 4MiB')
+    parser.add_argument(
+        '--timeout', metavar='SECONDS', type=float, default=30.0,
+        help='seconds to wait for every step, default: 30')
+    parser.add_argument(
+        '--seed', type=int, default=0, help='random seed, default: 0')
+    parser.add_argument(
+        '--json', metavar='FILE', help='path to dump the report')
+    args = parser.parse_args()
+
+    if args.listen:
+        if not args.upstream:
+            parser.error('--listen needs --upstream')
+        serve(args)
+        return
+    if not args.sweep:
+        parser.error('give --sweep, or --listen and --upstream')
+    random.seed(args.seed)
+    sweep(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,243 @@
+import socket
+import asyncio
+import logging
+import threading
+import typing
+
+from lightsocks.utils import net
+from lightsocks.core.cipher import Cipher
+from lightsocks.core import transport
+
+Connection = socket.socket
+logger = logging.getLogger(__name__)
+
+LATENCY = 'latency'
+LEAST_CONN = 'leastconn'
+STRATEGIES = (LATENCY, LEAST_CONN)
+
+CONNECT_TIMEOUT = 5.0
+PROBE_INTERVAL = 30.0
+RESOLVE_TTL = 300.0
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 60.0
+EWMA_ALPHA = 0.3
+
+
+class Remote:
+    """
+    Remote is one of the LsServer that LsLocal can dial,
+    with its own cipher and the statistics for choosing it.
+    With mptcp, it is dialed with Multipath TCP, see transport.
+    It may be dialed from the loops of the workers,
+    the statistics take a lock, see workers.
+    """
+
+    def __init__(self,
+                 loop: asyncio.AbstractEventLoop,
+                 address: net.Address,
+                 password: bytearray,
+                 mptcp: bool=False) -> None:
+        self.loop = loop
+        self.mptcp = mptcp
+        self.cipher = Cipher.NewCipher(password)
+        self.rtt = None
+        self.active = 0
+        self.failures = 0
+        self.retryAt = 0.0
+        self.lock = threading.Lock()
+        self.address = address
+
+    @property
+    def address(self) -> net.Address:
+        return self._address
+
+    @address.setter
+    def address(self, address: net.Address):
+        self._address = address
+        self.resolved = None
+        self.resolvedAt = 0.0
+
+    @property
+    def available(self) -> bool:
+        return self.retryAt <= self.loop.time()
+
+    async def resolve(self, loop: asyncio.AbstractEventLoop) -> list:
+        """
+        Resolve the address on the loop, and cache it for RESOLVE_TTL
+        seconds, so dialing does not resolve the hostname every time.
+        """
+        now = loop.time()
+        resolved = self.resolved
+        if resolved is None or now - self.resolvedAt > RESOLVE_TTL:
+            infos = await loop.getaddrinfo(
+                *self.address, type=socket.SOCK_STREAM)
+            resolved = [(family, socktype, proto, sockaddr)
+                        for family, socktype, proto, _, sockaddr in infos]
+            with self.lock:
+                self.resolved = resolved
+                self.resolvedAt = now
+        return resolved
+
+    async def connect(self, timeout: float=CONNECT_TIMEOUT,
+                      loop: asyncio.AbstractEventLoop=None) -> Connection:
+        """
+        Connect to the remote on the loop within the timeout,
+        and record the round trip time.
+        The loop defaults to the loop of the remote.
+        """
+        loop = loop or self.loop
+        try:
+            return await asyncio.wait_for(
+                self.connectAddresses(loop), timeout)
+        except (OSError, asyncio.TimeoutError) as err:
+            self.fail()
+            if isinstance(err, ConnectionError):
+                raise
+            raise ConnectionError(err)
+
+    async def connectAddresses(self,
+                               loop: asyncio.AbstractEventLoop) -> Connection:
+        """
+        Try the resolved addresses one by one.
+        """
+        lastErr = None
+        for family, socktype, proto, sockaddr in await self.resolve(loop):
+            try:
+                conn = transport.createSocket(loop, family, socktype,
+                                              proto, self.mptcp)
+            except OSError as err:
+                # the family is not supported on this host
+                lastErr = err
+                continue
+            start = loop.time()
+            try:
+                conn.setblocking(False)
+                await transport.connect(loop, conn, sockaddr)
+            except OSError as err:
+                conn.close()
+                lastErr = err
+                continue
+            except asyncio.CancelledError:
+                conn.close()
+                raise
+            self.succeed(loop.time() - start)
+            return conn
+
+        raise ConnectionError(lastErr)
+
+    def succeed(self, rtt: float):
+        with self.lock:
+            if self.rtt is None:
+                self.rtt = rtt
+            else:
+                self.rtt += EWMA_ALPHA * (rtt - self.rtt)
+            self.failures = 0
+            self.retryAt = 0.0
+
+    def fail(self):
+        with self.lock:
+            self.failures += 1
+            failures = self.failures
+            backoff = min(BACKOFF_MAX, BACKOFF_BASE * 2**(failures - 1))
+            self.retryAt = self.loop.time() + backoff
+            # the cached address may be stale
+            self.resolved = None
+        logger.warning('Remote %s:%d failed %d times, retry in %.1fs',
+                       *self.address, failures, backoff)
+
+    def acquire(self):
+        with self.lock:
+            self.active += 1
+
+    def release(self):
+        with self.lock:
+            self.active -= 1
+
+
+class Balancer:
+    """
+    Balancer chooses a Remote for every connection,
+    by the lowest latency or the least active connections,
+    and fails over to the next one.
+    It is shared by the services of the workers, they dial on their
+    own loops, and it is probed on its loop, see LsLocal.listen.
+    """
+
+    def __init__(self,
+                 loop: asyncio.AbstractEventLoop,
+                 remotes: typing.List[Remote],
+                 strategy: str=LATENCY,
+                 connectTimeout: float=CONNECT_TIMEOUT,
+                 probeInterval: float=PROBE_INTERVAL) -> None:
+        if not remotes:
+            raise ValueError('need at least one remote')
+        if strategy not in STRATEGIES:
+            raise ValueError('unknown strategy %r' % strategy)
+        self.loop = loop
+        self.remotes = remotes
+        self.strategy = strategy
+        self.connectTimeout = connectTimeout
+        self.probeInterval = probeInterval
+
+    def score(self, remote: Remote):
+        # the remotes that have not been measured are tried first
+        rtt = remote.rtt if remote.rtt is not None else 0.0
+        if self.strategy == LEAST_CONN:
+            return (remote.active, rtt)
+        return (rtt, remote.active)
+
+    def candidates(self) -> typing.List[Remote]:
+        """
+        The available remotes ordered by the score,
+        then the backing off remotes ordered by the retry time.
+        """
+        available = [remote for remote in self.remotes if remote.available]
+        backingOff = [
+            remote for remote in self.remotes if not remote.available
+        ]
+        available.sort(key=self.score)
+        backingOff.sort(key=lambda remote: remote.retryAt)
+        return available + backingOff
+
+    async def dial(self, loop: asyncio.AbstractEventLoop=None
+                   ) -> typing.Tuple[Remote, Connection]:
+        """
+        Connect to the best remote on the loop, the caller must release it.
+        The loop defaults to the loop of the balancer.
+        """
+        errors = []
+        for remote in self.candidates():
+            try:
+                conn = await remote.connect(self.connectTimeout,
+                                            loop or self.loop)
+            except ConnectionError as err:
+                errors.append((remote, err))
+                continue
+            remote.acquire()
+            return remote, conn
+
+        raise ConnectionError('\n'.join(
+            '链接到远程服务器 %s:%d 失败:\n%r' %
+            (*remote.address, err) for remote, err in errors))
+
+    def release(self, remote: Remote):
+        remote.release()
+
+    async def probe(self):
+        """
+        Measure the round trip time of every remote by connecting to it.
+        """
+
+        async def probeOne(remote):
+            try:
+                conn = await remote.connect(self.connectTimeout)
+            except ConnectionError:
+                return
+            conn.close()
+
+        await asyncio.gather(*(probeOne(remote) for remote in self.remotes))
+
+    async def probeForever(self):
+        while True:
+            await self.probe()
+            await asyncio.sleep(self.probeInterval)
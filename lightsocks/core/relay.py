@@ -0,0 +1,127 @@
+"""
+    this module is for relaying the data flow both ways
+    between the two sockets of a connection.
+"""
+import socket
+import asyncio
+import struct
+import typing
+
+from .scheduler import Flow
+from .securesocket import SecureSocket
+
+Connection = socket.socket
+
+# the close sends a reset, and the socket skips TIME_WAIT
+LINGER_RESET = struct.pack('ii', 1, 0)
+
+
+class Relay:
+    """
+    Relay owns the client and the upstream socket of a connection.
+    The task that runs it copies the upstream to the client,
+    one more task copies the client to the upstream.
+    An error in either direction shuts both sockets down,
+    that ends the other direction, and both sockets are closed in run.
+
+    toUpstream and toClient transform the chunks in place,
+    firstRead is called when the upstream sends the first chunk.
+    If the secureSocket has a scheduler, both directions are flows of it,
+    priority overrides their classification.
+    countToUpstream and countToClient count the bytes, see SecureSocket.copy.
+    With resetOnAbort, an aborted upstream is reset when it is closed.
+    beforeClose is called with the client and the upstream
+    before they are closed.
+    """
+    __slots__ = ('secureSocket', 'client', 'upstream', 'toUpstream',
+                 'toClient', 'firstRead', 'priority', 'countToUpstream',
+                 'countToClient', 'resetOnAbort', 'beforeClose')
+
+    def __init__(self,
+                 secureSocket: SecureSocket,
+                 client: Connection,
+                 upstream: Connection,
+                 toUpstream: typing.Callable=None,
+                 toClient: typing.Callable=None,
+                 firstRead: typing.Callable=None,
+                 priority: str=None,
+                 countToUpstream: typing.Callable=None,
+                 countToClient: typing.Callable=None,
+                 resetOnAbort: bool=False,
+                 beforeClose: typing.Callable=None) -> None:
+        self.secureSocket = secureSocket
+        self.client = client
+        self.upstream = upstream
+        self.toUpstream = toUpstream
+        self.toClient = toClient
+        self.firstRead = firstRead
+        self.priority = priority
+        self.countToUpstream = countToUpstream
+        self.countToClient = countToClient
+        self.resetOnAbort = resetOnAbort
+        self.beforeClose = beforeClose
+
+    def flow(self) -> typing.Optional[Flow]:
+        scheduler = self.secureSocket.scheduler
+        if scheduler is None:
+            return None
+        return scheduler.flow(self.priority)
+
+    async def run(self):
+        copying = asyncio.ensure_future(
+            self.copyToUpstream(), loop=self.secureSocket.loop)
+        try:
+            try:
+                await self.secureSocket.copy(self.client, self.upstream,
+                                             self.toClient, self.firstRead,
+                                             self.flow(), self.countToClient)
+            except OSError:
+                self.abort()
+            await copying
+        finally:
+            # the relay is cancelled, or both directions are done
+            copying.cancel()
+            if self.beforeClose is not None:
+                self.beforeClose(self.client, self.upstream)
+            self.upstream.close()
+            self.client.close()
+
+    async def copyToUpstream(self):
+        try:
+            await self.secureSocket.copy(
+                self.upstream,
+                self.client,
+                self.toUpstream,
+                flow=self.flow(),
+                count=self.countToUpstream)
+        except OSError:
+            self.abort()
+
+    def abort(self):
+        """
+        Shut both sockets down, the pending reads return the end of stream.
+        """
+        if self.resetOnAbort:
+            try:
+                self.upstream.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
+                                         LINGER_RESET)
+            except OSError:
+                pass
+        for conn in (self.client, self.upstream):
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+def installEagerTaskFactory(loop: asyncio.AbstractEventLoop) -> bool:
+    """
+    Start the new tasks eagerly, the tasks that finish before
+    their first suspension are never scheduled.
+    Return False if the Python does not support it (before 3.12).
+    """
+    factory = getattr(asyncio, 'eager_task_factory', None)
+    if factory is None:
+        return False
+    loop.set_task_factory(factory)
+    return True
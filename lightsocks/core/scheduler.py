@@ -0,0 +1,132 @@
+"""
+    this module is for serving the interactive flows ahead of the bulk ones,
+    when the relays of many connections share one event loop.
+"""
+import asyncio
+import typing
+from collections import deque
+
+INTERACTIVE = 'interactive'
+BULK = 'bulk'
+PRIORITIES = (INTERACTIVE, BULK)
+
+QUANTUM = 16 * 1024
+ROUND_BUDGET = 64 * 1024
+INTERACTIVE_CHUNK = 1024
+INTERACTIVE_RATE = 64 * 1024
+RATE_WINDOW = 1.0
+EWMA_ALPHA = 0.2
+
+
+class Flow:
+    """
+    Flow is one direction of a relay.
+    It is interactive if its recent chunks are small and its byte rate
+    is low, unless the priority overrides it.
+    deficit is the bytes a bulk flow may still read in this round.
+    """
+    __slots__ = ('scheduler', 'priority', 'chunkSize', 'rate', 'windowStart',
+                 'windowBytes', 'deficit', 'waiter')
+
+    def __init__(self, scheduler: 'Scheduler',
+                 priority: str=None) -> None:
+        self.scheduler = scheduler
+        self.priority = priority
+        self.chunkSize = 0.0
+        self.rate = 0.0
+        self.windowStart = scheduler.loop.time()
+        self.windowBytes = 0
+        self.deficit = scheduler.quantum
+        self.waiter = None
+
+    @property
+    def interactive(self) -> bool:
+        if self.priority is not None:
+            return self.priority == INTERACTIVE
+        scheduler = self.scheduler
+        rate = max(self.rate, self.windowBytes / RATE_WINDOW)
+        return (self.chunkSize <= scheduler.interactiveChunk
+                and rate <= scheduler.interactiveRate)
+
+    def admit(self) -> typing.Optional[asyncio.Future]:
+        """
+        Return None if the flow may read now,
+        or a future to wait for its turn.
+        """
+        return self.scheduler.admit(self)
+
+    def account(self, size: int):
+        """
+        Charge the flow for the bytes it has read.
+        """
+        self.chunkSize += EWMA_ALPHA * (size - self.chunkSize)
+        self.windowBytes += size
+        now = self.scheduler.loop.time()
+        elapsed = now - self.windowStart
+        if elapsed >= RATE_WINDOW:
+            self.rate = self.windowBytes / elapsed
+            self.windowStart = now
+            self.windowBytes = 0
+        if not self.interactive:
+            self.deficit -= size
+
+
+class Scheduler:
+    """
+    Scheduler lets the interactive flows read whenever they can,
+    and the bulk flows take turns by deficit round robin:
+    every loop iteration is one round, a waiting bulk flow gets
+    quantum bytes more in every round, and reads when it has a deficit.
+    At most budget bytes are given out in a round, so the interactive
+    flows never wait for more than that much bulk work in one iteration.
+    """
+
+    def __init__(self,
+                 loop: asyncio.AbstractEventLoop,
+                 quantum: int=QUANTUM,
+                 budget: int=ROUND_BUDGET,
+                 interactiveChunk: int=INTERACTIVE_CHUNK,
+                 interactiveRate: int=INTERACTIVE_RATE) -> None:
+        self.loop = loop
+        self.quantum = quantum
+        self.budget = budget
+        self.interactiveChunk = interactiveChunk
+        self.interactiveRate = interactiveRate
+        self.waiting = deque()
+        self.scheduled = False
+
+    def flow(self, priority: str=None) -> Flow:
+        return Flow(self, priority)
+
+    def admit(self, flow: Flow) -> typing.Optional[asyncio.Future]:
+        if flow.deficit > 0 or flow.interactive:
+            return None
+        flow.waiter = self.loop.create_future()
+        self.waiting.append(flow)
+        if not self.scheduled:
+            self.scheduled = True
+            self.loop.call_soon(self.round)
+        return flow.waiter
+
+    def round(self):
+        self.scheduled = False
+        waiting = self.waiting
+        given = 0
+        for _ in range(len(waiting)):
+            if given >= self.budget:
+                break
+            flow = waiting.popleft()
+            if flow.waiter.done():
+                # the relay has been cancelled
+                flow.waiter = None
+                continue
+            flow.deficit += self.quantum
+            given += self.quantum
+            if flow.deficit > 0:
+                flow.waiter.set_result(None)
+                flow.waiter = None
+            else:
+                waiting.append(flow)
+        if waiting:
+            self.scheduled = True
+            self.loop.call_soon(self.round)
@@ -1,10 +1,15 @@
 import logging
 import socket
 import asyncio
+import typing
 
 from .cipher import Cipher
+from .scheduler import Flow, Scheduler
 
 BUFFER_SIZE = 1024
+FLUSH_SIZE = 16 * BUFFER_SIZE
+FLUSH_DELAY = 0.0
+PIPELINE_SIZE = 4 * FLUSH_SIZE
 Connection = socket.socket
 logger = logging.getLogger(__name__)
 
@@ -13,11 +18,30 @@ class SecureSocket:
     """
     SecureSocket is a socket,
     that has the ability to decode read and encode write.
+
+    The copy loops read up to flushSize bytes at once,
+    and send the chunks that arrive within flushDelay
+    with one vectored write.
+    flushDelay 0 sends at once what has been read,
+    that keeps the latency low.
+
+    With a scheduler, the copy loops of the relays take turns,
+    see scheduler. With pipelineSize, they read ahead while
+    the other side is slow, see WriteBuffer.
     """
-    def __init__(self, loop: asyncio.AbstractEventLoop,
-                 cipher: Cipher) -> None:
+    def __init__(self,
+                 loop: asyncio.AbstractEventLoop,
+                 cipher: Cipher,
+                 flushDelay: float=FLUSH_DELAY,
+                 flushSize: int=FLUSH_SIZE,
+                 scheduler: Scheduler=None,
+                 pipelineSize: int=PIPELINE_SIZE) -> None:
         self.loop = loop or asyncio.get_event_loop()
         self.cipher = cipher
+        self.flushDelay = flushDelay
+        self.flushSize = flushSize
+        self.scheduler = scheduler
+        self.pipelineSize = pipelineSize
 
     async def decodeRead(self, conn: Connection):
         data = await self.loop.sock_recv(conn, BUFFER_SIZE)
@@ -28,6 +52,22 @@ class SecureSocket:
         self.cipher.decode(bs)
         return bs
 
+    async def readExactly(self, conn: Connection, size: int) -> bytearray:
+        """
+        Read size bytes and decode them, less if the conn is closed.
+        """
+        bs = bytearray()
+        try:
+            while len(bs) < size:
+                data = await self.loop.sock_recv(conn, size - len(bs))
+                if not data:
+                    break
+                bs += data
+        except OSError:
+            pass
+        self.cipher.decode(bs)
+        return bs
+
     async def encodeWrite(self, conn: Connection, bs: bytearray):
         logger.debug('%s:%d encodeWrite %s', *conn.getsockname(), bytes(bs))
 
@@ -36,30 +76,255 @@ class SecureSocket:
         self.cipher.encode(bs)
         await self.loop.sock_sendall(conn, bs)
 
-    async def encodeCopy(self, dst: Connection, src: Connection):
+    async def readChunks(self, conn: Connection) -> typing.List[bytearray]:
         """
-        It encodes the data flow from the src and sends to dst.
+        Read up to flushSize bytes, then the chunks that arrive
+        within flushDelay, until flushSize bytes in total.
+        An empty list means the conn has been closed,
+        an empty chunk at the end means it is closed after these chunks.
         """
-        logger.debug('encodeCopy %s:%d => %s:%d',
-                     *src.getsockname(), *dst.getsockname())
+        data = await self.loop.sock_recv(conn, self.flushSize)
+        if not data:
+            return []
 
-        while True:
-            data = await self.loop.sock_recv(src, BUFFER_SIZE)
+        chunks = [bytearray(data)]
+        size = len(data)
+        if self.flushDelay <= 0:
+            return chunks
+
+        deadline = self.loop.time() + self.flushDelay
+        while size < self.flushSize:
+            timeout = deadline - self.loop.time()
+            if timeout <= 0 or not await self.waitReadable(conn, timeout):
+                break
+            try:
+                data = conn.recv(self.flushSize - size)
+            except (BlockingIOError, InterruptedError):
+                continue
+            chunks.append(bytearray(data))
             if not data:
                 break
+            size += len(data)
+        return chunks
+
+    async def waitReadable(self, conn: Connection, timeout: float) -> bool:
+        """
+        Wait until the conn is readable, without reading it,
+        so nothing is lost when the timeout cancels the waiting.
+        """
+        readable = self.loop.create_future()
+
+        def onReadable():
+            if not readable.done():
+                readable.set_result(True)
+
+        fd = conn.fileno()
+        self.loop.add_reader(fd, onReadable)
+        try:
+            return await asyncio.wait_for(readable, timeout)
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self.loop.remove_reader(fd)
+
+    async def writeChunks(self, conn: Connection,
+                          chunks: typing.List[bytearray]):
+        """
+        Send all the chunks, with one sendmsg call if it is possible.
+        """
+        if len(chunks) == 1:
+            await self.loop.sock_sendall(conn, chunks[0])
+            return
+        remaining = sendChunks(conn, chunks)
+        if remaining:
+            await self.loop.sock_sendall(conn, b''.join(remaining))
 
-            await self.encodeWrite(dst, bytearray(data))
+    async def copy(self, dst: Connection, src: Connection,
+                   transform: typing.Callable=None,
+                   firstRead: typing.Callable=None,
+                   flow: Flow=None,
+                   count: typing.Callable=None):
+        """
+        It sends the data flow from the src to dst,
+        every chunk is transformed in place if transform is given.
+        firstRead is called when the first chunk is read.
+        The flow waits for its turn before every read.
+        count is called with the bytes of every read, and returns
+        the seconds to wait after sending them.
+        The end of the src is passed on to dst.
 
-    async def decodeCopy(self, dst: Connection, src: Connection):
+        With pipelineSize, it goes on reading while dst is not writable,
+        until pipelineSize bytes are waiting to be sent, see WriteBuffer.
+        """
+        buffer = None
+        if self.pipelineSize > 0:
+            buffer = WriteBuffer(self.loop, dst, self.pipelineSize)
+        try:
+            await self.copyChunks(dst, src, transform, firstRead, flow,
+                                  count, buffer)
+        finally:
+            if buffer is not None:
+                buffer.cancel()
+
+    async def copyChunks(self, dst: Connection, src: Connection,
+                         transform: typing.Callable,
+                         firstRead: typing.Callable,
+                         flow: typing.Optional[Flow],
+                         count: typing.Callable,
+                         buffer: typing.Optional['WriteBuffer']):
+        while True:
+            if flow is None:
+                # sock_recv and sock_sendall do not suspend while the sockets
+                # are ready, yield so a busy relay does not starve the others
+                await asyncio.sleep(0)
+            else:
+                waiter = flow.admit()
+                if waiter is not None:
+                    await waiter
+            chunks = await self.readChunks(src)
+            if not chunks:
+                break
+            if flow is not None or count is not None:
+                size = sum(map(len, chunks))
+                if flow is not None:
+                    flow.account(size)
+                if count is not None:
+                    delay = count(size)
+                    if delay:
+                        await asyncio.sleep(delay)
+            if firstRead is not None:
+                firstRead()
+                firstRead = None
+
+            if transform is not None:
+                for chunk in chunks:
+                    transform(chunk)
+            if buffer is None:
+                await self.writeChunks(dst, chunks)
+            else:
+                await buffer.write(chunks)
+            if not chunks[-1]:
+                break
+
+        if buffer is not None:
+            await buffer.flush()
+        try:
+            dst.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+
+    async def encodeCopy(self, dst: Connection, src: Connection,
+                         firstRead: typing.Callable=None):
+        """
+        It encodes the data flow from the src and sends to dst.
+        """
+        logger.debug('encodeCopy %s:%d => %s:%d',
+                     *src.getsockname(), *dst.getsockname())
+
+        await self.copy(dst, src, self.cipher.encode, firstRead)
+
+    async def decodeCopy(self, dst: Connection, src: Connection,
+                         firstRead: typing.Callable=None):
         """
         It decodes the data flow from the src and sends to dst.
         """
         logger.debug('decodeCopy %s:%d => %s:%d',
                      *src.getsockname(), *dst.getsockname())
 
-        while True:
-            bs = await self.decodeRead(src)
-            if not bs:
-                break
+        await self.copy(dst, src, self.cipher.decode, firstRead)
+
+
+def sendChunks(conn: Connection,
+               chunks: typing.List[bytearray]) -> typing.List[memoryview]:
+    """
+    Send what the conn takes now with one call, return the rest.
+    """
+    try:
+        if len(chunks) == 1 or not hasattr(conn, 'sendmsg'):
+            sent = conn.send(chunks[0] if len(chunks) == 1 else b''.join(
+                chunks))
+        else:
+            sent = conn.sendmsg(chunks)
+    except (BlockingIOError, InterruptedError):
+        sent = 0
+
+    remaining = []
+    for chunk in chunks:
+        if sent >= len(chunk):
+            sent -= len(chunk)
+            continue
+        remaining.append(memoryview(chunk)[sent:])
+        sent = 0
+    return remaining
+
+
+class WriteBuffer:
+    """
+    WriteBuffer sends the chunks at once if the conn takes them,
+    and keeps the rest for a writer task, that only runs while
+    there is something to send. write waits only when highWater bytes
+    are waiting, so the reading goes on while the conn is not writable.
+    An error of the writer is raised by the next write or flush.
+    """
+    __slots__ = ('loop', 'conn', 'highWater', 'chunks', 'size', 'writer',
+                 'space', 'error')
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, conn: Connection,
+                 highWater: int) -> None:
+        self.loop = loop
+        self.conn = conn
+        self.highWater = highWater
+        self.chunks = []
+        self.size = 0
+        self.writer = None
+        self.space = None
+        self.error = None
+
+    async def write(self, chunks: typing.List[bytearray]):
+        if self.error is not None:
+            raise self.error
+        if self.writer is None:
+            chunks = sendChunks(self.conn, chunks)
+            if not chunks:
+                return
+            self.writer = asyncio.ensure_future(
+                self.writeLoop(), loop=self.loop)
+        for chunk in chunks:
+            self.chunks.append(chunk)
+            self.size += len(chunk)
+        while self.size >= self.highWater and self.error is None:
+            self.space = self.loop.create_future()
+            await self.space
+        if self.error is not None:
+            raise self.error
+
+    async def writeLoop(self):
+        try:
+            while self.chunks:
+                chunks, self.chunks = self.chunks, []
+                data = b''.join(chunks)
+                await self.loop.sock_sendall(self.conn, data)
+                self.size -= len(data)
+                self.wake()
+        except OSError as err:
+            self.error = err
+            self.wake()
+        finally:
+            self.writer = None
+
+    def wake(self):
+        if self.space is not None and not self.space.done():
+            self.space.set_result(None)
+
+    async def flush(self):
+        """
+        Wait until everything has been sent.
+        """
+        if self.writer is not None:
+            await asyncio.shield(self.writer)
+        if self.error is not None:
+            raise self.error
 
-            await self.loop.sock_sendall(dst, bs)
+    def cancel(self):
+        if self.writer is not None:
+            self.writer.cancel()
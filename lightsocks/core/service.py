@@ -0,0 +1,146 @@
+import typing
+import socket
+import asyncio
+import logging
+
+from lightsocks.utils import net
+from .cipher import Cipher
+from .securesocket import SecureSocket
+from . import transport
+
+Connection = socket.socket
+logger = logging.getLogger(__name__)
+
+
+class Service(SecureSocket):
+    """
+    Service is a SecureSocket that listens on an address,
+    and handles every accepted connection in its own task.
+
+    It keeps track of the active connections,
+    so it can stop accepting and drain them gracefully.
+    The options are passed to SecureSocket.
+
+    With mptcp, the listener accepts Multipath TCP too, see transport.
+
+    With shards, the services of the same config on the other loops,
+    the accepted connections are handed to them in turn,
+    and drained with this service, see workers.
+    """
+
+    def __init__(self,
+                 loop: asyncio.AbstractEventLoop,
+                 cipher: Cipher,
+                 listenAddr: net.Address,
+                 listener: Connection=None,
+                 mptcp: bool=False,
+                 **options) -> None:
+        super().__init__(loop=loop, cipher=cipher, **options)
+        self.listenAddr = listenAddr
+        self.listener = listener
+        self.mptcp = mptcp
+        self.connections = set()
+        self.acceptor = None
+        self.shards = []
+        self.turn = 0
+
+    @property
+    def active(self) -> int:
+        return len(self.connections) + sum(
+            len(shard.connections) for shard in self.shards)
+
+    def bind(self) -> Connection:
+        """
+        Create the listening socket, unless one has been given,
+        for example inherited from the previous process.
+        """
+        if self.listener is None:
+            listener = transport.createSocket(
+                self.loop, socket.AF_INET, mptcp=self.mptcp)
+            listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            try:
+                listener.setblocking(False)
+                listener.bind(self.listenAddr)
+                listener.listen(socket.SOMAXCONN)
+            except OSError:
+                listener.close()
+                raise
+            self.listener = listener
+        self.listener.setblocking(False)
+        return self.listener
+
+    async def listen(self, didListen: typing.Callable=None):
+        listener = self.bind()
+
+        logger.info('Listen to %s:%d' % listener.getsockname()[:2])
+        if didListen:
+            didListen(listener.getsockname())
+
+        self.acceptor = asyncio.current_task(loop=self.loop)
+        try:
+            while True:
+                connection, address = await self.loop.sock_accept(listener)
+                logger.info('Receive %s:%d', *address[:2])
+                if self.shards:
+                    shard = self.shards[self.turn % len(self.shards)]
+                    self.turn += 1
+                    shard.loop.call_soon_threadsafe(shard.adopt, connection)
+                else:
+                    self.adopt(connection)
+        except asyncio.CancelledError:
+            if self.acceptor is not None:
+                raise
+            # stopAccepting was called, the listener may be handed over
+
+    def adopt(self, connection: Connection):
+        """
+        Handle the connection in a task on the loop of this service.
+        """
+        task = asyncio.ensure_future(
+            self.handleConn(connection), loop=self.loop)
+        self.connections.add(task)
+        task.add_done_callback(self.connections.discard)
+
+    async def handleConn(self, connection: Connection):
+        raise NotImplementedError
+
+    def stopAccepting(self, closeListener: bool=True):
+        """
+        Stop accepting new connections, the active ones keep running.
+        Keep the listener open if it is handed over to another service.
+        """
+        if self.acceptor is not None:
+            self.acceptor.cancel()
+            self.acceptor = None
+        if self.listener is not None:
+            if self.listener.fileno() != -1:
+                self.loop.remove_reader(self.listener.fileno())
+            if closeListener:
+                self.listener.close()
+            self.listener = None
+
+    async def drain(self, timeout: float=None) -> int:
+        """
+        Wait for the active connections up to the timeout,
+        then cancel the remaining ones.
+        Return the number of the connections that have been cancelled.
+        """
+        shards = [
+            asyncio.wrap_future(
+                asyncio.run_coroutine_threadsafe(
+                    shard.drain(timeout), shard.loop),
+                loop=self.loop) for shard in self.shards
+        ]
+        pending = set(self.connections)
+        if pending:
+            _, pending = await asyncio.wait(pending, timeout=timeout)
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.wait(pending)
+            logger.warning('Drop %d connections after %ss', len(pending),
+                           timeout)
+        dropped = len(pending)
+        if shards:
+            dropped += sum(await asyncio.gather(*shards))
+        return dropped
@@ -0,0 +1,482 @@
+"""
+    this module is for the sessions that survive the reconnects
+    of the tunnel between LsLocal and LsServer.
+
+    LsLocal opens a session with a header in front of the SOCKS greeting:
+        +--------+------+------------+
+        | MARKER | KIND | SESSION ID |
+        +--------+------+------------+
+        | X'FD'  | X'01'|     16     |
+        +--------+------+------------+
+    After the SOCKS reply, both sides send frames instead of the raw data:
+        +------+--------+---------+
+        | TYPE | LENGTH | PAYLOAD |
+        +------+--------+---------+
+        |  1   |   2    | LENGTH  |
+        +------+--------+---------+
+    DATA carries the data, ACK the offset of the data received so far,
+    FIN the end of the data, FIN_ACK that the FIN has been received,
+    RESET that the other side has failed.
+
+    The data sent is kept until it is acknowledged, at most replaySize
+    bytes, then the reading waits. The data received is acknowledged
+    every quarter of replaySize, and ACK_DELAY after the last data
+    otherwise, so a sender with a smaller replaySize does not wait
+    for good. When the tunnel is lost,
+    LsServer parks the session with its destination for the grace time,
+    LsLocal dials again and resumes it with:
+        +--------+------+------------+----------+
+        | MARKER | KIND | SESSION ID | RECEIVED |
+        +--------+------+------------+----------+
+        | X'FD'  | X'02'|     16     |    8     |
+        +--------+------+------------+----------+
+    LsServer replies with the status and the offset it has received,
+    BUSY if the session has not noticed the lost tunnel yet:
+        +--------+--------+----------+
+        | MARKER | STATUS | RECEIVED |
+        +--------+--------+----------+
+        | X'FD'  |   1    |    8     |
+        +--------+--------+----------+
+    and both sides send again the data after the offset of the other.
+"""
+import os
+import socket
+import asyncio
+import logging
+import struct
+import typing
+from collections import OrderedDict
+
+from .securesocket import BUFFER_SIZE, SecureSocket
+
+Connection = socket.socket
+logger = logging.getLogger(__name__)
+
+MARKER = 0xfd
+NEW = 0x01
+RESUME = 0x02
+RESUMED = 0x00
+UNKNOWN = 0x01
+BUSY = 0x02
+ID_SIZE = 16
+
+REPLAY_SIZE = 256 * 1024
+GRACE_TIME = 30.0
+MAX_PARKED = 64 * 1024 * 1024
+RETRY_DELAY = 0.5
+MAX_RETRY_DELAY = 5.0
+ACK_DELAY = 0.04
+
+DATA = 0
+ACK = 1
+FIN = 2
+FIN_ACK = 3
+RESET = 4
+
+FRAME = struct.Struct('!BH')
+OFFSET = struct.Struct('!Q')
+MAX_PAYLOAD = 0xffff
+RESUME_SIZE = 2 + ID_SIZE + OFFSET.size
+RESUMED_SIZE = 2 + OFFSET.size
+
+
+def newSessionId() -> bytes:
+    return os.urandom(ID_SIZE)
+
+
+def packNew(sessionId: bytes) -> bytes:
+    return bytes((MARKER, NEW)) + sessionId
+
+
+def packResume(sessionId: bytes, received: int) -> bytes:
+    return bytes((MARKER, RESUME)) + sessionId + OFFSET.pack(received)
+
+
+def packResumed(status: int, received: int=0) -> bytes:
+    return bytes((MARKER, status)) + OFFSET.pack(received)
+
+
+def unpackHeader(buf: bytes) -> typing.Tuple[typing.Optional[int],
+                                             typing.Optional[bytes], int,
+                                             bytes]:
+    """
+    Split the session header from the first data of the tunnel,
+    return its kind, the session id, the offset and the rest,
+    the kind is None if there is no header.
+    """
+    if len(buf) < 2 + ID_SIZE or buf[0] != MARKER:
+        return None, None, 0, buf
+    kind = buf[1]
+    sessionId = bytes(buf[2:2 + ID_SIZE])
+    if kind == RESUME and len(buf) >= RESUME_SIZE:
+        return kind, sessionId, OFFSET.unpack_from(buf, 2 + ID_SIZE)[0], \
+            buf[RESUME_SIZE:]
+    if kind == NEW:
+        return kind, sessionId, 0, buf[2 + ID_SIZE:]
+    return None, None, 0, buf
+
+
+def unpackResumed(buf: bytes) -> typing.Tuple[int, int]:
+    if len(buf) != RESUMED_SIZE or buf[0] != MARKER:
+        return UNKNOWN, 0
+    return buf[1], OFFSET.unpack_from(buf, 2)[0]
+
+
+class Session:
+    """
+    Session relays the plain socket, the client of LsLocal or
+    the destination of LsServer, over the tunnels one after another.
+
+    sent is the offset of the data read from the plain socket,
+    acked the offset the other side has received,
+    the buffer keeps the data between them.
+    flushed is the offset written to the current tunnel.
+    received is the offset of the data written to the plain socket.
+    """
+    __slots__ = ('secureSocket', 'loop', 'sessionId', 'plain', 'replaySize',
+                 'tunnel', 'buffer', 'sent', 'acked', 'flushed', 'received',
+                 'ackedReceived', 'finSent', 'finFlushed', 'finAcked',
+                 'finReceived', 'reset', 'window', 'sending', 'ackTimer')
+
+    def __init__(self,
+                 secureSocket: SecureSocket,
+                 sessionId: bytes,
+                 plain: Connection,
+                 replaySize: int=REPLAY_SIZE) -> None:
+        self.secureSocket = secureSocket
+        self.loop = secureSocket.loop
+        self.sessionId = sessionId
+        self.plain = plain
+        self.replaySize = replaySize
+        self.tunnel = None
+        self.buffer = bytearray()
+        self.sent = 0
+        self.acked = 0
+        self.flushed = 0
+        self.received = 0
+        self.ackedReceived = 0
+        self.finSent = False
+        self.finFlushed = False
+        self.finAcked = False
+        self.finReceived = False
+        self.reset = False
+        self.window = asyncio.Event()
+        self.sending = asyncio.Lock()
+        self.ackTimer = None
+
+    @property
+    def complete(self) -> bool:
+        return self.reset or self.finAcked and self.finReceived
+
+    async def run(self, tunnel: Connection,
+                  lost: typing.Callable[['Session'], typing.Awaitable[bool]]):
+        """
+        Relay until both sides are done. When the tunnel is lost,
+        lost is awaited, it attaches a new tunnel and returns True,
+        or returns False to give the session up.
+        """
+        await self.attach(tunnel, 0)
+        pumping = asyncio.ensure_future(self.pump(), loop=self.loop)
+        try:
+            while True:
+                await self.pull(self.tunnel)
+                if self.complete:
+                    break
+                await self.detach()
+                if not await lost(self):
+                    break
+        finally:
+            pumping.cancel()
+            self.cancelAck()
+            await self.detach()
+            if self.reset:
+                self.resetPlain()
+            self.plain.close()
+
+    async def attach(self, tunnel: Connection, received: int):
+        """
+        Use the tunnel, the other side has received up to the offset.
+        """
+        self.acknowledge(received)
+        self.tunnel = tunnel
+        self.flushed = self.acked
+        self.finFlushed = False
+        await self.flush()
+        if self.finReceived:
+            await self.sendFrame(FIN_ACK)
+
+    async def detach(self):
+        """
+        Drop the tunnel, a write in flight fails on the shutdown,
+        then it is closed.
+        """
+        tunnel, self.tunnel = self.tunnel, None
+        if tunnel is None:
+            return
+        try:
+            tunnel.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        async with self.sending:
+            tunnel.close()
+
+    def acknowledge(self, offset: int):
+        if offset <= self.acked:
+            return
+        del self.buffer[:offset - self.acked]
+        self.acked = offset
+        if len(self.buffer) < self.replaySize:
+            self.window.set()
+
+    async def pump(self):
+        """
+        Read the plain socket into the buffer, and flush it.
+        """
+        while True:
+            while len(self.buffer) >= self.replaySize:
+                self.window.clear()
+                await self.window.wait()
+            try:
+                data = await self.loop.sock_recv(self.plain, BUFFER_SIZE)
+            except OSError:
+                await self.abort()
+                return
+            if not data:
+                self.finSent = True
+                await self.flush()
+                return
+            self.buffer += data
+            self.sent += len(data)
+            await self.flush()
+
+    async def flush(self):
+        """
+        Write the data after flushed to the tunnel, and the FIN.
+        A failed write is not an error, the data is sent again on resume.
+        """
+        async with self.sending:
+            tunnel = self.tunnel
+            if tunnel is None:
+                return
+            frames = bytearray()
+            while self.flushed < self.sent:
+                start = self.flushed - self.acked
+                payload = self.buffer[start:start + MAX_PAYLOAD]
+                frames += FRAME.pack(DATA, len(payload)) + payload
+                self.flushed += len(payload)
+            if self.finSent and not self.finFlushed:
+                frames += FRAME.pack(FIN, 0)
+                self.finFlushed = True
+            await self.write(tunnel, frames)
+
+    async def sendFrame(self, frameType: int, payload: bytes=b''):
+        async with self.sending:
+            if self.tunnel is not None:
+                await self.write(
+                    self.tunnel,
+                    bytearray(FRAME.pack(frameType, len(payload)) + payload))
+
+    async def write(self, tunnel: Connection, frames: bytearray):
+        if not frames:
+            return
+        self.secureSocket.cipher.encode(frames)
+        try:
+            await self.loop.sock_sendall(tunnel, frames)
+        except OSError:
+            # the pull notices it and waits for a new tunnel
+            try:
+                tunnel.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    async def pull(self, tunnel: Connection):
+        """
+        Read the frames of the tunnel until it is lost,
+        or the session is complete.
+        """
+        buf = bytearray()
+        while not self.complete:
+            try:
+                data = await self.loop.sock_recv(tunnel, BUFFER_SIZE)
+            except OSError:
+                return
+            if not data:
+                return
+            data = bytearray(data)
+            self.secureSocket.cipher.decode(data)
+            buf += data
+            while len(buf) >= FRAME.size:
+                frameType, size = FRAME.unpack_from(buf)
+                if len(buf) < FRAME.size + size:
+                    break
+                payload = bytes(buf[FRAME.size:FRAME.size + size])
+                del buf[:FRAME.size + size]
+                await self.handleFrame(frameType, payload)
+                if self.complete:
+                    return
+
+    async def handleFrame(self, frameType: int, payload: bytes):
+        if frameType == DATA:
+            try:
+                await self.loop.sock_sendall(self.plain, payload)
+            except OSError:
+                await self.abort()
+                return
+            self.received += len(payload)
+            if self.received - self.ackedReceived >= self.replaySize // 4:
+                await self.sendAck()
+            elif self.ackTimer is None:
+                self.ackTimer = self.loop.call_later(ACK_DELAY,
+                                                     self.delayedAck)
+        elif frameType == ACK:
+            self.acknowledge(OFFSET.unpack(payload)[0])
+        elif frameType == FIN:
+            if not self.finReceived:
+                self.finReceived = True
+                try:
+                    self.plain.shutdown(socket.SHUT_WR)
+                except OSError:
+                    pass
+            await self.sendAck()
+            await self.sendFrame(FIN_ACK)
+        elif frameType == FIN_ACK:
+            self.finAcked = True
+        elif frameType == RESET:
+            self.reset = True
+
+    def delayedAck(self):
+        self.ackTimer = None
+        if self.received > self.ackedReceived:
+            asyncio.ensure_future(self.sendAck(), loop=self.loop)
+
+    def cancelAck(self):
+        if self.ackTimer is not None:
+            self.ackTimer.cancel()
+            self.ackTimer = None
+
+    async def sendAck(self):
+        self.cancelAck()
+        self.ackedReceived = self.received
+        await self.sendFrame(ACK, OFFSET.pack(self.received))
+
+    async def abort(self):
+        """
+        The plain socket has failed, tell the other side and give up.
+        """
+        self.reset = True
+        await self.sendFrame(RESET)
+        if self.tunnel is not None:
+            try:
+                self.tunnel.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def resetPlain(self):
+        try:
+            self.plain.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
+                                  struct.pack('ii', 1, 0))
+        except OSError:
+            pass
+
+
+class Sessions:
+    """
+    Sessions keeps the sessions of LsServer, so they can be resumed.
+    A session whose tunnel is lost is parked for the grace time.
+    At most maxParked bytes of replay buffers are parked,
+    the session parked first is given up to park one more.
+    """
+
+    def __init__(self,
+                 loop: asyncio.AbstractEventLoop,
+                 graceTime: float=GRACE_TIME,
+                 replaySize: int=REPLAY_SIZE,
+                 maxParked: int=MAX_PARKED) -> None:
+        self.loop = loop
+        self.graceTime = graceTime
+        self.replaySize = replaySize
+        self.maxParked = maxParked
+        self.sessions = {}
+        self.parked = OrderedDict()
+        self.resumed = 0
+        self.expired = 0
+
+    async def serve(self, secureSocket: SecureSocket, sessionId: bytes,
+                    tunnel: Connection, dstServer: Connection):
+        if sessionId in self.sessions:
+            tunnel.close()
+            dstServer.close()
+            return
+        session = Session(secureSocket, sessionId, dstServer, self.replaySize)
+        self.sessions[sessionId] = session
+        try:
+            await session.run(tunnel, self.park)
+        finally:
+            self.sessions.pop(sessionId, None)
+            self.parked.pop(sessionId, None)
+
+    async def park(self, session: Session) -> bool:
+        """
+        Wait for the session to be resumed within the grace time.
+        """
+        while self.parked and \
+                (len(self.parked) + 1) * self.replaySize > self.maxParked:
+            _, waiter = self.parked.popitem(last=False)
+            if not waiter.done():
+                waiter.set_result(False)
+        waiter = self.loop.create_future()
+        self.parked[session.sessionId] = waiter
+        logger.info('Park session %s', session.sessionId.hex())
+        try:
+            return await asyncio.wait_for(waiter, self.graceTime)
+        except asyncio.TimeoutError:
+            self.expired += 1
+            logger.info('Session %s expired', session.sessionId.hex())
+            return False
+        finally:
+            if self.parked.get(session.sessionId) is waiter:
+                del self.parked[session.sessionId]
+
+    async def resume(self, secureSocket: SecureSocket, sessionId: bytes,
+                     received: int, tunnel: Connection):
+        """
+        Attach the tunnel to the parked session,
+        the other side has received up to the offset.
+        """
+        session = self.sessions.get(sessionId)
+        waiter = self.parked.pop(sessionId, None)
+        status = UNKNOWN
+        if session is not None and waiter is None:
+            # the old tunnel is dead for LsLocal, park it at once
+            if session.tunnel is not None:
+                try:
+                    session.tunnel.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+            status = BUSY
+        elif session is None or waiter.done() or \
+                not session.acked <= received <= session.sent:
+            if waiter is not None and not waiter.done():
+                waiter.set_result(False)
+        else:
+            status = RESUMED
+        if status != RESUMED:
+            try:
+                await secureSocket.encodeWrite(
+                    tunnel, bytearray(packResumed(status)))
+            except OSError:
+                pass
+            tunnel.close()
+            return
+        try:
+            await secureSocket.encodeWrite(
+                tunnel, bytearray(packResumed(RESUMED, session.received)))
+        except OSError:
+            tunnel.close()
+            # the session waits for the next one
+            self.parked[sessionId] = waiter
+            return
+        self.resumed += 1
+        await session.attach(tunnel, received)
+        if not waiter.done():
+            waiter.set_result(True)
@@ -0,0 +1,83 @@
+import asyncio
+import socket
+import struct
+import unittest
+
+from lightsocks.core.cipher import Cipher
+from lightsocks.core.password import randomPassword
+from lightsocks.core.relay import Relay
+from lightsocks.core.securesocket import SecureSocket
+
+
+class TestRelay(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.cipher = Cipher.NewCipher(randomPassword())
+        self.secureSocket = SecureSocket(loop=self.loop, cipher=self.cipher)
+        self.user_client, self.client = socket.socketpair()
+        self.upstream, self.dst_server = socket.socketpair()
+        for sock in (self.user_client, self.client, self.upstream,
+                     self.dst_server):
+            sock.setblocking(False)
+        self.relay = Relay(
+            self.secureSocket,
+            client=self.client,
+            upstream=self.upstream,
+            toUpstream=self.cipher.encode,
+            toClient=self.cipher.decode)
+
+    def tearDown(self):
+        for sock in (self.user_client, self.dst_server):
+            sock.close()
+        self.loop.close()
+
+    def test_run(self):
+        msg = bytearray(b'hello world')
+        encrypted_msg = msg.copy()
+        self.cipher.encode(encrypted_msg)
+
+        async def test():
+            running = asyncio.ensure_future(self.relay.run())
+            await self.loop.sock_sendall(self.user_client, msg)
+            received_msg = await self.loop.sock_recv(self.dst_server, 1024)
+            self.assertEqual(received_msg, encrypted_msg)
+            # one more task besides the one that runs the relay
+            self.assertEqual(len(asyncio.all_tasks()), 3)
+
+            # the end of the client is passed on, the other way goes on
+            self.user_client.shutdown(socket.SHUT_WR)
+            self.assertEqual(await self.loop.sock_recv(self.dst_server, 1024),
+                             b'')
+            await self.loop.sock_sendall(self.dst_server, encrypted_msg)
+            received_msg = await self.loop.sock_recv(self.user_client, 1024)
+            self.assertEqual(received_msg, msg)
+
+            self.dst_server.shutdown(socket.SHUT_WR)
+            await asyncio.wait_for(running, 1)
+
+        self.loop.run_until_complete(test())
+        self.assertEqual(self.client.fileno(), -1)
+        self.assertEqual(self.upstream.fileno(), -1)
+
+    def test_abort(self):
+        async def test():
+            running = asyncio.ensure_future(self.relay.run())
+            await asyncio.sleep(0)
+            # reset the upstream, the relay must not wait for the client
+            self.dst_server.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
+                                       struct.pack('ii', 1, 0))
+            self.dst_server.close()
+            await self.loop.sock_sendall(self.user_client, b'hello')
+            await asyncio.wait_for(running, 1)
+
+        self.loop.run_until_complete(test())
+        self.assertEqual(self.client.fileno(), -1)
+
+    def test_reset_on_abort(self):
+        self.relay.resetOnAbort = True
+        self.relay.abort()
+        linger = self.upstream.getsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
+                                          struct.calcsize('ii'))
+        self.assertEqual(struct.unpack('ii', linger), (1, 0))
+        self.client.close()
+        self.upstream.close()
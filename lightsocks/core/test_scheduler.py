@@ -0,0 +1,78 @@
+import asyncio
+import unittest
+
+from lightsocks.core.scheduler import (BULK, INTERACTIVE, QUANTUM,
+                                       Scheduler)
+
+
+class TestScheduler(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.scheduler = Scheduler(self.loop, budget=2 * QUANTUM)
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_classify(self):
+        flow = self.scheduler.flow()
+        self.assertTrue(flow.interactive)
+        for _ in range(10):
+            flow.account(64)
+        self.assertTrue(flow.interactive)
+        flow.account(QUANTUM)
+        self.assertFalse(flow.interactive)
+
+        self.assertTrue(self.scheduler.flow(INTERACTIVE).interactive)
+        self.assertFalse(self.scheduler.flow(BULK).interactive)
+
+    def test_interactive_never_waits(self):
+        flow = self.scheduler.flow(INTERACTIVE)
+        for _ in range(10):
+            flow.account(QUANTUM)
+            self.assertIsNone(flow.admit())
+
+    def test_round_robin(self):
+        async def test():
+            flows = [self.scheduler.flow(BULK) for _ in range(3)]
+            for flow in flows:
+                # the first read is free
+                self.assertIsNone(flow.admit())
+                flow.account(QUANTUM)
+            waiters = [flow.admit() for flow in flows]
+            self.assertTrue(all(waiters))
+
+            # the budget of a round is two quanta
+            await asyncio.sleep(0)
+            self.assertEqual([waiter.done() for waiter in waiters],
+                             [True, True, False])
+            await asyncio.sleep(0)
+            self.assertTrue(waiters[2].done())
+
+        self.loop.run_until_complete(test())
+
+    def test_deficit(self):
+        async def test():
+            flow = self.scheduler.flow(BULK)
+            flow.account(3 * QUANTUM)
+            waiter = flow.admit()
+            # it has read two quanta ahead, it waits three rounds
+            for _ in range(2):
+                await asyncio.sleep(0)
+                self.assertFalse(waiter.done())
+            await asyncio.sleep(0)
+            self.assertTrue(waiter.done())
+
+        self.loop.run_until_complete(test())
+
+    def test_cancelled(self):
+        async def test():
+            first, second = (self.scheduler.flow(BULK) for _ in range(2))
+            for flow in (first, second):
+                flow.account(QUANTUM + 1)
+            first.admit().cancel()
+            waiter = second.admit()
+            await asyncio.sleep(0)
+            self.assertTrue(waiter.done())
+            self.assertFalse(self.scheduler.waiting)
+
+        self.loop.run_until_complete(test())
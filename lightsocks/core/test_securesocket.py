@@ -1,10 +1,12 @@
 import asyncio
+import os
 import socket
 import unittest
 
 from lightsocks.core.cipher import Cipher
 from lightsocks.core.password import randomPassword
-from lightsocks.core.securesocket import SecureSocket
+from lightsocks.core.securesocket import (FLUSH_SIZE, PIPELINE_SIZE,
+                                          SecureSocket, WriteBuffer)
 
 
 class TestSecuresocket(unittest.TestCase):
@@ -75,3 +77,189 @@ class TestSecuresocket(unittest.TestCase):
         self.assertEqual(bytearray(received_msg), self.encripted_msg * 10)
 
         ls_local_conn.close()
+
+
+class CountingSocket(socket.socket):
+    """
+    CountingSocket counts the write calls.
+    """
+    writes = 0
+
+    def send(self, data, *args):
+        self.writes += 1
+        return super().send(data, *args)
+
+    def sendmsg(self, buffers, *args):
+        self.writes += 1
+        return super().sendmsg(buffers, *args)
+
+
+class TestCoalescing(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.cipher = Cipher.NewCipher(randomPassword())
+        self.user_client, src = socket.socketpair()
+        dst, self.ls_server = socket.socketpair()
+        self.src = CountingSocket(fileno=src.detach())
+        self.dst = CountingSocket(fileno=dst.detach())
+        self.src.setblocking(False)
+        self.dst.setblocking(False)
+        self.msg = bytearray(b'hello world')
+
+    def tearDown(self):
+        self.loop.close()
+        for sock in (self.user_client, self.src, self.dst, self.ls_server):
+            sock.close()
+
+    def recvAll(self):
+        received = bytearray()
+        self.ls_server.settimeout(1)
+        while True:
+            data = self.ls_server.recv(65536)
+            if not data:
+                break
+            received.extend(data)
+        return received
+
+    def test_read_ready_data_at_once(self):
+        securesocket = SecureSocket(loop=self.loop, cipher=self.cipher)
+        payload = self.msg * 1000
+        self.user_client.sendall(payload)
+        self.user_client.close()
+
+        self.loop.run_until_complete(
+            securesocket.encodeCopy(self.dst, self.src))
+        self.dst.close()
+
+        self.cipher.encode(payload)
+        self.assertEqual(self.recvAll(), payload)
+        # 11 KB that are ready are read and sent at once
+        self.assertEqual(self.dst.writes, 1)
+
+    def test_flushSize(self):
+        securesocket = SecureSocket(
+            loop=self.loop, cipher=self.cipher, flushSize=4096)
+        payload = self.msg * 1000
+        self.user_client.sendall(payload)
+        self.user_client.close()
+
+        self.loop.run_until_complete(
+            securesocket.decodeCopy(self.dst, self.src))
+        self.dst.close()
+
+        self.cipher.decode(payload)
+        self.assertEqual(self.recvAll(), payload)
+        self.assertEqual(self.dst.writes, 3)
+
+    def test_flushDelay(self):
+        securesocket = SecureSocket(
+            loop=self.loop, cipher=self.cipher, flushDelay=0.05)
+
+        async def dribble():
+            for _ in range(3):
+                self.user_client.send(self.msg)
+                await asyncio.sleep(0.005)
+            self.user_client.close()
+
+        async def test():
+            await asyncio.gather(
+                securesocket.encodeCopy(self.dst, self.src), dribble())
+
+        self.loop.run_until_complete(test())
+        self.dst.close()
+
+        payload = self.msg * 3
+        self.cipher.encode(payload)
+        self.assertEqual(self.recvAll(), payload)
+        self.assertLessEqual(self.dst.writes, 3)
+
+
+class ReadingSocket(socket.socket):
+    """
+    ReadingSocket counts the bytes that have been read.
+    """
+    received = 0
+
+    def recv(self, size, *args):
+        data = super().recv(size, *args)
+        self.received += len(data)
+        return data
+
+
+class TestPipeline(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.cipher = Cipher.NewCipher(randomPassword())
+        self.payload = bytearray(os.urandom(1024 * 1024))
+
+    def tearDown(self):
+        self.loop.close()
+
+    def readAhead(self, pipelineSize: int) -> int:
+        """
+        Return the bytes read from the src
+        while nothing is read from the dst.
+        """
+        securesocket = SecureSocket(
+            loop=self.loop, cipher=self.cipher, pipelineSize=pipelineSize)
+        user_client, src = socket.socketpair()
+        dst, ls_server = socket.socketpair()
+        src = ReadingSocket(fileno=src.detach())
+        for sock in (user_client, src, dst):
+            sock.setblocking(False)
+
+        async def send():
+            await self.loop.sock_sendall(user_client, self.payload)
+            user_client.close()
+
+        async def test():
+            sending = asyncio.ensure_future(send())
+            copying = asyncio.ensure_future(securesocket.copy(dst, src))
+            await asyncio.sleep(0.1)
+            received = src.received
+
+            receiving = self.loop.run_in_executor(None, self.recvAll,
+                                                  ls_server)
+            await asyncio.wait_for(asyncio.gather(sending, copying), 5)
+            dst.close()
+            self.assertEqual(await receiving, self.payload)
+            return received
+
+        try:
+            return self.loop.run_until_complete(test())
+        finally:
+            for sock in (src, dst, ls_server):
+                sock.close()
+
+    def recvAll(self, conn):
+        received = bytearray()
+        conn.settimeout(5)
+        while True:
+            data = conn.recv(65536)
+            if not data:
+                return received
+            received.extend(data)
+
+    def test_read_ahead(self):
+        serial = self.readAhead(0)
+        pipelined = self.readAhead(PIPELINE_SIZE)
+        self.assertGreaterEqual(pipelined - serial,
+                                PIPELINE_SIZE - FLUSH_SIZE)
+
+    def test_writer_error(self):
+        dst, peer = socket.socketpair()
+        dst.setblocking(False)
+        buffer = WriteBuffer(self.loop, dst, PIPELINE_SIZE)
+
+        async def test():
+            # more than the socket takes, the rest is left to the writer
+            await buffer.write([bytearray(PIPELINE_SIZE // 2)] * 8)
+            peer.close()
+            with self.assertRaises(OSError):
+                await asyncio.wait_for(buffer.flush(), 1)
+
+        try:
+            self.loop.run_until_complete(test())
+        finally:
+            buffer.cancel()
+            dst.close()
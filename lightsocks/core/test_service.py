@@ -0,0 +1,113 @@
+import asyncio
+import socket
+import unittest
+
+from lightsocks.core.cipher import Cipher
+from lightsocks.core.password import randomPassword
+from lightsocks.core.service import Service
+from lightsocks.utils import net
+
+
+class EchoService(Service):
+    async def handleConn(self, connection):
+        with connection:
+            while True:
+                data = await self.loop.sock_recv(connection, 1024)
+                if not data:
+                    break
+                await self.loop.sock_sendall(connection, data)
+
+
+class TestService(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.cipher = Cipher.NewCipher(randomPassword())
+        self.service = EchoService(
+            loop=self.loop,
+            cipher=self.cipher,
+            listenAddr=net.Address('127.0.0.1', 0))
+
+    def tearDown(self):
+        self.service.stopAccepting()
+        self.loop.close()
+
+    async def connect(self, address):
+        client = socket.socket()
+        client.setblocking(False)
+        await self.loop.sock_connect(client, address)
+        return client
+
+    async def echo(self, client, msg=b'hello world'):
+        await self.loop.sock_sendall(client, msg)
+        return await self.loop.sock_recv(client, 1024)
+
+    def test_drain(self):
+        async def test():
+            listening = asyncio.ensure_future(self.service.listen())
+            await asyncio.sleep(0)
+            address = self.service.listener.getsockname()
+
+            client = await self.connect(address)
+            self.assertEqual(await self.echo(client), b'hello world')
+            self.assertEqual(len(self.service.connections), 1)
+
+            self.service.stopAccepting()
+            await listening
+            with self.assertRaises(ConnectionRefusedError):
+                await self.connect(address)
+
+            # the active connection is still served while draining
+            draining = asyncio.ensure_future(self.service.drain(1))
+            self.assertEqual(await self.echo(client), b'hello world')
+            client.close()
+            self.assertEqual(await draining, 0)
+            self.assertFalse(self.service.connections)
+
+        self.loop.run_until_complete(test())
+
+    def test_drain_timeout(self):
+        async def test():
+            asyncio.ensure_future(self.service.listen())
+            await asyncio.sleep(0)
+            address = self.service.listener.getsockname()
+
+            with await self.connect(address) as client:
+                self.assertEqual(await self.echo(client), b'hello world')
+                self.service.stopAccepting()
+
+                self.assertEqual(await self.service.drain(0.01), 1)
+                self.assertFalse(self.service.connections)
+                self.assertEqual(await self.loop.sock_recv(client, 1024),
+                                 b'')
+
+        self.loop.run_until_complete(test())
+
+    def test_hand_over_listener(self):
+        async def test():
+            asyncio.ensure_future(self.service.listen())
+            await asyncio.sleep(0)
+            listener = self.service.listener
+            address = listener.getsockname()
+            client = await self.connect(address)
+            self.assertEqual(await self.echo(client), b'hello world')
+
+            self.service.stopAccepting(closeListener=False)
+            successor = EchoService(
+                loop=self.loop,
+                cipher=self.cipher,
+                listenAddr=net.Address('127.0.0.1', 0),
+                listener=listener)
+            asyncio.ensure_future(successor.listen())
+            await asyncio.sleep(0)
+
+            with await self.connect(address) as other:
+                self.assertEqual(await self.echo(other), b'hello world')
+            self.assertEqual(await self.echo(client), b'hello world')
+            self.assertEqual(len(self.service.connections), 1)
+
+            client.close()
+            self.assertEqual(await self.service.drain(1), 0)
+            successor.stopAccepting()
+            await successor.drain(0)
+
+        self.loop.run_until_complete(test())
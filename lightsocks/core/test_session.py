@@ -0,0 +1,164 @@
+import asyncio
+import socket
+import unittest
+
+from lightsocks.core import session
+from lightsocks.core.cipher import Cipher
+from lightsocks.core.password import randomPassword
+from lightsocks.core.securesocket import SecureSocket
+
+
+def socketpair():
+    pair = socket.socketpair()
+    for sock in pair:
+        sock.setblocking(False)
+    return pair
+
+
+class TestHeader(unittest.TestCase):
+    def test_unpack(self):
+        sessionId = session.newSessionId()
+        self.assertEqual(
+            session.unpackHeader(session.packNew(sessionId) + b'\x05'),
+            (session.NEW, sessionId, 0, b'\x05'))
+        self.assertEqual(
+            session.unpackHeader(session.packResume(sessionId, 42)),
+            (session.RESUME, sessionId, 42, b''))
+        self.assertEqual(
+            session.unpackHeader(b'\x05\x01\x00'), (None, None, 0,
+                                                    b'\x05\x01\x00'))
+        self.assertEqual(
+            session.unpackResumed(session.packResumed(session.RESUMED, 7)),
+            (session.RESUMED, 7))
+        self.assertEqual(session.unpackResumed(b''), (session.UNKNOWN, 0))
+
+
+class TestSession(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.secureSocket = SecureSocket(
+            loop=self.loop, cipher=Cipher.NewCipher(randomPassword()))
+        self.client, localPlain = socketpair()
+        self.dst, serverPlain = socketpair()
+        sessionId = session.newSessionId()
+        self.local = session.Session(
+            self.secureSocket, sessionId, localPlain, replaySize=1024)
+        self.server = session.Session(
+            self.secureSocket, sessionId, serverPlain, replaySize=1024)
+        self.tunnels = asyncio.Queue()
+
+    def tearDown(self):
+        self.client.close()
+        self.dst.close()
+        self.loop.close()
+
+    async def lost(self, resumable):
+        """
+        Both sides wait for the next tunnel, the local one resumes it.
+        """
+        tunnel = await self.tunnels.get()
+        if tunnel is None:
+            return False
+        peer = self.server if resumable is self.local else self.local
+        await resumable.attach(tunnel, peer.received)
+        return True
+
+    async def recvExactly(self, conn, size):
+        buf = b''
+        while len(buf) < size:
+            data = await self.loop.sock_recv(conn, size - len(buf))
+            if not data:
+                break
+            buf += data
+        return buf
+
+    def test_resume(self):
+        data = bytes(range(256)) * 40
+
+        async def test():
+            localTunnel, serverTunnel = socketpair()
+            running = asyncio.gather(
+                self.local.run(localTunnel, self.lost),
+                self.server.run(serverTunnel, self.lost))
+            await self.loop.sock_sendall(self.client, data[:5000])
+            self.assertEqual(await self.recvExactly(self.dst, 5000),
+                             data[:5000])
+
+            # the tunnel is lost, the data goes on in the buffer
+            self.local.tunnel.shutdown(socket.SHUT_RDWR)
+            await self.loop.sock_sendall(self.client, data[5000:])
+            await self.loop.sock_sendall(self.dst, b'from the destination')
+            await asyncio.sleep(0.01)
+            self.assertIsNone(self.local.tunnel)
+            self.assertLessEqual(len(self.local.buffer), 1024)
+
+            for tunnel in socketpair():
+                self.tunnels.put_nowait(tunnel)
+            self.assertEqual(
+                await self.recvExactly(self.dst, len(data) - 5000),
+                data[5000:])
+            self.assertEqual(await self.recvExactly(self.client, 20),
+                             b'from the destination')
+
+            self.client.shutdown(socket.SHUT_WR)
+            self.assertEqual(await self.loop.sock_recv(self.dst, 1024), b'')
+            self.dst.shutdown(socket.SHUT_WR)
+            self.assertEqual(await self.loop.sock_recv(self.client, 1024),
+                             b'')
+            await asyncio.wait_for(running, 1)
+
+        self.loop.run_until_complete(test())
+        self.assertTrue(self.local.complete and self.server.complete)
+        self.assertEqual(self.local.received, 20)
+        self.assertEqual(self.server.received, len(data))
+
+    def test_replay_sizes(self):
+        data = bytes(range(256)) * 80
+        # the receiver acknowledges every quarter of its own size,
+        # more than the sender keeps
+        self.server.replaySize = 8192
+
+        async def test():
+            localTunnel, serverTunnel = socketpair()
+            running = asyncio.gather(
+                self.local.run(localTunnel, self.lost),
+                self.server.run(serverTunnel, self.lost))
+            await self.loop.sock_sendall(self.client, data)
+            self.assertEqual(
+                await asyncio.wait_for(
+                    self.recvExactly(self.dst, len(data)), 5), data)
+            self.client.shutdown(socket.SHUT_WR)
+            self.dst.shutdown(socket.SHUT_WR)
+            await asyncio.wait_for(running, 1)
+
+        self.loop.run_until_complete(test())
+        self.assertEqual(self.local.acked, len(data))
+
+    def test_give_up(self):
+        async def test():
+            localTunnel, serverTunnel = socketpair()
+            running = asyncio.gather(
+                self.local.run(localTunnel, self.lost),
+                self.server.run(serverTunnel, self.lost))
+            await asyncio.sleep(0)
+            localTunnel.shutdown(socket.SHUT_RDWR)
+            self.tunnels.put_nowait(None)
+            self.tunnels.put_nowait(None)
+            await asyncio.wait_for(running, 1)
+            self.assertEqual(await self.loop.sock_recv(self.dst, 1024), b'')
+
+        self.loop.run_until_complete(test())
+
+    def test_reset(self):
+        async def test():
+            localTunnel, serverTunnel = socketpair()
+            running = asyncio.gather(
+                self.local.run(localTunnel, self.lost),
+                self.server.run(serverTunnel, self.lost))
+            await asyncio.sleep(0)
+            self.dst.close()
+            await self.loop.sock_sendall(self.client, b'hello')
+            await asyncio.wait_for(running, 1)
+            self.assertTrue(self.local.reset)
+
+        self.loop.run_until_complete(test())
@@ -0,0 +1,206 @@
+import asyncio
+import socket
+import unittest
+
+from lightsocks.core import transport
+from lightsocks.core.password import randomPassword
+from lightsocks.core.relay import LINGER_RESET
+from lightsocks.local import LsLocal
+from lightsocks.server import LsServer
+from lightsocks.utils import net, socks
+
+
+class TestMemorySocket(unittest.TestCase):
+    def setUp(self):
+        self.loop = transport.MemoryLoop(pipeSize=16)
+        self.listener = transport.createSocket(self.loop)
+        self.listener.bind(('10.0.0.1', 80))
+        self.listener.listen()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def connect(self):
+        async def test():
+            client = transport.createSocket(self.loop)
+            await self.loop.sock_connect(client, ('10.0.0.1', 80))
+            server, address = await self.loop.sock_accept(self.listener)
+            self.assertEqual(address, client.getsockname())
+            self.assertEqual(server.getpeername(), client.getsockname())
+            return client, server
+
+        return self.loop.run_until_complete(test())
+
+    def test_refused(self):
+        client = transport.createSocket(self.loop)
+        with self.assertRaises(ConnectionRefusedError):
+            self.loop.run_until_complete(
+                self.loop.sock_connect(client, ('10.0.0.1', 81)))
+
+    def test_send_recv(self):
+        client, server = self.connect()
+
+        async def test():
+            # the pipe holds 16 bytes, sendall waits for the reader
+            sending = asyncio.ensure_future(
+                self.loop.sock_sendall(client, b'x' * 40), loop=self.loop)
+            received = b''
+            while len(received) < 40:
+                received += await self.loop.sock_recv(server, 1024)
+            await sending
+            self.assertEqual(received, b'x' * 40)
+
+            client.shutdown(socket.SHUT_WR)
+            self.assertEqual(await self.loop.sock_recv(server, 1024), b'')
+            with self.assertRaises(BrokenPipeError):
+                client.send(b'x')
+
+        self.loop.run_until_complete(test())
+
+    def test_close(self):
+        client, server = self.connect()
+
+        async def test():
+            reading = asyncio.ensure_future(
+                self.loop.sock_recv(server, 1024), loop=self.loop)
+            await asyncio.sleep(0)
+            client.close()
+            self.assertEqual(await reading, b'')
+            with self.assertRaises(ConnectionResetError):
+                server.send(b'x')
+            with self.assertRaises(OSError):
+                await self.loop.sock_recv(client, 1024)
+
+        self.loop.run_until_complete(test())
+
+    def test_reset(self):
+        client, server = self.connect()
+        client.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, LINGER_RESET)
+        client.close()
+        with self.assertRaises(ConnectionResetError):
+            server.recv(1024)
+
+    def test_add_reader(self):
+        client, server = self.connect()
+
+        async def test():
+            readable = self.loop.create_future()
+            self.loop.add_reader(server.fileno(), readable.set_result, True)
+            client.send(b'x')
+            self.assertTrue(await readable)
+            self.assertTrue(self.loop.remove_reader(server.fileno()))
+
+        self.loop.run_until_complete(test())
+
+
+class TestMemoryRelay(unittest.TestCase):
+    """
+    LsLocal and LsServer relay a SOCKS5 connection
+    to an echo destination, all of them in the memory.
+    """
+
+    def setUp(self):
+        self.loop = transport.MemoryLoop()
+        password = randomPassword()
+        self.local = LsLocal(
+            loop=self.loop,
+            password=password,
+            listenAddr=net.Address('10.0.0.1', 1080),
+            remoteAddr=net.Address('10.0.0.2', 8388))
+        self.server = LsServer(
+            loop=self.loop,
+            password=password,
+            listenAddr=net.Address('10.0.0.2', 8388))
+
+    def tearDown(self):
+        self.loop.close()
+
+    async def echo(self, listener):
+        conn, _ = await self.loop.sock_accept(listener)
+        with conn:
+            while True:
+                data = await self.loop.sock_recv(conn, 1024)
+                if not data:
+                    break
+                await self.loop.sock_sendall(conn, data)
+
+    def test_relay(self):
+        async def test():
+            dst = transport.createSocket(self.loop)
+            dst.bind(('10.0.0.3', 7))
+            dst.listen()
+            asyncio.ensure_future(self.echo(dst), loop=self.loop)
+            asyncio.ensure_future(self.server.listen(), loop=self.loop)
+            asyncio.ensure_future(self.local.listen(), loop=self.loop)
+            await asyncio.sleep(0)
+
+            client = await net.connect(self.loop, '10.0.0.1', 1080)
+            await self.loop.sock_sendall(client, b'\x05\x01\x00')
+            self.assertEqual(await self.loop.sock_recv(client, 2),
+                             socks.METHOD_SELECTION)
+            await self.loop.sock_sendall(
+                client, b'\x05\x01\x00\x01' +
+                socket.inet_aton('10.0.0.3') + (7).to_bytes(2, 'big'))
+            reply = await self.loop.sock_recv(client, 10)
+            self.assertEqual(reply[1], 0x00)
+
+            msg = b'hello world' * 1000
+            await self.loop.sock_sendall(client, msg)
+            client.shutdown(socket.SHUT_WR)
+            received = b''
+            while True:
+                data = await self.loop.sock_recv(client, 4096)
+                if not data:
+                    break
+                received += data
+            client.close()
+            self.assertEqual(received, msg)
+
+            self.server.stopAccepting()
+            self.local.stopAccepting()
+            await self.server.drain(1)
+            await self.local.drain(1)
+
+        self.loop.run_until_complete(asyncio.wait_for(test(), 5))
+
+
+class TestMptcp(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_createSocket(self):
+        with transport.createSocket(self.loop, socket.AF_INET,
+                                    socket.SOCK_DGRAM, mptcp=True) as conn:
+            self.assertEqual(conn.proto, 0)
+        memoryLoop = transport.MemoryLoop()
+        conn = transport.createSocket(memoryLoop, mptcp=True)
+        self.assertIsInstance(conn, transport.MemorySocket)
+        conn.close()
+        memoryLoop.close()
+        if not transport.mptcpSupported():
+            self.skipTest('MPTCP is not supported')
+        with transport.createSocket(self.loop, mptcp=True) as conn:
+            self.assertEqual(conn.proto, transport.IPPROTO_MPTCP)
+
+    def test_connect(self):
+        if not transport.mptcpSupported():
+            self.skipTest('MPTCP is not supported')
+
+        async def test():
+            with socket.socket() as listener:
+                listener.bind(('127.0.0.1', 0))
+                listener.listen()
+                address = listener.getsockname()
+                # the plain TCP listener, the kernel falls back to TCP
+                with transport.createSocket(self.loop, mptcp=True) as conn:
+                    await transport.connect(self.loop, conn, address)
+                    accepted, _ = listener.accept()
+                    accepted.close()
+            with transport.createSocket(self.loop, mptcp=True) as conn:
+                with self.assertRaises(ConnectionRefusedError):
+                    await transport.connect(self.loop, conn, address)
+
+        self.loop.run_until_complete(test())
@@ -0,0 +1,474 @@
+"""
+    this module is for running the services without the network of the kernel.
+
+    The services use the sockets only through the sock_* methods
+    and add_reader of the loop, and the few methods of the sockets
+    like shutdown and close. MemoryLoop is an event loop that serves
+    these for MemorySocket, a pair of connected MemorySockets passes
+    the bytes through two Pipes in the process.
+    The real sockets are still served by the loop as before,
+    so one side of a test may be a real socket.
+
+    createSocket creates the sockets that the services listen on
+    and connect with, the memory ones on a MemoryLoop.
+    The names are not resolved on a MemoryLoop, the IP addresses
+    are the addresses of the listeners.
+
+    With mptcp, the TCP sockets are created as Multipath TCP,
+    a connection may then use several paths at once, one subflow each,
+    the kernel falls back to TCP when the peer does not support it.
+    Without the support of the kernel, they are plain TCP sockets.
+"""
+import asyncio
+import errno
+import ipaddress
+import itertools
+import socket
+import struct
+import typing
+
+# the bytes one direction of a connection holds, like the socket buffers
+PIPE_SIZE = 256 * 1024
+EPHEMERAL_PORTS = range(32768, 61000)
+
+LINGER = struct.Struct('ii')
+
+# linux/in.h, Linux 5.6
+IPPROTO_MPTCP = getattr(socket, 'IPPROTO_MPTCP', 262)
+MPTCP_UNSUPPORTED = (errno.EPROTONOSUPPORT, errno.ENOPROTOOPT, errno.EINVAL,
+                     errno.EAFNOSUPPORT)
+
+
+def createSocket(loop: asyncio.AbstractEventLoop,
+                 family: int=socket.AF_INET,
+                 type: int=socket.SOCK_STREAM,
+                 proto: int=0,
+                 mptcp: bool=False) -> socket.socket:
+    """
+    Create a non-blocking socket, a MemorySocket on a MemoryLoop.
+    With mptcp, a stream socket of IPv4 or IPv6 is Multipath TCP
+    if the kernel supports it.
+    """
+    if isinstance(loop, MemoryLoop):
+        return loop.createSocket(family, type, proto)
+    conn = None
+    if (mptcp and type == socket.SOCK_STREAM and
+            proto in (0, socket.IPPROTO_TCP) and
+            family in (socket.AF_INET, socket.AF_INET6)):
+        try:
+            conn = socket.socket(family, type, IPPROTO_MPTCP)
+        except OSError as err:
+            if err.errno not in MPTCP_UNSUPPORTED:
+                raise
+    if conn is None:
+        conn = socket.socket(family, type, proto)
+    conn.setblocking(False)
+    return conn
+
+
+async def connect(loop: asyncio.AbstractEventLoop, conn: socket.socket,
+                  address: tuple):
+    """
+    loop.sock_connect to the resolved address, for Multipath TCP too,
+    the address of which asyncio resolves again with its proto and fails.
+    """
+    if getattr(conn, 'proto', 0) != IPPROTO_MPTCP:
+        await loop.sock_connect(conn, address)
+        return
+    try:
+        conn.connect(address)
+        return
+    except (BlockingIOError, InterruptedError):
+        pass
+    fd = conn.fileno()
+    writable = loop.create_future()
+    loop.add_writer(fd, lambda: writable.done() or writable.set_result(None))
+    try:
+        await writable
+    finally:
+        loop.remove_writer(fd)
+    err = conn.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+    if err:
+        raise OSError(err, 'Connect call failed %s' % (address, ))
+
+
+def mptcpSupported() -> bool:
+    """
+    Return True if the kernel creates Multipath TCP sockets.
+    """
+    try:
+        socket.socket(socket.AF_INET, socket.SOCK_STREAM,
+                      IPPROTO_MPTCP).close()
+    except OSError:
+        return False
+    return True
+
+
+class Pipe:
+    """
+    Pipe is one direction of a connection, the writer appends
+    up to size bytes, the reader takes them.
+    eof is set by the shutdown or the close of the writer,
+    reset by its close with a zero linger.
+    """
+    __slots__ = ('data', 'size', 'eof', 'reset', 'readerClosed', 'reader',
+                 'writer')
+
+    def __init__(self, size: int=PIPE_SIZE) -> None:
+        self.data = bytearray()
+        self.size = size
+        self.eof = False
+        self.reset = False
+        self.readerClosed = False
+        self.reader = None
+        self.writer = None
+
+    def changed(self):
+        for conn in (self.reader, self.writer):
+            if conn is not None:
+                conn.wake()
+
+
+class MemorySocket:
+    """
+    MemorySocket has the methods of a non-blocking socket
+    that the services use. Its fileno is a negative number,
+    so the loop can tell it from the real file descriptors.
+    """
+    _fds = itertools.count(-2, -1)
+
+    def __init__(self, loop: 'MemoryLoop', family: int, type: int,
+                 proto: int) -> None:
+        self.loop = loop
+        self.family = family
+        self.type = type
+        self.proto = proto
+        self.fd = next(self._fds)
+        self.options = {}
+        self.localAddr = None
+        self.peerAddr = None
+        self.incoming = None
+        self.outgoing = None
+        self.backlog = None
+        self.waiters = []
+        self.readCallback = None
+        self.writeCallback = None
+
+    def __repr__(self) -> str:
+        return '<MemorySocket fd=%d laddr=%r raddr=%r>' % (
+            self.fd, self.localAddr, self.peerAddr)
+
+    def __enter__(self) -> 'MemorySocket':
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def fileno(self) -> int:
+        return self.fd
+
+    def setblocking(self, flag: bool):
+        pass
+
+    def settimeout(self, value: float):
+        pass
+
+    def setsockopt(self, level: int, option: int, value):
+        self.checkOpen()
+        self.options[level, option] = value
+
+    def getsockopt(self, level: int, option: int, buflen: int=0):
+        self.checkOpen()
+        try:
+            return self.options[level, option]
+        except KeyError:
+            raise OSError(errno.ENOPROTOOPT,
+                          'option %d:%d is not set' % (level, option))
+
+    def bind(self, address: tuple):
+        self.checkOpen()
+        if self.localAddr is not None:
+            raise OSError(errno.EINVAL, 'already bound')
+        self.localAddr = self.loop.bindAddress(self, address)
+
+    def listen(self, backlog: int=socket.SOMAXCONN):
+        self.checkOpen()
+        if self.localAddr is None:
+            self.bind(('0.0.0.0', 0))
+        self.backlog = []
+        self.loop.listeners[self.localAddr[:2]] = self
+
+    def getsockname(self) -> tuple:
+        self.checkOpen()
+        if self.localAddr is None:
+            return ('::', 0, 0, 0) if self.family == socket.AF_INET6 else (
+                '0.0.0.0', 0)
+        return self.localAddr
+
+    def getpeername(self) -> tuple:
+        self.checkOpen()
+        if self.peerAddr is None:
+            raise OSError(errno.ENOTCONN, 'not connected')
+        return self.peerAddr
+
+    def recv(self, size: int) -> bytes:
+        self.checkConnected()
+        pipe = self.incoming
+        if pipe.reset:
+            raise ConnectionResetError(errno.ECONNRESET, 'reset by peer')
+        if pipe.data:
+            data = bytes(pipe.data[:size])
+            del pipe.data[:size]
+            pipe.changed()
+            return data
+        if pipe.eof:
+            return b''
+        raise BlockingIOError(errno.EAGAIN, 'nothing to read')
+
+    def send(self, data) -> int:
+        self.checkConnected()
+        pipe = self.outgoing
+        if pipe.eof:
+            raise BrokenPipeError(errno.EPIPE, 'shut down for writing')
+        if pipe.readerClosed:
+            raise ConnectionResetError(errno.ECONNRESET, 'closed by peer')
+        free = pipe.size - len(pipe.data)
+        if free <= 0:
+            raise BlockingIOError(errno.EAGAIN, 'the pipe is full')
+        chunk = memoryview(data)[:free]
+        pipe.data += chunk
+        pipe.changed()
+        return len(chunk)
+
+    def accept(self) -> typing.Tuple['MemorySocket', tuple]:
+        self.checkOpen()
+        if self.backlog is None:
+            raise OSError(errno.EINVAL, 'not listening')
+        if not self.backlog:
+            raise BlockingIOError(errno.EAGAIN, 'nothing to accept')
+        conn = self.backlog.pop(0)
+        return conn, conn.peerAddr
+
+    def shutdown(self, how: int):
+        self.checkConnected()
+        if how in (socket.SHUT_RD, socket.SHUT_RDWR):
+            self.incoming.eof = True
+            self.incoming.changed()
+        if how in (socket.SHUT_WR, socket.SHUT_RDWR):
+            self.outgoing.eof = True
+            self.outgoing.changed()
+
+    def close(self):
+        if self.fd == -1:
+            return
+        self.loop.forget(self)
+        for conn in self.backlog or ():
+            conn.close()
+        if self.outgoing is not None:
+            onoff, linger = LINGER.unpack(
+                self.options.get((socket.SOL_SOCKET, socket.SO_LINGER),
+                                 LINGER.pack(0, 0)))
+            if onoff and not linger:
+                self.outgoing.reset = True
+            self.outgoing.eof = True
+            self.incoming.readerClosed = True
+            self.outgoing.changed()
+            self.incoming.changed()
+        self.fd = -1
+        # the pending operations of the socket fail now
+        self.wake()
+
+    def checkOpen(self):
+        if self.fd == -1:
+            raise OSError(errno.EBADF, 'bad file descriptor')
+
+    def checkConnected(self):
+        self.checkOpen()
+        if self.incoming is None:
+            raise OSError(errno.ENOTCONN, 'not connected')
+
+    def readable(self) -> bool:
+        if self.backlog:
+            return True
+        pipe = self.incoming
+        return pipe is not None and bool(pipe.data or pipe.eof or pipe.reset)
+
+    def writable(self) -> bool:
+        pipe = self.outgoing
+        return pipe is not None and len(pipe.data) < pipe.size
+
+    def wake(self):
+        """
+        Something has changed, the waiting operations try again.
+        """
+        waiters, self.waiters = self.waiters, []
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+        if self.readCallback is not None and self.readable():
+            self.loop.call_soon(*self.readCallback)
+        if self.writeCallback is not None and self.writable():
+            self.loop.call_soon(*self.writeCallback)
+
+    async def wait(self):
+        waiter = self.loop.create_future()
+        self.waiters.append(waiter)
+        await waiter
+
+
+class MemoryLoop(asyncio.SelectorEventLoop):
+    """
+    MemoryLoop serves the MemorySockets besides the real ones.
+    A connect to the address of a memory listener is accepted at once,
+    the other ones are refused.
+    """
+
+    def __init__(self, pipeSize: int=PIPE_SIZE) -> None:
+        super().__init__()
+        self.pipeSize = pipeSize
+        self.memorySockets = {}
+        self.listeners = {}
+        self.ports = itertools.cycle(EPHEMERAL_PORTS)
+
+    def createSocket(self, family: int=socket.AF_INET,
+                     type: int=socket.SOCK_STREAM,
+                     proto: int=0) -> MemorySocket:
+        conn = MemorySocket(self, family, type, proto)
+        self.memorySockets[conn.fd] = conn
+        return conn
+
+    def forget(self, conn: MemorySocket):
+        self.memorySockets.pop(conn.fd, None)
+        if conn.localAddr is not None and self.listeners.get(
+                conn.localAddr[:2]) is conn:
+            del self.listeners[conn.localAddr[:2]]
+
+    def bindAddress(self, conn: MemorySocket, address: tuple) -> tuple:
+        host, port = address[:2]
+        if not host:
+            host = '::' if conn.family == socket.AF_INET6 else '0.0.0.0'
+        if not port:
+            port = self.freePort(host)
+        elif (host, port) in self.listeners:
+            raise OSError(errno.EADDRINUSE, 'address already in use')
+        if conn.family == socket.AF_INET6:
+            return (host, port, 0, 0)
+        return (host, port)
+
+    def freePort(self, host: str) -> int:
+        for port in itertools.islice(self.ports, len(EPHEMERAL_PORTS)):
+            if (host, port) not in self.listeners:
+                return port
+        raise OSError(errno.EADDRNOTAVAIL, 'no free port')
+
+    def findListener(self, address: tuple) -> typing.Optional[MemorySocket]:
+        host, port = address[:2]
+        for key in ((host, port), ('0.0.0.0', port), ('::', port)):
+            listener = self.listeners.get(key)
+            if listener is not None:
+                return listener
+        return None
+
+    def connectPair(self, conn: MemorySocket, address: tuple):
+        listener = self.findListener(address)
+        if listener is None:
+            raise ConnectionRefusedError(errno.ECONNREFUSED,
+                                         'connection refused')
+        if conn.localAddr is None:
+            conn.bind(('', 0))
+        peer = self.createSocket(listener.family, listener.type,
+                                 listener.proto)
+        peer.localAddr = address[:len(listener.localAddr)]
+        peer.peerAddr = conn.localAddr
+        conn.peerAddr = address
+        up, down = Pipe(self.pipeSize), Pipe(self.pipeSize)
+        conn.outgoing = peer.incoming = up
+        conn.incoming = peer.outgoing = down
+        up.writer, up.reader = conn, peer
+        down.writer, down.reader = peer, conn
+        listener.backlog.append(peer)
+        listener.wake()
+
+    async def sock_recv(self, sock, n: int) -> bytes:
+        if not isinstance(sock, MemorySocket):
+            return await super().sock_recv(sock, n)
+        while True:
+            try:
+                return sock.recv(n)
+            except BlockingIOError:
+                await sock.wait()
+
+    async def sock_sendall(self, sock, data):
+        if not isinstance(sock, MemorySocket):
+            return await super().sock_sendall(sock, data)
+        view = memoryview(data)
+        while view:
+            try:
+                view = view[sock.send(view):]
+            except BlockingIOError:
+                await sock.wait()
+
+    async def sock_connect(self, sock, address):
+        if not isinstance(sock, MemorySocket):
+            return await super().sock_connect(sock, address)
+        sock.checkOpen()
+        self.connectPair(sock, address)
+
+    async def sock_accept(self, sock):
+        if not isinstance(sock, MemorySocket):
+            return await super().sock_accept(sock)
+        while True:
+            try:
+                return sock.accept()
+            except BlockingIOError:
+                await sock.wait()
+
+    async def getaddrinfo(self, host, port, *, family=0, type=0, proto=0,
+                          flags=0):
+        try:
+            ip = ipaddress.ip_address(host)
+        except ValueError:
+            raise socket.gaierror(socket.EAI_NONAME,
+                                  'no names on a MemoryLoop')
+        if ip.version == 6:
+            return [(socket.AF_INET6, type or socket.SOCK_STREAM, proto, '',
+                     (host, port, 0, 0))]
+        return [(socket.AF_INET, type or socket.SOCK_STREAM, proto, '',
+                 (host, port))]
+
+    def add_reader(self, fd, callback, *args):
+        conn = self.memorySockets.get(fd)
+        if conn is None:
+            return super().add_reader(fd, callback, *args)
+        conn.readCallback = (callback, ) + args
+        if conn.readable():
+            self.call_soon(callback, *args)
+
+    def remove_reader(self, fd) -> bool:
+        conn = self.memorySockets.get(fd)
+        if conn is None:
+            return super().remove_reader(fd)
+        registered = conn.readCallback is not None
+        conn.readCallback = None
+        return registered
+
+    def add_writer(self, fd, callback, *args):
+        conn = self.memorySockets.get(fd)
+        if conn is None:
+            return super().add_writer(fd, callback, *args)
+        conn.writeCallback = (callback, ) + args
+        if conn.writable():
+            self.call_soon(callback, *args)
+
+    def remove_writer(self, fd) -> bool:
+        conn = self.memorySockets.get(fd)
+        if conn is None:
+            return super().remove_writer(fd)
+        registered = conn.writeCallback is not None
+        conn.writeCallback = None
+        return registered
+
+    def close(self):
+        for conn in list(self.memorySockets.values()):
+            conn.close()
+        super().close()
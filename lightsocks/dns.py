@@ -0,0 +1,492 @@
+"""
+    this module is for LsLocal to forward the DNS queries of the clients
+    through the tunnel, so the names are resolved on the side of LsServer.
+
+    The queries over UDP and TCP are sent to the upstream resolver
+    over one persistent TCP connection through the tunnel,
+    with their ids rewritten, so they share it.
+    The answers are cached for their TTL, the least recently used
+    ones are evicted, and the identical queries in flight
+    wait for the same answer.
+
+    Domain Names - Implementation https://www.ietf.org/rfc/rfc1035.txt
+"""
+import socket
+import asyncio
+import errno
+import logging
+import struct
+import typing
+from collections import OrderedDict
+
+from lightsocks.utils import net
+from lightsocks.core.securesocket import BUFFER_SIZE
+
+Connection = socket.socket
+logger = logging.getLogger(__name__)
+
+UPSTREAM = net.Address('8.8.8.8', 53)
+CACHE_SIZE = 4096
+MAX_TTL = 3600
+QUERY_TIMEOUT = 5.0
+MAX_UDP_SIZE = 512
+# times to pick a port free for both TCP and UDP
+BIND_ATTEMPTS = 8
+
+HEADER = struct.Struct('!HHHHHH')
+LENGTH = struct.Struct('!H')
+RR = struct.Struct('!HHIH')
+FLAG_QR = 0x8000
+FLAG_TC = 0x0200
+RCODE_MASK = 0x000f
+RCODE_SERVFAIL = 2
+TYPE_OPT = 41
+
+Key = typing.Tuple[bytes, bytes]
+
+
+class InvalidMessageError(Exception):
+    """不合法的 DNS 消息"""
+
+
+def skipName(msg: bytes, offset: int) -> int:
+    """
+    Return the offset after the name at the offset.
+    """
+    while True:
+        if offset >= len(msg):
+            raise InvalidMessageError('name out of the message')
+        length = msg[offset]
+        if length & 0xc0 == 0xc0:
+            # a pointer ends the name
+            return offset + 2
+        offset += 1 + length
+        if length == 0:
+            return offset
+
+
+def parseQuestion(msg: bytes) -> typing.Tuple[Key, int]:
+    """
+    Return the cache key of the only question, and the offset after it.
+    """
+    if len(msg) < HEADER.size:
+        raise InvalidMessageError('too short')
+    if HEADER.unpack_from(msg)[2] != 1:
+        raise InvalidMessageError('not one question')
+    end = skipName(msg, HEADER.size) + 4
+    if end > len(msg):
+        raise InvalidMessageError('question out of the message')
+    name = bytes(msg[HEADER.size:end - 4]).lower()
+    return (name, bytes(msg[end - 4:end])), end
+
+
+def ttlOffsets(msg: bytes, offset: int) -> typing.List[int]:
+    """
+    Return the offsets of the TTLs of the records after the question,
+    the OPT pseudo record has no TTL.
+    """
+    _, _, _, an, ns, ar = HEADER.unpack_from(msg)
+    offsets = []
+    for _ in range(an + ns + ar):
+        offset = skipName(msg, offset)
+        if offset + RR.size > len(msg):
+            raise InvalidMessageError('record out of the message')
+        rtype, _, _, rdlength = RR.unpack_from(msg, offset)
+        if rtype != TYPE_OPT:
+            offsets.append(offset + 4)
+        offset += RR.size + rdlength
+    return offsets
+
+
+def udpSize(query: bytes, offset: int) -> int:
+    """
+    Return the size of the UDP answers the client accepts,
+    the class of the OPT record of EDNS, see rfc6891.
+    """
+    _, _, _, an, ns, ar = HEADER.unpack_from(query)
+    for _ in range(an + ns + ar):
+        offset = skipName(query, offset)
+        if offset + RR.size > len(query):
+            break
+        rtype, rclass, _, rdlength = RR.unpack_from(query, offset)
+        if rtype == TYPE_OPT:
+            return max(MAX_UDP_SIZE, rclass)
+        offset += RR.size + rdlength
+    return MAX_UDP_SIZE
+
+
+def withId(msg: bytes, msgId: int) -> bytearray:
+    msg = bytearray(msg)
+    LENGTH.pack_into(msg, 0, msgId)
+    return msg
+
+
+def truncate(msg: bytes, end: int) -> bytearray:
+    """
+    Keep the header and the question, set TC, the client asks over TCP.
+    """
+    msgId, flags, qd, _, _, _ = HEADER.unpack_from(msg)
+    truncated = bytearray(msg[:end])
+    HEADER.pack_into(truncated, 0, msgId, flags | FLAG_TC, qd, 0, 0, 0)
+    return truncated
+
+
+def servfail(query: bytes, end: int) -> bytearray:
+    msgId, flags, qd, _, _, _ = HEADER.unpack_from(query)
+    answer = bytearray(query[:end])
+    flags = (flags | FLAG_QR) & ~RCODE_MASK | RCODE_SERVFAIL
+    HEADER.pack_into(answer, 0, msgId, flags, qd, 0, 0, 0)
+    return answer
+
+
+class Entry:
+    """
+    Entry is a cached answer, its TTLs are counted down when it is read.
+    """
+    __slots__ = ('answer', 'offsets', 'ttls', 'cachedAt', 'expires')
+
+    def __init__(self, answer: bytes, offsets: typing.List[int],
+                 cachedAt: float) -> None:
+        self.answer = answer
+        self.offsets = offsets
+        self.ttls = [struct.unpack_from('!I', answer, offset)[0]
+                     for offset in offsets]
+        self.cachedAt = cachedAt
+        self.expires = cachedAt + min(min(self.ttls), MAX_TTL)
+
+
+class Cache:
+    """
+    Cache keeps at most capacity answers until their smallest TTL expires,
+    the least recently used one is evicted.
+    The answers without records, truncated, or failed are not cached.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop,
+                 capacity: int=CACHE_SIZE) -> None:
+        self.loop = loop
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Key, msgId: int) -> typing.Optional[bytearray]:
+        entry = self.entries.get(key)
+        now = self.loop.time()
+        if entry is None or now >= entry.expires:
+            if entry is not None:
+                del self.entries[key]
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        answer = withId(entry.answer, msgId)
+        elapsed = int(now - entry.cachedAt)
+        for offset, ttl in zip(entry.offsets, entry.ttls):
+            struct.pack_into('!I', answer, offset, max(0, ttl - elapsed))
+        return answer
+
+    def put(self, key: Key, answer: bytes, end: int):
+        flags = HEADER.unpack_from(answer)[1]
+        if flags & FLAG_TC or flags & RCODE_MASK not in (0, 3):
+            return
+        offsets = ttlOffsets(answer, end)
+        if not offsets or self.capacity <= 0:
+            return
+        entry = Entry(bytes(answer), offsets, self.loop.time())
+        if entry.expires <= entry.cachedAt:
+            return
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+
+
+class DnsTunnel:
+    """
+    DnsTunnel sends the queries to the upstream over one TCP connection
+    through the tunnel of local, it is opened on the first query,
+    and again after it is closed.
+    The answers are matched to the queries by the ids it gives them.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop,
+                 upstream: net.Address=UPSTREAM,
+                 timeout: float=QUERY_TIMEOUT) -> None:
+        self.loop = loop
+        self.upstream = upstream
+        self.timeout = timeout
+        self.local = None
+        # the LsLocal that has opened the connection
+        self.owner = None
+        self.remote = None
+        self.conn = None
+        self.cipher = None
+        self.reader = None
+        self.connecting = None
+        self.pending = {}
+        self.nextId = 0
+        # the queries write to the connection one after another
+        self.writing = asyncio.Lock()
+
+    async def connect(self):
+        if self.conn is not None:
+            return
+        if self.connecting is None:
+            self.connecting = asyncio.ensure_future(
+                self.open(), loop=self.loop)
+        connecting = self.connecting
+        try:
+            await asyncio.shield(connecting)
+        finally:
+            if self.connecting is connecting and connecting.done():
+                self.connecting = None
+
+    async def open(self):
+        owner = self.local
+        remote, conn = await owner.connectTunnel(*self.upstream)
+        self.owner = owner
+        self.remote = remote
+        self.conn = conn
+        self.cipher = owner.secureSockets[remote].cipher
+        self.reader = asyncio.ensure_future(self.read(conn), loop=self.loop)
+
+    def allocateId(self) -> int:
+        for _ in range(0x10000):
+            self.nextId = (self.nextId + 1) & 0xffff
+            if self.nextId not in self.pending:
+                return self.nextId
+        raise ConnectionError('too many queries in flight')
+
+    async def query(self, query: bytes) -> bytes:
+        """
+        Return the answer with the id of the query.
+        Raise ConnectionError or asyncio.TimeoutError if there is none.
+        """
+        await self.connect()
+        msgId = self.allocateId()
+        waiter = self.loop.create_future()
+        self.pending[msgId] = waiter
+        try:
+            msg = bytearray(LENGTH.pack(len(query))) + withId(query, msgId)
+            self.cipher.encode(msg)
+            try:
+                async with self.writing:
+                    if self.conn is None:
+                        raise ConnectionError('closed')
+                    await self.loop.sock_sendall(self.conn, msg)
+            except OSError as err:
+                self.close()
+                raise ConnectionError(err)
+            answer = await asyncio.wait_for(waiter, self.timeout)
+        finally:
+            self.pending.pop(msgId, None)
+        return withId(answer, HEADER.unpack_from(query)[0])
+
+    async def read(self, conn: Connection):
+        buf = bytearray()
+        try:
+            while True:
+                data = bytearray(await self.loop.sock_recv(conn, BUFFER_SIZE))
+                if not data:
+                    break
+                self.cipher.decode(data)
+                buf += data
+                while len(buf) >= LENGTH.size:
+                    size = LENGTH.unpack_from(buf)[0]
+                    if len(buf) < LENGTH.size + size:
+                        break
+                    answer = bytes(buf[LENGTH.size:LENGTH.size + size])
+                    del buf[:LENGTH.size + size]
+                    if size < HEADER.size:
+                        continue
+                    waiter = self.pending.get(HEADER.unpack_from(answer)[0])
+                    if waiter is not None and not waiter.done():
+                        waiter.set_result(answer)
+        except OSError:
+            pass
+        finally:
+            if self.conn is conn:
+                self.close()
+
+    def close(self):
+        """
+        Close the connection, the queries in flight fail.
+        """
+        conn, self.conn = self.conn, None
+        if conn is None:
+            return
+        conn.close()
+        self.owner.balancer.release(self.remote)
+        if self.reader is not None:
+            self.reader.cancel()
+            self.reader = None
+        for waiter in self.pending.values():
+            if not waiter.done():
+                waiter.set_exception(ConnectionError('closed'))
+
+
+class DatagramProtocol(asyncio.DatagramProtocol):
+    def __init__(self, forwarder: 'DnsForwarder') -> None:
+        self.forwarder = forwarder
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.forwarder.spawn(self.forwarder.answerDatagram(
+            self.transport, data, addr))
+
+
+class DnsForwarder:
+    """
+    DnsForwarder listens on the listenAddr for the queries over UDP and TCP,
+    and answers them from the cache or through the DnsTunnel.
+    local is the LsLocal to open the tunnel with,
+    it is set again when the LsLocal is replaced on reload.
+    """
+
+    def __init__(self,
+                 loop: asyncio.AbstractEventLoop,
+                 listenAddr: net.Address,
+                 upstream: net.Address=UPSTREAM,
+                 capacity: int=CACHE_SIZE,
+                 timeout: float=QUERY_TIMEOUT) -> None:
+        self.loop = loop
+        self.listenAddr = listenAddr
+        self.cache = Cache(loop, capacity)
+        self.tunnel = DnsTunnel(loop, upstream, timeout)
+        self.inflight = {}
+        self.tasks = set()
+        self.transport = None
+        self.listener = None
+
+    @property
+    def local(self):
+        return self.tunnel.local
+
+    @local.setter
+    def local(self, local):
+        self.tunnel.local = local
+
+    def spawn(self, coro):
+        task = asyncio.ensure_future(coro, loop=self.loop)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def start(self):
+        family = socket.AF_INET6 if ':' in self.listenAddr.ip \
+            else socket.AF_INET
+        # the UDP port is the same as the TCP one, picked by the system
+        # for 0, it is picked again if it is taken for UDP
+        for attempt in range(BIND_ATTEMPTS):
+            listener = self.bindStream(family)
+            port = listener.getsockname()[1]
+            try:
+                self.transport, _ = await self.loop.create_datagram_endpoint(
+                    lambda: DatagramProtocol(self),
+                    local_addr=(self.listenAddr.ip, port))
+            except OSError as err:
+                listener.close()
+                if err.errno != errno.EADDRINUSE or self.listenAddr.port \
+                        or attempt == BIND_ATTEMPTS - 1:
+                    raise
+                continue
+            break
+        self.listener = listener
+        self.spawn(self.accept(listener))
+        logger.info('Forward DNS on %s:%d', self.listenAddr.ip, port)
+
+    def bindStream(self, family: int) -> Connection:
+        listener = socket.socket(family, socket.SOCK_STREAM)
+        try:
+            listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            listener.setblocking(False)
+            listener.bind(tuple(self.listenAddr))
+            listener.listen(socket.SOMAXCONN)
+        except OSError:
+            listener.close()
+            raise
+        return listener
+
+    async def resolve(self, query: bytes) -> bytes:
+        """
+        Return the answer of the query, SERVFAIL if it fails.
+        """
+        key, end = parseQuestion(query)
+        msgId = HEADER.unpack_from(query)[0]
+        answer = self.cache.get(key, msgId)
+        if answer is not None:
+            return answer
+
+        waiter = self.inflight.get(key)
+        if waiter is None:
+            waiter = self.inflight[key] = asyncio.ensure_future(
+                self.tunnel.query(query), loop=self.loop)
+            waiter.add_done_callback(
+                lambda _: self.inflight.pop(key, None))
+        try:
+            answer = await asyncio.shield(waiter)
+        except (ConnectionError, asyncio.TimeoutError) as err:
+            logger.warning('DNS query failed: %r', err)
+            return servfail(query, end)
+        try:
+            self.cache.put(key, answer, end)
+        except InvalidMessageError:
+            pass
+        return withId(answer, msgId)
+
+    async def answerDatagram(self, transport: asyncio.DatagramTransport,
+                             query: bytes, addr):
+        try:
+            answer = await self.resolve(query)
+            _, end = parseQuestion(query)
+            if len(answer) > udpSize(query, end):
+                answer = truncate(answer, end)
+        except InvalidMessageError:
+            return
+        if not transport.is_closing():
+            transport.sendto(answer, addr)
+
+    async def accept(self, listener: Connection):
+        while True:
+            conn, _ = await self.loop.sock_accept(listener)
+            self.spawn(self.serveStream(conn))
+
+    async def serveStream(self, conn: Connection):
+        """
+        Answer the queries of a TCP connection one after another.
+        """
+        try:
+            while True:
+                size = LENGTH.unpack(await self.recvExactly(
+                    conn, LENGTH.size))[0]
+                query = await self.recvExactly(conn, size)
+                answer = await self.resolve(query)
+                await self.loop.sock_sendall(
+                    conn, LENGTH.pack(len(answer)) + answer)
+        except (OSError, InvalidMessageError, struct.error):
+            pass
+        finally:
+            conn.close()
+
+    async def recvExactly(self, conn: Connection, size: int) -> bytes:
+        buf = b''
+        while len(buf) < size:
+            data = await self.loop.sock_recv(conn, size - len(buf))
+            if not data:
+                raise ConnectionError('closed by the client')
+            buf += data
+        return buf
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
+        if self.listener is not None:
+            self.listener.close()
+            self.listener = None
+        for task in list(self.tasks):
+            task.cancel()
+        self.tunnel.close()
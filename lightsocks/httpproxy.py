@@ -0,0 +1,449 @@
+"""
+    this module is for LsLocal to serve the HTTP proxy clients.
+
+    CONNECT requests are tunneled like the SOCKS5 ones,
+    the absolute-URI requests are rewritten to the origin form,
+    and sent through the tunnel with HTTP keep-alive.
+"""
+import socket
+import asyncio
+import logging
+import typing
+from urllib.parse import urlsplit
+
+from lightsocks.utils import net, socks
+from lightsocks.core.securesocket import BUFFER_SIZE, SecureSocket
+
+Connection = socket.socket
+logger = logging.getLogger(__name__)
+
+MAX_HEAD_SIZE = 64 * 1024
+HOP_BY_HOP_HEADERS = frozenset((b'connection', b'keep-alive',
+                                b'proxy-connection', b'proxy-authorization',
+                                b'proxy-authenticate', b'te', b'trailer',
+                                b'transfer-encoding', b'upgrade'))
+METHODS = frozenset((b'GET', b'HEAD', b'POST', b'PUT', b'DELETE', b'OPTIONS',
+                     b'TRACE', b'PATCH', b'CONNECT'))
+
+
+class HttpError(Exception):
+    """不合法的 HTTP 请求"""
+
+    def __init__(self, status: int, reason: str) -> None:
+        super().__init__(status, reason)
+        self.status = status
+        self.reason = reason
+
+
+def isHttp(buf: bytes) -> bool:
+    """
+    Whether the first bytes of a connection look like an HTTP request.
+    """
+    method = bytes(buf[:8]).split(b' ', 1)[0]
+    return method in METHODS or (method.isalpha() and method.isupper())
+
+
+class Stream:
+    """
+    Stream is a buffered connection,
+    the data is decoded after read and encoded before written
+    if a SecureSocket is given.
+    remote is the Remote of the tunnel, None for a direct connection.
+    """
+
+    def __init__(self,
+                 loop: asyncio.AbstractEventLoop,
+                 conn: Connection,
+                 secureSocket: SecureSocket=None,
+                 buf: bytes=b'',
+                 remote=None) -> None:
+        self.loop = loop
+        self.conn = conn
+        self.secureSocket = secureSocket
+        self.remote = remote
+        self.buf = bytearray(buf)
+        self.eof = False
+        self.sent = 0
+
+    async def fill(self) -> bool:
+        if self.eof:
+            return False
+        if self.secureSocket is not None:
+            data = await self.secureSocket.decodeRead(self.conn)
+        else:
+            data = await self.loop.sock_recv(self.conn, BUFFER_SIZE)
+        if not data:
+            self.eof = True
+            return False
+        self.buf.extend(data)
+        return True
+
+    async def readUntil(self, separator: bytes,
+                        limit: int=MAX_HEAD_SIZE) -> bytes:
+        """
+        Read until the separator, return b'' at the end of the stream.
+        """
+        start = 0
+        while True:
+            idx = self.buf.find(separator, start)
+            if idx >= 0:
+                idx += len(separator)
+                data = bytes(self.buf[:idx])
+                del self.buf[:idx]
+                return data
+            if len(self.buf) > limit:
+                raise HttpError(431, 'Request Header Fields Too Large')
+            start = max(0, len(self.buf) - len(separator) + 1)
+            if not await self.fill():
+                if self.buf:
+                    raise HttpError(400, 'Bad Request')
+                return b''
+
+    async def readExactly(self, n: int) -> bytes:
+        while len(self.buf) < n:
+            if not await self.fill():
+                raise ConnectionError('unexpected end of the stream')
+        data = bytes(self.buf[:n])
+        del self.buf[:n]
+        return data
+
+    async def readSome(self, n: int) -> bytes:
+        if not self.buf:
+            await self.fill()
+        data = bytes(self.buf[:n])
+        del self.buf[:n]
+        return data
+
+    async def write(self, data: bytes):
+        self.sent += len(data)
+        if self.secureSocket is not None:
+            await self.secureSocket.encodeWrite(self.conn, bytearray(data))
+        else:
+            await self.loop.sock_sendall(self.conn, data)
+
+    async def copyExactly(self, dst: 'Stream', n: int):
+        while n > 0:
+            data = await self.readSome(min(n, BUFFER_SIZE * 16))
+            if not data:
+                raise ConnectionError('unexpected end of the stream')
+            await dst.write(data)
+            n -= len(data)
+
+    async def copyChunked(self, dst: 'Stream'):
+        """
+        Copy a chunked body as it is, until the last chunk and trailers.
+        """
+        while True:
+            line = await self.readUntil(b'\r\n')
+            if not line:
+                raise ConnectionError('unexpected end of the stream')
+            await dst.write(line)
+            try:
+                size = int(line.split(b';', 1)[0].strip(), 16)
+            except ValueError:
+                raise HttpError(400, 'Bad Request')
+            if size == 0:
+                break
+            await self.copyExactly(dst, size + 2)
+
+        while True:
+            line = await self.readUntil(b'\r\n')
+            if not line:
+                raise ConnectionError('unexpected end of the stream')
+            await dst.write(line)
+            if line == b'\r\n':
+                break
+
+    async def copyUntilEOF(self, dst: 'Stream'):
+        while True:
+            data = await self.readSome(BUFFER_SIZE * 16)
+            if not data:
+                break
+            await dst.write(data)
+
+    def close(self):
+        self.conn.close()
+
+
+class Message:
+    """
+    Message is the head of an HTTP request or response.
+    """
+
+    def __init__(self, startLine: typing.List[bytes],
+                 headers: typing.List[typing.Tuple[bytes, bytes]]) -> None:
+        self.startLine = startLine
+        self.headers = headers
+
+    @classmethod
+    def parse(cls, head: bytes) -> 'Message':
+        lines = head.split(b'\r\n')
+        startLine = lines[0].split(b' ', 2)
+        if len(startLine) < 2:
+            raise HttpError(400, 'Bad Request')
+        headers = []
+        for line in lines[1:]:
+            if not line:
+                continue
+            name, sep, value = line.partition(b':')
+            if not sep:
+                raise HttpError(400, 'Bad Request')
+            headers.append((name.strip(), value.strip()))
+        return cls(startLine, headers)
+
+    def get(self, name: bytes, default: bytes=None) -> bytes:
+        for key, value in self.headers:
+            if key.lower() == name:
+                return value
+        return default
+
+    def tokens(self, name: bytes) -> typing.Set[bytes]:
+        return {
+            token.strip().lower()
+            for key, value in self.headers if key.lower() == name
+            for token in value.split(b',')
+        }
+
+    @property
+    def version(self) -> bytes:
+        return self.startLine[0] if self.isResponse else self.startLine[2]
+
+    @property
+    def isResponse(self) -> bool:
+        return self.startLine[0].startswith(b'HTTP/')
+
+    @property
+    def keepAlive(self) -> bool:
+        connection = self.tokens(b'connection') | self.tokens(
+            b'proxy-connection')
+        if b'close' in connection:
+            return False
+        return self.version != b'HTTP/1.0' or b'keep-alive' in connection
+
+    @property
+    def chunked(self) -> bool:
+        return b'chunked' in self.tokens(b'transfer-encoding')
+
+    @property
+    def contentLength(self) -> typing.Optional[int]:
+        value = self.get(b'content-length')
+        if value is None:
+            return None
+        try:
+            return int(value)
+        except ValueError:
+            raise HttpError(400, 'Bad Request')
+
+    def dumps(self, keepAlive: bool) -> bytes:
+        """
+        Dump the head without the hop-by-hop headers.
+        """
+        lines = [b' '.join(self.startLine)]
+        chunked = self.chunked
+        for name, value in self.headers:
+            key = name.lower()
+            if key in HOP_BY_HOP_HEADERS:
+                continue
+            if chunked and key == b'content-length':
+                # the chunked encoding wins, never forward both
+                continue
+            lines.append(name + b': ' + value)
+        if chunked:
+            lines.append(b'Transfer-Encoding: chunked')
+        lines.append(b'Connection: ' + (b'keep-alive'
+                                        if keepAlive else b'close'))
+        return b'\r\n'.join(lines) + b'\r\n\r\n'
+
+
+def errorResponse(status: int, reason: str) -> bytes:
+    body = ('%d %s\n' % (status, reason)).encode()
+    return (b'HTTP/1.1 %d %s\r\nContent-Type: text/plain\r\n'
+            b'Content-Length: %d\r\nConnection: close\r\n\r\n' %
+            (status, reason.encode(), len(body))) + body
+
+
+def splitHostPort(target: bytes, defaultPort: int) -> typing.Tuple[str, int]:
+    try:
+        url = urlsplit(b'//' + target)
+        host, port = url.hostname, url.port or defaultPort
+    except ValueError:
+        raise HttpError(400, 'Bad Request')
+    if not host:
+        raise HttpError(400, 'Bad Request')
+    return host.decode('idna'), port
+
+
+class HttpProxy:
+    """
+    HttpProxy serves the HTTP proxy clients of a LsLocal.
+    """
+
+    def __init__(self, local) -> None:
+        self.local = local
+        self.loop = local.loop
+
+    async def openUpstream(self, host: str, port: int) -> Stream:
+        """
+        Connect the destination directly if it matches the rules,
+        or through the tunnel.
+        """
+        local = self.local
+        if local.rules is not None:
+            await local.rules.prepare(self.loop)
+        if local.rules is not None and local.rules.match(host):
+            try:
+                conn = await net.connect(self.loop, host, port)
+            except OSError as err:
+                raise HttpError(502, 'Bad Gateway') from err
+            return Stream(self.loop, conn)
+
+        try:
+            remote, conn = await local.openTunnel(
+                socks.packRequest(host, port))
+        except ConnectionError as err:
+            raise HttpError(502, 'Bad Gateway') from err
+        stream = Stream(
+            self.loop, conn, local.secureSockets[remote], remote=remote)
+        try:
+            reply = await stream.readExactly(len(socks.packReply()))
+        except OSError:
+            reply = b''
+        if not reply or reply[1] != socks.REP_SUCCEEDED:
+            self.closeUpstream(stream)
+            raise HttpError(502, 'Bad Gateway')
+        return stream
+
+    def closeUpstream(self, upstream: Stream):
+        upstream.close()
+        if upstream.remote is not None:
+            self.local.balancer.release(upstream.remote)
+
+    async def handleConn(self, connection: Connection, buf: bytes):
+        client = Stream(self.loop, connection, buf=buf)
+        upstream = None
+        upstreamAddr = None
+        sent = 0
+        try:
+            while True:
+                sent = client.sent
+                head = await client.readUntil(b'\r\n\r\n')
+                if not head:
+                    break
+                request = Message.parse(head[:-4])
+                method = request.startLine[0]
+                if len(request.startLine) != 3:
+                    raise HttpError(400, 'Bad Request')
+
+                if method == b'CONNECT':
+                    host, port = splitHostPort(request.startLine[1], 443)
+                    if upstream is not None:
+                        self.closeUpstream(upstream)
+                    upstream = None
+                    tunnel = await self.openUpstream(host, port)
+                    await client.write(
+                        b'HTTP/1.1 200 Connection Established\r\n\r\n')
+                    await self.relay(client, tunnel)
+                    return
+
+                url = urlsplit(request.startLine[1])
+                if url.scheme != b'http':
+                    raise HttpError(400, 'Bad Request')
+                address = splitHostPort(url.netloc, 80)
+                if upstream is not None and upstreamAddr != address:
+                    self.closeUpstream(upstream)
+                    upstream = None
+                if upstream is None:
+                    upstream = await self.openUpstream(*address)
+                    upstreamAddr = address
+
+                keepAlive = request.keepAlive
+                path = url.path or b'/'
+                if url.query:
+                    path += b'?' + url.query
+                request.startLine[1] = path
+                if request.get(b'host') is None:
+                    request.headers.append((b'Host', url.netloc))
+                await upstream.write(request.dumps(keepAlive=True))
+                await self.copyBody(client, upstream, request)
+
+                upstreamKeepAlive, keepAlive = await self.forwardResponse(
+                    upstream, client, method, keepAlive)
+                if not upstreamKeepAlive:
+                    self.closeUpstream(upstream)
+                    upstream = None
+                if not keepAlive:
+                    break
+        except HttpError as err:
+            if client.sent != sent:
+                # the response has been partly sent, just close it
+                return
+            try:
+                await client.write(errorResponse(err.status, err.reason))
+            except OSError:
+                pass
+        except OSError:
+            pass
+        finally:
+            if upstream is not None:
+                self.closeUpstream(upstream)
+            client.close()
+
+    async def copyBody(self, src: Stream, dst: Stream, message: Message):
+        if message.chunked:
+            await src.copyChunked(dst)
+            return
+        length = message.contentLength
+        if length:
+            await src.copyExactly(dst, length)
+
+    async def forwardResponse(self, upstream: Stream, client: Stream,
+                              method: bytes, keepAlive: bool
+                              ) -> typing.Tuple[bool, bool]:
+        """
+        Forward the response to the client, return whether
+        the upstream and the client connection can be used again.
+        """
+        while True:
+            head = await upstream.readUntil(b'\r\n\r\n')
+            if not head:
+                raise HttpError(502, 'Bad Gateway')
+            response = Message.parse(head[:-4])
+            try:
+                status = int(response.startLine[1])
+            except ValueError:
+                raise HttpError(502, 'Bad Gateway')
+            if 100 <= status < 200:
+                # the interim responses have no body
+                await client.write(head)
+                continue
+            break
+
+        upstreamKeepAlive = response.keepAlive
+        if (method == b'HEAD' or status in (204, 304)):
+            await client.write(response.dumps(keepAlive))
+        elif response.chunked:
+            await client.write(response.dumps(keepAlive))
+            await upstream.copyChunked(client)
+        elif response.contentLength is not None:
+            await client.write(response.dumps(keepAlive))
+            await upstream.copyExactly(client, response.contentLength)
+        else:
+            # the body ends when the upstream closes the connection
+            await client.write(response.dumps(keepAlive=False))
+            await upstream.copyUntilEOF(client)
+            return False, False
+        return upstreamKeepAlive, keepAlive
+
+    async def relay(self, client: Stream, upstream: Stream):
+        """
+        Relay the CONNECT tunnel with the SecureSocket copy loops.
+        """
+        if client.buf:
+            await upstream.write(bytes(client.buf))
+        if upstream.buf:
+            await client.write(bytes(upstream.buf))
+
+        if upstream.remote is not None:
+            await self.local.relay(client.conn, upstream.remote, upstream.conn)
+        else:
+            await self.local.pipe(client.conn, upstream.conn)
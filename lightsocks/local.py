@@ -1,73 +1,464 @@
-import typing
+import functools
 import socket
 import asyncio
 import logging
+import typing
 
-from lightsocks.utils import net
+from lightsocks import balancer, httpproxy, transparent
+from lightsocks.utils import net, socks, tcpinfo, tracing
+from lightsocks.utils.rules import RuleSet
 from lightsocks.core.cipher import Cipher
-from lightsocks.core.securesocket import SecureSocket
+from lightsocks.core.relay import Relay
+from lightsocks.core import session
+from lightsocks.core.securesocket import BUFFER_SIZE, SecureSocket
+from lightsocks.core.service import Service
 
 Connection = socket.socket
 logger = logging.getLogger(__name__)
 
 
-class LsLocal(SecureSocket):
+class LsLocal(Service):
+    """
+    LsLocal dials one of the remotes for every connection.
+    remotes is a list of (address, password) of LsServer,
+    it defaults to the remoteAddr with the password.
+
+    Without rules, the SOCKS5 negotiation is relayed to LsServer as is.
+    With rules, LsLocal negotiates with the client itself,
+    and connects the destinations that match the rules directly.
+
+    The HTTP proxy clients are served on the same port,
+    they are told apart from SOCKS5 by the first bytes.
+    With transparent, the connections redirected by the firewall
+    are served on the same port too, see transparent.
+    With resume, the SOCKS5 and redirected connections are relayed
+    as sessions, that dial the same LsServer again when the tunnel is lost,
+    and go on within graceTime, see session.
+    With mptcp, the remotes are dialed with Multipath TCP,
+    and the subflows of every tunnel are logged when it is closed.
+
+    The services on the loops of the workers share the cipher,
+    the rules and the remoteBalancer of the service on the main loop,
+    the remotes and the strategy are ignored with a remoteBalancer.
+    """
+
     def __init__(self,
                  loop: asyncio.AbstractEventLoop,
                  password: bytearray,
                  listenAddr: net.Address,
-                 remoteAddr: net.Address) -> None:
-        super().__init__(loop=loop, cipher=Cipher.NewCipher(password))
-        self.listenAddr = listenAddr
-        self.remoteAddr = remoteAddr
+                 remoteAddr: net.Address,
+                 listener: Connection=None,
+                 remotes: typing.List[typing.Tuple[net.Address,
+                                                   bytearray]]=None,
+                 strategy: str=balancer.LATENCY,
+                 connectTimeout: float=balancer.CONNECT_TIMEOUT,
+                 probeInterval: float=balancer.PROBE_INTERVAL,
+                 rules: RuleSet=None,
+                 tracer: tracing.Tracer=None,
+                 transparent: bool=False,
+                 resume: bool=False,
+                 graceTime: float=session.GRACE_TIME,
+                 replaySize: int=session.REPLAY_SIZE,
+                 tcpInfo: tcpinfo.Sampler=None,
+                 mptcp: bool=False,
+                 cipher: Cipher=None,
+                 remoteBalancer: balancer.Balancer=None,
+                 **options) -> None:
+        super().__init__(
+            loop=loop,
+            cipher=cipher or Cipher.NewCipher(password),
+            listenAddr=listenAddr,
+            listener=listener,
+            **options)
+        if not remotes:
+            remotes = [(remoteAddr, password)]
+        self.balancer = remoteBalancer or balancer.Balancer(
+            loop=self.loop,
+            remotes=[
+                balancer.Remote(self.loop, address, password, mptcp)
+                for address, password in remotes
+            ],
+            strategy=strategy,
+            connectTimeout=connectTimeout,
+            probeInterval=probeInterval)
+        self.secureSockets = {
+            remote: SecureSocket(
+                loop=self.loop, cipher=remote.cipher, **options)
+            for remote in self.balancer.remotes
+        }
+        self.rules = rules
+        self.tracer = tracer or tracing.Tracer()
+        self.httpProxy = httpproxy.HttpProxy(self)
+        self.transparent = transparent
+        self.listenPort = listenAddr.port
+        self.resume = resume
+        self.graceTime = graceTime
+        self.replaySize = replaySize
+        self.tcpInfo = tcpInfo or tcpinfo.Sampler()
 
-    async def listen(self, didListen: typing.Callable=None):
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as listener:
-            listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            listener.bind(self.listenAddr)
-            listener.listen(socket.SOMAXCONN)
-            listener.setblocking(False)
+    @property
+    def remoteAddr(self) -> net.Address:
+        return self.balancer.remotes[0].address
 
-            logger.info('Listen to %s:%d' % self.listenAddr)
-            if didListen:
-                didListen(listener.getsockname())
+    @remoteAddr.setter
+    def remoteAddr(self, remoteAddr: net.Address):
+        self.balancer.remotes[0].address = remoteAddr
 
-            while True:
-                connection, address = await self.loop.sock_accept(listener)
-                logger.info('Receive %s:%d', *address)
-                asyncio.ensure_future(self.handleConn(connection))
+    def bind(self) -> Connection:
+        listener = super().bind()
+        self.listenPort = listener.getsockname()[1]
+        if self.transparent:
+            transparent.enableTransparent(listener)
+        return listener
+
+    async def listen(self, didListen: typing.Callable=None):
+        probing = None
+        if len(self.balancer.remotes) > 1:
+            probing = asyncio.ensure_future(
+                self.balancer.probeForever(), loop=self.loop)
+        try:
+            await super().listen(didListen)
+        finally:
+            if probing is not None:
+                probing.cancel()
 
     async def handleConn(self, connection: Connection):
-        remoteServer = await self.dialRemote()
+        trace = self.tracer.begin('local')
+        try:
+            if self.transparent:
+                dst = transparent.originalDst(connection, self.listenPort)
+                if dst is not None:
+                    await self.transparentConn(connection, dst, trace)
+                    return
+            try:
+                buf = await self.loop.sock_recv(connection, BUFFER_SIZE)
+            except OSError:
+                buf = b''
+
+            if not buf:
+                connection.close()
+            elif buf[0] == socks.VERSION and (self.rules is not None or
+                                              self.resume):
+                await self.routeConn(connection, buf, trace)
+            elif buf[0] != socks.VERSION and httpproxy.isHttp(buf):
+                await self.httpProxy.handleConn(connection, buf)
+            else:
+                await self.tunnelConn(connection, buf, trace)
+        finally:
+            self.tracer.finish(trace)
+
+    async def tunnelConn(self, connection: Connection, buf: bytes,
+                         trace: tracing.Trace=tracing.NULL_TRACE):
+        """
+        Relay the data flow to LsServer as it is,
+        buf is the data that has been read from the connection.
+        """
+        try:
+            remote, remoteServer = await self.balancer.dial(self.loop)
+        except ConnectionError:
+            trace.fail('dial')
+            connection.close()
+            raise
+        trace.mark('dial')
+
+        if trace.traceId is not None:
+            buf = tracing.packTraceId(trace.traceId) + buf
+        try:
+            await self.secureSockets[remote].encodeWrite(
+                remoteServer, bytearray(buf))
+        except OSError:
+            remoteServer.close()
+            connection.close()
+            self.balancer.release(remote)
+            return
+        await self.relay(connection, remote, remoteServer, trace)
+
+    async def relay(self, connection: Connection, remote: balancer.Remote,
+                    remoteServer: Connection,
+                    trace: tracing.Trace=tracing.NULL_TRACE):
+        secureSocket = self.secureSockets[remote]
+        self.tcpInfo.track(remoteServer, tcpinfo.TUNNEL,
+                           '%s:%d' % tuple(remote.address))
+        try:
+            await Relay(
+                secureSocket,
+                client=connection,
+                upstream=remoteServer,
+                toUpstream=secureSocket.cipher.encode,
+                toClient=secureSocket.cipher.decode,
+                firstRead=trace.markFirstByte,
+                beforeClose=functools.partial(self.releaseConns,
+                                              remote)).run()
+        finally:
+            self.balancer.release(remote)
+
+    def releaseConns(self, remote: balancer.Remote, connection: Connection,
+                     remoteServer: Connection):
+        """
+        Report the tunnel before it is closed.
+        """
+        if remote.mptcp:
+            tcpinfo.logSubflows(remoteServer,
+                                '%s:%d' % tuple(remote.address))
+        self.tcpInfo.release(connection, remoteServer)
+
+    async def routeConn(self, connection: Connection, buf: bytes,
+                        trace: tracing.Trace=tracing.NULL_TRACE):
+        """
+        Negotiate SOCKS5 with the client, then connect the destination
+        directly if it matches the rules, or through the tunnel.
+        buf is the method selection message from the client.
+        """
+        try:
+            await self.loop.sock_sendall(connection, socks.METHOD_SELECTION)
+
+            buf = await self.loop.sock_recv(connection, BUFFER_SIZE)
+            request = socks.parseRequest(buf)
+            if request.cmd != socks.CMD_CONNECT:
+                await self.loop.sock_sendall(
+                    connection,
+                    socks.packReply(socks.REP_COMMAND_NOT_SUPPORTED))
+                connection.close()
+                return
+        except (OSError, socks.InvalidRequestError):
+            trace.fail('request')
+            connection.close()
+            return
+        trace.mark('handshake')
+        trace.setDst(request.host, request.port)
+
+        if self.rules is not None:
+            await self.rules.prepare(self.loop)
+            if self.rules.match(request.host):
+                await self.directConn(connection, request, trace)
+                return
+        if self.resume:
+            await self.sessionConn(connection, request.host, request.port,
+                                   trace)
+            return
+
+        try:
+            remote, remoteServer = await self.openTunnel(buf, trace)
+        except ConnectionError:
+            await self.loop.sock_sendall(
+                connection, socks.packReply(socks.REP_GENERAL_FAILURE))
+            connection.close()
+            raise
+
+        # the reply of LsServer is relayed to the client
+        await self.relay(connection, remote, remoteServer, trace)
+
+    async def transparentConn(self, connection: Connection,
+                              dst: net.Address,
+                              trace: tracing.Trace=tracing.NULL_TRACE):
+        """
+        Connect the original destination of a redirected connection,
+        directly if it matches the rules, or through the tunnel.
+        The client has sent no SOCKS request, and expects no reply.
+        """
+        trace.setDst(dst.ip, dst.port)
+        if self.rules is not None:
+            await self.rules.prepare(self.loop)
+            if self.rules.match(dst.ip):
+                logger.debug('Direct %s:%d', *dst)
+                try:
+                    dstServer = await net.connect(self.loop, *dst)
+                except OSError:
+                    trace.fail('connect')
+                    connection.close()
+                    return
+                trace.mark('connect')
+                await self.pipe(connection, dstServer, trace)
+                return
 
-        def cleanUp(task):
-            """
-            Close the socket when they succeeded or had an exception.
-            """
+        if self.resume:
+            await self.sessionConn(connection, dst.ip, dst.port, trace,
+                                   reply=False)
+            return
+        try:
+            remote, remoteServer = await self.connectTunnel(
+                dst.ip, dst.port, trace)
+        except ConnectionError:
+            connection.close()
+            raise
+        trace.mark('connect')
+        await self.relay(connection, remote, remoteServer, trace)
+
+    async def sessionConn(self, connection: Connection, host: str, port: int,
+                          trace: tracing.Trace=tracing.NULL_TRACE,
+                          reply: bool=True):
+        """
+        Open a session to the host and port, and relay the connection in it.
+        With reply, the client waits for the SOCKS reply.
+        """
+        sessionId = session.newSessionId()
+        try:
+            remote, remoteServer = await self.connectTunnel(
+                host, port, trace, session.packNew(sessionId))
+        except ConnectionError:
+            if reply:
+                try:
+                    await self.loop.sock_sendall(
+                        connection,
+                        socks.packReply(socks.REP_GENERAL_FAILURE))
+                except OSError:
+                    pass
+            connection.close()
+            raise
+        trace.mark('connect')
+        try:
+            if reply:
+                await self.loop.sock_sendall(connection, socks.packReply())
+        except OSError:
             remoteServer.close()
             connection.close()
+            self.balancer.release(remote)
+            return
+
+        secureSocket = self.secureSockets[remote]
+        resumable = session.Session(secureSocket, sessionId, connection,
+                                    self.replaySize)
 
-        local2remote = asyncio.ensure_future(
-            self.decodeCopy(connection, remoteServer))
-        remote2local = asyncio.ensure_future(
-            self.encodeCopy(remoteServer, connection))
-        task = asyncio.ensure_future(
-            asyncio.gather(
-                local2remote,
-                remote2local,
-                loop=self.loop,
-                return_exceptions=True))
-        task.add_done_callback(cleanUp)
+        async def lost(resumable):
+            return await self.resumeSession(remote, resumable)
 
-    async def dialRemote(self):
+        try:
+            await resumable.run(remoteServer, lost)
+        finally:
+            self.balancer.release(remote)
+
+    async def resumeSession(self, remote: balancer.Remote,
+                            resumable: session.Session) -> bool:
         """
-        Create a socket that connects to the Remote Server.
+        Dial the remote again until it resumes the session,
+        or the graceTime has passed.
         """
+        secureSocket = self.secureSockets[remote]
+        deadline = self.loop.time() + self.graceTime
+        delay = session.RETRY_DELAY
+        while True:
+            try:
+                conn = await remote.connect(self.balancer.connectTimeout,
+                                           self.loop)
+            except ConnectionError:
+                conn = None
+            if conn is not None:
+                try:
+                    await secureSocket.encodeWrite(
+                        conn,
+                        bytearray(
+                            session.packResume(resumable.sessionId,
+                                               resumable.received)))
+                except OSError:
+                    pass
+                status, received = session.unpackResumed(
+                    await secureSocket.readExactly(conn,
+                                                   session.RESUMED_SIZE))
+                if status == session.RESUMED:
+                    logger.info('Resume session %s',
+                                resumable.sessionId.hex())
+                    await resumable.attach(conn, received)
+                    return True
+                conn.close()
+                if status != session.BUSY:
+                    # LsServer has given it up
+                    return False
+            timeout = deadline - self.loop.time()
+            if timeout <= 0:
+                return False
+            await asyncio.sleep(min(delay, timeout))
+            delay = min(delay * 2, session.MAX_RETRY_DELAY)
+
+    async def directConn(self, connection: Connection,
+                         request: socks.Request,
+                         trace: tracing.Trace=tracing.NULL_TRACE):
+        logger.debug('Direct %s:%d', request.host, request.port)
         try:
-            remoteConn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            remoteConn.setblocking(False)
-            await self.loop.sock_connect(remoteConn, self.remoteAddr)
-        except Exception as err:
-            raise ConnectionError('链接到远程服务器 %s:%d 失败:\n%r' % (*self.remoteAddr,
-                                                              err))
-        return remoteConn
+            dstServer = await net.connect(self.loop, request.host,
+                                          request.port)
+        except OSError:
+            trace.fail('connect')
+            await self.loop.sock_sendall(
+                connection, socks.packReply(socks.REP_HOST_UNREACHABLE))
+            connection.close()
+            return
+        trace.mark('connect')
+
+        try:
+            await self.loop.sock_sendall(connection, socks.packReply())
+        except OSError:
+            dstServer.close()
+            connection.close()
+            return
+        await self.pipe(connection, dstServer, trace)
+
+    async def pipe(self, connection: Connection, dstServer: Connection,
+                   trace: tracing.Trace=tracing.NULL_TRACE):
+        """
+        Relay the connection and the destination without the cipher.
+        """
+        if self.tcpInfo.enabled:
+            self.tcpInfo.track(dstServer, tcpinfo.DST,
+                               tcpinfo.peerName(dstServer, port=True))
+        await Relay(
+            self,
+            client=connection,
+            upstream=dstServer,
+            firstRead=trace.markFirstByte,
+            beforeClose=self.tcpInfo.release).run()
+
+    async def openTunnel(self, request: bytes,
+                         trace: tracing.Trace=tracing.NULL_TRACE,
+                         header: bytes=b''
+                         ) -> typing.Tuple[balancer.Remote, Connection]:
+        """
+        Dial a remote and send the SOCKS request to it,
+        the reply of the request is left to the caller.
+        header is sent in front of the SOCKS greeting.
+        """
+        try:
+            remote, remoteServer = await self.balancer.dial(self.loop)
+        except ConnectionError:
+            trace.fail('dial')
+            raise
+        trace.mark('dial')
+
+        greeting = header + socks.GREETING
+        if trace.traceId is not None:
+            greeting = tracing.packTraceId(trace.traceId) + greeting
+        secureSocket = self.secureSockets[remote]
+        try:
+            await secureSocket.encodeWrite(remoteServer, bytearray(greeting))
+            buf = await secureSocket.decodeRead(remoteServer)
+            if buf != socks.METHOD_SELECTION:
+                raise ConnectionError('远程服务器 %s:%d 拒绝了请求' %
+                                      remote.address)
+            await secureSocket.encodeWrite(remoteServer, bytearray(request))
+        except OSError as err:
+            remoteServer.close()
+            self.balancer.release(remote)
+            if isinstance(err, ConnectionError):
+                raise
+            raise ConnectionError(err)
+        return remote, remoteServer
+
+    async def connectTunnel(self, host: str, port: int,
+                            trace: tracing.Trace=tracing.NULL_TRACE,
+                            header: bytes=b''
+                            ) -> typing.Tuple[balancer.Remote, Connection]:
+        """
+        Open a tunnel to the host and port, and read the reply of LsServer.
+        Raise ConnectionError if LsServer fails to connect them.
+        header is sent in front of the SOCKS greeting.
+        """
+        remote, remoteServer = await self.openTunnel(
+            socks.packRequest(host, port), trace, header)
+        reply = await self.secureSockets[remote].readExactly(
+            remoteServer, len(socks.packReply()))
+        if len(reply) < len(socks.packReply()) or \
+                reply[1] != socks.REP_SUCCEEDED:
+            trace.fail('connect')
+            remoteServer.close()
+            self.balancer.release(remote)
+            raise ConnectionError('%s:%d 连接失败' % (host, port))
+        return remote, remoteServer
@@ -1,39 +1,68 @@
+import functools
 import logging
-import typing
 import socket
 import asyncio
+import time
+import typing
 
-from lightsocks.utils import net
+from lightsocks.utils import net, socks, tracing
+from lightsocks.utils import accounting, tcpinfo
+from lightsocks.utils.breaker import Breaker
+from lightsocks.utils.srcpool import Source, SourcePool
+from lightsocks.utils.recorder import UP, DOWN, ConnRecord, Recorder
 from lightsocks.core.cipher import Cipher
-from lightsocks.core.securesocket import SecureSocket
+from lightsocks.core.relay import LINGER_RESET, Relay
+from lightsocks.core import session, transport
+from lightsocks.core.scheduler import INTERACTIVE
+from lightsocks.core.service import Service
 
 Connection = socket.socket
 logger = logging.getLogger(__name__)
 
+# the bytes read ahead while the destination is being connected
+OPTIMISTIC_BUFFER = 64 * 1024
 
-class LsServer(SecureSocket):
+
+class LsServer(Service):
     def __init__(self,
                  loop: asyncio.AbstractEventLoop,
                  password: bytearray,
-                 listenAddr: net.Address) -> None:
-        super().__init__(loop=loop, cipher=Cipher.NewCipher(password))
-        self.listenAddr = listenAddr
-
-    async def listen(self, didListen: typing.Callable=None):
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as listener:
-            listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            listener.setblocking(False)
-            listener.bind(self.listenAddr)
-            listener.listen(socket.SOMAXCONN)
-
-            logger.info('Listen to %s:%d' % self.listenAddr)
-            if didListen:
-                didListen(listener.getsockname())
-
-            while True:
-                connection, address = await self.loop.sock_accept(listener)
-                logger.info('Receive %s:%d', *address)
-                asyncio.ensure_future(self.handleConn(connection))
+                 listenAddr: net.Address,
+                 listener: Connection=None,
+                 tracer: tracing.Tracer=None,
+                 recorder: Recorder=None,
+                 breaker: Breaker=None,
+                 interactivePorts: typing.Iterable[int]=(),
+                 accounts: accounting.Accounting=None,
+                 user: str=None,
+                 sources: SourcePool=None,
+                 sessions: session.Sessions=None,
+                 tcpInfo: tcpinfo.Sampler=None,
+                 optimistic: bool=False,
+                 cipher: Cipher=None,
+                 **options) -> None:
+        super().__init__(
+            loop=loop,
+            cipher=cipher or Cipher.NewCipher(password),
+            listenAddr=listenAddr,
+            listener=listener,
+            **options)
+        self.tracer = tracer or tracing.Tracer()
+        self.recorder = recorder or Recorder()
+        self.breaker = breaker or Breaker(loop)
+        # the relays to these ports are always served first by the scheduler
+        self.interactivePorts = frozenset(interactivePorts)
+        self.accounts = accounts or accounting.Accounting()
+        # the traffic is accounted to the user of the port by default
+        self.user = user or str(listenAddr.port)
+        # the source addresses of the connections to the destinations
+        self.sources = sources or SourcePool()
+        # the resumable sessions are refused without it
+        self.sessions = sessions
+        # the tunnels are aggregated by LsLocal, the destinations by request
+        self.tcpInfo = tcpInfo or tcpinfo.Sampler()
+        # reply the success before the destination is connected
+        self.optimistic = optimistic
 
     async def handleConn(self, connection: Connection):
         """
@@ -51,8 +80,40 @@ class LsServer(SecureSocket):
         The VER field is set to X'05' for this ver of the protocol.  The
         NMETHODS field contains the number of method identifier octets that
         appear in the METHODS field.
+
+        LsLocal may send a trace id in front of it, see tracing,
+        and a session header, see session.
         """
+        accepted = time.monotonic()
+        record = self.recorder.begin()
         buf = await self.decodeRead(connection)
+        traceId, buf = tracing.unpackTraceId(buf)
+        trace = self.tracer.begin('server', traceId, accepted)
+        try:
+            if traceId is not None and not buf:
+                buf = await self.decodeRead(connection)
+            kind, sessionId, received, buf = session.unpackHeader(buf)
+            if kind is not None and self.sessions is None:
+                connection.close()
+                return
+            if kind == session.RESUME:
+                await self.sessions.resume(self, sessionId, received,
+                                           connection)
+                return
+            if kind == session.NEW and not buf:
+                buf = await self.decodeRead(connection)
+            await self.serveConn(connection, buf, trace, record, sessionId)
+        finally:
+            self.tracer.finish(trace)
+            self.recorder.finish(record)
+
+    async def serveConn(self, connection: Connection, buf: bytearray,
+                        trace: tracing.Trace, record: ConnRecord,
+                        sessionId: bytes=None):
+        """
+        Serve the SOCKS5 negotiation, buf is the method selection message.
+        With sessionId, the connection is relayed as a resumable session.
+        """
         if not buf or buf[0] != 0x05:
             connection.close()
             return
@@ -103,66 +164,60 @@ class LsServer(SecureSocket):
              order
         """
         buf = await self.decodeRead(connection)
-        if len(buf) < 7:
+        try:
+            request = socks.parseRequest(buf)
+        except socks.InvalidRequestError:
+            trace.fail('request')
             connection.close()
             return
 
-        if buf[1] != 0x01:
+        if request.cmd != socks.CMD_CONNECT:
+            trace.fail('command')
             connection.close()
             return
+        trace.mark('handshake')
+        trace.setDst(request.host, request.port)
+        record.setDst(request.host, request.port)
+        if self.accounts.refuse(self.user):
+            trace.fail('quota')
+            await self.replyFailure(connection, socks.REP_NOT_ALLOWED)
+            return
 
-        dstIP = None
-
-        dstPort = buf[-2:]
-        dstPort = int(dstPort.hex(), 16)
-
-        dstFamily = None
-
-        if buf[3] == 0x01:
-            # ipv4
-            dstIP = socket.inet_ntop(socket.AF_INET, buf[4:4 + 4])
-            dstAddress = net.Address(ip=dstIP, port=dstPort)
-            dstFamily = socket.AF_INET
-        elif buf[3] == 0x03:
-            # domain
-            dstIP = buf[5:-2].decode()
-            dstAddress = net.Address(ip=dstIP, port=dstPort)
-        elif buf[3] == 0x04:
-            # ipv6
-            dstIP = socket.inet_ntop(socket.AF_INET6, buf[4:4 + 16])
-            dstAddress = (dstIP, dstPort, 0, 0)
-            dstFamily = socket.AF_INET6
-        else:
-            connection.close()
+        key = (request.host, request.port)
+        rep = self.breaker.check(key)
+        if rep is not None:
+            trace.fail('breaker')
+            await self.replyFailure(connection, rep)
             return
 
-        dstServer = None
-        if dstFamily:
+        # a resumable session replies after it is set up, see session
+        optimistic = self.optimistic and sessionId is None
+        early = None
+        if optimistic:
             try:
-                dstServer = socket.socket(
-                    family=dstFamily, type=socket.SOCK_STREAM)
-                dstServer.setblocking(False)
-                await self.loop.sock_connect(dstServer, dstAddress)
+                await self.encodeWrite(connection, socks.packReply())
             except OSError:
-                if dstServer is not None:
-                    dstServer.close()
-                    dstServer = None
-        else:
-            host, port = dstAddress
-            for res in await self.loop.getaddrinfo(host, port):
-                dstFamily, socktype, proto, _, dstAddress = res
-                try:
-                    dstServer = socket.socket(dstFamily, socktype, proto)
-                    dstServer.setblocking(False)
-                    await self.loop.sock_connect(dstServer, dstAddress)
-                    break
-                except OSError:
-                    if dstServer is not None:
-                        dstServer.close()
-                        dstServer = None
-
-        if dstFamily is None:
+                connection.close()
+                return
+        try:
+            if optimistic:
+                dstServer, source, early = await self.connectEarly(
+                    connection, request, trace)
+            else:
+                dstServer, source = await self.connectDst(request, trace)
+        except OSError as err:
+            rep = socks.replyCode(err)
+            self.breaker.fail(key, rep)
+            trace.fail('connect')
+            if optimistic:
+                # the success has been replied, the client sees a reset
+                self.resetConn(connection)
+            else:
+                await self.replyFailure(connection, rep)
             return
+        self.breaker.succeed(key)
+        trace.mark('connect')
+        record.connected()
         """
         The SOCKS request information is sent by the client as soon as it has
         established a connection to the SOCKS server, and completed the
@@ -192,22 +247,193 @@ class LsServer(SecureSocket):
                 o  RSV    RESERVED
                 o  ATYP   address type of following address
         """
-        await self.encodeWrite(connection,
-                               bytearray((0x05, 0x00, 0x00, 0x01, 0x00, 0x00,
-                                          0x00, 0x00, 0x00, 0x00)))
+        try:
+            await self.serveRelay(connection, dstServer, request, trace,
+                                  record, sessionId, early)
+        finally:
+            if source is not None:
+                self.sources.release(source)
 
-        def cleanUp(task):
-            """
-            Close the socket when they succeeded or had an exception.
-            """
-            dstServer.close()
-            connection.close()
+    async def serveRelay(self, connection: Connection, dstServer: Connection,
+                         request: socks.Request, trace: tracing.Trace,
+                         record: ConnRecord, sessionId: bytes=None,
+                         early: bytearray=None):
+        """
+        Reply the success, and relay until either side is done.
+        early is what the client has sent after an optimistic reply,
+        None if the success has not been replied yet.
+        """
+        if early is None:
+            try:
+                await self.encodeWrite(connection, socks.packReply())
+            except OSError:
+                dstServer.close()
+                connection.close()
+                return
+        if sessionId is not None:
+            await self.sessions.serve(self, sessionId, connection, dstServer)
+            return
 
-        conn2dst = asyncio.ensure_future(
-            self.decodeCopy(dstServer, connection))
-        dst2conn = asyncio.ensure_future(
-            self.encodeCopy(connection, dstServer))
-        task = asyncio.ensure_future(
-            asyncio.gather(
-                conn2dst, dst2conn, loop=self.loop, return_exceptions=True))
-        task.add_done_callback(cleanUp)
+        dst = '%s:%d' % (request.host, request.port)
+        usage = self.accounts.begin(self.user, dst)
+        if self.tcpInfo.enabled:
+            self.tcpInfo.track(connection, tcpinfo.TUNNEL,
+                               tcpinfo.peerName(connection))
+            self.tcpInfo.track(dstServer, tcpinfo.DST, dst)
+        relay = Relay(
+            self,
+            client=connection,
+            upstream=dstServer,
+            toUpstream=record.observe(UP, self.cipher.decode),
+            toClient=record.observe(DOWN, self.cipher.encode),
+            firstRead=trace.markFirstByte,
+            priority=INTERACTIVE
+            if request.port in self.interactivePorts else None,
+            countToUpstream=usage.count(accounting.UP),
+            countToClient=usage.count(accounting.DOWN),
+            resetOnAbort=self.sources.fastClose,
+            beforeClose=self.releaseConns)
+        # the quotas are checked on the main loop, see workers
+        usage.attach(
+            functools.partial(self.loop.call_soon_threadsafe, relay.abort))
+        try:
+            if early:
+                relay.toUpstream(early)
+                if relay.countToUpstream is not None:
+                    relay.countToUpstream(len(early))
+                try:
+                    await self.loop.sock_sendall(dstServer, early)
+                except OSError:
+                    relay.abort()
+            await relay.run()
+        finally:
+            self.accounts.finish(usage)
+
+    async def connectEarly(self, connection: Connection,
+                           request: socks.Request, trace: tracing.Trace
+                           ) -> typing.Tuple[Connection,
+                                             typing.Optional[Source],
+                                             bytearray]:
+        """
+        Connect the destination, and read what the client sends meanwhile,
+        up to OPTIMISTIC_BUFFER bytes, still encoded.
+        Return the connection, its source and the data read.
+        """
+        connecting = asyncio.ensure_future(
+            self.connectDst(request, trace), loop=self.loop)
+        # wait for the client without a recv in flight,
+        # a cancelled recv may have taken the data already
+        waiting = None
+        early = bytearray()
+        try:
+            while not connecting.done() and len(early) < OPTIMISTIC_BUFFER:
+                waiting = asyncio.ensure_future(
+                    self.waitReadable(connection, None), loop=self.loop)
+                await asyncio.wait(
+                    (connecting, waiting),
+                    return_when=asyncio.FIRST_COMPLETED)
+                if not waiting.done():
+                    # nothing to read, the relay reads it later
+                    break
+                try:
+                    data = connection.recv(OPTIMISTIC_BUFFER - len(early))
+                except (BlockingIOError, InterruptedError):
+                    continue
+                except OSError:
+                    data = b''
+                if not data:
+                    # the end of the client is read again by the relay
+                    break
+                early += data
+            dstServer, source = await connecting
+        finally:
+            connecting.cancel()
+            if waiting is not None and not waiting.done():
+                waiting.cancel()
+                # its reader is removed before the relay adds its own
+                await asyncio.wait((waiting, ))
+        return dstServer, source, early
+
+    def releaseConns(self, connection: Connection, dstServer: Connection):
+        """
+        Report the tunnel and the destination before they are closed.
+        """
+        if self.mptcp:
+            tcpinfo.logSubflows(connection,
+                                tcpinfo.peerName(connection, port=True))
+        self.tcpInfo.release(connection, dstServer)
+
+    def resetConn(self, connection: Connection):
+        """
+        Close the connection with a reset.
+        """
+        try:
+            connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
+                                  LINGER_RESET)
+        except OSError:
+            pass
+        connection.close()
+
+    async def connectDst(self, request: socks.Request,
+                         trace: tracing.Trace
+                         ) -> typing.Tuple[Connection,
+                                           typing.Optional[Source]]:
+        """
+        Connect the destination of the request, try every address of a domain.
+        Raise the error of the last address if none of them is connected.
+        With a pool of source addresses, the next source is tried
+        while the ones before have no free port to the address.
+        Return the connection and its source, which must be released.
+        """
+        if request.atyp == socks.ATYP_IPV4:
+            infos = [(socket.AF_INET, socket.SOCK_STREAM, 0, '',
+                      (request.host, request.port))]
+        elif request.atyp == socks.ATYP_IPV6:
+            infos = [(socket.AF_INET6, socket.SOCK_STREAM, 0, '',
+                      (request.host, request.port, 0, 0))]
+        else:
+            try:
+                infos = await self.loop.getaddrinfo(
+                    request.host, request.port, type=socket.SOCK_STREAM)
+            except OSError:
+                trace.fail('dns')
+                raise
+            finally:
+                trace.mark('dns')
+
+        lastErr = OSError('no address of %s' % request.host)
+        for dstFamily, socktype, proto, _, dstAddress in infos:
+            for source in self.sources.candidates(dstFamily,
+                                                  dstAddress) or [None]:
+                dstServer = None
+                try:
+                    dstServer = transport.createSocket(
+                        self.loop, dstFamily, socktype, proto)
+                    dstServer.setblocking(False)
+                    if source is not None:
+                        self.sources.bind(dstServer, source)
+                    await self.loop.sock_connect(dstServer, dstAddress)
+                    if source is not None:
+                        self.sources.connected(source)
+                    return dstServer, source
+                except OSError as err:
+                    lastErr = err
+                    if dstServer is not None:
+                        dstServer.close()
+                    if source is None or not self.sources.failed(source, err):
+                        break
+                except asyncio.CancelledError:
+                    if dstServer is not None:
+                        dstServer.close()
+                    raise
+        raise lastErr
+
+    async def replyFailure(self, connection: Connection, rep: int):
+        """
+        Tell the client why the destination can not be connected, and close.
+        """
+        try:
+            await self.encodeWrite(connection, socks.packReply(rep))
+        except OSError:
+            pass
+        connection.close()
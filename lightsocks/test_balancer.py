@@ -0,0 +1,144 @@
+import asyncio
+import socket
+import unittest
+
+from lightsocks import balancer
+from lightsocks.core.password import randomPassword
+from lightsocks.utils import net, workers
+
+
+class TestBalancer(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+
+        self.servers = []
+        for _ in range(2):
+            server = socket.socket()
+            server.bind(('127.0.0.1', 0))
+            server.listen(socket.SOMAXCONN)
+            self.servers.append(server)
+
+        self.remotes = [
+            balancer.Remote(self.loop,
+                            net.Address(*server.getsockname()),
+                            randomPassword()) for server in self.servers
+        ]
+
+    def tearDown(self):
+        for server in self.servers:
+            server.close()
+        self.loop.close()
+
+    def test_strategy(self):
+        self.remotes[0].rtt, self.remotes[0].active = 0.2, 0
+        self.remotes[1].rtt, self.remotes[1].active = 0.1, 3
+
+        latency = balancer.Balancer(self.loop, self.remotes)
+        self.assertEqual(latency.candidates(), self.remotes[::-1])
+
+        leastconn = balancer.Balancer(
+            self.loop, self.remotes, strategy=balancer.LEAST_CONN)
+        self.assertEqual(leastconn.candidates(), self.remotes)
+
+        with self.assertRaises(ValueError):
+            balancer.Balancer(self.loop, self.remotes, strategy='random')
+
+        with self.assertRaises(ValueError):
+            balancer.Balancer(self.loop, [])
+
+    def test_failover(self):
+        self.remotes[0].address = net.Address('127.0.0.1', 0)
+        pool = balancer.Balancer(self.loop, self.remotes)
+
+        async def test():
+            remote, conn = await pool.dial()
+            conn.close()
+            self.assertIs(remote, self.remotes[1])
+            self.assertEqual(remote.active, 1)
+            pool.release(remote)
+            self.assertEqual(remote.active, 0)
+
+            failed = self.remotes[0]
+            self.assertEqual(failed.failures, 1)
+            self.assertFalse(failed.available)
+            # the failed remote backs off, and is tried last
+            self.assertEqual(pool.candidates(), self.remotes[::-1])
+
+            self.remotes[1].address = net.Address('127.0.0.1', 0)
+            with self.assertRaises(ConnectionError):
+                await pool.dial()
+            self.assertEqual(failed.failures, 2)
+
+        self.loop.run_until_complete(test())
+
+    def test_failover_unsupported_family(self):
+        # an address of a family the host does not support
+        failed = self.remotes[0]
+        failed.resolved = [(-1, socket.SOCK_STREAM, 0, ('::1', 1))]
+        failed.resolvedAt = self.loop.time()
+        pool = balancer.Balancer(self.loop, self.remotes)
+
+        async def test():
+            remote, conn = await pool.dial()
+            conn.close()
+            pool.release(remote)
+            self.assertIs(remote, self.remotes[1])
+            self.assertEqual(failed.failures, 1)
+
+        self.loop.run_until_complete(test())
+
+    def test_probe(self):
+        pool = balancer.Balancer(self.loop, self.remotes)
+
+        self.loop.run_until_complete(pool.probe())
+        for remote in self.remotes:
+            self.assertIsNotNone(remote.rtt)
+            self.assertEqual(remote.failures, 0)
+
+    def test_resolve_cache(self):
+        remote = balancer.Remote(self.loop,
+                                 net.Address('localhost',
+                                             self.servers[0].getsockname()[1]),
+                                 randomPassword())
+        calls = []
+        getaddrinfo = self.loop.getaddrinfo
+
+        async def countingGetaddrinfo(*args, **kwargs):
+            calls.append(args)
+            return await getaddrinfo(*args, **kwargs)
+
+        self.loop.getaddrinfo = countingGetaddrinfo
+
+        async def test():
+            for _ in range(3):
+                conn = await remote.connect()
+                conn.close()
+
+        self.loop.run_until_complete(test())
+        self.assertEqual(len(calls), 1)
+
+    def test_shared(self):
+        pool = balancer.Balancer(self.loop, self.remotes,
+                                 strategy=balancer.LEAST_CONN)
+        workerPool = workers.WorkerPool(2)
+        workerPool.start()
+
+        async def dialMany(loop):
+            for _ in range(20):
+                remote, conn = await pool.dial(loop)
+                conn.close()
+                pool.release(remote)
+
+        try:
+            # the services of the workers dial on their own loops
+            dialing = [
+                asyncio.run_coroutine_threadsafe(dialMany(loop), loop)
+                for loop in workerPool.loops
+            ]
+            for future in dialing:
+                future.result(5)
+        finally:
+            workerPool.stop()
+        self.assertEqual([remote.active for remote in self.remotes], [0, 0])
+        self.assertTrue(all(remote.rtt is not None
+                            for remote in self.remotes))
@@ -0,0 +1,256 @@
+import asyncio
+import errno
+import socket
+import struct
+import unittest
+
+from lightsocks import dns
+from lightsocks.core.password import randomPassword
+from lightsocks.local import LsLocal
+from lightsocks.server import LsServer
+from lightsocks.utils import net
+
+
+def packQuery(msgId: int, name: str, qtype: int=1) -> bytes:
+    labels = b''.join(
+        bytes((len(label), )) + label.encode()
+        for label in name.split('.'))
+    return dns.HEADER.pack(msgId, 0x0100, 1, 0, 0, 0) + labels + b'\0' + \
+        struct.pack('!HH', qtype, 1)
+
+
+def packAnswer(query: bytes, ttl: int, address: str) -> bytes:
+    msgId = dns.HEADER.unpack_from(query)[0]
+    _, end = dns.parseQuestion(query)
+    return dns.HEADER.pack(msgId, 0x8180, 1, 1, 0, 0) + query[12:end] + \
+        struct.pack('!HHHIH', 0xc00c, 1, 1, ttl, 4) + \
+        socket.inet_aton(address)
+
+
+class FakeLoop:
+    def __init__(self):
+        self.now = 0.0
+
+    def time(self):
+        return self.now
+
+
+class TestCache(unittest.TestCase):
+    def test_ttl(self):
+        loop = FakeLoop()
+        cache = dns.Cache(loop, capacity=2)
+        query = packQuery(1, 'example.com')
+        key, end = dns.parseQuestion(query)
+        self.assertEqual(
+            dns.parseQuestion(packQuery(2, 'EXAMPLE.com'))[0], key)
+        cache.put(key, packAnswer(query, 60, '1.2.3.4'), end)
+
+        loop.now = 20.5
+        answer = cache.get(key, 7)
+        self.assertEqual(dns.HEADER.unpack_from(answer)[0], 7)
+        self.assertEqual(dns.ttlOffsets(answer, end), [end + 6])
+        self.assertEqual(
+            struct.unpack_from('!I', answer, end + 6)[0], 40)
+
+        loop.now = 60
+        self.assertIsNone(cache.get(key, 7))
+        self.assertFalse(cache.entries)
+
+    def test_lru(self):
+        loop = FakeLoop()
+        cache = dns.Cache(loop, capacity=2)
+        keys = []
+        for name in ('a.com', 'b.com', 'c.com'):
+            query = packQuery(1, name)
+            key, end = dns.parseQuestion(query)
+            keys.append(key)
+            cache.put(key, packAnswer(query, 60, '1.2.3.4'), end)
+            if name == 'b.com':
+                cache.get(keys[0], 1)
+        self.assertEqual(list(cache.entries), [keys[0], keys[2]])
+
+    def test_not_cached(self):
+        cache = dns.Cache(FakeLoop())
+        query = packQuery(1, 'example.com')
+        key, end = dns.parseQuestion(query)
+        cache.put(key, dns.servfail(query, end), end)
+        cache.put(key, packAnswer(query, 0, '1.2.3.4'), end)
+        self.assertFalse(cache.entries)
+
+    def test_truncate(self):
+        query = packQuery(1, 'example.com')
+        _, end = dns.parseQuestion(query)
+        self.assertEqual(dns.udpSize(query, end), dns.MAX_UDP_SIZE)
+        truncated = dns.truncate(packAnswer(query, 60, '1.2.3.4'), end)
+        self.assertEqual(len(truncated), end)
+        self.assertTrue(dns.HEADER.unpack_from(truncated)[1] & dns.FLAG_TC)
+
+
+class TestDnsForwarder(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        password = randomPassword()
+        self.server = LsServer(
+            loop=self.loop,
+            password=password,
+            listenAddr=net.Address('127.0.0.1', 0))
+        self.server.bind()
+        self.local = LsLocal(
+            loop=self.loop,
+            password=password,
+            listenAddr=net.Address('127.0.0.1', 0),
+            remoteAddr=net.Address(*self.server.listener.getsockname()))
+
+        # the stub upstream answers every query after the delay
+        self.upstream = socket.socket()
+        self.upstream.bind(('127.0.0.1', 0))
+        self.upstream.listen(socket.SOMAXCONN)
+        self.upstream.setblocking(False)
+        self.queries = []
+        self.delay = 0
+        self.forwarder = dns.DnsForwarder(
+            self.loop,
+            net.Address('127.0.0.1', 0),
+            upstream=net.Address(*self.upstream.getsockname()))
+        self.forwarder.local = self.local
+
+    def tearDown(self):
+        self.upstream.close()
+        self.loop.close()
+
+    async def serveUpstream(self):
+        conn, _ = await self.loop.sock_accept(self.upstream)
+        buf = b''
+        with conn:
+            while True:
+                data = await self.loop.sock_recv(conn, 1024)
+                if not data:
+                    break
+                buf += data
+                while len(buf) >= 2 and len(buf) >= 2 + buf[0] * 256 + buf[1]:
+                    size = buf[0] * 256 + buf[1]
+                    query, buf = buf[2:2 + size], buf[2 + size:]
+                    self.queries.append(query)
+                    await asyncio.sleep(self.delay)
+                    answer = packAnswer(query, 60, '1.2.3.4')
+                    await self.loop.sock_sendall(
+                        conn, struct.pack('!H', len(answer)) + answer)
+
+    async def start(self):
+        asyncio.ensure_future(self.server.listen())
+        serving = asyncio.ensure_future(self.serveUpstream())
+        await self.forwarder.start()
+        return serving
+
+    async def finish(self, serving):
+        self.forwarder.close()
+        await asyncio.wait_for(serving, 1)
+        self.server.stopAccepting()
+        await self.server.drain(1)
+
+    async def queryUdp(self, msgId, name):
+        client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        client.setblocking(False)
+        with client:
+            await self.loop.sock_connect(
+                client, self.forwarder.transport.get_extra_info('sockname'))
+            await self.loop.sock_sendall(client, packQuery(msgId, name))
+            return await asyncio.wait_for(
+                self.loop.sock_recv(client, 1024), 1)
+
+    def test_udp(self):
+        async def test():
+            serving = await self.start()
+            first = await self.queryUdp(1, 'example.com')
+            self.assertEqual(first[-4:], socket.inet_aton('1.2.3.4'))
+            # the second one is answered from the cache with its own id
+            second = await self.queryUdp(2, 'Example.com')
+            self.assertEqual(dns.HEADER.unpack_from(second)[0], 2)
+            self.assertEqual(len(self.queries), 1)
+            self.assertEqual(self.forwarder.cache.hits, 1)
+            await self.finish(serving)
+
+        self.loop.run_until_complete(test())
+        self.assertEqual(self.local.balancer.remotes[0].active, 0)
+
+    def test_coalesce(self):
+        self.delay = 0.05
+
+        async def test():
+            serving = await self.start()
+            answers = await asyncio.gather(
+                *(self.queryUdp(msgId, 'example.com')
+                  for msgId in range(1, 6)),
+                self.queryUdp(6, 'example.org'))
+            self.assertEqual(
+                [dns.HEADER.unpack_from(answer)[0] for answer in answers],
+                list(range(1, 7)))
+            # one query for each name over one connection
+            self.assertEqual(len(self.queries), 2)
+            await self.finish(serving)
+
+        self.loop.run_until_complete(test())
+
+    def test_tcp(self):
+        async def test():
+            serving = await self.start()
+            client = socket.socket()
+            client.setblocking(False)
+            with client:
+                await self.loop.sock_connect(client,
+                                             self.forwarder.listener
+                                             .getsockname())
+                for msgId in (1, 2):
+                    query = packQuery(msgId, 'example.com')
+                    await self.loop.sock_sendall(
+                        client, struct.pack('!H', len(query)) + query)
+                    size = struct.unpack(
+                        '!H', await self.loop.sock_recv(client, 2))[0]
+                    answer = await self.loop.sock_recv(client, size)
+                    self.assertEqual(dns.HEADER.unpack_from(answer)[0],
+                                     msgId)
+            self.assertEqual(len(self.queries), 1)
+            await self.finish(serving)
+
+        self.loop.run_until_complete(test())
+
+    def test_port_taken(self):
+        create = self.loop.create_datagram_endpoint
+        taken = []
+
+        async def createTaken(factory, local_addr):
+            if not taken:
+                taken.append(local_addr[1])
+                raise OSError(errno.EADDRINUSE, 'Address already in use')
+            return await create(factory, local_addr=local_addr)
+
+        self.loop.create_datagram_endpoint = createTaken
+
+        async def test():
+            serving = await self.start()
+            # the port is picked again, the same for TCP and UDP
+            port = self.forwarder.listener.getsockname()[1]
+            self.assertEqual(
+                self.forwarder.transport.get_extra_info('sockname')[1], port)
+            answer = await self.queryUdp(1, 'example.com')
+            self.assertEqual(answer[-4:], socket.inet_aton('1.2.3.4'))
+            await self.finish(serving)
+
+        self.loop.run_until_complete(test())
+        self.assertEqual(len(taken), 1)
+
+    def test_servfail(self):
+        async def test():
+            asyncio.ensure_future(self.server.listen())
+            # nothing listens on the upstream
+            self.upstream.close()
+            await self.forwarder.start()
+            answer = await self.queryUdp(1, 'example.com')
+            self.assertEqual(
+                dns.HEADER.unpack_from(answer)[1] & dns.RCODE_MASK,
+                dns.RCODE_SERVFAIL)
+            self.forwarder.close()
+            self.server.stopAccepting()
+            await self.server.drain(1)
+
+        self.loop.run_until_complete(test())
@@ -1,11 +1,17 @@
 import asyncio
+import os
 import socket
+import tempfile
 import unittest
 
 from lightsocks.core.cipher import Cipher
 from lightsocks.core.password import randomPassword
+from lightsocks.core import transport
+from lightsocks.core.session import Sessions
 from lightsocks.local import LsLocal
-from lightsocks.utils import net
+from lightsocks.server import LsServer
+from lightsocks.utils import net, socks
+from lightsocks.utils.rules import RuleSet
 
 
 class TestLsLocal(unittest.TestCase):
@@ -36,20 +42,24 @@ class TestLsLocal(unittest.TestCase):
         self.remoteServer.close()
         self.loop.close()
 
-    def test_dialRemote(self):
+    def test_dial(self):
         async def test():
-            with await self.local.dialRemote() as connection:
+            remote, connection = await self.local.balancer.dial()
+            with connection:
+                self.assertEqual(remote.active, 1)
                 await self.loop.sock_sendall(connection, self.msg)
                 remoteConn, _ = await self.loop.sock_accept(self.remoteServer)
                 received_msg = await self.loop.sock_recv(remoteConn, 1024)
                 remoteConn.close()
                 self.assertEqual(received_msg, self.msg)
+            self.local.balancer.release(remote)
+            self.assertEqual(remote.active, 0)
 
         self.loop.run_until_complete(test())
 
         with self.assertRaises(ConnectionError):
             self.local.remoteAddr = net.Address('127.0.0.1', 0)
-            self.loop.run_until_complete(self.local.dialRemote())
+            self.loop.run_until_complete(self.local.balancer.dial())
 
     def test_run(self):
         def didListen(address):
@@ -77,3 +87,373 @@ class TestLsLocal(unittest.TestCase):
 
         with self.assertRaises(RuntimeError):
             self.loop.run_until_complete(self.local.listen(didListen))
+
+
+class TestLsLocalRules(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        path = os.path.join(self.dir.name, 'direct.txt')
+        with open(path, 'w') as f:
+            f.write('10.0.0.0/8\nlocalhost\n')
+
+        self.loop = asyncio.new_event_loop()
+        password = randomPassword()
+        self.server = LsServer(
+            loop=self.loop,
+            password=password,
+            listenAddr=net.Address('127.0.0.1', 0))
+        self.server.bind()
+        self.local = LsLocal(
+            loop=self.loop,
+            password=password,
+            listenAddr=net.Address('127.0.0.1', 0),
+            remoteAddr=net.Address(*self.server.listener.getsockname()),
+            rules=RuleSet([path]))
+        self.local.bind()
+
+        self.dstServer = socket.socket()
+        self.dstServer.bind(('127.0.0.1', 0))
+        self.dstServer.listen(socket.SOMAXCONN)
+        self.dstServer.setblocking(False)
+
+    def tearDown(self):
+        self.dstServer.close()
+        self.local.stopAccepting()
+        self.server.stopAccepting()
+        self.loop.close()
+        self.dir.cleanup()
+
+    async def request(self, host):
+        client = socket.socket()
+        client.setblocking(False)
+        await self.loop.sock_connect(client, self.local.listener.getsockname())
+        await self.loop.sock_sendall(client, socks.GREETING)
+        received_msg = await self.loop.sock_recv(client, 1024)
+        self.assertEqual(received_msg, socks.METHOD_SELECTION)
+
+        port = self.dstServer.getsockname()[1]
+        await self.loop.sock_sendall(client, socks.packRequest(host, port))
+        received_msg = await self.loop.sock_recv(client, 1024)
+        self.assertEqual(received_msg, socks.packReply())
+
+        await self.loop.sock_sendall(client, b'hello world')
+        dstConn, _ = await self.loop.sock_accept(self.dstServer)
+        with dstConn:
+            received_msg = await self.loop.sock_recv(dstConn, 1024)
+            self.assertEqual(received_msg, b'hello world')
+            await self.loop.sock_sendall(dstConn, b'hello client')
+        received_msg = await self.loop.sock_recv(client, 1024)
+        self.assertEqual(received_msg, b'hello client')
+        return client
+
+    def test_route(self):
+        async def test():
+            asyncio.ensure_future(self.server.listen())
+            asyncio.ensure_future(self.local.listen())
+
+            # 127.0.0.1 is not in the rules, it goes through LsServer
+            tunneled = await self.request('127.0.0.1')
+            self.assertEqual(len(self.server.connections), 1)
+
+            # localhost matches the rules, it is connected directly
+            direct = await self.request('localhost')
+            self.assertEqual(len(self.server.connections), 1)
+            self.assertEqual(len(self.local.connections), 2)
+
+            tunneled.close()
+            direct.close()
+
+            self.local.stopAccepting()
+            self.server.stopAccepting()
+            await self.local.drain(1)
+            await self.server.drain(1)
+
+        self.loop.run_until_complete(test())
+        self.assertTrue(self.local.rules.loaded)
+
+
+class TestLsLocalHttp(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        password = randomPassword()
+        self.server = LsServer(
+            loop=self.loop,
+            password=password,
+            listenAddr=net.Address('127.0.0.1', 0))
+        self.server.bind()
+        self.local = LsLocal(
+            loop=self.loop,
+            password=password,
+            listenAddr=net.Address('127.0.0.1', 0),
+            remoteAddr=net.Address(*self.server.listener.getsockname()))
+        self.local.bind()
+
+        self.dstServer = socket.socket()
+        self.dstServer.bind(('127.0.0.1', 0))
+        self.dstServer.listen(socket.SOMAXCONN)
+        self.dstServer.setblocking(False)
+        self.dstAddr = '127.0.0.1:%d' % self.dstServer.getsockname()[1]
+
+    def tearDown(self):
+        self.dstServer.close()
+        self.local.stopAccepting()
+        self.server.stopAccepting()
+        self.loop.close()
+
+    async def connect(self):
+        asyncio.ensure_future(self.server.listen())
+        asyncio.ensure_future(self.local.listen())
+        client = socket.socket()
+        client.setblocking(False)
+        await self.loop.sock_connect(client, self.local.listener.getsockname())
+        return client
+
+    async def recvUntil(self, conn, separator):
+        buf = b''
+        while separator not in buf:
+            data = await self.loop.sock_recv(conn, 1024)
+            if not data:
+                break
+            buf += data
+        return buf
+
+    async def finish(self, *conns):
+        for conn in conns:
+            conn.close()
+        self.local.stopAccepting()
+        self.server.stopAccepting()
+        await self.local.drain(1)
+        await self.server.drain(1)
+
+    def test_connect(self):
+        async def test():
+            client = await self.connect()
+            await self.loop.sock_sendall(
+                client, b'CONNECT %s HTTP/1.1\r\nHost: %s\r\n\r\n' %
+                ((self.dstAddr.encode(), ) * 2))
+            received_msg = await self.recvUntil(client, b'\r\n\r\n')
+            self.assertEqual(received_msg,
+                             b'HTTP/1.1 200 Connection Established\r\n\r\n')
+
+            await self.loop.sock_sendall(client, b'hello world')
+            dstConn, _ = await self.loop.sock_accept(self.dstServer)
+            received_msg = await self.loop.sock_recv(dstConn, 1024)
+            self.assertEqual(received_msg, b'hello world')
+            await self.loop.sock_sendall(dstConn, b'hello client')
+            received_msg = await self.loop.sock_recv(client, 1024)
+            self.assertEqual(received_msg, b'hello client')
+
+            await self.finish(client, dstConn)
+
+        self.loop.run_until_complete(test())
+
+    def test_keep_alive(self):
+        async def test():
+            client = await self.connect()
+            dstConn = None
+            for path in (b'/a', b'/b?c=d'):
+                await self.loop.sock_sendall(
+                    client, b'GET http://%s%s HTTP/1.1\r\n'
+                    b'Host: %s\r\nProxy-Connection: keep-alive\r\n\r\n' %
+                    (self.dstAddr.encode(), path, self.dstAddr.encode()))
+                if dstConn is None:
+                    # both requests go through the same upstream connection
+                    dstConn, _ = await self.loop.sock_accept(self.dstServer)
+                received_msg = await self.recvUntil(dstConn, b'\r\n\r\n')
+                self.assertTrue(
+                    received_msg.startswith(b'GET %s HTTP/1.1\r\n' % path))
+                self.assertNotIn(b'Proxy-Connection', received_msg)
+
+                await self.loop.sock_sendall(
+                    dstConn, b'HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok')
+                received_msg = await self.recvUntil(client, b'\r\n\r\nok')
+                self.assertTrue(received_msg.startswith(b'HTTP/1.1 200 OK'))
+                self.assertIn(b'Connection: keep-alive', received_msg)
+
+            self.assertEqual(len(self.server.connections), 1)
+            await self.finish(client, dstConn)
+
+        self.loop.run_until_complete(test())
+
+    def test_chunked(self):
+        async def test():
+            client = await self.connect()
+            await self.loop.sock_sendall(
+                client, b'POST http://%s/ HTTP/1.1\r\nHost: %s\r\n'
+                b'Transfer-Encoding: chunked\r\nContent-Length: 4\r\n\r\n'
+                b'5\r\nhello\r\n0\r\n\r\n' % ((self.dstAddr.encode(), ) * 2))
+            dstConn, _ = await self.loop.sock_accept(self.dstServer)
+            received_msg = await self.recvUntil(dstConn, b'0\r\n\r\n')
+            head, body = received_msg.split(b'\r\n\r\n', 1)
+            # Content-Length is dropped, the chunked encoding wins
+            self.assertNotIn(b'Content-Length', head)
+            self.assertIn(b'Transfer-Encoding: chunked', head)
+            self.assertEqual(body, b'5\r\nhello\r\n0\r\n\r\n')
+
+            await self.loop.sock_sendall(
+                dstConn, b'HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n'
+                b'\r\n2\r\nok\r\n0\r\n\r\n')
+            received_msg = await self.recvUntil(client, b'0\r\n\r\n')
+            head, body = received_msg.split(b'\r\n\r\n', 1)
+            self.assertIn(b'Transfer-Encoding: chunked', head)
+            self.assertEqual(body, b'2\r\nok\r\n0\r\n\r\n')
+
+            # a bad chunk after the head is sent only closes the client
+            await self.loop.sock_sendall(
+                client, b'GET http://%s/ HTTP/1.1\r\n\r\n' %
+                self.dstAddr.encode())
+            await self.recvUntil(dstConn, b'\r\n\r\n')
+            await self.loop.sock_sendall(
+                dstConn, b'HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n'
+                b'\r\nxx\r\n')
+            received_msg = await self.recvUntil(client, b'\r\n\r\nnever')
+            self.assertTrue(received_msg.endswith(b'\r\nxx\r\n'))
+
+            await self.finish(client, dstConn)
+
+        self.loop.run_until_complete(test())
+
+
+class TestLsLocalSession(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        password = randomPassword()
+        self.server = LsServer(
+            loop=self.loop,
+            password=password,
+            listenAddr=net.Address('127.0.0.1', 0),
+            sessions=Sessions(self.loop, graceTime=5))
+        self.server.bind()
+        self.local = LsLocal(
+            loop=self.loop,
+            password=password,
+            listenAddr=net.Address('127.0.0.1', 0),
+            remoteAddr=net.Address(*self.server.listener.getsockname()),
+            resume=True,
+            graceTime=5)
+        self.local.bind()
+
+        self.dstServer = socket.socket()
+        self.dstServer.bind(('127.0.0.1', 0))
+        self.dstServer.listen(socket.SOMAXCONN)
+        self.dstServer.setblocking(False)
+
+    def tearDown(self):
+        self.dstServer.close()
+        self.local.stopAccepting()
+        self.server.stopAccepting()
+        self.loop.close()
+
+    async def recvExactly(self, conn, size):
+        buf = b''
+        while len(buf) < size:
+            data = await self.loop.sock_recv(conn, size - len(buf))
+            if not data:
+                break
+            buf += data
+        return buf
+
+    def test_resume(self):
+        async def test():
+            asyncio.ensure_future(self.server.listen())
+            asyncio.ensure_future(self.local.listen())
+            client = socket.socket()
+            client.setblocking(False)
+            await self.loop.sock_connect(client,
+                                         self.local.listener.getsockname())
+            await self.loop.sock_sendall(client, socks.GREETING)
+            await self.recvExactly(client, 2)
+            await self.loop.sock_sendall(
+                client, socks.packRequest(*self.dstServer.getsockname()))
+            self.assertEqual(await self.recvExactly(client, 10),
+                             socks.packReply())
+            dstConn, _ = await self.loop.sock_accept(self.dstServer)
+
+            await self.loop.sock_sendall(client, b'before')
+            self.assertEqual(await self.recvExactly(dstConn, 6), b'before')
+
+            # the network changes, the tunnel is lost
+            resumable, = self.server.sessions.sessions.values()
+            resumable.tunnel.shutdown(socket.SHUT_RDWR)
+            await self.loop.sock_sendall(client, b'after')
+            await self.loop.sock_sendall(dstConn, b'reply')
+            self.assertEqual(await self.recvExactly(dstConn, 5), b'after')
+            self.assertEqual(await self.recvExactly(client, 5), b'reply')
+            self.assertEqual(self.server.sessions.resumed, 1)
+
+            client.close()
+            self.assertEqual(await self.loop.sock_recv(dstConn, 1024), b'')
+            dstConn.close()
+            self.local.stopAccepting()
+            self.server.stopAccepting()
+            await self.local.drain(1)
+            await self.server.drain(1)
+
+        self.loop.run_until_complete(test())
+        self.assertFalse(self.server.sessions.sessions)
+        self.assertEqual(self.local.balancer.remotes[0].active, 0)
+
+
+class TestLsLocalMptcp(unittest.TestCase):
+    def setUp(self):
+        if not transport.mptcpSupported():
+            self.skipTest('MPTCP is not supported')
+        self.loop = asyncio.new_event_loop()
+        password = randomPassword()
+        self.server = LsServer(
+            loop=self.loop,
+            password=password,
+            listenAddr=net.Address('127.0.0.1', 0),
+            mptcp=True)
+        self.server.bind()
+        self.local = LsLocal(
+            loop=self.loop,
+            password=password,
+            listenAddr=net.Address('127.0.0.1', 0),
+            remoteAddr=net.Address(*self.server.listener.getsockname()),
+            mptcp=True)
+        self.local.bind()
+
+        self.dstServer = socket.socket()
+        self.dstServer.bind(('127.0.0.1', 0))
+        self.dstServer.listen(socket.SOMAXCONN)
+        self.dstServer.setblocking(False)
+
+    def tearDown(self):
+        self.dstServer.close()
+        self.local.stopAccepting()
+        self.server.stopAccepting()
+        self.loop.close()
+
+    def test_subflows(self):
+        async def test():
+            asyncio.ensure_future(self.server.listen())
+            asyncio.ensure_future(self.local.listen())
+            client = socket.socket()
+            client.setblocking(False)
+            await self.loop.sock_connect(client,
+                                         self.local.listener.getsockname())
+            await self.loop.sock_sendall(client, socks.GREETING)
+            await self.loop.sock_recv(client, 2)
+            await self.loop.sock_sendall(
+                client, socks.packRequest(*self.dstServer.getsockname()))
+            self.assertEqual(await self.loop.sock_recv(client, 10),
+                             socks.packReply())
+            dstConn, _ = await self.loop.sock_accept(self.dstServer)
+            await self.loop.sock_sendall(client, b'hello')
+            self.assertEqual(await self.loop.sock_recv(dstConn, 5), b'hello')
+
+            client.close()
+            dstConn.close()
+            self.local.stopAccepting()
+            self.server.stopAccepting()
+            await self.local.drain(1)
+            await self.server.drain(1)
+
+        self.assertEqual(self.server.listener.proto, transport.IPPROTO_MPTCP)
+        with self.assertLogs('lightsocks.utils.tcpinfo', 'INFO') as logs:
+            self.loop.run_until_complete(test())
+        # the tunnel on both sides, with the only path of loopback
+        self.assertEqual(
+            len([line for line in logs.output if 'used 1 subflows' in line]),
+            2)
@@ -5,7 +5,9 @@ import unittest
 from lightsocks.core.cipher import Cipher
 from lightsocks.core.password import randomPassword
 from lightsocks.server import LsServer
-from lightsocks.utils import net
+from lightsocks.utils import net, socks
+from lightsocks.utils.breaker import Breaker
+from lightsocks.utils.srcpool import SourcePool
 
 
 def getValidAddr():
@@ -323,3 +325,141 @@ class TestLsServer(unittest.TestCase):
 
         with self.assertRaises(RuntimeError):
             self.loop.run_until_complete(self.server.listen(didListen))
+
+    def test_breaker(self):
+        self.server.breaker = Breaker(self.loop, threshold=2)
+        dstPort = getValidAddr()[1]
+
+        async def request():
+            localServer = socket.socket()
+            localServer.setblocking(False)
+            await self.loop.sock_connect(localServer, self.listenAddr)
+            msg = bytearray(socks.GREETING)
+            self.cipher.encode(msg)
+            await self.loop.sock_sendall(localServer, msg)
+            await self.loop.sock_recv(localServer, 1024)
+            msg = socks.packRequest('127.0.0.1', dstPort)
+            self.cipher.encode(msg)
+            await self.loop.sock_sendall(localServer, msg)
+            received_msg = bytearray(
+                await self.loop.sock_recv(localServer, 1024))
+            self.cipher.decode(received_msg)
+            self.assertFalse(await self.loop.sock_recv(localServer, 1024))
+            localServer.close()
+            return received_msg
+
+        async def test():
+            self.server.bind()
+            asyncio.ensure_future(self.server.listen())
+            # nothing listens on the port, the connection is refused
+            for _ in range(3):
+                self.assertEqual(
+                    await request(),
+                    socks.packReply(socks.REP_CONNECTION_REFUSED))
+            self.assertEqual(self.server.breaker.hits, 1)
+            self.server.stopAccepting()
+            await self.server.drain(1)
+
+        self.loop.run_until_complete(test())
+
+    def test_sources(self):
+        # the first source is not a local address, the next one is tried
+        self.server.sources = SourcePool(['192.0.2.1', '127.0.0.2'])
+        dstServer = socket.socket()
+        dstServer.bind(('127.0.0.1', 0))
+        dstServer.listen(socket.SOMAXCONN)
+        dstServer.setblocking(False)
+
+        async def test():
+            self.server.bind()
+            asyncio.ensure_future(self.server.listen())
+            localServer = socket.socket()
+            localServer.setblocking(False)
+            await self.loop.sock_connect(localServer, self.listenAddr)
+            for msg in (socks.GREETING,
+                        socks.packRequest(*dstServer.getsockname())):
+                msg = bytearray(msg)
+                self.cipher.encode(msg)
+                await self.loop.sock_sendall(localServer, msg)
+                await self.loop.sock_recv(localServer, 1024)
+            dstConn, peer = await self.loop.sock_accept(dstServer)
+            self.assertEqual(peer[0], '127.0.0.2')
+            stats = self.server.sources.stats()
+            self.assertEqual(stats['192.0.2.1']['exhausted'], 1)
+            self.assertEqual(stats['127.0.0.2']['active'], 1)
+
+            dstConn.close()
+            self.assertFalse(await self.loop.sock_recv(localServer, 1024))
+            localServer.close()
+            self.server.stopAccepting()
+            await self.server.drain(1)
+            self.assertEqual(self.server.sources.stats()['127.0.0.2'], {
+                'active': 0,
+                'connects': 1,
+                'exhausted': 0,
+                'failures': 0,
+            })
+
+        try:
+            self.loop.run_until_complete(test())
+        finally:
+            dstServer.close()
+
+    def test_optimistic(self):
+        self.server.optimistic = True
+        dstServer = socket.socket()
+        dstServer.bind(('127.0.0.1', 0))
+        dstServer.listen(socket.SOMAXCONN)
+        dstServer.setblocking(False)
+        connectDst = self.server.connectDst
+        connecting = []
+
+        async def slowConnect(request, trace):
+            connecting.append(request.port)
+            await asyncio.sleep(0.05)
+            return await connectDst(request, trace)
+
+        self.server.connectDst = slowConnect
+
+        async def request(port):
+            localServer = socket.socket()
+            localServer.setblocking(False)
+            await self.loop.sock_connect(localServer, self.listenAddr)
+            for msg in (socks.GREETING, socks.packRequest('127.0.0.1', port)):
+                msg = bytearray(msg)
+                self.cipher.encode(msg)
+                await self.loop.sock_sendall(localServer, msg)
+                received_msg = bytearray(
+                    await self.loop.sock_recv(localServer, 1024))
+                self.cipher.decode(received_msg)
+            # the success is replied while the destination is connected
+            self.assertEqual(received_msg, socks.packReply())
+            msg = bytearray(b'hello world')
+            self.cipher.encode(msg)
+            await self.loop.sock_sendall(localServer, msg)
+            return localServer
+
+        async def test():
+            self.server.bind()
+            asyncio.ensure_future(self.server.listen())
+            localServer = await request(dstServer.getsockname()[1])
+            dstConn, _ = await self.loop.sock_accept(dstServer)
+            self.assertEqual(await self.loop.sock_recv(dstConn, 1024),
+                             b'hello world')
+            dstConn.close()
+            self.assertFalse(await self.loop.sock_recv(localServer, 1024))
+            localServer.close()
+
+            # nothing listens on the port, the tunnel is reset
+            localServer = await request(getValidAddr()[1])
+            with self.assertRaises(ConnectionResetError):
+                await self.loop.sock_recv(localServer, 1024)
+            localServer.close()
+            self.assertEqual(len(connecting), 2)
+            self.server.stopAccepting()
+            await self.server.drain(1)
+
+        try:
+            self.loop.run_until_complete(test())
+        finally:
+            dstServer.close()
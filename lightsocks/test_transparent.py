@@ -0,0 +1,86 @@
+import asyncio
+import socket
+import unittest
+
+from lightsocks import transparent
+from lightsocks.core.password import randomPassword
+from lightsocks.local import LsLocal
+from lightsocks.server import LsServer
+from lightsocks.utils import net
+
+
+class TestTransparent(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        password = randomPassword()
+        self.server = LsServer(
+            loop=self.loop,
+            password=password,
+            listenAddr=net.Address('127.0.0.1', 0))
+        self.server.bind()
+        self.local = LsLocal(
+            loop=self.loop,
+            password=password,
+            listenAddr=net.Address('127.0.0.1', 0),
+            remoteAddr=net.Address(*self.server.listener.getsockname()),
+            transparent=True)
+        self.local.bind()
+
+        self.dstServer = socket.socket()
+        self.dstServer.bind(('127.0.0.1', 0))
+        self.dstServer.listen(socket.SOMAXCONN)
+        self.dstServer.setblocking(False)
+
+    def tearDown(self):
+        self.dstServer.close()
+        self.local.stopAccepting()
+        self.server.stopAccepting()
+        self.loop.close()
+
+    def test_not_redirected(self):
+        async def test():
+            client = socket.socket()
+            client.setblocking(False)
+            await self.loop.sock_connect(client,
+                                         self.local.listener.getsockname())
+            conn, _ = await self.loop.sock_accept(self.local.listener)
+            # the client has connected LsLocal itself, it speaks SOCKS
+            self.assertIsNone(
+                transparent.originalDst(conn, self.local.listenPort))
+            # TPROXY keeps the destination as the local address
+            self.assertEqual(
+                transparent.originalDst(conn, self.local.listenPort + 1),
+                net.Address(*conn.getsockname()))
+            client.close()
+            conn.close()
+
+        self.loop.run_until_complete(test())
+
+    def test_tunnel(self):
+        async def test():
+            asyncio.ensure_future(self.server.listen())
+            client, conn = socket.socketpair()
+            for sock in (client, conn):
+                sock.setblocking(False)
+            dstAddr = net.Address(*self.dstServer.getsockname())
+            relaying = asyncio.ensure_future(
+                self.local.transparentConn(conn, dstAddr))
+            dstConn, _ = await self.loop.sock_accept(self.dstServer)
+
+            # the destination speaks first, no SOCKS reply comes before it
+            await self.loop.sock_sendall(dstConn, b'220 ready\r\n')
+            self.assertEqual(await self.loop.sock_recv(client, 1024),
+                             b'220 ready\r\n')
+            await self.loop.sock_sendall(client, b'QUIT\r\n')
+            self.assertEqual(await self.loop.sock_recv(dstConn, 1024),
+                             b'QUIT\r\n')
+
+            dstConn.close()
+            self.assertEqual(await self.loop.sock_recv(client, 1024), b'')
+            client.close()
+            await asyncio.wait_for(relaying, 1)
+            self.server.stopAccepting()
+            await self.server.drain(1)
+
+        self.loop.run_until_complete(test())
+        self.assertEqual(self.local.balancer.remotes[0].active, 0)
@@ -0,0 +1,76 @@
+"""
+    this module is for LsLocal to serve the connections
+    that are redirected to it by the firewall of Linux.
+
+    With the REDIRECT (or DNAT) target of iptables/nftables,
+    the accepted connection is addressed to LsLocal,
+    the original destination is read with SO_ORIGINAL_DST.
+    With the TPROXY target, the accepted connection keeps
+    its original destination as its local address,
+    the listener needs IP_TRANSPARENT for that.
+
+    The client does not know about the proxy, it sends no SOCKS request,
+    LsLocal sends the request to LsServer for it.
+"""
+import socket
+import logging
+import struct
+import typing
+
+from lightsocks.utils import net
+
+logger = logging.getLogger(__name__)
+
+# linux/netfilter_ipv4.h and linux/netfilter_ipv6/ip6_tables.h
+SO_ORIGINAL_DST = 80
+IP6T_SO_ORIGINAL_DST = 80
+# linux/in.h, not exported by the socket module of Python before 3.12
+IP_TRANSPARENT = getattr(socket, 'IP_TRANSPARENT', 19)
+
+SOCKADDR_IN = struct.Struct('!2xH4s8x')
+SOCKADDR_IN6 = struct.Struct('!2xH4x16s4x')
+
+
+def enableTransparent(listener: socket.socket) -> bool:
+    """
+    Let the listener accept the connections of the TPROXY target,
+    it needs CAP_NET_ADMIN. Return False if it is not allowed.
+    """
+    try:
+        listener.setsockopt(socket.SOL_IP, IP_TRANSPARENT, 1)
+    except OSError as err:
+        logger.warning('TPROXY is not available: %r', err)
+        return False
+    return True
+
+
+def soOriginalDst(conn: socket.socket) -> net.Address:
+    """
+    Read the destination before the NAT of the firewall.
+    Raise OSError if the connection has not been NATed by the firewall.
+    """
+    if conn.family == socket.AF_INET6:
+        raw = conn.getsockopt(socket.SOL_IPV6, IP6T_SO_ORIGINAL_DST,
+                              SOCKADDR_IN6.size)
+        port, address = SOCKADDR_IN6.unpack(raw)
+        return net.Address(socket.inet_ntop(socket.AF_INET6, address), port)
+    raw = conn.getsockopt(socket.SOL_IP, SO_ORIGINAL_DST, SOCKADDR_IN.size)
+    port, address = SOCKADDR_IN.unpack(raw)
+    return net.Address(socket.inet_ntop(socket.AF_INET, address), port)
+
+
+def originalDst(conn: socket.socket,
+                listenPort: int) -> typing.Optional[net.Address]:
+    """
+    Return the destination the client has connected,
+    or None if the client has connected LsLocal itself.
+    """
+    local = net.Address(*conn.getsockname()[:2])
+    try:
+        dst = soOriginalDst(conn)
+    except OSError:
+        # not NATed, TPROXY keeps the destination as the local address
+        dst = local
+    if dst == local and local.port == listenPort:
+        return None
+    return dst
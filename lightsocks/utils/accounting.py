@@ -0,0 +1,273 @@
+"""
+    this module is for counting the bytes of every user and destination,
+    and enforcing the quotas of the users.
+
+    The copy loops only add to the counters of their connection.
+    Every interval the new bytes are gathered on the event loop,
+    the connections on the loops of the workers included,
+    and handed in one batch to a background thread,
+    that adds them to the totals in a SQLite database.
+"""
+import asyncio
+import logging
+import queue
+import sqlite3
+import threading
+import typing
+
+logger = logging.getLogger(__name__)
+
+FLUSH_INTERVAL = 1.0
+THROTTLE_RATE = 128 * 1024
+
+DISCONNECT = 'disconnect'
+THROTTLE = 'throttle'
+ACTIONS = (DISCONNECT, THROTTLE)
+
+UP = 0
+DOWN = 1
+
+SCHEMA = '''CREATE TABLE IF NOT EXISTS traffic (
+    user TEXT NOT NULL,
+    dst TEXT NOT NULL,
+    up INTEGER NOT NULL DEFAULT 0,
+    down INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (user, dst)
+)'''
+UPSERT = '''INSERT INTO traffic (user, dst, up, down) VALUES (?, ?, ?, ?)
+ON CONFLICT (user, dst) DO UPDATE
+SET up = up + excluded.up, down = down + excluded.down'''
+TOTALS = 'SELECT user, SUM(up + down) FROM traffic GROUP BY user'
+
+Batch = typing.Dict[typing.Tuple[str, str], typing.List[int]]
+
+
+class Usage:
+    """
+    Usage counts the bytes of one connection.
+    The counters return how long to wait after the chunk,
+    that is 0 unless the user is throttled.
+    """
+    __slots__ = ('user', 'dst', 'up', 'down', 'flushedUp', 'flushedDown',
+                 'throttle', 'abort')
+
+    def __init__(self, user: str, dst: str, throttle: int=0) -> None:
+        self.user = user
+        self.dst = dst
+        self.up = 0
+        self.down = 0
+        self.flushedUp = 0
+        self.flushedDown = 0
+        self.throttle = throttle
+        self.abort = None
+
+    def count(self, direction: int) -> typing.Callable:
+        return self.countUp if direction == UP else self.countDown
+
+    def countUp(self, size: int) -> float:
+        self.up += size
+        return self.throttle and size / self.throttle
+
+    def countDown(self, size: int) -> float:
+        self.down += size
+        return self.throttle and size / self.throttle
+
+    def attach(self, abort: typing.Callable):
+        """
+        abort is called to disconnect the connection.
+        """
+        self.abort = abort
+
+    def take(self) -> typing.Tuple[int, int]:
+        """
+        Return the bytes counted since the last take.
+        """
+        # read once, the copy loop may count on another thread meanwhile
+        up, down = self.up, self.down
+        taken = up - self.flushedUp, down - self.flushedDown
+        self.flushedUp = up
+        self.flushedDown = down
+        return taken
+
+
+class NullUsage:
+    """
+    NullUsage is for LsServer without accounting, it counts nothing.
+    """
+    __slots__ = ()
+
+    def count(self, direction: int) -> None:
+        return None
+
+    def attach(self, abort: typing.Callable):
+        pass
+
+
+NULL_USAGE = NullUsage()
+
+
+class Accounting:
+    """
+    Accounting keeps the counters of the active connections,
+    the totals of the users, and the writer thread.
+
+    Without a path, the totals are only kept in memory.
+    Without a path and without quotas, nothing is counted.
+    A user over its quota in quotas is disconnected and refused,
+    or throttled to throttleRate bytes per second for every connection.
+    The quotas are checked every interval on loop,
+    begin and finish may be called on the other loops too.
+    """
+
+    def __init__(self,
+                 loop: asyncio.AbstractEventLoop=None,
+                 path: str=None,
+                 quotas: typing.Dict[str, int]=None,
+                 action: str=DISCONNECT,
+                 throttleRate: int=THROTTLE_RATE,
+                 interval: float=FLUSH_INTERVAL) -> None:
+        self.loop = loop
+        self.path = path
+        self.quotas = quotas or {}
+        self.action = action
+        self.throttleRate = throttleRate
+        self.interval = interval
+        self.enabled = path is not None or bool(self.quotas)
+        self.usages = set()
+        self.pending = {}
+        self.totals = {}
+        self.timer = None
+        self.queue = None
+        self.writer = None
+        self.lock = threading.Lock()
+        if path is not None:
+            self.totals = loadTotals(path)
+            self.queue = queue.Queue()
+            self.writer = threading.Thread(
+                target=self.write, name='accounting', daemon=True)
+            self.writer.start()
+
+    def over(self, user: str) -> bool:
+        quota = self.quotas.get(user)
+        return quota is not None and self.totals.get(user, 0) >= quota
+
+    def refuse(self, user: str) -> bool:
+        """
+        Return True if the new connections of the user must be refused.
+        """
+        return self.action == DISCONNECT and self.over(user)
+
+    def begin(self, user: str, dst: str) -> typing.Union[Usage, NullUsage]:
+        if not self.enabled:
+            return NULL_USAGE
+        throttle = self.throttleRate if self.over(user) else 0
+        usage = Usage(user, dst, throttle)
+        with self.lock:
+            self.usages.add(usage)
+            if self.timer is None:
+                self.timer = self.loop.call_soon_threadsafe(self.schedule)
+        return usage
+
+    def schedule(self):
+        with self.lock:
+            if self.timer is not None:
+                self.timer = self.loop.call_later(self.interval, self.tick)
+
+    def finish(self, usage: typing.Union[Usage, NullUsage]):
+        if usage is NULL_USAGE:
+            return
+        with self.lock:
+            self.usages.discard(usage)
+            self.gather(usage)
+
+    def gather(self, usage: Usage):
+        """
+        Add the new bytes of the usage, with the lock held.
+        """
+        up, down = usage.take()
+        if not up and not down:
+            return
+        counters = self.pending.get((usage.user, usage.dst))
+        if counters is None:
+            counters = self.pending[(usage.user, usage.dst)] = [0, 0]
+        counters[0] += up
+        counters[1] += down
+        self.totals[usage.user] = self.totals.get(usage.user, 0) + up + down
+
+    def tick(self):
+        """
+        Gather the new bytes, hand them to the writer, check the quotas.
+        """
+        with self.lock:
+            self.timer = None
+            self.flushLocked()
+            usages = list(self.usages)
+        for usage in usages:
+            if not self.over(usage.user):
+                continue
+            if self.action == THROTTLE:
+                usage.throttle = self.throttleRate
+            elif usage.abort is not None:
+                logger.info('User %s is over the quota, disconnect %s',
+                            usage.user, usage.dst)
+                usage.abort()
+        with self.lock:
+            if self.usages and self.timer is None:
+                self.timer = self.loop.call_later(self.interval, self.tick)
+
+    def flush(self):
+        with self.lock:
+            self.flushLocked()
+
+    def flushLocked(self):
+        for usage in self.usages:
+            self.gather(usage)
+        if not self.pending:
+            return
+        if self.queue is not None:
+            self.queue.put(self.pending)
+        self.pending = {}
+
+    def write(self):
+        db = sqlite3.connect(self.path)
+        try:
+            while True:
+                batch = self.queue.get()
+                if batch is None:
+                    break
+                try:
+                    writeBatch(db, batch)
+                except sqlite3.Error:
+                    logger.exception('Failed to write the accounting')
+        finally:
+            db.close()
+
+    def close(self):
+        """
+        Write the remaining bytes and wait for the writer.
+        """
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+        self.flush()
+        if self.writer is not None:
+            self.queue.put(None)
+            self.writer.join()
+            self.writer = None
+
+
+def loadTotals(path: str) -> typing.Dict[str, int]:
+    db = sqlite3.connect(path)
+    try:
+        with db:
+            db.execute(SCHEMA)
+        return dict(db.execute(TOTALS))
+    finally:
+        db.close()
+
+
+def writeBatch(db: sqlite3.Connection, batch: Batch):
+    with db:
+        db.executemany(UPSERT, [(user, dst, up, down)
+                                for (user, dst), (up, down) in batch.items()])
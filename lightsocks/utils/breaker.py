@@ -0,0 +1,108 @@
+"""
+    this module is for failing fast on the destinations that keep failing,
+    so the retries of the clients do not resolve and connect them again.
+"""
+import asyncio
+import logging
+import threading
+import typing
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+THRESHOLD = 3
+BACKOFF_BASE = 5.0
+BACKOFF_MAX = 300.0
+CAPACITY = 4096
+
+Key = typing.Tuple[str, int]
+
+
+class Failure:
+    """
+    Failure is the state of one failing destination,
+    rep is the SOCKS reply of its last failure.
+    """
+    __slots__ = ('failures', 'rep', 'openUntil')
+
+    def __init__(self) -> None:
+        self.failures = 0
+        self.rep = 0
+        self.openUntil = 0.0
+
+
+class Breaker:
+    """
+    Breaker is the circuit breaker of the destinations.
+    After threshold failures in a row, a destination is open:
+    check returns the cached reply for the backoff, which doubles
+    after every failure up to BACKOFF_MAX. When the backoff is over,
+    a single probe is let through (half open), the others still fail fast
+    until the probe succeeds or fails, or until one more backoff has passed.
+
+    At most capacity destinations are kept, the least recently used
+    one is evicted. With threshold 0, nothing is ever cached.
+    It may be shared by the loops of the workers.
+    """
+
+    def __init__(self,
+                 loop: asyncio.AbstractEventLoop,
+                 threshold: int=THRESHOLD,
+                 backoff: float=BACKOFF_BASE,
+                 capacity: int=CAPACITY) -> None:
+        self.loop = loop
+        self.threshold = threshold
+        self.backoff = backoff
+        self.capacity = capacity
+        self.failures = OrderedDict()
+        self.hits = 0
+        self.lock = threading.Lock()
+
+    def backoffFor(self, failure: Failure) -> float:
+        return min(BACKOFF_MAX,
+                   self.backoff * 2**(failure.failures - self.threshold))
+
+    def check(self, key: Key) -> typing.Optional[int]:
+        """
+        Return the SOCKS reply to fail fast with,
+        or None if the destination may be connected.
+        """
+        with self.lock:
+            failure = self.failures.get(key)
+            if failure is None:
+                return None
+            self.failures.move_to_end(key)
+            if failure.failures < self.threshold:
+                return None
+            now = self.loop.time()
+            if now < failure.openUntil:
+                self.hits += 1
+                return failure.rep
+            # let this one probe, hold the others back meanwhile
+            failure.openUntil = now + self.backoffFor(failure)
+            return None
+
+    def fail(self, key: Key, rep: int):
+        if self.threshold <= 0:
+            return
+        with self.lock:
+            failure = self.failures.get(key)
+            if failure is None:
+                failure = self.failures[key] = Failure()
+                if len(self.failures) > self.capacity:
+                    self.failures.popitem(last=False)
+            else:
+                self.failures.move_to_end(key)
+            failure.failures += 1
+            failure.rep = rep
+            if failure.failures >= self.threshold:
+                backoff = self.backoffFor(failure)
+                failure.openUntil = self.loop.time() + backoff
+                if failure.failures == self.threshold:
+                    logger.info('Destination %s:%d failed %d times, '
+                                'fail fast for %.1fs', *key, failure.failures,
+                                backoff)
+
+    def succeed(self, key: Key):
+        with self.lock:
+            self.failures.pop(key, None)
@@ -6,8 +6,12 @@ from urllib.parse import urlparse
 from lightsocks.core.password import (InvalidPasswordError, dumpsPassword,
                                       loadsPassword)
 
-Config = namedtuple('Config',
-                    'serverAddr serverPort localAddr localPort password')
+Config = namedtuple(
+    'Config', 'serverAddr serverPort localAddr localPort password servers')
+# servers is optional, it is a list of Server for load balancing
+Config.__new__.__defaults__ = (None, )
+
+Server = namedtuple('Server', 'serverAddr serverPort password')
 
 
 class InvalidURLError(Exception):
@@ -41,6 +45,21 @@ def loadURL(url: str) -> Config:
         password=password)
 
 
+def loadURLs(urls: typing.List[str]) -> Config:
+    """
+    Load a config with the servers from every URL,
+    the first one is the default server.
+    """
+    configs = [loadURL(url) for url in urls]
+    servers = [
+        Server(
+            serverAddr=config.serverAddr,
+            serverPort=config.serverPort,
+            password=config.password) for config in configs
+    ]
+    return configs[0]._replace(servers=servers)
+
+
 def dumpURL(config: Config) -> str:
     config = config._replace(password=dumpsPassword(config.password))
 
@@ -51,8 +70,29 @@ def dumpURL(config: Config) -> str:
     return url
 
 
-def dumps(config: Config) -> str:
+def _dumpsServers(config: Config) -> Config:
     config = config._replace(password=dumpsPassword(config.password))
+    if config.servers is not None:
+        config = config._replace(servers=[
+            server._replace(password=dumpsPassword(server.password))._asdict()
+            for server in config.servers
+        ])
+    return config
+
+
+def _loadsServers(config: Config) -> Config:
+    config = config._replace(password=loadsPassword(config.password))
+    if config.servers is not None:
+        config = config._replace(servers=[
+            Server(**server)._replace(
+                password=loadsPassword(server['password']))
+            for server in config.servers
+        ])
+    return config
+
+
+def dumps(config: Config) -> str:
+    config = _dumpsServers(config)
     return json.dumps(config._asdict(), indent=2)
 
 
@@ -61,7 +101,7 @@ def loads(string: str) -> Config:
         data = json.loads(string)
         config = Config(**data)
 
-        config = config._replace(password=loadsPassword(config.password))
+        config = _loadsServers(config)
 
         # TODO: 验证 Addr 有效性
 
@@ -73,7 +113,7 @@ def loads(string: str) -> Config:
 
 
 def dump(f: typing.TextIO, config: Config) -> None:
-    config = config._replace(password=dumpsPassword(config.password))
+    config = _dumpsServers(config)
 
     json.dump(config._asdict(), f, indent=2)
 
@@ -83,7 +123,7 @@ def load(f: typing.TextIO) -> Config:
         data = json.load(f)
         config = Config(**data)
 
-        config = config._replace(password=loadsPassword(config.password))
+        config = _loadsServers(config)
 
         # TODO: 验证 Addr 有效性
 
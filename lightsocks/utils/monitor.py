@@ -0,0 +1,209 @@
+"""
+    this module is for watching the event loop of a process,
+    every blocking call stalls all the connections of it.
+
+    A timer on the loop measures how late it runs, into a histogram.
+    A watchdog thread checks that the timer keeps running,
+    when it is late for more than the threshold, the loop is stuck
+    in a callback, and the watchdog records the stack of the loop thread
+    and the task that is running.
+"""
+import asyncio
+import json
+import logging
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+INTERVAL = 0.1
+THRESHOLD = 0.1
+ALARM_LAG = 0.05
+ALARM_DURATION = 10.0
+MAX_STALLS = 32
+# the upper bounds of the buckets in milliseconds, the last one is the rest
+BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+
+class Histogram:
+    """
+    Histogram counts the lags in the BUCKETS.
+    """
+    __slots__ = ('counts', 'count', 'total', 'max')
+
+    def __init__(self) -> None:
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, ms: float):
+        for index, bound in enumerate(BUCKETS):
+            if ms <= bound:
+                break
+        else:
+            index = len(BUCKETS)
+        self.counts[index] += 1
+        self.count += 1
+        self.total += ms
+        if ms > self.max:
+            self.max = ms
+
+    def percentile(self, pct: float) -> float:
+        """
+        Return the upper bound of the bucket of the percentile.
+        """
+        rank = self.count * pct
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                return BUCKETS[index] if index < len(BUCKETS) else self.max
+        return 0.0
+
+    def asDict(self) -> dict:
+        buckets = {'<=%d' % bound: count
+                   for bound, count in zip(BUCKETS, self.counts)}
+        buckets['>%d' % BUCKETS[-1]] = self.counts[-1]
+        return {
+            'count': self.count,
+            'meanMs': round(self.total / self.count, 3) if self.count else 0,
+            'maxMs': round(self.max, 3),
+            'p50Ms': self.percentile(0.5),
+            'p99Ms': self.percentile(0.99),
+            'buckets': buckets,
+        }
+
+
+class Monitor:
+    """
+    Monitor measures the lag of the loop every interval.
+    A stall longer than threshold is logged with the stack of the loop,
+    the last MAX_STALLS of them are kept for stats.
+    When the lag stays over alarmLag for alarmDuration,
+    the alarm is logged once, and again when it recovers.
+    """
+
+    def __init__(self,
+                 loop: asyncio.AbstractEventLoop,
+                 interval: float=INTERVAL,
+                 threshold: float=THRESHOLD,
+                 alarmLag: float=ALARM_LAG,
+                 alarmDuration: float=ALARM_DURATION,
+                 statsFile: str=None) -> None:
+        self.loop = loop
+        self.interval = interval
+        self.threshold = threshold
+        self.alarmLag = alarmLag
+        self.alarmDuration = alarmDuration
+        self.statsFile = statsFile
+        self.histogram = Histogram()
+        self.stalls = deque(maxlen=MAX_STALLS)
+        self.stallCount = 0
+        self.alarms = 0
+        self.alarming = False
+        self.highSince = None
+        self.due = 0.0
+        self.reported = None
+        self.handle = None
+        self.loopThread = None
+        self.stopping = threading.Event()
+        self.watchdog = None
+
+    def start(self):
+        self.loopThread = threading.get_ident()
+        self.due = time.monotonic() + self.interval
+        self.handle = self.loop.call_later(self.interval, self.tick)
+        self.watchdog = threading.Thread(
+            target=self.watch, name='monitor', daemon=True)
+        self.watchdog.start()
+
+    def stop(self):
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+        self.stopping.set()
+        if self.watchdog is not None:
+            self.watchdog.join()
+            self.watchdog = None
+
+    def tick(self):
+        now = time.monotonic()
+        lag = max(0.0, now - self.due)
+        self.histogram.add(lag * 1000)
+        self.checkAlarm(lag, now)
+        self.due = now + self.interval
+        self.handle = self.loop.call_later(self.interval, self.tick)
+
+    def checkAlarm(self, lag: float, now: float):
+        if lag < self.alarmLag:
+            self.highSince = None
+            if self.alarming:
+                self.alarming = False
+                logger.warning('Event loop lag is back under %.0fms',
+                               self.alarmLag * 1000)
+            return
+        if self.highSince is None:
+            self.highSince = now
+        if not self.alarming and now - self.highSince >= self.alarmDuration:
+            self.alarming = True
+            self.alarms += 1
+            logger.warning(
+                'Event loop lag has stayed over %.0fms for %.0fs, '
+                'p99 %.0fms', self.alarmLag * 1000, now - self.highSince,
+                self.histogram.percentile(0.99))
+
+    def watch(self):
+        """
+        Run in the watchdog thread, record the stack of a stuck loop
+        once for every stall.
+        """
+        while not self.stopping.wait(self.threshold / 2):
+            due = self.due
+            stalled = time.monotonic() - due
+            if stalled < self.threshold or self.reported == due:
+                continue
+            self.reported = due
+            self.recordStall(stalled)
+
+    def recordStall(self, stalled: float):
+        frame = sys._current_frames().get(self.loopThread)
+        if frame is None:
+            return
+        stack = ''.join(traceback.format_stack(frame))
+        task = asyncio.current_task(self.loop)
+        stall = {
+            'time': time.time(),
+            'stalledMs': round(stalled * 1000, 3),
+            'task': repr(task) if task is not None else None,
+            'stack': stack,
+        }
+        self.stallCount += 1
+        self.stalls.append(stall)
+        logger.warning('Event loop stalled for %.0fms in %s\n%s',
+                       stall['stalledMs'], stall['task'] or 'a callback',
+                       stack)
+
+    def stats(self) -> dict:
+        return {
+            'lag': self.histogram.asDict(),
+            'stalls': self.stallCount,
+            'alarms': self.alarms,
+            'alarming': self.alarming,
+            'recentStalls': list(self.stalls),
+        }
+
+    def dump(self):
+        """
+        Write the stats into statsFile, or log them.
+        """
+        stats = self.stats()
+        if self.statsFile is None:
+            # it has been asked for, the warnings are shown without config
+            logger.warning('Event loop stats %s', json.dumps(stats['lag']))
+            return
+        with open(self.statsFile, 'w', encoding='utf-8') as f:
+            json.dump(stats, f, indent=2)
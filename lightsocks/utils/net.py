@@ -1,4 +1,43 @@
+import socket
+import asyncio
 from collections import namedtuple
 
+from lightsocks.core import transport
+
 
 Address = namedtuple('Address', 'ip port')
+
+
+async def connect(loop: asyncio.AbstractEventLoop, host: str,
+                  port: int) -> socket.socket:
+    """
+    Resolve the host, and connect to the first address that accepts.
+    """
+    lastErr = OSError('no address for %s' % host)
+    for family, socktype, proto, _, address in await loop.getaddrinfo(
+            host, port, type=socket.SOCK_STREAM):
+        conn = transport.createSocket(loop, family, socktype, proto)
+        try:
+            await loop.sock_connect(conn, address)
+        except OSError as err:
+            conn.close()
+            lastErr = err
+            continue
+        return conn
+    raise lastErr
+
+
+def parseAddress(text: str, port: int=None) -> Address:
+    """
+    Parse host:port, or [ipv6]:port, the port may be left out
+    if there is a default one.
+    """
+    host, sep, portText = text.rpartition(':')
+    if not sep or host.count(':') and not host.startswith('['):
+        host, portText = text, ''
+    host = host.strip('[]')
+    if portText:
+        port = int(portText)
+    if not host or port is None or not 0 <= port <= 65535:
+        raise ValueError('invalid address %r' % text)
+    return Address(host, port)
@@ -0,0 +1,209 @@
+"""
+    this module is for reloading and upgrading a running service
+    without dropping the connections in flight.
+
+    SIGHUP   reload the config, the new connections use the new config,
+             the old ones keep running until they finish.
+    SIGUSR2  start a new process that inherits the listening socket,
+             then drain the old connections and exit.
+    SIGTERM  stop accepting, drain the connections up to the timeout and exit.
+    SIGUSR1  dump the stats, see Supervisor.dumps.
+"""
+import os
+import sys
+import socket
+import signal
+import asyncio
+import logging
+import subprocess
+import typing
+
+from lightsocks.core.service import Service
+from lightsocks.utils.workers import WorkerPool
+
+LISTEN_FD_ENV = 'LIGHTSOCKS_LISTEN_FD'
+DRAIN_TIMEOUT = 30.0
+logger = logging.getLogger(__name__)
+
+
+def inheritedListener() -> typing.Optional[socket.socket]:
+    """
+    Return the listening socket passed down by the previous process.
+    """
+    fd = os.environ.pop(LISTEN_FD_ENV, None)
+    if fd is None:
+        return None
+    listener = socket.socket(fileno=int(fd))
+    listener.setblocking(False)
+    return listener
+
+
+def spawnSuccessor(listener: socket.socket,
+                   argv: typing.List[str]=None) -> subprocess.Popen:
+    """
+    Start the same command again, and pass the listening socket to it.
+    """
+    if argv is None:
+        argv = sys.argv
+    fd = listener.fileno()
+    os.set_inheritable(fd, True)
+    env = dict(os.environ)
+    env[LISTEN_FD_ENV] = str(fd)
+    return subprocess.Popen(
+        [sys.executable] + argv, env=env, pass_fds=(fd, ))
+
+
+class Supervisor:
+    """
+    Supervisor owns the running service,
+    and replaces it when the config is reloaded.
+
+    createService(config, listener) returns a new Service,
+    it should reuse the listener if it is not None.
+    loadConfig() returns the new config, listenAddr(config) tells
+    whether the listener can be handed over.
+    successorArgv(config) returns the command line of the new process.
+    The callables in dumps are called on SIGUSR1 to dump the stats.
+
+    With workers, a service is created on every worker loop too,
+    by createService(config, None, loop), as the shards of the service
+    on this loop, that only accepts, see Service.shards.
+    """
+
+    def __init__(self,
+                 loop: asyncio.AbstractEventLoop,
+                 config,
+                 createService: typing.Callable[..., Service],
+                 loadConfig: typing.Callable=None,
+                 listenAddr: typing.Callable=None,
+                 drainTimeout: float=DRAIN_TIMEOUT,
+                 didListen: typing.Callable=None,
+                 successorArgv: typing.Callable=None,
+                 workers: WorkerPool=None) -> None:
+        self.loop = loop
+        self.config = config
+        self.createService = createService
+        self.loadConfig = loadConfig
+        self.listenAddr = listenAddr
+        self.drainTimeout = drainTimeout
+        self.didListen = didListen
+        self.successorArgv = successorArgv
+        self.workers = workers
+        self.service = None
+        self.draining = set()
+        self.dumps = []
+
+    def create(self, config, listener: socket.socket=None) -> Service:
+        service = self.createService(config, listener)
+        if self.workers is not None:
+            service.shards = [
+                self.createService(config, None, loop)
+                for loop in self.workers.loops
+            ]
+        return service
+
+    def start(self, listener: socket.socket=None):
+        self.serve(self.create(self.config, listener))
+
+    def serve(self, service: Service):
+        """
+        Bind the service at once, so a bad address fails the caller,
+        then accept the connections in the background.
+        """
+        service.bind()
+        self.service = service
+        asyncio.ensure_future(service.listen(self.didListen), loop=self.loop)
+
+    def installSignalHandlers(self):
+        handlers = (
+            ('SIGHUP', self.reload),
+            ('SIGUSR2', self.upgrade),
+            ('SIGUSR1', self.dump),
+            ('SIGTERM', self.shutdown),
+            ('SIGINT', self.shutdown), )
+        for name, handler in handlers:
+            signum = getattr(signal, name, None)
+            if signum is None:
+                continue
+            try:
+                self.loop.add_signal_handler(signum, handler)
+            except (NotImplementedError, RuntimeError):
+                # Windows has no signal handlers for the event loop
+                pass
+
+    def dump(self):
+        for dump in self.dumps:
+            try:
+                dump()
+            except OSError:
+                logger.exception('Failed to dump the stats')
+
+    def retire(self, service: Service, closeListener: bool=True):
+        """
+        Stop the service from accepting, and drain it in the background.
+        """
+        service.stopAccepting(closeListener=closeListener)
+        task = asyncio.ensure_future(
+            service.drain(self.drainTimeout), loop=self.loop)
+        self.draining.add(task)
+        task.add_done_callback(self.draining.discard)
+        return task
+
+    def reload(self):
+        try:
+            config = self.loadConfig()
+        except Exception as err:
+            logger.error('Reload config failed, keep the old one: %r', err)
+            return
+
+        old = self.service
+        handOver = (self.listenAddr is not None and
+                    self.listenAddr(config) == self.listenAddr(self.config))
+        listener = old.listener if handOver else None
+        try:
+            # the old service keeps accepting until the new one is bound
+            service = self.create(config, listener)
+            service.bind()
+        except Exception as err:
+            logger.error('Reload config failed, keep the old one: %r', err)
+            return
+        self.retire(old, closeListener=not handOver)
+
+        self.config = config
+        self.serve(service)
+        logger.info('Reload config, draining %d connections',
+                    old.active)
+
+    def upgrade(self):
+        """
+        Hand the listening socket over to a new process, then shutdown.
+        """
+        listener = self.service and self.service.listener
+        if listener is None:
+            logger.error('Upgrade failed, not listening')
+            return
+        argv = None
+        if self.successorArgv is not None:
+            argv = self.successorArgv(self.config)
+        try:
+            process = spawnSuccessor(listener, argv)
+        except OSError as err:
+            logger.error('Upgrade failed: %r', err)
+            return
+        logger.info('Hand the listener over to process %d', process.pid)
+        self.shutdown()
+
+    def shutdown(self):
+        """
+        Stop accepting, wait for the active connections, then stop the loop.
+        """
+        if self.service is not None:
+            self.retire(self.service)
+            self.service = None
+
+        async def stop():
+            if self.draining:
+                await asyncio.wait(set(self.draining))
+            self.loop.stop()
+
+        asyncio.ensure_future(stop(), loop=self.loop)
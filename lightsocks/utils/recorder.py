@@ -0,0 +1,207 @@
+"""
+    this module is for recording the traffic shape of LsServer,
+    benchmarks/replay.py plays it again against a local sink.
+
+    The log starts with a header, then one record per connection:
+        +-------+---------+
+        | MAGIC | VERSION |
+        +-------+---------+
+        |   4   |    1    |
+        +-------+---------+
+
+        +-------+---------+----------+--------+-------+---------+-----+
+        | START | CONNECT | DURATION | EVENTS | FLAGS | DST.LEN | DST |
+        +-------+---------+----------+--------+-------+---------+-----+
+        |   8   |    4    |    8     |   4    |   1   |    2    |  *  |
+        +-------+---------+----------+--------+-------+---------+-----+
+    START is the wall time of the accept, CONNECT and DURATION are
+    the microseconds from the accept to the destination connected
+    and to the close. Then EVENTS events follow:
+        +--------+-----------+------+---------+
+        | OFFSET | DIRECTION | SIZE | PAYLOAD |
+        +--------+-----------+------+---------+
+        |   4    |     1     |  4   |    *    |
+        +--------+-----------+------+---------+
+    OFFSET is the microseconds from the accept, every event is a chunk
+    that has been read. The PAYLOAD is there only if FLAGS has PAYLOAD.
+"""
+import struct
+import time
+import typing
+from collections import namedtuple
+
+MAGIC = b'LSRC'
+VERSION = 1
+MAX_EVENTS = 10000
+MAX_OFFSET = 0xffffffff
+
+UP = 0
+DOWN = 1
+
+PAYLOAD = 0x01
+TRUNCATED = 0x02
+
+HEADER = struct.Struct('<4sB')
+CONN = struct.Struct('<dIQIBH')
+EVENT = struct.Struct('<IBI')
+
+Conn = namedtuple('Conn', 'start connect duration dst truncated events')
+Event = namedtuple('Event', 'offset direction size payload')
+
+
+class InvalidLogError(Exception):
+    """不合法的记录文件"""
+
+
+class ConnRecord:
+    """
+    ConnRecord collects the chunks of one connection,
+    up to MAX_EVENTS chunks are kept.
+    """
+    __slots__ = ('recorder', 'start', 'accept', 'connect', 'dst', 'events',
+                 'truncated')
+
+    def __init__(self, recorder: 'Recorder') -> None:
+        self.recorder = recorder
+        self.start = time.time()
+        self.accept = time.monotonic()
+        self.connect = 0
+        self.dst = ''
+        self.events = []
+        self.truncated = False
+
+    def offset(self) -> int:
+        return min(MAX_OFFSET, int((time.monotonic() - self.accept) * 1e6))
+
+    def setDst(self, host: str, port: int):
+        self.dst = '%s:%d' % (host, port)
+
+    def connected(self):
+        self.connect = self.offset()
+
+    def observe(self, direction: int,
+                transform: typing.Callable=None) -> typing.Callable:
+        """
+        Return a transform that records the chunks after transforming them.
+        """
+
+        def observing(chunk: bytearray):
+            if transform is not None:
+                transform(chunk)
+            if len(self.events) >= self.recorder.maxEvents:
+                self.truncated = True
+                return
+            payload = bytes(chunk) if self.recorder.payload else None
+            self.events.append((self.offset(), direction, len(chunk),
+                                payload))
+
+        return observing
+
+
+class NullRecord:
+    """
+    NullRecord is for LsServer without a recorder, it records nothing.
+    """
+    __slots__ = ()
+
+    def setDst(self, host: str, port: int):
+        pass
+
+    def connected(self):
+        pass
+
+    def observe(self, direction: int,
+                transform: typing.Callable=None) -> typing.Callable:
+        return transform
+
+
+NULL_RECORD = NullRecord()
+
+
+class Recorder:
+    """
+    Recorder appends the records of the finished connections to the log,
+    the payload is recorded only if payload is True.
+    Without a path, nothing is recorded.
+    """
+
+    def __init__(self,
+                 path: str=None,
+                 payload: bool=False,
+                 maxEvents: int=MAX_EVENTS) -> None:
+        self.payload = payload
+        self.maxEvents = maxEvents
+        self.file = None
+        if path is not None:
+            self.file = open(path, 'ab')
+            if self.file.tell() == 0:
+                self.file.write(HEADER.pack(MAGIC, VERSION))
+
+    def begin(self) -> typing.Union[ConnRecord, NullRecord]:
+        if self.file is None:
+            return NULL_RECORD
+        return ConnRecord(self)
+
+    def finish(self, record: typing.Union[ConnRecord, NullRecord]):
+        if record is NULL_RECORD or self.file is None:
+            return
+        self.file.write(packConn(record, self.payload))
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def packConn(record: ConnRecord, payload: bool) -> bytes:
+    dst = record.dst.encode()
+    flags = (PAYLOAD if payload else 0) | (TRUNCATED
+                                          if record.truncated else 0)
+    parts = [
+        CONN.pack(record.start, record.connect,
+                  int((time.monotonic() - record.accept) * 1e6),
+                  len(record.events), flags, len(dst)), dst
+    ]
+    for offset, direction, size, data in record.events:
+        parts.append(EVENT.pack(offset, direction, size))
+        if payload:
+            parts.append(data)
+    return b''.join(parts)
+
+
+def readExactly(f: typing.BinaryIO, n: int) -> bytes:
+    data = f.read(n)
+    if len(data) != n:
+        raise InvalidLogError('unexpected end of the log')
+    return data
+
+
+def readLog(f: typing.BinaryIO) -> typing.Iterator[Conn]:
+    """
+    Read the connections from the log one by one.
+    """
+    magic, version = HEADER.unpack(readExactly(f, HEADER.size))
+    if magic != MAGIC or version != VERSION:
+        raise InvalidLogError('unknown log format')
+
+    while True:
+        head = f.read(CONN.size)
+        if not head:
+            return
+        if len(head) != CONN.size:
+            raise InvalidLogError('unexpected end of the log')
+        start, connect, duration, count, flags, dstLen = CONN.unpack(head)
+        dst = readExactly(f, dstLen).decode()
+        events = []
+        for _ in range(count):
+            offset, direction, size = EVENT.unpack(
+                readExactly(f, EVENT.size))
+            data = readExactly(f, size) if flags & PAYLOAD else None
+            events.append(Event(offset, direction, size, data))
+        yield Conn(start, connect, duration, dst, bool(flags & TRUNCATED),
+                   events)
+
+
+def loadLog(path: str) -> typing.List[Conn]:
+    with open(path, 'rb') as f:
+        return list(readLog(f))
@@ -0,0 +1,274 @@
+"""
+    this module is for routing the connections of LsLocal,
+    the destinations that match the rules are connected directly,
+    the others go through the tunnel.
+
+    A rule file has one rule per line:
+        192.168.0.0/16      an ip network
+        10.1.2.3            an ip address
+        example.com         the domain and all its subdomains
+        keyword:google      the domains that contain the keyword
+    The lines start with # are comments.
+
+    The rule files are compiled in a thread when the first destination
+    is matched, so the event loop keeps running, and the compiled rules
+    are cached beside the first rule file, so the next start only has
+    to load the cache.
+"""
+import asyncio
+import bisect
+import concurrent.futures
+import hashlib
+import ipaddress
+import logging
+import marshal
+import os
+import re
+import socket
+import threading
+import typing
+
+CACHE_VERSION = 1
+KEYWORD_PREFIX = 'keyword:'
+logger = logging.getLogger(__name__)
+
+
+class InvalidRuleError(Exception):
+    """不合法的规则"""
+
+
+class CIDRTable:
+    """
+    CIDRTable matches the ip addresses against the networks.
+    The networks are merged into sorted disjoint ranges when compiled,
+    so one lookup is one binary search.
+    """
+
+    def __init__(self, starts: typing.List[int],
+                 ends: typing.List[int]) -> None:
+        self.starts = starts
+        self.ends = ends
+
+    @classmethod
+    def compile(cls, networks: typing.Iterable) -> 'CIDRTable':
+        ranges = sorted((int(network.network_address),
+                         int(network.broadcast_address))
+                        for network in networks)
+        starts, ends = [], []
+        for start, end in ranges:
+            if ends and start <= ends[-1] + 1:
+                ends[-1] = max(ends[-1], end)
+            else:
+                starts.append(start)
+                ends.append(end)
+        return cls(starts, ends)
+
+    def __contains__(self, ip: int) -> bool:
+        idx = bisect.bisect_right(self.starts, ip) - 1
+        return idx >= 0 and ip <= self.ends[idx]
+
+    def __len__(self) -> int:
+        return len(self.starts)
+
+
+class DomainTrie:
+    """
+    DomainTrie matches the domains against the suffixes,
+    the labels are stored reversed, 'www.example.com' is found
+    by walking 'com' -> 'example' until a suffix ends.
+    """
+    END = ''
+
+    def __init__(self, root: dict=None) -> None:
+        self.root = root if root is not None else {}
+
+    def add(self, suffix: str):
+        node = self.root
+        labels = suffix.strip('.').lower().split('.')[::-1]
+        for label in labels[:-1]:
+            if self.END in node:
+                # a shorter suffix covers it already
+                return
+            node = node.setdefault(label, {})
+        if self.END not in node:
+            # the longer suffixes are covered by this one
+            node[labels[-1]] = {self.END: 1}
+
+    def __contains__(self, domain: str) -> bool:
+        node = self.root
+        for label in reversed(domain.rstrip('.').lower().split('.')):
+            node = node.get(label)
+            if node is None:
+                return False
+            if self.END in node:
+                return True
+        return False
+
+
+class RuleSet:
+    """
+    RuleSet matches the destinations against the rule files,
+    it loads them on the first match.
+    The async callers should await prepare before matching,
+    that loads the rules without blocking the event loop.
+    It is shared by the services of the workers, see workers.
+    """
+
+    def __init__(self, paths: typing.List[str],
+                 cacheDir: str=None) -> None:
+        self.paths = [os.path.abspath(path) for path in paths]
+        self.cacheDir = cacheDir
+        self.loaded = False
+        self.loading = None
+        self.lock = threading.Lock()
+        self.ipv4 = CIDRTable([], [])
+        self.ipv6 = CIDRTable([], [])
+        self.domains = DomainTrie()
+        self.keywords = None
+
+    @property
+    def cachePath(self) -> str:
+        digest = hashlib.sha1('\n'.join(self.paths).encode()).hexdigest()
+        cacheDir = self.cacheDir or os.path.dirname(self.paths[0])
+        return os.path.join(cacheDir, '.lightsocks-rules-%s' % digest[:12])
+
+    def cacheKey(self) -> list:
+        key = []
+        for path in self.paths:
+            stat = os.stat(path)
+            key.append([path, stat.st_mtime_ns, stat.st_size])
+        return key
+
+    def load(self):
+        key = self.cacheKey()
+        compiled = self.loadCache(key)
+        if compiled is None:
+            compiled = self.compile()
+            self.dumpCache(key, compiled)
+
+        self.ipv4 = CIDRTable(*compiled['ipv4'])
+        self.ipv6 = CIDRTable(*compiled['ipv6'])
+        self.domains = DomainTrie(compiled['domains'])
+        if compiled['keywords']:
+            self.keywords = re.compile('|'.join(
+                map(re.escape, compiled['keywords'])))
+        self.loaded = True
+        logger.info('Load %d ip ranges, %d keywords from %d rule files',
+                    len(self.ipv4) + len(self.ipv6),
+                    len(compiled['keywords']), len(self.paths))
+
+    def loadCache(self, key: list) -> typing.Optional[dict]:
+        try:
+            with open(self.cachePath, 'rb') as f:
+                compiled = marshal.load(f)
+        except (OSError, EOFError, ValueError, TypeError):
+            return None
+        if (not isinstance(compiled, dict) or
+                compiled.get('version') != CACHE_VERSION or
+                compiled.get('key') != key):
+            return None
+        return compiled
+
+    def dumpCache(self, key: list, compiled: dict):
+        compiled = dict(compiled, version=CACHE_VERSION, key=key)
+        try:
+            with open(self.cachePath, 'wb') as f:
+                marshal.dump(compiled, f)
+        except OSError as err:
+            logger.warning('Cache the rules failed: %r', err)
+
+    def compile(self) -> dict:
+        networks = {4: [], 6: []}
+        domains = DomainTrie()
+        keywords = set()
+        for path in self.paths:
+            with open(path, encoding='utf-8') as f:
+                for lineno, line in enumerate(f, 1):
+                    line = line.strip()
+                    if not line or line.startswith('#'):
+                        continue
+                    try:
+                        self.parseRule(line, networks, domains, keywords)
+                    except ValueError:
+                        raise InvalidRuleError('%s:%d %r' % (path, lineno,
+                                                             line))
+
+        ipv4 = CIDRTable.compile(networks[4])
+        ipv6 = CIDRTable.compile(networks[6])
+        return {
+            'ipv4': (ipv4.starts, ipv4.ends),
+            'ipv6': (ipv6.starts, ipv6.ends),
+            'domains': domains.root,
+            'keywords': sorted(keywords, key=len),
+        }
+
+    @staticmethod
+    def parseRule(line: str, networks: dict, domains: DomainTrie,
+                  keywords: set):
+        if line.startswith(KEYWORD_PREFIX):
+            keyword = line[len(KEYWORD_PREFIX):].strip().lower()
+            if not keyword:
+                raise ValueError(line)
+            keywords.add(keyword)
+            return
+
+        try:
+            network = ipaddress.ip_network(line, strict=False)
+        except ValueError:
+            pass
+        else:
+            networks[network.version].append(network)
+            return
+
+        if any(c.isspace() or c in '/:' for c in line):
+            raise ValueError(line)
+        domains.add(line)
+
+    def tryLoad(self):
+        try:
+            self.load()
+        except (OSError, InvalidRuleError) as err:
+            # tunnel everything rather than failing every connection
+            logger.error('Load the rules failed: %r', err)
+            self.loaded = True
+
+    async def prepare(self, loop: asyncio.AbstractEventLoop):
+        """
+        Load the rules in the default executor on the first call,
+        the concurrent callers wait for the same loading,
+        from any loop.
+        """
+        if self.loaded:
+            return
+        with self.lock:
+            if self.loading is None:
+                self.loading = concurrent.futures.Future()
+                loop.run_in_executor(None, self.loadOnce)
+        await asyncio.shield(asyncio.wrap_future(self.loading, loop=loop))
+
+    def loadOnce(self):
+        try:
+            self.tryLoad()
+        finally:
+            self.loading.set_result(None)
+
+    def match(self, host: str) -> bool:
+        """
+        Whether the host, an ip address or a domain, matches the rules.
+        """
+        if not self.loaded:
+            self.tryLoad()
+
+        for family, table in ((socket.AF_INET, self.ipv4),
+                              (socket.AF_INET6, self.ipv6)):
+            try:
+                ip = int.from_bytes(socket.inet_pton(family, host), 'big')
+            except (OSError, ValueError):
+                continue
+            return ip in table
+
+        if host in self.domains:
+            return True
+        if self.keywords is not None:
+            return self.keywords.search(host.lower()) is not None
+        return False
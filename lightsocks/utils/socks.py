@@ -0,0 +1,121 @@
+"""
+    this module is for packing and parsing the SOCKS5 messages,
+    SOCKS Protocol Version 5 https://www.ietf.org/rfc/rfc1928.txt
+"""
+import errno
+import socket
+from collections import namedtuple
+
+VERSION = 0x05
+
+METHOD_NO_AUTH = 0x00
+METHOD_NO_ACCEPTABLE = 0xff
+
+CMD_CONNECT = 0x01
+CMD_BIND = 0x02
+CMD_UDP_ASSOCIATE = 0x03
+
+ATYP_IPV4 = 0x01
+ATYP_DOMAIN = 0x03
+ATYP_IPV6 = 0x04
+
+REP_SUCCEEDED = 0x00
+REP_GENERAL_FAILURE = 0x01
+REP_NOT_ALLOWED = 0x02
+REP_NETWORK_UNREACHABLE = 0x03
+REP_HOST_UNREACHABLE = 0x04
+REP_CONNECTION_REFUSED = 0x05
+REP_TTL_EXPIRED = 0x06
+REP_COMMAND_NOT_SUPPORTED = 0x07
+REP_ADDRESS_TYPE_NOT_SUPPORTED = 0x08
+
+ERRNO_REPLIES = {
+    errno.ECONNREFUSED: REP_CONNECTION_REFUSED,
+    errno.ENETUNREACH: REP_NETWORK_UNREACHABLE,
+    errno.EHOSTUNREACH: REP_HOST_UNREACHABLE,
+    errno.ETIMEDOUT: REP_HOST_UNREACHABLE,
+    errno.EAFNOSUPPORT: REP_ADDRESS_TYPE_NOT_SUPPORTED,
+}
+
+GREETING = bytes((VERSION, 0x01, METHOD_NO_AUTH))
+METHOD_SELECTION = bytes((VERSION, METHOD_NO_AUTH))
+
+Request = namedtuple('Request', 'cmd atyp host port')
+
+
+class InvalidRequestError(Exception):
+    """不合法的 SOCKS 请求"""
+
+
+def parseRequest(buf: bytes) -> Request:
+    """
+    Parse the SOCKS request:
+        +----+-----+-------+------+----------+----------+
+        |VER | CMD |  RSV  | ATYP | DST.ADDR | DST.PORT |
+        +----+-----+-------+------+----------+----------+
+        | 1  |  1  | X'00' |  1   | Variable |    2     |
+        +----+-----+-------+------+----------+----------+
+    """
+    if len(buf) < 7:
+        raise InvalidRequestError('too short')
+
+    cmd = buf[1]
+    atyp = buf[3]
+    port = int.from_bytes(buf[-2:], 'big')
+
+    if atyp == ATYP_IPV4:
+        host = socket.inet_ntop(socket.AF_INET, bytes(buf[4:4 + 4]))
+    elif atyp == ATYP_DOMAIN:
+        try:
+            host = bytes(buf[5:-2]).decode()
+        except UnicodeDecodeError:
+            raise InvalidRequestError('invalid domain')
+    elif atyp == ATYP_IPV6:
+        try:
+            host = socket.inet_ntop(socket.AF_INET6, bytes(buf[4:4 + 16]))
+        except ValueError:
+            raise InvalidRequestError('invalid ipv6 address')
+    else:
+        raise InvalidRequestError('unknown address type %d' % atyp)
+
+    return Request(cmd=cmd, atyp=atyp, host=host, port=port)
+
+
+def packRequest(host: str, port: int, cmd: int=CMD_CONNECT) -> bytearray:
+    """
+    Pack the SOCKS request, host can be an ip address or a domain.
+    """
+    buf = bytearray((VERSION, cmd, 0x00))
+    for family, atyp in ((socket.AF_INET, ATYP_IPV4),
+                         (socket.AF_INET6, ATYP_IPV6)):
+        try:
+            address = socket.inet_pton(family, host)
+        except (OSError, ValueError):
+            continue
+        buf.append(atyp)
+        buf.extend(address)
+        break
+    else:
+        domain = host.encode('idna')
+        buf.append(ATYP_DOMAIN)
+        buf.append(len(domain))
+        buf.extend(domain)
+    buf.extend(port.to_bytes(2, 'big'))
+    return buf
+
+
+def packReply(rep: int=REP_SUCCEEDED) -> bytearray:
+    """
+    Pack the SOCKS reply, the bound address is always 0.0.0.0:0.
+    """
+    return bytearray((VERSION, rep, 0x00, ATYP_IPV4, 0x00, 0x00, 0x00, 0x00,
+                      0x00, 0x00))
+
+
+def replyCode(err: OSError) -> int:
+    """
+    Choose the REP of the reply for the error of connecting the destination.
+    """
+    if isinstance(err, socket.gaierror):
+        return REP_HOST_UNREACHABLE
+    return ERRNO_REPLIES.get(err.errno, REP_GENERAL_FAILURE)
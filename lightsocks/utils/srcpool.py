@@ -0,0 +1,159 @@
+"""
+    this module is for spreading the connections to the destinations
+    over a pool of local source addresses.
+
+    One source address has one range of ephemeral ports
+    for every destination address and port, a busy server exhausts it
+    on the popular destinations. Every source address adds one range.
+    With IP_BIND_ADDRESS_NO_PORT, binding the source address does not
+    pick the port yet, the connect picks it for the destination,
+    so the ports are shared by the destinations as without binding.
+"""
+import errno
+import hashlib
+import ipaddress
+import json
+import logging
+import socket
+import threading
+import typing
+
+logger = logging.getLogger(__name__)
+
+# Linux 4.2, not exported by the socket module of Python
+IP_BIND_ADDRESS_NO_PORT = getattr(socket, 'IP_BIND_ADDRESS_NO_PORT', 24)
+
+ROUND_ROBIN = 'round-robin'
+HASH = 'hash'
+POLICIES = (ROUND_ROBIN, HASH)
+
+# the errors of a source address that has no free port to the destination
+EXHAUSTED_ERRORS = (errno.EADDRNOTAVAIL, errno.EADDRINUSE)
+
+
+class Source:
+    """
+    Source is one source address and its counters.
+    active is the connections open now, connects the connected ones,
+    exhausted the connects that found no free port,
+    failures the other failed connects.
+    """
+    __slots__ = ('address', 'family', 'active', 'connects', 'exhausted',
+                 'failures')
+
+    def __init__(self, address: str) -> None:
+        self.address = address
+        self.family = socket.AF_INET6 if ipaddress.ip_address(
+            address).version == 6 else socket.AF_INET
+        self.active = 0
+        self.connects = 0
+        self.exhausted = 0
+        self.failures = 0
+
+    def asDict(self) -> dict:
+        return {
+            'active': self.active,
+            'connects': self.connects,
+            'exhausted': self.exhausted,
+            'failures': self.failures,
+        }
+
+
+class SourcePool:
+    """
+    SourcePool picks the source address of a new connection,
+    in turn or by the hash of the destination, so one destination
+    keeps its source address while it has free ports.
+    candidates returns the picked source first, then the others,
+    the next one is tried when a source has no free port.
+
+    Without addresses, the system picks the source address as before.
+    With fastClose, the aborted connections are reset,
+    so they do not wait in TIME_WAIT, see Relay.
+    The counters take a lock, the loops of the workers share the pool.
+    """
+
+    def __init__(self,
+                 addresses: typing.Iterable[str]=(),
+                 policy: str=ROUND_ROBIN,
+                 fastClose: bool=False,
+                 statsFile: str=None) -> None:
+        self.sources = [Source(address) for address in addresses]
+        self.policy = policy
+        self.fastClose = fastClose
+        self.statsFile = statsFile
+        self.turn = 0
+        self.lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.sources)
+
+    def candidates(self, family: int,
+                   dstAddress: tuple) -> typing.List[Source]:
+        sources = [
+            source for source in self.sources if source.family == family
+        ]
+        if not sources:
+            return []
+        if self.policy == HASH:
+            key = ('%s:%d' % dstAddress[:2]).encode()
+            start = int.from_bytes(
+                hashlib.blake2b(key, digest_size=4).digest(), 'big')
+        else:
+            with self.lock:
+                start = self.turn
+                self.turn += 1
+        start %= len(sources)
+        return sources[start:] + sources[:start]
+
+    def bind(self, conn: socket.socket, source: Source):
+        """
+        Bind the conn to the source address, the port is picked on connect.
+        """
+        try:
+            conn.setsockopt(socket.IPPROTO_IP, IP_BIND_ADDRESS_NO_PORT, 1)
+        except OSError:
+            # not Linux, bind picks the port without the destination
+            pass
+        conn.bind((source.address, 0))
+
+    def connected(self, source: Source):
+        with self.lock:
+            source.active += 1
+            source.connects += 1
+
+    def failed(self, source: Source, err: OSError) -> bool:
+        """
+        Count the failure, return True if the next source may be tried.
+        """
+        with self.lock:
+            if err.errno in EXHAUSTED_ERRORS:
+                source.exhausted += 1
+                return True
+            source.failures += 1
+            return False
+
+    def release(self, source: Source):
+        with self.lock:
+            source.active -= 1
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                source.address: source.asDict()
+                for source in self.sources
+            }
+
+    def dump(self):
+        """
+        Write the stats into statsFile, or log them.
+        """
+        if not self.sources:
+            return
+        if self.statsFile is None:
+            logger.warning('Source address stats %s', json.dumps(self.stats()))
+            return
+        with open(self.statsFile, 'w', encoding='utf-8') as f:
+            json.dump(self.stats(), f, indent=2)
+
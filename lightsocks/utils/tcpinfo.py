@@ -0,0 +1,338 @@
+"""
+    this module is for telling a slow destination from a slow tunnel
+    by the view of the kernel on every TCP connection.
+
+    getsockopt(TCP_INFO) returns the smoothed RTT, its variance,
+    the congestion window, the retransmits and the delivery rate
+    of a connection. The tracked connections are sampled in turn,
+    at most budget of them every interval, so the more connections,
+    the less often each one is sampled, and the cost stays the same.
+    Every connection is sampled once more before it is closed.
+    The samples are aggregated per path, the remote of a tunnel
+    or the destination, the least recently seen paths are dropped.
+
+    subflows lists the paths a Multipath TCP connection uses,
+    the kernel takes a header in the buffer of MPTCP_SUBFLOW_ADDRS,
+    that socket.getsockopt can not pass, so it is called through ctypes.
+"""
+import asyncio
+import ctypes
+import json
+import logging
+import socket
+import struct
+import sys
+import threading
+import typing
+from collections import OrderedDict, deque, namedtuple
+
+logger = logging.getLogger(__name__)
+
+# linux/tcp.h
+TCP_INFO = getattr(socket, 'TCP_INFO', 11)
+# struct tcp_info up to tcpi_delivery_rate, Linux 4.9
+TCP_INFO_STRUCT = struct.Struct('=8B24I4Q6IQ')
+
+# linux/tcp.h, Linux 5.16
+TCP_IS_MPTCP = 43
+# linux/mptcp.h, Linux 5.17
+SOL_MPTCP = getattr(socket, 'SOL_MPTCP', 284)
+MPTCP_SUBFLOW_ADDRS = 3
+# struct mptcp_subflow_data, then struct mptcp_subflow_addrs for each,
+# the local and the remote sockaddr_storage
+SUBFLOW_DATA = struct.Struct('=4I')
+SOCKADDR_SIZE = 128
+SUBFLOW_ADDRS_SIZE = 2 * SOCKADDR_SIZE
+MAX_SUBFLOWS = 8
+
+INTERVAL = 1.0
+BUDGET = 256
+MAX_PATHS = 1024
+# the weight of a new sample in the averages
+EWMA_ALPHA = 0.125
+
+TUNNEL = 'tunnel'
+DST = 'dst'
+
+# rtt, rttvar and minRtt in microseconds, cwnd in segments,
+# retransmits of the unacked segment, totalRetrans of the connection,
+# deliveryRate in bytes per second
+Sample = namedtuple(
+    'Sample', 'rtt rttvar minRtt cwnd retransmits totalRetrans deliveryRate')
+
+
+def sample(conn: socket.socket) -> typing.Optional[Sample]:
+    """
+    Read TCP_INFO of the conn, None if it is not a TCP socket,
+    it has been closed, or the system does not support it.
+    """
+    try:
+        raw = conn.getsockopt(socket.IPPROTO_TCP, TCP_INFO,
+                              TCP_INFO_STRUCT.size)
+    except (OSError, AttributeError):
+        return None
+    if not isinstance(raw, bytes):
+        return None
+    # the older kernels return a shorter struct
+    fields = TCP_INFO_STRUCT.unpack(raw.ljust(TCP_INFO_STRUCT.size, b'\0'))
+    return Sample(
+        rtt=fields[23],
+        rttvar=fields[24],
+        minRtt=fields[39],
+        cwnd=fields[26],
+        retransmits=fields[2],
+        totalRetrans=fields[31],
+        deliveryRate=fields[42])
+
+
+def peerName(conn: socket.socket, port: bool=False) -> str:
+    """
+    The address of the peer of the conn, with the port if port is True.
+    """
+    try:
+        address = conn.getpeername()
+    except OSError:
+        return 'unknown'
+    return '%s:%d' % address[:2] if port else address[0]
+
+
+def isMptcp(conn: socket.socket) -> bool:
+    """
+    Return True if the conn is Multipath TCP,
+    False if it is TCP or has fallen back to TCP.
+    """
+    try:
+        return bool(conn.getsockopt(socket.IPPROTO_TCP, TCP_IS_MPTCP))
+    except (OSError, AttributeError):
+        return False
+
+
+def sockaddrName(buf: bytes, offset: int) -> str:
+    family, = struct.unpack_from('=H', buf, offset)
+    port, = struct.unpack_from('!H', buf, offset + 2)
+    if family == socket.AF_INET:
+        return '%s:%d' % (socket.inet_ntop(
+            socket.AF_INET, buf[offset + 4:offset + 8]), port)
+    if family == socket.AF_INET6:
+        return '[%s]:%d' % (socket.inet_ntop(
+            socket.AF_INET6, buf[offset + 8:offset + 24]), port)
+    return 'unknown'
+
+
+def subflows(conn: socket.socket
+             ) -> typing.Optional[typing.List[typing.Tuple[str, str]]]:
+    """
+    The local and the remote address of every subflow of the conn,
+    None if it is not Multipath TCP, or the system can not tell.
+    """
+    if not sys.platform.startswith('linux') or not isMptcp(conn):
+        return None
+    size = SUBFLOW_DATA.size + SUBFLOW_ADDRS_SIZE * MAX_SUBFLOWS
+    buf = ctypes.create_string_buffer(size)
+    SUBFLOW_DATA.pack_into(buf, 0, SUBFLOW_DATA.size, 0, 0,
+                           SUBFLOW_ADDRS_SIZE)
+    optlen = ctypes.c_uint32(size)
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        failed = libc.getsockopt(conn.fileno(), SOL_MPTCP,
+                                 MPTCP_SUBFLOW_ADDRS, buf,
+                                 ctypes.byref(optlen))
+    except (OSError, AttributeError):
+        return None
+    if failed:
+        return None
+    _, count, _, _ = SUBFLOW_DATA.unpack_from(buf)
+    raw = buf.raw
+    flows = []
+    for index in range(min(count, MAX_SUBFLOWS)):
+        offset = SUBFLOW_DATA.size + index * SUBFLOW_ADDRS_SIZE
+        flows.append((sockaddrName(raw, offset),
+                      sockaddrName(raw, offset + SOCKADDR_SIZE)))
+    return flows
+
+
+def logSubflows(conn: socket.socket, tunnel: str):
+    """
+    Log the subflows of the tunnel before it is closed.
+    """
+    flows = subflows(conn)
+    if flows is None:
+        logger.info('Tunnel %s is TCP', tunnel)
+        return
+    logger.info('Tunnel %s used %d subflows: %s', tunnel, len(flows),
+                ', '.join('%s-%s' % flow for flow in flows))
+
+
+def average(old: typing.Optional[float], new: float) -> float:
+    if old is None:
+        return float(new)
+    return old + EWMA_ALPHA * (new - old)
+
+
+class Path:
+    """
+    Path aggregates the samples of the connections of one
+    remote or destination. rtt, rttvar, cwnd and deliveryRate
+    are moving averages, minRtt and maxRtt the extremes,
+    retrans is the sum of the retransmits of the closed connections.
+    """
+    __slots__ = ('samples', 'closed', 'rtt', 'rttvar', 'minRtt', 'maxRtt',
+                 'cwnd', 'deliveryRate', 'retrans')
+
+    def __init__(self) -> None:
+        self.samples = 0
+        self.closed = 0
+        self.rtt = None
+        self.rttvar = None
+        self.minRtt = None
+        self.maxRtt = 0
+        self.cwnd = None
+        self.deliveryRate = None
+        self.retrans = 0
+
+    def add(self, info: Sample, closing: bool=False):
+        self.samples += 1
+        if info.rtt:
+            self.rtt = average(self.rtt, info.rtt)
+            self.rttvar = average(self.rttvar, info.rttvar)
+            self.maxRtt = max(self.maxRtt, info.rtt)
+        if info.minRtt and (self.minRtt is None or info.minRtt < self.minRtt):
+            self.minRtt = info.minRtt
+        if info.cwnd:
+            self.cwnd = average(self.cwnd, info.cwnd)
+        if info.deliveryRate:
+            self.deliveryRate = average(self.deliveryRate, info.deliveryRate)
+        if closing:
+            self.closed += 1
+            self.retrans += info.totalRetrans
+
+    def asDict(self) -> dict:
+        def ms(us):
+            return None if us is None else round(us / 1000, 3)
+
+        return {
+            'samples': self.samples,
+            'closed': self.closed,
+            'rttMs': ms(self.rtt),
+            'rttvarMs': ms(self.rttvar),
+            'minRttMs': ms(self.minRtt),
+            'maxRttMs': ms(self.maxRtt),
+            'cwnd': None if self.cwnd is None else round(self.cwnd, 1),
+            'deliveryRate': None if self.deliveryRate is None else int(
+                self.deliveryRate),
+            'retrans': self.retrans,
+        }
+
+
+class Sampler:
+    """
+    Sampler samples the tracked connections every interval,
+    track adds a connection with its kind, TUNNEL or DST,
+    and its path, release samples it the last time and forgets it.
+
+    Without an interval, nothing is sampled.
+    The connections on the loops of the workers are tracked
+    and sampled under the lock, the ticks run on loop.
+    """
+
+    def __init__(self,
+                 loop: asyncio.AbstractEventLoop=None,
+                 interval: float=None,
+                 budget: int=BUDGET,
+                 maxPaths: int=MAX_PATHS,
+                 statsFile: str=None) -> None:
+        self.loop = loop
+        self.interval = interval
+        self.budget = budget
+        self.maxPaths = maxPaths
+        self.statsFile = statsFile
+        self.tracked = {}
+        # the order to sample in, the released connections are skipped
+        self.turns = deque()
+        self.paths = {TUNNEL: OrderedDict(), DST: OrderedDict()}
+        self.handle = None
+        self.lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.interval is not None
+
+    def start(self):
+        if self.enabled and self.handle is None:
+            self.handle = self.loop.call_later(self.interval, self.tick)
+
+    def stop(self):
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+
+    def track(self, conn: socket.socket, kind: str, path: str):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.tracked[conn] = (kind, path)
+            self.turns.append(conn)
+
+    def release(self, *conns: socket.socket):
+        """
+        Sample the conns before they are closed, and forget them.
+        """
+        with self.lock:
+            for conn in conns:
+                key = self.tracked.pop(conn, None)
+                if key is not None:
+                    self.record(conn, key, closing=True)
+
+    def tick(self):
+        sampled = 0
+        with self.lock:
+            for _ in range(len(self.turns)):
+                if sampled >= self.budget:
+                    break
+                conn = self.turns.popleft()
+                key = self.tracked.get(conn)
+                if key is None:
+                    continue
+                self.record(conn, key)
+                self.turns.append(conn)
+                sampled += 1
+        self.handle = self.loop.call_later(self.interval, self.tick)
+
+    def record(self, conn: socket.socket, key: typing.Tuple[str, str],
+               closing: bool=False):
+        """
+        Sample the conn into its path, with the lock held.
+        """
+        info = sample(conn)
+        if info is None:
+            return
+        kind, name = key
+        paths = self.paths[kind]
+        path = paths.pop(name, None)
+        if path is None:
+            path = Path()
+            if len(paths) >= self.maxPaths:
+                paths.popitem(last=False)
+        paths[name] = path
+        path.add(info, closing)
+
+    def stats(self) -> dict:
+        with self.lock:
+            stats = {
+                kind: {name: path.asDict() for name, path in paths.items()}
+                for kind, paths in self.paths.items()
+            }
+            stats['tracked'] = len(self.tracked)
+        return stats
+
+    def dump(self):
+        """
+        Write the stats into statsFile, or log them.
+        """
+        if not self.enabled:
+            return
+        if self.statsFile is None:
+            logger.warning('TCP info stats %s', json.dumps(self.stats()))
+            return
+        with open(self.statsFile, 'w', encoding='utf-8') as f:
+            json.dump(self.stats(), f, indent=2)
@@ -0,0 +1,139 @@
+import asyncio
+import os
+import socket
+import sqlite3
+import tempfile
+import unittest
+
+from lightsocks.core.cipher import Cipher
+from lightsocks.core.password import randomPassword
+from lightsocks.server import LsServer
+from lightsocks.utils import accounting, net, socks
+
+
+class TestAccounting(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'traffic.db')
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+        self.dir.cleanup()
+
+    def readTraffic(self):
+        db = sqlite3.connect(self.path)
+        try:
+            return db.execute(
+                'SELECT user, dst, up, down FROM traffic ORDER BY dst'
+            ).fetchall()
+        finally:
+            db.close()
+
+    def test_disabled(self):
+        accounts = accounting.Accounting()
+        usage = accounts.begin('8388', 'example.com:443')
+        self.assertIs(usage, accounting.NULL_USAGE)
+        self.assertIsNone(usage.count(accounting.UP))
+        accounts.finish(usage)
+        self.assertFalse(accounts.refuse('8388'))
+
+    def test_flush(self):
+        accounts = accounting.Accounting(self.loop, self.path, interval=0.01)
+        first = accounts.begin('8388', 'example.com:443')
+        second = accounts.begin('8388', 'example.org:80')
+        self.assertEqual(first.count(accounting.UP)(10), 0)
+        first.count(accounting.DOWN)(100)
+        second.count(accounting.UP)(1)
+
+        # the live connections are flushed too
+        self.loop.run_until_complete(asyncio.sleep(0.05))
+        accounts.finish(second)
+        first.count(accounting.DOWN)(100)
+        accounts.finish(first)
+        accounts.close()
+        self.assertEqual(self.readTraffic(),
+                         [('8388', 'example.com:443', 10, 200),
+                          ('8388', 'example.org:80', 1, 0)])
+
+        # the totals are loaded again for the quotas
+        accounts = accounting.Accounting(
+            self.loop, self.path, quotas={'8388': 211})
+        self.assertEqual(accounts.totals, {'8388': 211})
+        self.assertTrue(accounts.refuse('8388'))
+        accounts.close()
+
+    def test_throttle(self):
+        accounts = accounting.Accounting(
+            self.loop,
+            quotas={'8388': 10},
+            action=accounting.THROTTLE,
+            throttleRate=1000,
+            interval=0.01)
+        usage = accounts.begin('8388', 'example.com:443')
+        self.assertEqual(usage.count(accounting.UP)(10), 0)
+        self.loop.run_until_complete(asyncio.sleep(0.05))
+        self.assertFalse(accounts.refuse('8388'))
+        self.assertEqual(usage.count(accounting.UP)(100), 0.1)
+        self.assertEqual(
+            accounts.begin('8388', 'example.org:80').count(
+                accounting.DOWN)(500), 0.5)
+        accounts.close()
+
+    def test_disconnect(self):
+        password = randomPassword()
+        cipher = Cipher.NewCipher(password)
+        server = LsServer(
+            loop=self.loop,
+            password=password,
+            listenAddr=net.Address('127.0.0.1', 0),
+            accounts=accounting.Accounting(
+                self.loop, self.path, quotas={'alice': 10}, interval=0.01),
+            user='alice')
+        server.bind()
+        dstServer = socket.socket()
+        dstServer.bind(('127.0.0.1', 0))
+        dstServer.listen(socket.SOMAXCONN)
+        dstServer.setblocking(False)
+        dstAddr = '127.0.0.1:%d' % dstServer.getsockname()[1]
+
+        async def request():
+            client = socket.socket()
+            client.setblocking(False)
+            await self.loop.sock_connect(client, server.listener.getsockname())
+            for msg in (socks.GREETING,
+                        socks.packRequest(*dstServer.getsockname())):
+                msg = bytearray(msg)
+                cipher.encode(msg)
+                await self.loop.sock_sendall(client, msg)
+                reply = bytearray(await self.loop.sock_recv(client, 1024))
+                cipher.decode(reply)
+            return client, reply
+
+        async def test():
+            asyncio.ensure_future(server.listen())
+            client, reply = await request()
+            self.assertEqual(reply, socks.packReply())
+            dstConn, _ = await self.loop.sock_accept(dstServer)
+            await self.loop.sock_sendall(dstConn, b'over the quota')
+            await self.loop.sock_recv(client, 1024)
+            # it is disconnected at the next check
+            self.assertEqual(
+                await asyncio.wait_for(self.loop.sock_recv(client, 1024), 1),
+                b'')
+            client.close()
+            dstConn.close()
+
+            client, reply = await request()
+            self.assertEqual(reply, socks.packReply(socks.REP_NOT_ALLOWED))
+            client.close()
+
+            server.stopAccepting()
+            await server.drain(1)
+
+        try:
+            self.loop.run_until_complete(test())
+        finally:
+            dstServer.close()
+            server.accounts.close()
+        self.assertEqual(self.readTraffic(), [('alice', dstAddr, 0, 14)])
@@ -0,0 +1,79 @@
+import unittest
+
+from lightsocks.utils import socks
+from lightsocks.utils.breaker import BACKOFF_MAX, Breaker
+
+
+class FakeLoop:
+    def __init__(self):
+        self.now = 100.0
+
+    def time(self):
+        return self.now
+
+
+class TestBreaker(unittest.TestCase):
+    def setUp(self):
+        self.loop = FakeLoop()
+        self.breaker = Breaker(self.loop, threshold=2, backoff=1, capacity=2)
+        self.key = ('example.com', 443)
+
+    def test_open_and_probe(self):
+        breaker = self.breaker
+        rep = socks.REP_CONNECTION_REFUSED
+        self.assertIsNone(breaker.check(self.key))
+        breaker.fail(self.key, rep)
+        self.assertIsNone(breaker.check(self.key))
+        breaker.fail(self.key, rep)
+        self.assertEqual(breaker.check(self.key), rep)
+        self.assertEqual(breaker.check(self.key), rep)
+        self.assertEqual(breaker.hits, 2)
+
+        # half open: one probe, the others still fail fast
+        self.loop.now += 1
+        self.assertIsNone(breaker.check(self.key))
+        self.assertEqual(breaker.check(self.key), rep)
+
+        # the probe fails, the backoff doubles
+        breaker.fail(self.key, rep)
+        self.loop.now += 1
+        self.assertEqual(breaker.check(self.key), rep)
+        self.loop.now += 1
+        self.assertIsNone(breaker.check(self.key))
+
+        # the probe succeeds, the destination is closed again
+        breaker.succeed(self.key)
+        self.assertIsNone(breaker.check(self.key))
+        self.assertNotIn(self.key, breaker.failures)
+
+    def test_lost_probe(self):
+        breaker = self.breaker
+        breaker.fail(self.key, socks.REP_HOST_UNREACHABLE)
+        breaker.fail(self.key, socks.REP_HOST_UNREACHABLE)
+        self.loop.now += 1
+        self.assertIsNone(breaker.check(self.key))
+        # the probe never reports, another one is let through later
+        self.loop.now += 1
+        self.assertIsNone(breaker.check(self.key))
+
+    def test_backoff_max(self):
+        for _ in range(64):
+            self.breaker.fail(self.key, socks.REP_HOST_UNREACHABLE)
+        failure = self.breaker.failures[self.key]
+        self.assertEqual(failure.openUntil, self.loop.now + BACKOFF_MAX)
+
+    def test_lru(self):
+        breaker = self.breaker
+        first, second, third = ('a', 1), ('b', 1), ('c', 1)
+        breaker.fail(first, socks.REP_GENERAL_FAILURE)
+        breaker.fail(second, socks.REP_GENERAL_FAILURE)
+        breaker.check(first)
+        breaker.fail(third, socks.REP_GENERAL_FAILURE)
+        self.assertEqual(list(breaker.failures), [first, third])
+
+    def test_disabled(self):
+        breaker = Breaker(self.loop, threshold=0)
+        for _ in range(3):
+            breaker.fail(self.key, socks.REP_GENERAL_FAILURE)
+        self.assertIsNone(breaker.check(self.key))
+        self.assertEqual(len(breaker.failures), 0)
@@ -0,0 +1,85 @@
+import asyncio
+import json
+import os
+import tempfile
+import time
+import unittest
+
+from lightsocks.utils import monitor
+
+
+def blockingCall():
+    time.sleep(0.2)
+
+
+class TestMonitor(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_histogram(self):
+        histogram = monitor.Histogram()
+        for ms in (0.5, 0.5, 3, 7000):
+            histogram.add(ms)
+        self.assertEqual(histogram.percentile(0.5), 1)
+        self.assertEqual(histogram.percentile(0.75), 5)
+        self.assertEqual(histogram.percentile(1), 7000)
+        stats = histogram.asDict()
+        self.assertEqual(stats['count'], 4)
+        self.assertEqual(stats['buckets']['>5000'], 1)
+
+    def test_stall(self):
+        watcher = monitor.Monitor(self.loop, interval=0.01, threshold=0.05)
+
+        async def test():
+            watcher.start()
+            await asyncio.sleep(0.05)
+            self.loop.call_soon(blockingCall)
+            await asyncio.sleep(0.05)
+
+        try:
+            self.loop.run_until_complete(test())
+        finally:
+            watcher.stop()
+
+        stats = watcher.stats()
+        self.assertEqual(stats['stalls'], 1)
+        self.assertIn('blockingCall', stats['recentStalls'][0]['stack'])
+        self.assertGreaterEqual(stats['lag']['maxMs'], 150)
+        self.assertGreater(stats['lag']['count'], 5)
+
+    def test_alarm(self):
+        watcher = monitor.Monitor(
+            self.loop,
+            interval=0.01,
+            threshold=1,
+            alarmLag=0.005,
+            alarmDuration=0.05)
+
+        async def test():
+            watcher.start()
+            # keep the loop busy for a while, then let it idle
+            until = time.monotonic() + 0.2
+            while time.monotonic() < until:
+                time.sleep(0.02)
+                await asyncio.sleep(0)
+            self.assertTrue(watcher.alarming)
+            await asyncio.sleep(0.05)
+            self.assertFalse(watcher.alarming)
+
+        try:
+            self.loop.run_until_complete(test())
+        finally:
+            watcher.stop()
+        self.assertEqual(watcher.alarms, 1)
+        self.assertEqual(watcher.stats()['stalls'], 0)
+
+    def test_dump(self):
+        with tempfile.TemporaryDirectory() as path:
+            statsFile = os.path.join(path, 'stats.json')
+            watcher = monitor.Monitor(self.loop, statsFile=statsFile)
+            watcher.dump()
+            with open(statsFile, encoding='utf-8') as f:
+                self.assertEqual(json.load(f)['lag']['count'], 0)
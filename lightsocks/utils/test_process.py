@@ -0,0 +1,127 @@
+import asyncio
+import os
+import socket
+import unittest
+
+from lightsocks.core.password import randomPassword
+from lightsocks.core.test_service import EchoService
+from lightsocks.core.cipher import Cipher
+from lightsocks.utils import net, process
+
+
+class TestSupervisor(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.created = []
+
+        def createService(config, listener):
+            service = EchoService(
+                loop=self.loop,
+                cipher=Cipher.NewCipher(randomPassword()),
+                listenAddr=net.Address('127.0.0.1', config),
+                listener=listener)
+            self.created.append(service)
+            return service
+
+        self.configs = [0]
+        self.supervisor = process.Supervisor(
+            loop=self.loop,
+            config=0,
+            createService=createService,
+            loadConfig=lambda: self.configs.pop(),
+            listenAddr=lambda config: config,
+            drainTimeout=1)
+
+    def tearDown(self):
+        self.loop.close()
+
+    async def connect(self, address):
+        client = socket.socket()
+        client.setblocking(False)
+        await self.loop.sock_connect(client, address)
+        await self.loop.sock_sendall(client, b'hello')
+        self.assertEqual(await self.loop.sock_recv(client, 1024), b'hello')
+        return client
+
+    def test_reload_and_shutdown(self):
+        async def test():
+            self.supervisor.start()
+            await asyncio.sleep(0)
+            old = self.supervisor.service
+            address = old.listener.getsockname()
+            client = await self.connect(address)
+
+            self.supervisor.reload()
+            await asyncio.sleep(0)
+            new = self.supervisor.service
+            self.assertIsNot(old, new)
+            self.assertIsNone(old.listener)
+            self.assertEqual(new.listener.getsockname(), address)
+            self.assertEqual(len(self.supervisor.draining), 1)
+
+            other = await self.connect(address)
+            self.assertEqual(len(new.connections), 1)
+            self.assertEqual(len(old.connections), 1)
+
+            client.close()
+            other.close()
+            self.supervisor.shutdown()
+
+        self.loop.run_until_complete(test())
+        self.loop.run_forever()
+        self.assertIsNone(self.supervisor.service)
+        self.assertFalse(self.supervisor.draining)
+        self.assertEqual(len(self.created), 2)
+
+    def test_reload_fail(self):
+        async def test():
+            self.supervisor.start()
+            await asyncio.sleep(0)
+            service = self.supervisor.service
+            self.supervisor.reload()
+            self.assertIs(self.supervisor.service, service)
+            self.supervisor.shutdown()
+
+        self.configs = []
+        self.loop.run_until_complete(test())
+        self.loop.run_forever()
+
+    def test_reload_bind_fail(self):
+        busy = socket.socket()
+        busy.bind(('127.0.0.1', 0))
+        busy.listen(1)
+
+        async def test():
+            self.supervisor.start()
+            await asyncio.sleep(0)
+            service = self.supervisor.service
+            address = service.listener.getsockname()
+
+            # the port is in use, the old service keeps running
+            self.supervisor.reload()
+            await asyncio.sleep(0)
+            self.assertIs(self.supervisor.service, service)
+            self.assertEqual(self.supervisor.config, 0)
+            self.assertIsNone(self.created[-1].listener)
+            client = await self.connect(address)
+            client.close()
+            self.supervisor.shutdown()
+
+        self.configs = [busy.getsockname()[1]]
+        with busy:
+            self.loop.run_until_complete(test())
+            self.loop.run_forever()
+
+
+class TestInheritedListener(unittest.TestCase):
+    def test_inheritedListener(self):
+        self.assertIsNone(process.inheritedListener())
+
+        with socket.socket() as listener:
+            listener.bind(('127.0.0.1', 0))
+            listener.listen(1)
+            os.environ[process.LISTEN_FD_ENV] = str(os.dup(listener.fileno()))
+            with process.inheritedListener() as inherited:
+                self.assertEqual(inherited.getsockname(),
+                                 listener.getsockname())
+            self.assertNotIn(process.LISTEN_FD_ENV, os.environ)
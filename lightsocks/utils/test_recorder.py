@@ -0,0 +1,137 @@
+import asyncio
+import io
+import os
+import socket
+import tempfile
+import unittest
+
+from lightsocks.core.password import randomPassword
+from lightsocks.local import LsLocal
+from lightsocks.server import LsServer
+from lightsocks.utils import net, recorder, socks
+
+
+class TestRecorder(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'traffic.lsrc')
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_null(self):
+        r = recorder.Recorder()
+        record = r.begin()
+        self.assertIs(record, recorder.NULL_RECORD)
+        transform = bytearray.reverse
+        self.assertIs(record.observe(recorder.UP, transform), transform)
+        r.finish(record)
+        r.close()
+
+    def test_roundtrip(self):
+        r = recorder.Recorder(self.path, payload=True, maxEvents=2)
+        record = r.begin()
+        record.setDst('example.com', 443)
+        record.connected()
+        up = record.observe(recorder.UP)
+        down = record.observe(recorder.DOWN, bytearray.reverse)
+        up(bytearray(b'hello'))
+        down(bytearray(b'dlrow'))
+        up(bytearray(b'dropped'))
+        r.finish(record)
+        r.finish(r.begin())
+        r.close()
+
+        # the header is written once for the appended logs
+        r = recorder.Recorder(self.path)
+        r.finish(r.begin())
+        r.close()
+
+        first, second, third = recorder.loadLog(self.path)
+        self.assertEqual(first.dst, 'example.com:443')
+        self.assertTrue(first.truncated)
+        self.assertLessEqual(first.connect, first.duration)
+        self.assertEqual([(e.direction, e.size, e.payload)
+                          for e in first.events],
+                         [(recorder.UP, 5, b'hello'),
+                          (recorder.DOWN, 5, b'world')])
+        self.assertLessEqual(first.events[0].offset, first.events[1].offset)
+        self.assertEqual(second.events, [])
+        self.assertFalse(second.truncated)
+        self.assertEqual(third.dst, '')
+
+    def test_invalid(self):
+        with self.assertRaises(recorder.InvalidLogError):
+            list(recorder.readLog(io.BytesIO(b'LSTR\x01')))
+
+        r = recorder.Recorder(self.path)
+        record = r.begin()
+        record.observe(recorder.UP)(bytearray(b'hello'))
+        r.finish(record)
+        r.close()
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        with self.assertRaises(recorder.InvalidLogError):
+            list(recorder.readLog(io.BytesIO(data[:-1])))
+
+    def test_server(self):
+        loop = asyncio.new_event_loop()
+        password = randomPassword()
+        server = LsServer(
+            loop=loop,
+            password=password,
+            listenAddr=net.Address('127.0.0.1', 0),
+            recorder=recorder.Recorder(self.path))
+        server.bind()
+        local = LsLocal(
+            loop=loop,
+            password=password,
+            listenAddr=net.Address('127.0.0.1', 0),
+            remoteAddr=net.Address(*server.listener.getsockname()))
+        local.bind()
+        dstServer = socket.socket()
+        dstServer.bind(('127.0.0.1', 0))
+        dstServer.listen(socket.SOMAXCONN)
+        dstServer.setblocking(False)
+        dstAddr = '127.0.0.1:%d' % dstServer.getsockname()[1]
+
+        async def test():
+            asyncio.ensure_future(server.listen())
+            asyncio.ensure_future(local.listen())
+            client = socket.socket()
+            client.setblocking(False)
+            await loop.sock_connect(client, local.listener.getsockname())
+            await loop.sock_sendall(client, socks.GREETING)
+            await loop.sock_recv(client, 1024)
+            await loop.sock_sendall(
+                client,
+                socks.packRequest('127.0.0.1', dstServer.getsockname()[1]))
+            received_msg = await loop.sock_recv(client, 1024)
+            self.assertEqual(received_msg, socks.packReply())
+
+            dstConn, _ = await loop.sock_accept(dstServer)
+            await loop.sock_sendall(client, b'hello server')
+            await loop.sock_recv(dstConn, 1024)
+            await loop.sock_sendall(dstConn, b'hello client')
+            await loop.sock_recv(client, 1024)
+            dstConn.close()
+            client.close()
+
+            local.stopAccepting()
+            server.stopAccepting()
+            await local.drain(1)
+            await server.drain(1)
+
+        try:
+            loop.run_until_complete(test())
+        finally:
+            dstServer.close()
+            server.recorder.close()
+            loop.close()
+
+        [conn] = recorder.loadLog(self.path)
+        self.assertEqual(conn.dst, dstAddr)
+        self.assertGreater(conn.connect, 0)
+        self.assertEqual([(e.direction, e.size, e.payload)
+                          for e in conn.events],
+                         [(recorder.UP, 12, None), (recorder.DOWN, 12, None)])
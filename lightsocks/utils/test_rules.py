@@ -0,0 +1,184 @@
+import asyncio
+import ipaddress
+import os
+import tempfile
+import threading
+import unittest
+
+from lightsocks.utils.rules import (CIDRTable, DomainTrie, InvalidRuleError,
+                                    RuleSet)
+
+RULES = '''
+# lan
+10.0.0.0/8
+192.168.0.0/16
+192.168.1.0/24
+172.16.0.1
+fc00::/7
+
+example.com
+.example.org
+keyword:baidu
+'''
+
+
+class TestCIDRTable(unittest.TestCase):
+    def test_merge_and_match(self):
+        table = CIDRTable.compile(
+            ipaddress.ip_network(network)
+            for network in ('10.0.0.0/8', '10.1.0.0/16', '11.0.0.0/8',
+                            '192.168.1.0/24'))
+        self.assertEqual(len(table), 2)
+
+        for ip, expected in (('9.255.255.255', False), ('10.0.0.0', True),
+                             ('11.255.255.255', True), ('12.0.0.0', False),
+                             ('192.168.1.1', True), ('192.168.2.1', False)):
+            with self.subTest(ip):
+                self.assertIs(int(ipaddress.ip_address(ip)) in table,
+                              expected)
+
+        self.assertNotIn(1, CIDRTable.compile([]))
+
+
+class TestDomainTrie(unittest.TestCase):
+    def test_suffix(self):
+        trie = DomainTrie()
+        trie.add('a.example.com')
+        trie.add('example.com')
+        trie.add('b.example.com')
+        trie.add('.cn')
+
+        self.assertIn('example.com', trie)
+        self.assertIn('WWW.Example.com.', trie)
+        self.assertIn('baidu.cn', trie)
+        self.assertNotIn('com', trie)
+        self.assertNotIn('notexample.com', trie)
+        self.assertNotIn('example.net', trie)
+        # the shorter suffix replaces the longer ones
+        self.assertEqual(trie.root['com'], {'example': {DomainTrie.END: 1}})
+
+
+class TestRuleSet(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'direct.txt')
+        with open(self.path, 'w') as f:
+            f.write(RULES)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_match(self):
+        rules = RuleSet([self.path])
+        self.assertFalse(rules.loaded)
+
+        for host, expected in (('10.2.3.4', True), ('192.168.1.1', True),
+                               ('172.16.0.1', True), ('172.16.0.2', False),
+                               ('8.8.8.8', False), ('fd00::1', True),
+                               ('2001:db8::1', False),
+                               ('www.example.com', True),
+                               ('example.org', True),
+                               ('www.baidu.com', True),
+                               ('example.net', False)):
+            with self.subTest(host):
+                self.assertIs(rules.match(host), expected)
+        self.assertTrue(rules.loaded)
+
+    def test_prepare(self):
+        rules = RuleSet([self.path])
+        compiled = []
+        compile = rules.compile
+
+        def countingCompile():
+            compiled.append(True)
+            return compile()
+
+        rules.compile = countingCompile
+        loop = asyncio.new_event_loop()
+
+        async def test():
+            # the concurrent first connections share one loading
+            await asyncio.gather(*(rules.prepare(loop) for _ in range(3)))
+
+        try:
+            loop.run_until_complete(test())
+        finally:
+            loop.close()
+        self.assertTrue(rules.loaded)
+        self.assertEqual(len(compiled), 1)
+        self.assertTrue(rules.match('10.0.0.1'))
+
+    def test_prepare_loops(self):
+        rules = RuleSet([self.path])
+        compile = rules.compile
+        compiling = threading.Event()
+        waiting = threading.Event()
+
+        def blockingCompile():
+            compiling.set()
+            waiting.wait(5)
+            return compile()
+
+        rules.compile = blockingCompile
+        loops = [asyncio.new_event_loop() for _ in range(2)]
+        errors = []
+
+        async def prepare(loop):
+            preparing = asyncio.ensure_future(rules.prepare(loop), loop=loop)
+            await asyncio.sleep(0)
+            if loop is loops[1]:
+                waiting.set()
+            await preparing
+
+        def run(loop):
+            try:
+                loop.run_until_complete(prepare(loop))
+            except Exception as err:
+                errors.append(err)
+
+        # the services of the workers share the rules,
+        # the second loop waits for the loading of the first one
+        threads = [
+            threading.Thread(target=run, args=(loop, )) for loop in loops
+        ]
+        try:
+            threads[0].start()
+            compiling.wait(5)
+            threads[1].start()
+            for thread in threads:
+                thread.join()
+        finally:
+            for loop in loops:
+                loop.close()
+        self.assertEqual(errors, [])
+        self.assertTrue(rules.loaded)
+        self.assertTrue(rules.match('10.0.0.1'))
+
+    def test_cache(self):
+        rules = RuleSet([self.path])
+        rules.load()
+        self.assertTrue(os.path.exists(rules.cachePath))
+
+        cached = RuleSet([self.path])
+        cached.compile = None  # must not compile again
+        cached.load()
+        self.assertTrue(cached.match('10.0.0.1'))
+        self.assertTrue(cached.match('www.example.com'))
+
+        # the cache is stale after the rule file changes
+        with open(self.path, 'a') as f:
+            f.write('example.net\n')
+        os.utime(self.path, ns=(0, 0))
+        changed = RuleSet([self.path])
+        self.assertTrue(changed.match('example.net'))
+
+    def test_invalid(self):
+        with open(self.path, 'a') as f:
+            f.write('not a rule\n')
+
+        with self.assertRaises(InvalidRuleError):
+            RuleSet([self.path]).load()
+
+        # match everything through the tunnel
+        rules = RuleSet([self.path])
+        self.assertFalse(rules.match('10.0.0.1'))
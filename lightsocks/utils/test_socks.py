@@ -0,0 +1,46 @@
+import errno
+import socket
+import unittest
+
+from lightsocks.utils import socks
+
+
+class TestSocks(unittest.TestCase):
+    def test_pack_and_parse(self):
+        for host, atyp in (('127.0.0.1', socks.ATYP_IPV4),
+                           ('::1', socks.ATYP_IPV6),
+                           ('example.com', socks.ATYP_DOMAIN)):
+            with self.subTest(host):
+                buf = socks.packRequest(host, 443)
+                request = socks.parseRequest(buf)
+                self.assertEqual(request,
+                                 socks.Request(socks.CMD_CONNECT, atyp, host,
+                                               443))
+
+    def test_parse_fail(self):
+        for buf in (b'\x05\x01\x00', b'\x05\x01\x00\x02\xff\xff\xff',
+                    b'\x05\x01\x00\x03\x02\xff\xfe\x00\x50'):
+            with self.subTest(buf):
+                with self.assertRaises(socks.InvalidRequestError):
+                    socks.parseRequest(buf)
+
+    def test_packReply(self):
+        self.assertEqual(
+            socks.packReply(),
+            bytearray((0x05, 0x00, 0x00, 0x01, 0x00, 0x00, 0x00, 0x00, 0x00,
+                       0x00)))
+        self.assertEqual(
+            socks.packReply(socks.REP_HOST_UNREACHABLE)[1], 0x04)
+
+    def test_replyCode(self):
+        self.assertEqual(
+            socks.replyCode(ConnectionRefusedError(errno.ECONNREFUSED, '')),
+            socks.REP_CONNECTION_REFUSED)
+        self.assertEqual(
+            socks.replyCode(OSError(errno.ENETUNREACH, '')),
+            socks.REP_NETWORK_UNREACHABLE)
+        self.assertEqual(
+            socks.replyCode(socket.gaierror(socket.EAI_NONAME, '')),
+            socks.REP_HOST_UNREACHABLE)
+        self.assertEqual(
+            socks.replyCode(OSError('no address')), socks.REP_GENERAL_FAILURE)
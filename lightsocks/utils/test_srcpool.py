@@ -0,0 +1,57 @@
+import errno
+import socket
+import unittest
+
+from lightsocks.utils import srcpool
+
+
+class TestSourcePool(unittest.TestCase):
+    def setUp(self):
+        self.pool = srcpool.SourcePool(['127.0.0.2', '127.0.0.3', '::1'])
+
+    def addresses(self, sources):
+        return [source.address for source in sources]
+
+    def test_round_robin(self):
+        dstAddress = ('127.0.0.1', 80)
+        self.assertEqual(
+            self.addresses(self.pool.candidates(socket.AF_INET, dstAddress)),
+            ['127.0.0.2', '127.0.0.3'])
+        self.assertEqual(
+            self.addresses(self.pool.candidates(socket.AF_INET, dstAddress)),
+            ['127.0.0.3', '127.0.0.2'])
+        self.assertEqual(
+            self.addresses(
+                self.pool.candidates(socket.AF_INET6, ('::1', 80, 0, 0))),
+            ['::1'])
+        self.assertEqual(srcpool.SourcePool().candidates(
+            socket.AF_INET, dstAddress), [])
+
+    def test_hash(self):
+        self.pool.policy = srcpool.HASH
+        picked = {
+            self.pool.candidates(socket.AF_INET, ('127.0.0.1', port))[0]
+            for port in range(80, 90)
+        }
+        # one destination keeps its source, the destinations are spread
+        self.assertEqual(len(picked), 2)
+        for port in range(80, 90):
+            self.assertEqual(
+                self.pool.candidates(socket.AF_INET, ('127.0.0.1', port)),
+                self.pool.candidates(socket.AF_INET, ('127.0.0.1', port)))
+
+    def test_stats(self):
+        source = self.pool.sources[0]
+        self.assertTrue(
+            self.pool.failed(source, OSError(errno.EADDRNOTAVAIL, 'no port')))
+        self.assertFalse(
+            self.pool.failed(source, OSError(errno.ECONNREFUSED, 'refused')))
+        self.pool.connected(source)
+        self.assertEqual(self.pool.stats()['127.0.0.2'], {
+            'active': 1,
+            'connects': 1,
+            'exhausted': 1,
+            'failures': 1,
+        })
+        self.pool.release(source)
+        self.assertEqual(self.pool.stats()['127.0.0.2']['active'], 0)
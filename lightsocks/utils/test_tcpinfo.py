@@ -0,0 +1,107 @@
+import asyncio
+import socket
+import unittest
+
+from lightsocks.core import transport
+from lightsocks.utils import tcpinfo
+
+
+class TestTcpInfo(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.listener = socket.socket()
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen()
+        self.conns = []
+
+    def tearDown(self):
+        for conn in self.conns:
+            conn.close()
+        self.listener.close()
+        self.loop.close()
+
+    def connect(self) -> socket.socket:
+        conn = socket.create_connection(self.listener.getsockname())
+        accepted, _ = self.listener.accept()
+        conn.sendall(b'hello')
+        accepted.recv(5)
+        self.conns += [conn, accepted]
+        return conn
+
+    def test_sample(self):
+        info = tcpinfo.sample(self.connect())
+        if info is None:
+            self.skipTest('TCP_INFO is not supported')
+        self.assertGreater(info.cwnd, 0)
+        self.assertEqual(info.retransmits, 0)
+
+        a, b = socket.socketpair()
+        with a, b:
+            self.assertIsNone(tcpinfo.sample(a))
+
+    def test_sampler(self):
+        conn = self.connect()
+        if tcpinfo.sample(conn) is None:
+            self.skipTest('TCP_INFO is not supported')
+        other = self.connect()
+        sampler = tcpinfo.Sampler(self.loop, 1.0, budget=1)
+        sampler.track(conn, tcpinfo.TUNNEL, '127.0.0.1')
+        sampler.track(other, tcpinfo.DST, 'example.com:80')
+
+        sampler.tick()
+        sampler.stop()
+        stats = sampler.stats()
+        self.assertEqual(stats['tracked'], 2)
+        self.assertEqual(stats['tunnel']['127.0.0.1']['samples'], 1)
+        # over the budget, the other one waits for the next tick
+        self.assertEqual(stats['dst'], {})
+
+        sampler.release(conn, other)
+        stats = sampler.stats()
+        self.assertEqual(stats['tracked'], 0)
+        self.assertEqual(stats['tunnel']['127.0.0.1']['closed'], 1)
+        self.assertEqual(stats['dst']['example.com:80']['closed'], 1)
+        # the released ones are not sampled any more
+        sampler.tick()
+        sampler.stop()
+        self.assertEqual(sampler.stats()['tunnel']['127.0.0.1']['samples'], 2)
+
+    def test_max_paths(self):
+        conn = self.connect()
+        if tcpinfo.sample(conn) is None:
+            self.skipTest('TCP_INFO is not supported')
+        sampler = tcpinfo.Sampler(self.loop, 1.0, maxPaths=2)
+        for port in (1, 2, 1, 3):
+            sampler.track(conn, tcpinfo.DST, 'example.com:%d' % port)
+            sampler.release(conn)
+        self.assertEqual(
+            list(sampler.stats()['dst']), ['example.com:1', 'example.com:3'])
+
+    def test_disabled(self):
+        sampler = tcpinfo.Sampler()
+        sampler.track(self.connect(), tcpinfo.TUNNEL, '127.0.0.1')
+        sampler.start()
+        self.assertIsNone(sampler.handle)
+        self.assertEqual(sampler.stats()['tracked'], 0)
+
+    def test_subflows(self):
+        self.assertIsNone(tcpinfo.subflows(self.connect()))
+        if not transport.mptcpSupported():
+            self.skipTest('MPTCP is not supported')
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM,
+                                 transport.IPPROTO_MPTCP)
+        with listener:
+            listener.bind(('127.0.0.1', 0))
+            listener.listen()
+            conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM,
+                                 transport.IPPROTO_MPTCP)
+            conn.connect(listener.getsockname())
+            accepted, _ = listener.accept()
+            self.conns += [conn, accepted]
+        if not tcpinfo.isMptcp(conn):
+            self.skipTest('TCP_IS_MPTCP is not supported')
+        flows = tcpinfo.subflows(conn)
+        if flows is None:
+            self.skipTest('MPTCP_SUBFLOW_ADDRS is not supported')
+        self.assertEqual(flows, [('%s:%d' % conn.getsockname(),
+                                  '%s:%d' % conn.getpeername())])
@@ -0,0 +1,126 @@
+import asyncio
+import json
+import os
+import socket
+import tempfile
+import unittest
+
+from lightsocks.core.password import randomPassword
+from lightsocks.local import LsLocal
+from lightsocks.server import LsServer
+from lightsocks.utils import net, socks, tracing
+
+
+class TestTracer(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'trace.jsonl')
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def readTraces(self, path=None):
+        with open(path or self.path, encoding='utf-8') as f:
+            return [json.loads(line) for line in f]
+
+    def test_traceId(self):
+        traceId = os.urandom(tracing.ID_SIZE).hex()
+        buf = tracing.packTraceId(traceId) + socks.GREETING
+        self.assertEqual(
+            tracing.unpackTraceId(buf), (traceId, socks.GREETING))
+        self.assertEqual(
+            tracing.unpackTraceId(socks.GREETING), (None, socks.GREETING))
+
+    def test_sampling(self):
+        self.assertIs(tracing.Tracer().begin('local'), tracing.NULL_TRACE)
+
+        tracer = tracing.Tracer(self.path, rate=0)
+        self.assertIs(tracer.begin('local'), tracing.NULL_TRACE)
+        # the traces from the other side are always kept
+        trace = tracer.begin('server', traceId='00' * tracing.ID_SIZE)
+        self.assertIsInstance(trace, tracing.Trace)
+        tracer.close()
+
+    def test_finish(self):
+        tracer = tracing.Tracer(self.path, rate=1)
+        trace = tracer.begin('local')
+        trace.mark('dial')
+        trace.markFirstByte()
+        trace.setDst('example.com', 443)
+        trace.fail('connect')
+        trace.fail('later')
+        tracer.finish(trace)
+        tracer.finish(tracing.NULL_TRACE)
+        tracer.close()
+
+        [record] = self.readTraces()
+        self.assertEqual(record['id'], trace.traceId)
+        self.assertEqual(record['side'], 'local')
+        self.assertEqual(record['dst'], 'example.com:443')
+        self.assertEqual(record['error'], 'connect')
+        self.assertEqual(set(record['ms']), {'dial', 'firstByte', 'close'})
+
+    def test_join(self):
+        localPath = os.path.join(self.dir.name, 'local.jsonl')
+        loop = asyncio.new_event_loop()
+        password = randomPassword()
+        server = LsServer(
+            loop=loop,
+            password=password,
+            listenAddr=net.Address('127.0.0.1', 0),
+            tracer=tracing.Tracer(self.path, rate=0))
+        server.bind()
+        local = LsLocal(
+            loop=loop,
+            password=password,
+            listenAddr=net.Address('127.0.0.1', 0),
+            remoteAddr=net.Address(*server.listener.getsockname()),
+            tracer=tracing.Tracer(localPath, rate=1))
+        local.bind()
+        dstServer = socket.socket()
+        dstServer.bind(('127.0.0.1', 0))
+        dstServer.listen(socket.SOMAXCONN)
+        dstServer.setblocking(False)
+        dstAddr = '127.0.0.1:%d' % dstServer.getsockname()[1]
+
+        async def test():
+            asyncio.ensure_future(server.listen())
+            asyncio.ensure_future(local.listen())
+            client = socket.socket()
+            client.setblocking(False)
+            await loop.sock_connect(client, local.listener.getsockname())
+            await loop.sock_sendall(client, socks.GREETING)
+            await loop.sock_recv(client, 1024)
+            await loop.sock_sendall(
+                client,
+                socks.packRequest('127.0.0.1', dstServer.getsockname()[1]))
+            received_msg = await loop.sock_recv(client, 1024)
+            self.assertEqual(received_msg, socks.packReply())
+
+            dstConn, _ = await loop.sock_accept(dstServer)
+            await loop.sock_sendall(dstConn, b'hello client')
+            await loop.sock_recv(client, 1024)
+            dstConn.close()
+            client.close()
+
+            local.stopAccepting()
+            server.stopAccepting()
+            await local.drain(1)
+            await server.drain(1)
+
+        try:
+            loop.run_until_complete(test())
+        finally:
+            dstServer.close()
+            local.tracer.close()
+            server.tracer.close()
+            loop.close()
+
+        [localTrace] = self.readTraces(localPath)
+        [serverTrace] = self.readTraces()
+        self.assertEqual(localTrace['id'], serverTrace['id'])
+        self.assertEqual(serverTrace['dst'], dstAddr)
+        self.assertIn('dial', localTrace['ms'])
+        self.assertIn('firstByte', localTrace['ms'])
+        for phase in ('handshake', 'connect', 'firstByte', 'close'):
+            self.assertIn(phase, serverTrace['ms'])
@@ -0,0 +1,114 @@
+import asyncio
+import socket
+import threading
+import unittest
+
+from lightsocks.core.cipher import Cipher
+from lightsocks.core.password import randomPassword
+from lightsocks.core.test_service import EchoService
+from lightsocks.utils import accounting, net, process, workers
+
+
+class ThreadEchoService(EchoService):
+    async def handleConn(self, connection):
+        self.threads.add(threading.current_thread().name)
+        await super().handleConn(connection)
+
+
+class TestWorkers(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.pool = workers.WorkerPool(2)
+        self.created = []
+        self.threads = set()
+        cipher = Cipher.NewCipher(randomPassword())
+
+        def createService(config, listener, loop=self.loop):
+            service = ThreadEchoService(
+                loop=loop,
+                cipher=cipher,
+                listenAddr=net.Address('127.0.0.1', config),
+                listener=listener)
+            service.threads = self.threads
+            self.created.append(service)
+            return service
+
+        self.configs = [0]
+        self.supervisor = process.Supervisor(
+            loop=self.loop,
+            config=0,
+            createService=createService,
+            loadConfig=lambda: self.configs.pop(),
+            listenAddr=lambda config: config,
+            drainTimeout=1,
+            workers=self.pool)
+        self.pool.start()
+
+    def tearDown(self):
+        self.pool.stop()
+        self.loop.close()
+
+    async def connect(self, address):
+        client = socket.socket()
+        client.setblocking(False)
+        await self.loop.sock_connect(client, address)
+        await self.loop.sock_sendall(client, b'hello')
+        self.assertEqual(await self.loop.sock_recv(client, 1024), b'hello')
+        return client
+
+    def test_shards(self):
+        async def test():
+            self.supervisor.start()
+            await asyncio.sleep(0)
+            service = self.supervisor.service
+            self.assertEqual([shard.loop for shard in service.shards],
+                             self.pool.loops)
+            address = service.listener.getsockname()
+            clients = [await self.connect(address) for _ in range(4)]
+            self.assertEqual(self.threads, {'worker-0', 'worker-1'})
+            self.assertEqual(service.active, 4)
+            self.assertFalse(service.connections)
+
+            # the old shards are drained with the old service
+            self.supervisor.reload()
+            await asyncio.sleep(0)
+            self.assertEqual(len(self.created), 6)
+            other = await self.connect(address)
+            self.assertEqual(self.supervisor.service.active, 1)
+            for client in clients + [other]:
+                client.close()
+            self.supervisor.shutdown()
+
+        self.loop.run_until_complete(test())
+        self.loop.run_forever()
+        self.assertFalse(self.supervisor.draining)
+        self.assertEqual(sum(service.active for service in self.created), 0)
+
+    def test_stop(self):
+        loops = self.pool.loops
+        self.pool.stop()
+        self.assertTrue(all(loop.is_closed() for loop in loops))
+        # stopped twice by tearDown
+        self.pool.stop()
+
+
+class TestSharedUsage(unittest.TestCase):
+    def test_take(self):
+        usage = accounting.Usage('user', 'example.com:80')
+        taken = [0]
+        counting = True
+
+        def count():
+            while counting:
+                usage.countUp(1)
+
+        thread = threading.Thread(target=count)
+        thread.start()
+        try:
+            for _ in range(1000):
+                taken[0] += usage.take()[0]
+        finally:
+            counting = False
+            thread.join()
+        taken[0] += usage.take()[0]
+        self.assertEqual(taken[0], usage.up)
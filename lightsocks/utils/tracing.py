@@ -0,0 +1,178 @@
+"""
+    this module is for tracing the phases of the connections,
+    to tell where the time goes when the proxy is slow.
+
+    The phases are recorded in monotonic time since the accept:
+        dial        LsLocal connected to LsServer
+        handshake   the SOCKS5 negotiation finished
+        dns         LsServer resolved the destination
+        connect     the destination is connected
+        firstByte   the first bytes came back from the destination side
+        close       the connection is closed
+    The phases that do not apply to a side stay empty.
+
+    LsLocal sends the trace id to LsServer in front of the tunnel,
+        +--------+---------+
+        | MARKER | TRACEID |
+        +--------+---------+
+        | X'FE'  |    8    |
+        +--------+---------+
+    so the traces of both sides can be joined by the id.
+    The traces are sampled, and written to a rotating JSONL file.
+"""
+import json
+import logging
+import logging.handlers
+import os
+import random
+import time
+import typing
+
+TRACE_RATE = 0.01
+TRACE_MAX_BYTES = 64 * 1024 * 1024
+TRACE_BACKUPS = 3
+
+MARKER = 0xfe
+ID_SIZE = 8
+
+PHASES = ('dial', 'handshake', 'dns', 'connect', 'firstByte', 'close')
+
+
+class Trace:
+    """
+    Trace is the record of one connection on one side.
+    """
+    __slots__ = ('traceId', 'side', 'wallTime', 'accept', 'dial', 'handshake',
+                 'dns', 'connect', 'firstByte', 'close', 'dst', 'error')
+
+    def __init__(self, side: str, traceId: str,
+                 accept: float=None) -> None:
+        self.traceId = traceId
+        self.side = side
+        self.wallTime = time.time()
+        self.accept = accept if accept is not None else time.monotonic()
+        self.dial = None
+        self.handshake = None
+        self.dns = None
+        self.connect = None
+        self.firstByte = None
+        self.close = None
+        self.dst = None
+        self.error = None
+
+    def mark(self, phase: str):
+        setattr(self, phase, time.monotonic())
+
+    def markFirstByte(self):
+        if self.firstByte is None:
+            self.firstByte = time.monotonic()
+
+    def setDst(self, host: str, port: int):
+        self.dst = '%s:%d' % (host, port)
+
+    def fail(self, error: str):
+        # keep the first error, the later ones are caused by it
+        if self.error is None:
+            self.error = error
+
+    def asDict(self) -> dict:
+        phases = {}
+        for phase in PHASES:
+            at = getattr(self, phase)
+            if at is not None:
+                phases[phase] = round((at - self.accept) * 1000, 3)
+        return {
+            'id': self.traceId,
+            'side': self.side,
+            'time': round(self.wallTime, 6),
+            'dst': self.dst,
+            'error': self.error,
+            'ms': phases,
+        }
+
+
+class NullTrace:
+    """
+    NullTrace is for the connections that are not sampled,
+    it records nothing, so the callers do not check for None.
+    """
+    __slots__ = ()
+    traceId = None
+
+    def mark(self, phase: str):
+        pass
+
+    def markFirstByte(self):
+        pass
+
+    def setDst(self, host: str, port: int):
+        pass
+
+    def fail(self, error: str):
+        pass
+
+
+NULL_TRACE = NullTrace()
+
+
+class Tracer:
+    """
+    Tracer samples the connections, and writes the finished traces.
+    Without a path, nothing is traced.
+    The connections with a trace id from the other side are always traced,
+    so the sampled traces of LsLocal can be joined.
+    """
+
+    def __init__(self,
+                 path: str=None,
+                 rate: float=TRACE_RATE,
+                 maxBytes: int=TRACE_MAX_BYTES,
+                 backupCount: int=TRACE_BACKUPS) -> None:
+        self.rate = rate
+        self.handler = None
+        if path is not None:
+            self.handler = logging.handlers.RotatingFileHandler(
+                path,
+                maxBytes=maxBytes,
+                backupCount=backupCount,
+                encoding='utf-8')
+
+    @property
+    def enabled(self) -> bool:
+        return self.handler is not None
+
+    def begin(self, side: str, traceId: str=None,
+              accept: float=None) -> typing.Union[Trace, NullTrace]:
+        if self.handler is None:
+            return NULL_TRACE
+        if traceId is None:
+            if self.rate <= 0 or random.random() >= self.rate:
+                return NULL_TRACE
+            traceId = os.urandom(ID_SIZE).hex()
+        return Trace(side, traceId, accept)
+
+    def finish(self, trace: typing.Union[Trace, NullTrace]):
+        if trace.traceId is None:
+            return
+        trace.mark('close')
+        line = json.dumps(trace.asDict(), separators=(',', ':'))
+        self.handler.handle(logging.makeLogRecord({'msg': line}))
+
+    def close(self):
+        if self.handler is not None:
+            self.handler.close()
+
+
+def packTraceId(traceId: str) -> bytes:
+    return bytes((MARKER, )) + bytes.fromhex(traceId)
+
+
+def unpackTraceId(buf: bytes
+                  ) -> typing.Tuple[typing.Optional[str], bytes]:
+    """
+    Split the trace id from the first data of the tunnel,
+    return None if there is no trace id.
+    """
+    if len(buf) < 1 + ID_SIZE or buf[0] != MARKER:
+        return None, buf
+    return bytes(buf[1:1 + ID_SIZE]).hex(), buf[1 + ID_SIZE:]
@@ -0,0 +1,68 @@
+"""
+    this module is for serving the connections on several event loops
+    in one process, one thread each.
+
+    The main loop keeps the listener, the signals and the timers,
+    it accepts the connections and hands them to the workers in turn,
+    see Service.shards. The workers share the config and the stats,
+    the objects that are used on every loop take a lock.
+    On free-threaded Python the loops run in parallel,
+    with the GIL they take turns, it works but does not scale.
+"""
+import asyncio
+import threading
+import typing
+
+
+class Worker:
+    """
+    Worker runs its own event loop in a thread until it is stopped.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, name: str) -> None:
+        self.loop = loop
+        self.name = name
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(
+            target=self.run, name=self.name, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def stop(self):
+        if self.thread is None:
+            return
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.thread = None
+        self.loop.close()
+
+
+class WorkerPool:
+    """
+    WorkerPool is count workers, each with a loop from newLoop.
+    """
+
+    def __init__(self,
+                 count: int,
+                 newLoop: typing.Callable[[], asyncio.AbstractEventLoop]=
+                 asyncio.new_event_loop) -> None:
+        self.workers = [
+            Worker(newLoop(), 'worker-%d' % index) for index in range(count)
+        ]
+
+    @property
+    def loops(self) -> typing.List[asyncio.AbstractEventLoop]:
+        return [worker.loop for worker in self.workers]
+
+    def start(self):
+        for worker in self.workers:
+            worker.start()
+
+    def stop(self):
+        for worker in self.workers:
+            worker.stop()
@@ -1,29 +1,212 @@
 import argparse
 import asyncio
 import sys
+import typing
 
+from lightsocks import balancer, dns
+from lightsocks.core import relay, session, transport
 from lightsocks.core.password import InvalidPasswordError, loadsPassword
+from lightsocks.core.securesocket import (FLUSH_DELAY, FLUSH_SIZE,
+                                          PIPELINE_SIZE)
 from lightsocks.local import LsLocal
 from lightsocks.utils import config as lsConfig
 from lightsocks.utils import net
+from lightsocks.utils import process
+from lightsocks.utils import tracing
+from lightsocks.utils import tcpinfo
+from lightsocks.utils import workers
+from lightsocks.utils.monitor import THRESHOLD as MONITOR_THRESHOLD
+from lightsocks.utils.monitor import Monitor
+from lightsocks.utils.rules import RuleSet
 
 
-def run_server(config: lsConfig.Config):
+def run_server(config: lsConfig.Config,
+               loadConfig: typing.Callable=None,
+               drainTimeout: float=process.DRAIN_TIMEOUT,
+               flushDelay: float=FLUSH_DELAY,
+               flushSize: int=FLUSH_SIZE,
+               pipelineSize: int=PIPELINE_SIZE,
+               strategy: str=balancer.LATENCY,
+               connectTimeout: float=balancer.CONNECT_TIMEOUT,
+               rules: typing.List[str]=None,
+               tracer: tracing.Tracer=None,
+               transparent: bool=False,
+               resume: bool=False,
+               sessionGrace: float=session.GRACE_TIME,
+               sessionReplaySize: int=session.REPLAY_SIZE,
+               dnsAddr: net.Address=None,
+               dnsUpstream: net.Address=dns.UPSTREAM,
+               dnsCacheSize: int=dns.CACHE_SIZE,
+               monitor: bool=False,
+               monitorThreshold: float=MONITOR_THRESHOLD,
+               monitorFile: str=None,
+               tcpInfoInterval: float=None,
+               tcpInfoFile: str=None,
+               eagerTasks: bool=False,
+               threads: int=1,
+               mptcp: bool=False):
     loop = asyncio.get_event_loop()
+    # the main loop only accepts with more threads, see workers
+    pool = workers.WorkerPool(threads) if threads > 1 else None
+    # the paths are kept across reloads
+    tcpInfo = tcpinfo.Sampler(loop, tcpInfoInterval, statsFile=tcpInfoFile)
+    if mptcp and not transport.mptcpSupported():
+        print('MPTCP is not supported by the kernel, use TCP')
+    if eagerTasks and not relay.installEagerTaskFactory(loop):
+        print('eager tasks need Python 3.12 or later, ignored')
+    elif eagerTasks and pool is not None:
+        for workerLoop in pool.loops:
+            relay.installEagerTaskFactory(workerLoop)
+    # the cache and the tunnel of the forwarder are kept across reloads
+    forwarder = None
+    if dnsAddr is not None:
+        forwarder = dns.DnsForwarder(loop, dnsAddr, dnsUpstream,
+                                     dnsCacheSize)
 
-    listenAddr = net.Address(config.localAddr, config.localPort)
-    remoteAddr = net.Address(config.serverAddr, config.serverPort)
-    server = LsLocal(
-        loop=loop,
-        password=config.password,
-        listenAddr=listenAddr,
-        remoteAddr=remoteAddr)
+    # the services of the workers share the cipher, the rules and the
+    # balancer of the service on the main loop, that is created first
+    mainLoop = loop
+    mainLocal = None
+
+    def createServer(config, listener, loop=loop):
+        nonlocal mainLocal
+        listenAddr = net.Address(config.localAddr, config.localPort)
+        remoteAddr = net.Address(config.serverAddr, config.serverPort)
+        remotes = None
+        if config.servers:
+            remotes = [(net.Address(server.serverAddr, server.serverPort),
+                        server.password) for server in config.servers]
+        if loop is mainLoop:
+            cipher, remoteBalancer = None, None
+            ruleSet = RuleSet(rules) if rules else None
+        else:
+            cipher, remoteBalancer = mainLocal.cipher, mainLocal.balancer
+            ruleSet = mainLocal.rules
+        local = LsLocal(
+            loop=loop,
+            password=config.password,
+            listenAddr=listenAddr,
+            remoteAddr=remoteAddr,
+            listener=listener,
+            remotes=remotes,
+            strategy=strategy,
+            connectTimeout=connectTimeout,
+            rules=ruleSet,
+            tracer=tracer,
+            transparent=transparent,
+            resume=resume,
+            graceTime=sessionGrace,
+            replaySize=sessionReplaySize,
+            tcpInfo=tcpInfo,
+            mptcp=mptcp,
+            flushDelay=flushDelay,
+            flushSize=flushSize,
+            pipelineSize=pipelineSize,
+            cipher=cipher,
+            remoteBalancer=remoteBalancer)
+        if loop is mainLoop:
+            mainLocal = local
+            # the forwarder tunnels the queries on the main loop
+            if forwarder is not None:
+                forwarder.local = local
+        return local
 
     def didListen(address):
         print('Listen to %s:%d\n' % address)
 
-    asyncio.ensure_future(server.listen(didListen))
-    loop.run_forever()
+    supervisor = process.Supervisor(
+        loop=loop,
+        config=config,
+        createService=createServer,
+        loadConfig=loadConfig,
+        listenAddr=lambda config: (config.localAddr, config.localPort),
+        drainTimeout=drainTimeout,
+        didListen=didListen,
+        workers=pool)
+    if pool is not None:
+        pool.start()
+    supervisor.installSignalHandlers()
+    supervisor.start(process.inheritedListener())
+    if forwarder is not None:
+        loop.run_until_complete(forwarder.start())
+    tcpInfo.start()
+    supervisor.dumps.append(tcpInfo.dump)
+    watcher = None
+    if monitor:
+        watcher = Monitor(
+            loop, threshold=monitorThreshold, statsFile=monitorFile)
+        watcher.start()
+        supervisor.dumps.append(watcher.dump)
+    try:
+        loop.run_forever()
+    finally:
+        if pool is not None:
+            pool.stop()
+        if watcher is not None:
+            watcher.stop()
+            watcher.dump()
+        tcpInfo.stop()
+        tcpInfo.dump()
+        if forwarder is not None:
+            forwarder.close()
+
+
+def loadConfig(args: argparse.Namespace) -> lsConfig.Config:
+    config = lsConfig.Config(None, None, None, None, None)
+    if args.c:
+        with open(args.c, encoding='utf-8') as f:
+            file_config = lsConfig.load(f)
+        config = config._replace(**file_config._asdict())
+
+    if args.u:
+        url_config = lsConfig.loadURLs(args.u)
+        config = config._replace(**url_config._asdict())
+
+    if args.s:
+        serverAddr = args.s
+        # TODO: 验证 serverAddr 有效性
+        config = config._replace(serverAddr=serverAddr)
+
+    if args.p:
+        serverPort = args.p
+        # TODO: 验证 serverPort 有效性
+        config = config._replace(serverPort=serverPort)
+
+    if args.b:
+        localAddr = args.b
+        # TODO: 验证 localPort 有效性
+        config = config._replace(localAddr=localAddr)
+
+    if args.l:
+        localPort = args.l
+        # TODO: 验证 localPort 有效性
+        config = config._replace(localPort=localPort)
+
+    if args.k:
+        password = loadsPassword(args.k)
+        config = config._replace(password=password)
+
+    if config.localAddr is None:
+        config = config._replace(localAddr='127.0.0.1')
+
+    if config.localPort is None:
+        config = config._replace(localPort=1080)
+
+    if config.serverPort is None:
+        config = config._replace(serverPort=8388)
+
+    if config.servers:
+        # the default server may be overridden by the options
+        primary = lsConfig.Server(
+            serverAddr=config.serverAddr,
+            serverPort=config.serverPort,
+            password=config.password)
+        servers = [primary] + config.servers[1:]
+        # a single server is kept in the plain fields only
+        config = config._replace(
+            servers=servers if len(servers) > 1 else None)
+
+    return config
 
 
 def main():
@@ -44,7 +227,9 @@ def main():
     proxy_options.add_argument(
         '-u',
         metavar='URL',
-        help='url contains server address, port and password')
+        action='append',
+        help='url contains server address, port and password, '
+        'use it multiple times for multiple servers')
     proxy_options.add_argument(
         '-s', metavar='SERVER_ADDR', help='server address')
     proxy_options.add_argument(
@@ -57,76 +242,194 @@ def main():
         metavar='LOCAL_ADDR',
         help='local binding address, default: 127.0.0.1')
     proxy_options.add_argument(
-        '-l', metavar='LOCAL_PORT', type=int, help='local port, default: 1080')
+        '-l',
+        metavar='LOCAL_PORT',
+        type=int,
+        help='local port for SOCKS5 and HTTP proxy, default: 1080')
     proxy_options.add_argument('-k', metavar='PASSWORD', help='password')
+    proxy_options.add_argument(
+        '--balance',
+        choices=balancer.STRATEGIES,
+        default=balancer.LATENCY,
+        help='how to choose the server for multiple servers, '
+        'default: %s' % balancer.LATENCY)
+    proxy_options.add_argument(
+        '--connect-timeout',
+        metavar='SECONDS',
+        type=float,
+        default=balancer.CONNECT_TIMEOUT,
+        help='seconds to wait for connecting to the server, '
+        'default: %d' % balancer.CONNECT_TIMEOUT)
+    proxy_options.add_argument(
+        '--mptcp',
+        action='store_true',
+        default=False,
+        help='dial the server with Multipath TCP, and log the subflows '
+        'of the tunnels when they are closed, Linux 5.6 or later')
+    proxy_options.add_argument(
+        '--rules',
+        metavar='FILE',
+        action='append',
+        help='connect the destinations in the rule file directly, '
+        'use it multiple times for multiple files')
+    proxy_options.add_argument(
+        '--drain-timeout',
+        metavar='SECONDS',
+        type=float,
+        default=process.DRAIN_TIMEOUT,
+        help='seconds to wait for active connections on shutdown, '
+        'default: %d' % process.DRAIN_TIMEOUT)
+    proxy_options.add_argument(
+        '--flush-delay',
+        metavar='MS',
+        type=float,
+        default=FLUSH_DELAY * 1000,
+        help='milliseconds to wait for more data before sending, '
+        'default: 0, send at once')
+    proxy_options.add_argument(
+        '--flush-size',
+        metavar='BYTES',
+        type=int,
+        default=FLUSH_SIZE,
+        help='bytes to gather at most before sending, '
+        'default: %d' % FLUSH_SIZE)
+    proxy_options.add_argument(
+        '--pipeline-size',
+        metavar='BYTES',
+        type=int,
+        default=PIPELINE_SIZE,
+        help='bytes to read ahead while the other side is slow, '
+        '0 to read after every send, default: %d' % PIPELINE_SIZE)
+    proxy_options.add_argument(
+        '--threads',
+        metavar='N',
+        type=int,
+        default=1,
+        help='serve the connections on N event loops, one thread each, '
+        'they run in parallel on free-threaded Python only, default: 1')
+    proxy_options.add_argument(
+        '--eager-tasks',
+        action='store_true',
+        default=False,
+        help='start the tasks eagerly, needs Python 3.12 or later')
+    proxy_options.add_argument(
+        '--monitor',
+        action='store_true',
+        default=False,
+        help='watch the event loop lag, and log the stack of the calls '
+        'that block it')
+    proxy_options.add_argument(
+        '--monitor-threshold',
+        metavar='MS',
+        type=float,
+        default=MONITOR_THRESHOLD * 1000,
+        help='milliseconds of blocking to log, default: %d' %
+        (MONITOR_THRESHOLD * 1000))
+    proxy_options.add_argument(
+        '--monitor-file',
+        metavar='FILE',
+        help='dump the lag histogram and the recent stalls into the file '
+        'on SIGUSR1 and on exit, instead of logging the histogram')
+    proxy_options.add_argument(
+        '--tcp-info',
+        metavar='SECONDS',
+        type=float,
+        help='sample TCP_INFO of the tunnels and the destinations every '
+        'SECONDS, at most %d connections at a time, and on close' %
+        tcpinfo.BUDGET)
+    proxy_options.add_argument(
+        '--tcp-info-file',
+        metavar='FILE',
+        help='dump the RTT, cwnd, retransmits and delivery rate per path '
+        'into the file on SIGUSR1 and on exit, instead of logging them')
+    proxy_options.add_argument(
+        '--trace-file',
+        metavar='FILE',
+        help='write the phase timing of the sampled connections '
+        'into the file as JSON lines')
+    proxy_options.add_argument(
+        '--trace-rate',
+        metavar='RATE',
+        type=float,
+        default=tracing.TRACE_RATE,
+        help='the fraction of the connections to trace, '
+        'default: %s' % tracing.TRACE_RATE)
+    proxy_options.add_argument(
+        '--transparent',
+        action='store_true',
+        default=False,
+        help='also serve the connections redirected to the port '
+        'by iptables/nftables REDIRECT or TPROXY, Linux only')
+    proxy_options.add_argument(
+        '--resume',
+        action='store_true',
+        default=False,
+        help='resume the connections when the tunnel is lost, '
+        'needs lsserver --sessions')
+    proxy_options.add_argument(
+        '--session-grace',
+        metavar='SECONDS',
+        type=float,
+        default=session.GRACE_TIME,
+        help='seconds to try resuming a connection, '
+        'default: %d' % session.GRACE_TIME)
+    proxy_options.add_argument(
+        '--session-replay-size',
+        metavar='BYTES',
+        type=int,
+        default=session.REPLAY_SIZE,
+        help='bytes kept to send again on resume for every connection, '
+        'default: %d' % session.REPLAY_SIZE)
+    proxy_options.add_argument(
+        '--dns',
+        metavar='ADDR:PORT',
+        type=lambda addr: net.parseAddress(addr, 53),
+        help='answer the DNS queries over UDP and TCP on the address, '
+        'resolved by --dns-upstream through the tunnel, e.g. 127.0.0.1:5353')
+    proxy_options.add_argument(
+        '--dns-upstream',
+        metavar='ADDR:PORT',
+        type=lambda addr: net.parseAddress(addr, 53),
+        default=dns.UPSTREAM,
+        help='the DNS server to resolve on the side of lsserver, '
+        'default: %s:%d' % dns.UPSTREAM)
+    proxy_options.add_argument(
+        '--dns-cache',
+        metavar='N',
+        type=int,
+        default=dns.CACHE_SIZE,
+        help='answers to cache at most, 0 to disable, '
+        'default: %d' % dns.CACHE_SIZE)
 
     args = parser.parse_args()
+    if args.threads < 1:
+        parser.error('--threads must be at least 1')
+    if args.threads > 1 and args.resume:
+        parser.error('--resume needs one thread, '
+                     'a session is resumed on the loop it is parked on')
 
     if args.version:
         print('lightsocks 0.1.0')
         sys.exit(0)
 
-    config = lsConfig.Config(None, None, None, None, None)
-    if args.c:
-        try:
-            with open(args.c, encoding='utf-8') as f:
-                file_config = lsConfig.load(f)
-        except lsConfig.InvalidFileError:
-            parser.print_usage()
-            print(f'invalid config file {args.c!r}')
-            sys.exit(1)
-        except FileNotFoundError:
-            parser.print_usage()
-            print(f'config file {args.c!r} not found')
-            sys.exit(1)
-        config = config._replace(**file_config._asdict())
-
-    if args.u:
-        try:
-            url_config = lsConfig.loadURL(args.u)
-        except lsConfig.InvalidURLError:
-            parser.print_usage()
-            print(f'invalid config URL {args.u!r}')
-            sys.exit(1)
-        config = config._replace(**url_config._asdict())
-
-    if args.s:
-        serverAddr = args.s
-        # TODO: 验证 serverAddr 有效性
-        config = config._replace(serverAddr=serverAddr)
-
-    if args.p:
-        serverPort = args.p
-        # TODO: 验证 serverPort 有效性
-        config = config._replace(serverPort=serverPort)
-
-    if args.b:
-        localAddr = args.b
-        # TODO: 验证 localPort 有效性
-        config = config._replace(localAddr=localAddr)
-
-    if args.l:
-        localPort = args.l
-        # TODO: 验证 localPort 有效性
-        config = config._replace(localPort=localPort)
-
-    if args.k:
-        try:
-            password = loadsPassword(args.k)
-            config = config._replace(password=password)
-        except InvalidPasswordError:
-            parser.print_usage()
-            print('invalid password')
-            sys.exit(1)
-
-    if config.localAddr is None:
-        config = config._replace(localAddr='127.0.0.1')
-
-    if config.localPort is None:
-        config = config._replace(localPort=1080)
-
-    if config.serverPort is None:
-        config = config._replace(serverPort=8388)
+    try:
+        config = loadConfig(args)
+    except lsConfig.InvalidFileError:
+        parser.print_usage()
+        print(f'invalid config file {args.c!r}')
+        sys.exit(1)
+    except FileNotFoundError:
+        parser.print_usage()
+        print(f'config file {args.c!r} not found')
+        sys.exit(1)
+    except lsConfig.InvalidURLError:
+        parser.print_usage()
+        print(f'invalid config URL {args.u!r}')
+        sys.exit(1)
+    except InvalidPasswordError:
+        parser.print_usage()
+        print('invalid password')
+        sys.exit(1)
 
     if config.password is None:
         parser.print_usage()
@@ -142,7 +445,32 @@ def main():
         with open(args.save, 'w', encoding='utf-8') as f:
             lsConfig.dump(f, config)
 
-    run_server(config)
+    run_server(
+        config,
+        loadConfig=lambda: loadConfig(args),
+        drainTimeout=args.drain_timeout,
+        flushDelay=args.flush_delay / 1000,
+        flushSize=args.flush_size,
+        pipelineSize=args.pipeline_size,
+        strategy=args.balance,
+        connectTimeout=args.connect_timeout,
+        rules=args.rules,
+        tracer=tracing.Tracer(args.trace_file, args.trace_rate),
+        transparent=args.transparent,
+        resume=args.resume,
+        sessionGrace=args.session_grace,
+        sessionReplaySize=args.session_replay_size,
+        dnsAddr=args.dns,
+        dnsUpstream=args.dns_upstream,
+        dnsCacheSize=args.dns_cache,
+        monitor=args.monitor,
+        monitorThreshold=args.monitor_threshold / 1000,
+        monitorFile=args.monitor_file,
+        tcpInfoInterval=args.tcp_info,
+        tcpInfoFile=args.tcp_info_file,
+        eagerTasks=args.eager_tasks,
+        threads=args.threads,
+        mptcp=args.mptcp)
 
 
 if __name__ == '__main__':
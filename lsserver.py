@@ -1,30 +1,205 @@
 import argparse
 import asyncio
+import ipaddress
 import sys
+import typing
 
+from lightsocks.core import relay, session, transport
+from lightsocks.core.cipher import Cipher
+from lightsocks.core.scheduler import Scheduler
 from lightsocks.core.password import (InvalidPasswordError, dumpsPassword,
                                       loadsPassword, randomPassword)
+from lightsocks.core.securesocket import (FLUSH_DELAY, FLUSH_SIZE,
+                                          PIPELINE_SIZE)
 from lightsocks.server import LsServer
 from lightsocks.utils import config as lsConfig
 from lightsocks.utils import net
+from lightsocks.utils import process
+from lightsocks.utils import tracing
+from lightsocks.utils.monitor import THRESHOLD as MONITOR_THRESHOLD
+from lightsocks.utils.monitor import Monitor
+from lightsocks.utils import breaker
+from lightsocks.utils import accounting
+from lightsocks.utils import srcpool
+from lightsocks.utils import tcpinfo
+from lightsocks.utils import workers
+from lightsocks.utils.recorder import Recorder
 
 
-def run_server(config: lsConfig.Config):
+def run_server(config: lsConfig.Config,
+               loadConfig: typing.Callable=None,
+               drainTimeout: float=process.DRAIN_TIMEOUT,
+               flushDelay: float=FLUSH_DELAY,
+               flushSize: int=FLUSH_SIZE,
+               pipelineSize: int=PIPELINE_SIZE,
+               successorArgv: typing.Callable=None,
+               tracer: tracing.Tracer=None,
+               recorder: Recorder=None,
+               breakerThreshold: int=breaker.THRESHOLD,
+               breakerBackoff: float=breaker.BACKOFF_BASE,
+               schedule: bool=False,
+               interactivePorts: typing.Iterable[int]=(),
+               accountingFile: str=None,
+               quota: int=None,
+               quotaAction: str=accounting.DISCONNECT,
+               throttleRate: int=accounting.THROTTLE_RATE,
+               monitor: bool=False,
+               monitorThreshold: float=MONITOR_THRESHOLD,
+               monitorFile: str=None,
+               tcpInfoInterval: float=None,
+               tcpInfoFile: str=None,
+               sources: srcpool.SourcePool=None,
+               sessions: bool=False,
+               sessionGrace: float=session.GRACE_TIME,
+               sessionReplaySize: int=session.REPLAY_SIZE,
+               sessionMaxParked: int=session.MAX_PARKED,
+               optimistic: bool=False,
+               eagerTasks: bool=False,
+               threads: int=1,
+               mptcp: bool=False):
     loop = asyncio.get_event_loop()
+    # the main loop only accepts with more threads, see workers
+    pool = workers.WorkerPool(threads) if threads > 1 else None
+    # the paths are kept across reloads
+    tcpInfo = tcpinfo.Sampler(loop, tcpInfoInterval, statsFile=tcpInfoFile)
+    # the failing destinations are kept across reloads
+    dstBreaker = breaker.Breaker(loop, breakerThreshold, breakerBackoff)
+    # the scheduler takes turns on one loop, one for every loop
+    schedulers = {}
+    # the totals are kept across reloads, the user of a server is its port
+    accounts = accounting.Accounting(
+        loop,
+        accountingFile,
+        quotas={str(config.serverPort): quota} if quota is not None else None,
+        action=quotaAction,
+        throttleRate=throttleRate)
+    # the parked sessions are kept across reloads
+    serverSessions = None
+    if sessions:
+        serverSessions = session.Sessions(loop, sessionGrace,
+                                          sessionReplaySize,
+                                          sessionMaxParked)
+    if mptcp and not transport.mptcpSupported():
+        print('MPTCP is not supported by the kernel, use TCP')
+    if eagerTasks and not relay.installEagerTaskFactory(loop):
+        print('eager tasks need Python 3.12 or later, ignored')
+    elif eagerTasks and pool is not None:
+        for workerLoop in pool.loops:
+            relay.installEagerTaskFactory(workerLoop)
 
-    listenAddr = net.Address(config.serverAddr, config.serverPort)
-    server = LsServer(
-        loop=loop, password=config.password, listenAddr=listenAddr)
+    # the services of the workers share the cipher of the service
+    # on the main loop, that is created first
+    mainLoop = loop
+    mainCipher = None
+
+    def createServer(config, listener, loop=loop):
+        nonlocal mainCipher
+        listenAddr = net.Address(config.serverAddr, config.serverPort)
+        user = str(config.serverPort)
+        if quota is not None:
+            accounts.quotas[user] = quota
+        if schedule and loop not in schedulers:
+            schedulers[loop] = Scheduler(loop)
+        if loop is mainLoop:
+            mainCipher = Cipher.NewCipher(config.password)
+        return LsServer(
+            loop=loop,
+            password=config.password,
+            listenAddr=listenAddr,
+            listener=listener,
+            tracer=tracer,
+            recorder=recorder,
+            breaker=dstBreaker,
+            scheduler=schedulers.get(loop),
+            interactivePorts=interactivePorts,
+            accounts=accounts,
+            user=user,
+            sources=sources,
+            sessions=serverSessions,
+            tcpInfo=tcpInfo,
+            optimistic=optimistic,
+            cipher=mainCipher,
+            mptcp=mptcp,
+            flushDelay=flushDelay,
+            flushSize=flushSize,
+            pipelineSize=pipelineSize)
 
     def didListen(address):
         print('Listen to %s:%d\n' % address)
         print('Please use:\n')
         print('''lslocal -u "http://hostname:port/#'''
-              f'''{dumpsPassword(config.password)}"''')
+              f'''{dumpsPassword(supervisor.config.password)}"''')
         print('\nto config lslocal')
 
-    asyncio.ensure_future(server.listen(didListen))
-    loop.run_forever()
+    supervisor = process.Supervisor(
+        loop=loop,
+        config=config,
+        createService=createServer,
+        loadConfig=loadConfig,
+        listenAddr=lambda config: (config.serverAddr, config.serverPort),
+        drainTimeout=drainTimeout,
+        didListen=didListen,
+        successorArgv=successorArgv,
+        workers=pool)
+    if pool is not None:
+        pool.start()
+    supervisor.installSignalHandlers()
+    supervisor.start(process.inheritedListener())
+    if sources is not None:
+        supervisor.dumps.append(sources.dump)
+    tcpInfo.start()
+    supervisor.dumps.append(tcpInfo.dump)
+    watcher = None
+    if monitor:
+        watcher = Monitor(
+            loop, threshold=monitorThreshold, statsFile=monitorFile)
+        watcher.start()
+        supervisor.dumps.append(watcher.dump)
+    try:
+        loop.run_forever()
+    finally:
+        if pool is not None:
+            pool.stop()
+        if watcher is not None:
+            watcher.stop()
+            watcher.dump()
+        tcpInfo.stop()
+        tcpInfo.dump()
+        if sources is not None:
+            sources.dump()
+        accounts.close()
+        if recorder is not None:
+            recorder.close()
+
+
+def loadConfig(args: argparse.Namespace) -> lsConfig.Config:
+    config = lsConfig.Config(None, None, None, None, None)
+    if args.c:
+        with open(args.c, encoding='utf-8') as f:
+            file_config = lsConfig.load(f)
+        config = config._replace(**file_config._asdict())
+
+    if args.s:
+        serverAddr = args.s
+        # TODO: 验证 serverAddr 有效性
+        config = config._replace(serverAddr=serverAddr)
+
+    if args.p:
+        serverPort = args.p
+        # TODO: 验证 serverPort 有效性
+        config = config._replace(serverPort=serverPort)
+
+    if args.k:
+        password = loadsPassword(args.k)
+        config = config._replace(password=password)
+
+    if config.serverAddr is None:
+        config = config._replace(serverAddr='0.0.0.0')
+
+    if config.serverPort is None:
+        config = config._replace(serverPort=8388)
+
+    return config
 
 
 def main():
@@ -55,52 +230,236 @@ def main():
         action='store_true',
         default=False,
         help='generate a random password to use')
+    proxy_options.add_argument(
+        '--drain-timeout',
+        metavar='SECONDS',
+        type=float,
+        default=process.DRAIN_TIMEOUT,
+        help='seconds to wait for active connections on shutdown, '
+        'default: %d' % process.DRAIN_TIMEOUT)
+    proxy_options.add_argument(
+        '--flush-delay',
+        metavar='MS',
+        type=float,
+        default=FLUSH_DELAY * 1000,
+        help='milliseconds to wait for more data before sending, '
+        'default: 0, send at once')
+    proxy_options.add_argument(
+        '--flush-size',
+        metavar='BYTES',
+        type=int,
+        default=FLUSH_SIZE,
+        help='bytes to gather at most before sending, '
+        'default: %d' % FLUSH_SIZE)
+    proxy_options.add_argument(
+        '--pipeline-size',
+        metavar='BYTES',
+        type=int,
+        default=PIPELINE_SIZE,
+        help='bytes to read ahead while the other side is slow, '
+        '0 to read after every send, default: %d' % PIPELINE_SIZE)
+    proxy_options.add_argument(
+        '--threads',
+        metavar='N',
+        type=int,
+        default=1,
+        help='serve the connections on N event loops, one thread each, '
+        'they run in parallel on free-threaded Python only, default: 1')
+    proxy_options.add_argument(
+        '--eager-tasks',
+        action='store_true',
+        default=False,
+        help='start the tasks eagerly, needs Python 3.12 or later')
+    proxy_options.add_argument(
+        '--monitor',
+        action='store_true',
+        default=False,
+        help='watch the event loop lag, and log the stack of the calls '
+        'that block it')
+    proxy_options.add_argument(
+        '--monitor-threshold',
+        metavar='MS',
+        type=float,
+        default=MONITOR_THRESHOLD * 1000,
+        help='milliseconds of blocking to log, default: %d' %
+        (MONITOR_THRESHOLD * 1000))
+    proxy_options.add_argument(
+        '--monitor-file',
+        metavar='FILE',
+        help='dump the lag histogram and the recent stalls into the file '
+        'on SIGUSR1 and on exit, instead of logging the histogram')
+    proxy_options.add_argument(
+        '--tcp-info',
+        metavar='SECONDS',
+        type=float,
+        help='sample TCP_INFO of the tunnels and the destinations every '
+        'SECONDS, at most %d connections at a time, and on close' %
+        tcpinfo.BUDGET)
+    proxy_options.add_argument(
+        '--tcp-info-file',
+        metavar='FILE',
+        help='dump the RTT, cwnd, retransmits and delivery rate per path '
+        'into the file on SIGUSR1 and on exit, instead of logging them')
+    proxy_options.add_argument(
+        '--trace-file',
+        metavar='FILE',
+        help='write the phase timing of the sampled connections '
+        'into the file as JSON lines')
+    proxy_options.add_argument(
+        '--trace-rate',
+        metavar='RATE',
+        type=float,
+        default=tracing.TRACE_RATE,
+        help='the fraction of the connections to trace, '
+        'default: %s' % tracing.TRACE_RATE)
+    proxy_options.add_argument(
+        '--record',
+        metavar='FILE',
+        help='record the traffic shape of the connections into the file, '
+        'see benchmarks/replay.py')
+    proxy_options.add_argument(
+        '--record-payload',
+        action='store_true',
+        default=False,
+        help='record the payload too, it is NOT encrypted in the file')
+    proxy_options.add_argument(
+        '--breaker-threshold',
+        metavar='N',
+        type=int,
+        default=breaker.THRESHOLD,
+        help='fail fast on a destination after N failures in a row, '
+        '0 to disable, default: %d' % breaker.THRESHOLD)
+    proxy_options.add_argument(
+        '--breaker-backoff',
+        metavar='SECONDS',
+        type=float,
+        default=breaker.BACKOFF_BASE,
+        help='seconds to fail fast before trying the destination again, '
+        'doubled after every failure, default: %d' % breaker.BACKOFF_BASE)
+    proxy_options.add_argument(
+        '--schedule',
+        action='store_true',
+        default=False,
+        help='serve the interactive connections ahead of the bulk ones')
+    proxy_options.add_argument(
+        '--interactive-ports',
+        metavar='PORTS',
+        type=lambda ports: [int(port) for port in ports.split(',')],
+        default=[],
+        help='comma separated destination ports that are always '
+        'interactive with --schedule, e.g. 22,3389')
+    proxy_options.add_argument(
+        '--accounting',
+        metavar='FILE',
+        help='add up the bytes of every destination into the SQLite file')
+    proxy_options.add_argument(
+        '--quota',
+        metavar='BYTES',
+        type=int,
+        help='bytes the users of this port may send and receive in total')
+    proxy_options.add_argument(
+        '--quota-action',
+        choices=accounting.ACTIONS,
+        default=accounting.DISCONNECT,
+        help='what to do over the quota, default: %s' % accounting.DISCONNECT)
+    proxy_options.add_argument(
+        '--throttle-rate',
+        metavar='BYTES',
+        type=int,
+        default=accounting.THROTTLE_RATE,
+        help='bytes per second of every connection when throttled, '
+        'default: %d' % accounting.THROTTLE_RATE)
+    proxy_options.add_argument(
+        '--source-addresses',
+        metavar='ADDRS',
+        type=lambda addrs: [
+            str(ipaddress.ip_address(addr)) for addr in addrs.split(',')
+        ],
+        default=[],
+        help='comma separated local addresses to connect the destinations '
+        'from, each adds a range of ephemeral ports')
+    proxy_options.add_argument(
+        '--source-policy',
+        choices=srcpool.POLICIES,
+        default=srcpool.ROUND_ROBIN,
+        help='take the source addresses in turn, or by the hash '
+        'of the destination, default: %s' % srcpool.ROUND_ROBIN)
+    proxy_options.add_argument(
+        '--source-stats',
+        metavar='FILE',
+        help='dump the connections of every source address into the file '
+        'on SIGUSR1 and on exit, instead of logging them')
+    proxy_options.add_argument(
+        '--fast-close',
+        action='store_true',
+        default=False,
+        help='reset the aborted connections to the destinations, '
+        'so they skip TIME_WAIT')
+    proxy_options.add_argument(
+        '--optimistic-reply',
+        action='store_true',
+        default=False,
+        help='reply the success before the destination is connected, '
+        'a failed connect resets the tunnel')
+    proxy_options.add_argument(
+        '--mptcp',
+        action='store_true',
+        default=False,
+        help='accept the tunnels with Multipath TCP, and log their '
+        'subflows when they are closed, Linux 5.6 or later')
+    proxy_options.add_argument(
+        '--sessions',
+        action='store_true',
+        default=False,
+        help='accept the sessions of lslocal --resume, that survive '
+        'the reconnects of the tunnel')
+    proxy_options.add_argument(
+        '--session-grace',
+        metavar='SECONDS',
+        type=float,
+        default=session.GRACE_TIME,
+        help='seconds to keep a session after its tunnel is lost, '
+        'default: %d' % session.GRACE_TIME)
+    proxy_options.add_argument(
+        '--session-replay-size',
+        metavar='BYTES',
+        type=int,
+        default=session.REPLAY_SIZE,
+        help='bytes kept to send again on resume for every session, '
+        'default: %d' % session.REPLAY_SIZE)
+    proxy_options.add_argument(
+        '--session-max-parked',
+        metavar='BYTES',
+        type=int,
+        default=session.MAX_PARKED,
+        help='bytes of the sessions to keep at most after their tunnels '
+        'are lost, default: %d' % session.MAX_PARKED)
 
     args = parser.parse_args()
+    if args.threads < 1:
+        parser.error('--threads must be at least 1')
+    if args.threads > 1 and args.sessions:
+        parser.error('--sessions needs one thread, '
+                     'a session is resumed on the loop it is parked on')
 
     if args.version:
         print('lightsocks 0.1.0')
         sys.exit(0)
 
-    config = lsConfig.Config(None, None, None, None, None)
-    if args.c:
-        try:
-            with open(args.c, encoding='utf-8') as f:
-                file_config = lsConfig.load(f)
-        except lsConfig.InvalidFileError:
-            parser.print_usage()
-            print(f'invalid config file {args.c!r}')
-            sys.exit(1)
-        except FileNotFoundError:
-            parser.print_usage()
-            print(f'config file {args.c!r} not found')
-            sys.exit(1)
-        config = config._replace(**file_config._asdict())
-
-    if args.s:
-        serverAddr = args.s
-        # TODO: 验证 serverAddr 有效性
-        config = config._replace(serverAddr=serverAddr)
-
-    if args.p:
-        serverPort = args.p
-        # TODO: 验证 serverPort 有效性
-        config = config._replace(serverPort=serverPort)
-
-    if args.k:
-        try:
-            password = loadsPassword(args.k)
-            config = config._replace(password=password)
-        except InvalidPasswordError:
-            parser.print_usage()
-            print('invalid password')
-            sys.exit(1)
-
-    if config.serverAddr is None:
-        config = config._replace(serverAddr='0.0.0.0')
-
-    if config.serverPort is None:
-        config = config._replace(serverPort=8388)
+    try:
+        config = loadConfig(args)
+    except lsConfig.InvalidFileError:
+        parser.print_usage()
+        print(f'invalid config file {args.c!r}')
+        sys.exit(1)
+    except FileNotFoundError:
+        parser.print_usage()
+        print(f'config file {args.c!r} not found')
+        sys.exit(1)
+    except InvalidPasswordError:
+        parser.print_usage()
+        print('invalid password')
+        sys.exit(1)
 
     if config.password is None and not args.random:
         parser.print_usage()
@@ -117,7 +476,53 @@ def main():
         with open(args.save, 'w', encoding='utf-8') as f:
             lsConfig.dump(f, config)
 
-    run_server(config)
+    def reloadConfig():
+        newConfig = loadConfig(args)
+        if args.random or newConfig.password is None:
+            # keep the random password
+            newConfig = newConfig._replace(password=config.password)
+        return newConfig
+
+    def successorArgv(config):
+        if not args.random:
+            return None
+        # the new process must keep using the random password
+        argv = [arg for arg in sys.argv if arg != '--random']
+        return argv + ['-k', dumpsPassword(config.password)]
+
+    run_server(
+        config,
+        loadConfig=reloadConfig,
+        drainTimeout=args.drain_timeout,
+        flushDelay=args.flush_delay / 1000,
+        flushSize=args.flush_size,
+        pipelineSize=args.pipeline_size,
+        successorArgv=successorArgv,
+        tracer=tracing.Tracer(args.trace_file, args.trace_rate),
+        recorder=Recorder(args.record, args.record_payload),
+        breakerThreshold=args.breaker_threshold,
+        breakerBackoff=args.breaker_backoff,
+        schedule=args.schedule,
+        interactivePorts=args.interactive_ports,
+        accountingFile=args.accounting,
+        quota=args.quota,
+        quotaAction=args.quota_action,
+        throttleRate=args.throttle_rate,
+        monitor=args.monitor,
+        monitorThreshold=args.monitor_threshold / 1000,
+        monitorFile=args.monitor_file,
+        tcpInfoInterval=args.tcp_info,
+        tcpInfoFile=args.tcp_info_file,
+        sources=srcpool.SourcePool(args.source_addresses, args.source_policy,
+                                   args.fast_close, args.source_stats),
+        sessions=args.sessions,
+        sessionGrace=args.session_grace,
+        sessionReplaySize=args.session_replay_size,
+        sessionMaxParked=args.session_max_parked,
+        optimistic=args.optimistic_reply,
+        eagerTasks=args.eager_tasks,
+        threads=args.threads,
+        mptcp=args.mptcp)
 
 
 if __name__ == '__main__':